@@ -32,17 +32,13 @@ import datetime
 import html
 import logging
 import os
-import traceback
 from typing import Any, Dict, List, Optional, Tuple, TYPE_CHECKING
 
 from cardinal_pythonlib.datetimefunc import (
     coerce_to_datetime,
     truncate_date_to_first_of_month,
 )
-from cardinal_pythonlib.extract_text import (
-    document_to_text,
-    TextProcessingConfig,
-)
+from cardinal_pythonlib.timing import MultiTimerContext, timer
 import regex
 
 # don't import config: circular dependency would have to be sorted out
@@ -63,6 +59,13 @@ log = logging.getLogger(__name__)
 
 HTML_TAG_RE = regex.compile('<[^>]*>')
 
+TIMING_ALTER_SCRUB = "alter_scrub"
+TIMING_ALTER_TRUNCATE_DATE = "alter_truncate_date"
+TIMING_ALTER_EXTRACT_TEXT = "alter_extract_text"
+TIMING_ALTER_HASH = "alter_hash"
+TIMING_ALTER_HTML_UNESCAPE = "alter_html_unescape"
+TIMING_ALTER_HTML_UNTAG = "alter_html_untag"
+
 
 # =============================================================================
 # AlterMethod
@@ -339,13 +342,16 @@ class AlterMethod(object):
         """
 
         if self.scrub:
-            return self._scrub_func(value, patient), False
+            with MultiTimerContext(timer, TIMING_ALTER_SCRUB):
+                return self._scrub_func(value, patient), False
 
         if self.truncate_date:
-            return self._truncate_date_func(value), False
+            with MultiTimerContext(timer, TIMING_ALTER_TRUNCATE_DATE):
+                return self._truncate_date_func(value), False
 
         if self.extract_text:
-            value, extracted = self._extract_text_func(value, row, ddrows)
+            with MultiTimerContext(timer, TIMING_ALTER_EXTRACT_TEXT):
+                value, extracted = self._extract_text_func(value, row, ddrows)
             if not extracted and ddr.skip_row_if_extract_text_fails:
                 log.debug("Skipping row as text extraction failed")
                 return None, True
@@ -353,16 +359,19 @@ class AlterMethod(object):
 
         if self.hash:
             assert self.hasher is not None
-            return self.hasher.hash(value), False
+            with MultiTimerContext(timer, TIMING_ALTER_HASH):
+                return self.hasher.hash(value), False
 
         # if alter_method.html_escape:
         #     return html.escape(value), False
 
         if self.html_unescape:
-            return html.unescape(value), False
+            with MultiTimerContext(timer, TIMING_ALTER_HTML_UNESCAPE):
+                return html.unescape(value), False
 
         if self.html_untag:
-            return self._html_untag_func(value), False
+            with MultiTimerContext(timer, TIMING_ALTER_HTML_UNTAG):
+                return self._html_untag_func(value), False
 
         if self.skip_if_text_extract_fails:
             # Modifies other alter methods; doesn't do anything itself
@@ -423,13 +432,13 @@ class AlterMethod(object):
         #    http://stackoverflow.com/questions/3662142
         return HTML_TAG_RE.sub('', text)
 
-    def _extract_text_func(
+    def get_extraction_source(
             self, value: Any, row: List[Any],
-            ddrows: List["DataDictionaryRow"]) -> Tuple[Optional[str], bool]:
+            ddrows: List["DataDictionaryRow"]) \
+            -> Optional[Tuple[Optional[str], Optional[bytes], Optional[str]]]:
         """
-        Take a field's value and return extracted text, for file-related
-        fields, where the DD row indicated that this field contains a filename
-        or a BLOB.
+        For file-related fields, where the DD row indicated that this field
+        contains a filename or a BLOB, work out where to extract text from.
 
         Args:
             value: source field contents
@@ -437,7 +446,8 @@ class AlterMethod(object):
             ddrows: all data dictionary rows
 
         Returns:
-            tuple: ``value, extracted``
+            tuple: ``filename, blob, extension``, or ``None`` if there's
+            nothing (permissible) to extract text from
 
         """
         use_filename = False
@@ -501,30 +511,42 @@ class AlterMethod(object):
         # Is it a permissible file type?
         if not self.config.extract_text_extension_permissible(extension):
             log.info(f"Extension {extension!r} not permissible; skipping")
-            return None, False
+            return None
 
         if use_filename:
             if not filename:
                 log.error("No filename; skipping")
-                return None, False
+                return None
 
             if not os.path.isfile(filename):
                 log.error(f"Filename {filename!r} is not a file; skipping")
-                return None, False
+                return None
 
-        # Extract text from the file (given its filename), or from a BLOB.
-        try:
-            textconfig = TextProcessingConfig(
-                plain=self.config.extract_text_plain,
-                width=self.config.extract_text_width,
-            )
-            value = document_to_text(filename=filename,
-                                     blob=blob,
-                                     extension=extension,
-                                     config=textconfig)
-        except Exception as e:
-            # Runtime error
-            traceback.print_exc()  # full details, please
-            log.error(f"Caught exception from document_to_text: {e}")
+        return filename, blob, extension
+
+    def _extract_text_func(
+            self, value: Any, row: List[Any],
+            ddrows: List["DataDictionaryRow"]) -> Tuple[Optional[str], bool]:
+        """
+        Take a field's value and return extracted text, for file-related
+        fields, where the DD row indicated that this field contains a filename
+        or a BLOB.
+
+        Args:
+            value: source field contents
+            row: all values in the same source row
+            ddrows: all data dictionary rows
+
+        Returns:
+            tuple: ``value, extracted``
+
+        """
+        source = self.get_extraction_source(value, row, ddrows)
+        if source is None:
             return None, False
-        return value, True
+        filename, blob, extension = source
+        # Extract text from the file (given its filename), or from a BLOB.
+        # See crate_anon.anonymise.text_extraction.
+        return self.config.text_extractor.extract(filename=filename,
+                                                  blob=blob,
+                                                  extension=extension)
@@ -33,49 +33,95 @@ using a data dictionary.**
 # Imports
 # =============================================================================
 
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    wait,
+)
 import logging
+import multiprocessing
+import pickle
 import random
 import sys
 from datetime import datetime
-from typing import Any, Dict, Iterable, Generator, List, Tuple, Union
+import time
+from typing import (Any, Deque, Dict, Iterable, Generator, List, Optional,
+                    Set, Tuple, Union)
 
 from cardinal_pythonlib.datetimefunc import get_now_utc_pendulum
+from cardinal_pythonlib.sizeformatter import sizeof_fmt
 from cardinal_pythonlib.sqlalchemy.core_query import count_star, exists_plain
-from cardinal_pythonlib.sqlalchemy.schema import (
-    add_index,
-    get_column_names,
-)
+from cardinal_pythonlib.sql.validation import is_sqltype_integer
+from cardinal_pythonlib.sqlalchemy.schema import get_column_names
+from cardinal_pythonlib.timing import MultiTimerContext, timer
 from sortedcontainers import SortedSet
 from sqlalchemy.schema import Column, Index, MetaData, Table
 from sqlalchemy.sql import column, func, or_, select, table, text
+from sqlalchemy.sql.expression import ColumnElement
 
 from crate_anon.anonymise.config_singleton import config
 from crate_anon.anonymise.constants import (
     BIGSEP,
     DEFAULT_CHUNKSIZE,
+    DEFAULT_NONPATIENT_PK_BLOCK_SIZE,
     DEFAULT_REPORT_EVERY,
     INDEX,
     TABLE_KWARGS,
     SEP,
 )
+from crate_anon.anonymise.coordinator import gen_work_units
 from crate_anon.anonymise.models import (
+    NonPatientProgress,
     OptOutMpid,
     OptOutPid,
     PatientInfo,
+    PatientProgress,
+    ScrubberRegexCacheRecord,
+    TextExtractionCacheRecord,
     TridRecord,
 )
-from crate_anon.anonymise.patient import Patient
+from crate_anon.anonymise.patient import (
+    DetachedPatient,
+    Patient,
+    ScrubSourcePrefetcher,
+)
 from crate_anon.anonymise.ddr import DataDictionaryRow
+from crate_anon.anonymise.indexing import (
+    build_indexes,
+    get_approx_n_rows,
+    IndexJob,
+    TableIndexJobs,
+)
+from crate_anon.anonymise.timing import AnonymiserTimings, gen_timed
 from crate_anon.common.file_io import (
     gen_integers_from_file,
     gen_words_from_file,
 )
 from crate_anon.common.formatting import print_record_counts
+from crate_anon.common.hashing import CachingHasher
+from crate_anon.common.memsize import get_peak_memory_bytes
 from crate_anon.common.parallel import is_my_job_by_hash, is_my_job_by_int
-from crate_anon.common.sql import matches_tabledef
+from crate_anon.common.sql import (
+    gen_result_rows,
+    gen_sorted_difference,
+    gen_unique_values_by_keyset,
+    matches_tabledef,
+)
 
 log = logging.getLogger(__name__)
 
+TIMING_GEN_ROWS = "gen_rows"
+TIMING_COUNT_ROWS = "count_rows"
+TIMING_BUILD_PATIENT = "build_patient"
+TIMING_INSERT = "anonymise_sql_insert"
+TIMING_COMMIT = "anonymise_commit"
+TIMING_WAIT_FOR_WORKERS = "wait_for_scrub_workers"
+TIMING_WAIT_FOR_TEXT = "wait_for_text_extraction"
+
+_TIMINGS = AnonymiserTimings()  # per-phase and per-table timings
+
 
 # =============================================================================
 # Database queries
@@ -117,6 +163,134 @@ def identical_record_exists_by_pk(dest_table: str,
                         column(pkfield) == pkvalue)
 
 
+class DestinationHashLookup(object):
+    """
+    Answers the incremental-mode questions "does the destination already have
+    a record with this PK?" and "... with this PK and source hash?" for many
+    source rows, without a database query per row. (Those per-row queries are
+    what :func:`identical_record_exists_by_hash` and
+    :func:`identical_record_exists_by_pk` do.)
+
+    The destination's ``(PK, source hash)`` pairs are read into memory:
+
+    - If ``paged`` is false, all of them (subject to ``where``) are read in one
+      query. Use this when there won't be many; e.g. for one patient.
+
+    - If ``paged`` is true, they are read a page of ``chunksize`` pairs at a
+      time, in PK order, with keyset pagination (``WHERE pk >= next ORDER BY
+      pk LIMIT n``, where ``next`` is the PK being asked about). The caller
+      must then ask about source rows in ascending PK order, so this is a
+      merge join. Use this for big tables. Stretches of the destination that
+      the caller doesn't ask about (e.g. because they are another process's
+      work) are skipped. If a PK arrives out of order, we fall back to a
+      per-row query for it.
+
+    The answers are only ever "yes" if the destination really does contain a
+    matching record, so the worst case is some unnecessary reprocessing.
+    """
+    def __init__(self,
+                 dest_table: str,
+                 pkfield: str,
+                 with_hash: bool,
+                 where: List[ColumnElement] = None,
+                 paged: bool = False,
+                 chunksize: int = DEFAULT_CHUNKSIZE) -> None:
+        """
+        Args:
+            dest_table: name of the destination table
+            pkfield: name of the PK column in the destination table
+            with_hash: read the source hash column too?
+            where: optional WHERE criteria to restrict the destination rows
+                considered (e.g. to one patient, or to this task's share)
+            paged: read in pages, in PK order (see above)?
+            chunksize: page size, if paged
+        """
+        self._dest_table = dest_table
+        self._pkfield = pkfield
+        self._pkcol = column(pkfield)
+        self._hashcol = (
+            column(config.source_hash_fieldname) if with_hash else None
+        )
+        self._where = where or []  # type: List[ColumnElement]
+        self._paged = paged
+        self._chunksize = chunksize
+        self._hashes = {}  # type: Dict[Any, Optional[str]]
+        self._exhausted = False
+        self._page_lower_pk = None  # inclusive lower bound of current page
+        self._page_upper_pk = None  # inclusive upper bound of current page
+        self._prev_pk = None  # most recent PK asked about
+        if not paged:
+            self._read()
+
+    def _read(self, from_pk: Any = None) -> None:
+        """
+        Read the next page, starting at ``from_pk`` (or, if unpaged,
+        everything) from the destination.
+        """
+        cols = [self._pkcol]
+        if self._hashcol is not None:
+            cols.append(self._hashcol)
+        q = select(cols).select_from(table(self._dest_table))
+        for criterion in self._where:
+            q = q.where(criterion)
+        if self._paged:
+            if from_pk is not None:
+                q = q.where(self._pkcol >= from_pk)
+            q = q.order_by(self._pkcol).limit(self._chunksize)
+        rows = config.destdb.session.execute(q).fetchall()
+        if self._hashcol is not None:
+            self._hashes = {row[0]: row[1] for row in rows}
+        else:
+            self._hashes = dict.fromkeys(row[0] for row in rows)
+        if not self._paged or len(rows) < self._chunksize:
+            self._exhausted = True
+        self._page_lower_pk = from_pk
+        if rows:
+            self._page_upper_pk = rows[-1][0]
+
+    def _can_answer(self, pkvalue: Any) -> bool:
+        """
+        Ensures that the page that would contain this PK is loaded, if
+        possible. Returns ``False`` if we can't answer from memory (a PK out
+        of order, in paged mode).
+        """
+        if not self._paged:
+            return True
+        if self._prev_pk is not None and pkvalue < self._prev_pk:
+            return False
+        self._prev_pk = pkvalue
+        if (self._page_lower_pk is not None and
+                pkvalue < self._page_lower_pk):
+            return False
+        if not self._exhausted and (self._page_upper_pk is None or
+                                    pkvalue > self._page_upper_pk):
+            self._read(from_pk=pkvalue)
+        return True
+
+    def identical_record_exists_by_hash(self,
+                                        pkvalue: Any,
+                                        hashvalue: str) -> bool:
+        """
+        Is there a destination record with this PK and source hash? As for
+        :func:`identical_record_exists_by_hash`.
+        """
+        assert self._hashcol is not None
+        if not self._can_answer(pkvalue):
+            return identical_record_exists_by_hash(
+                self._dest_table, self._pkfield, pkvalue, hashvalue)
+        return pkvalue in self._hashes and self._hashes[pkvalue] == hashvalue
+
+    def identical_record_exists_by_pk(self, pkvalue: Any) -> bool:
+        """
+        Is there a destination record with this PK? As for
+        :func:`identical_record_exists_by_pk`.
+        """
+        if not self._can_answer(pkvalue):
+            return identical_record_exists_by_pk(
+                self._dest_table, self._pkfield, pkvalue)
+        return pkvalue in self._hashes
+
+
 # =============================================================================
 # Database actions
 # =============================================================================
@@ -173,6 +347,9 @@ def delete_dest_rows_with_no_src_row(
       the values and use a ``DELETE FROM x WHERE y NOT IN (v1, v2, v3, ...)``
       query. This crashes the MySQL connection, etc.
     - Therefore, we need a temporary table in the destination.
+    - Alternatively (with the ``delete_orphans_by_merge`` option), we work out
+      which destination rows are orphans ourselves, and delete just those;
+      see :func:`delete_dest_orphans_by_merge`.
 
     Args:
         srcdbname: name (as per the data dictionary) of the source database
@@ -202,12 +379,24 @@ def delete_dest_rows_with_no_src_row(
         log.info("... No source PK; deleting everything")
         destsession.execute(dest_table.delete())
         commit_destdb()
+        forget_progress_for_table(srcdbname, src_table)
         return
 
     if pkddr.addition_only:
         log.info("... Table marked as addition-only; not deleting anything")
         return
 
+    if config.delete_orphans_by_merge:
+        delete_dest_orphans_by_merge(
+            srcdbname=srcdbname,
+            src_table=src_table,
+            pkddr=pkddr,
+            dest_table=dest_table,
+            report_every=report_every,
+            chunksize=chunksize,
+        )
+        return
+
     # Drop/create temporary table
     pkfield = 'srcpk'
     temptable = Table(
@@ -263,8 +452,9 @@ def delete_dest_rows_with_no_src_row(
             select([temptable.columns[pkfield]])
         )
     )
-    destengine.execute(query)
+    n_deleted = destengine.execute(query).rowcount
     commit_destdb()
+    log.info(start + f"... deleted {n_deleted} rows")
 
     # 6. Drop temporary table
     log.debug("... dropping temporary table")
@@ -274,11 +464,105 @@ def delete_dest_rows_with_no_src_row(
     commit_destdb()
 
 
+def delete_dest_orphans_by_merge(
+        srcdbname: str,
+        src_table: str,
+        pkddr: DataDictionaryRow,
+        dest_table: Table,
+        report_every: int = DEFAULT_REPORT_EVERY,
+        chunksize: int = DEFAULT_CHUNKSIZE) -> int:
+    """
+    The ``delete_orphans_by_merge`` version of
+    :func:`delete_dest_rows_with_no_src_row`, for a table with a PK that isn't
+    addition-only. Rather than copying all source PKs to the destination and
+    deleting with ``NOT IN``, which locks the whole destination table, we:
+
+    - read the destination PKs in ascending order, a page at a time;
+    - compare them with the source PKs: for an integer PK that is copied
+      as-is, with a merge of the source PKs in ascending order (see
+      :func:`crate_anon.common.sql.gen_sorted_difference`), so neither side
+      is held in memory; otherwise (e.g. a PID/MPID PK, which we hash, which
+      doesn't preserve order, or a string PK, which the two databases might
+      not collate as Python does) by holding the source PKs in memory as a
+      set;
+    - delete the orphans, ``max_rows_per_orphan_delete`` at a time, with a
+      ``COMMIT`` after each batch.
+
+    Args:
+        srcdbname: name (as per the data dictionary) of the source database
+        src_table: name of the source table
+        pkddr: data dictionary row for the table's PK
+        dest_table: SQLAlchemy Table for the destination table
+        report_every: report to the Python log every *n* records
+        chunksize: read destination PKs *n* at a time
+
+    Returns:
+        the number of destination rows deleted
+    """
+    start = (
+        f"delete_dest_orphans_by_merge: "
+        f"{srcdbname}.{src_table} -> {config.destdb.name}.{dest_table.name}: "
+    )
+    destsession = config.destdb.session
+    dest_pkcol = dest_table.columns[pkddr.dest_field]
+    counts = {"src": 0, "dest": 0}
+
+    def gen_counted(pks: Iterable[Any], side: str) -> Iterable[Any]:
+        for pk_ in pks:
+            counts[side] += 1
+            if report_every and counts[side] % report_every == 0:
+                log.debug(start + f"... {side} row# {counts[side]}")
+            yield pk_
+
+    src_pks = gen_counted(
+        gen_pks(srcdbname, src_table, pkddr.src_field,
+                order_by_pk=True),
+        "src")
+    dest_pks = gen_counted(
+        gen_unique_values_by_keyset(destsession, dest_table,
+                                    pkddr.dest_field, pagesize=chunksize),
+        "dest")
+    if (pkddr.primary_pid or pkddr.master_pid or
+            not is_sqltype_integer(pkddr.src_datatype)):
+        encrypt = (
+            config.encrypt_primary_pid if pkddr.primary_pid
+            else config.encrypt_master_pid if pkddr.master_pid
+            else None
+        )
+        src_pk_set = set(encrypt(pk) for pk in src_pks) if encrypt \
+            else set(src_pks)
+        orphans = (pk for pk in dest_pks if pk not in src_pk_set)
+    else:
+        orphans = gen_sorted_difference(dest_pks, src_pks)
+
+    n_deleted = 0
+
+    def delete(batch_: List[Any]) -> None:
+        nonlocal n_deleted
+        log.debug(start + f"... deleting {len(batch_)} rows")
+        destsession.execute(dest_table.delete().where(dest_pkcol.in_(batch_)))
+        commit_destdb()
+        n_deleted += len(batch_)
+
+    batch = []  # type: List[Any]
+    for pk in orphans:
+        batch.append(pk)
+        if len(batch) >= config.max_rows_per_orphan_delete:
+            delete(batch)
+            batch = []  # type: List[Any]
+    if batch:  # remainder
+        delete(batch)
+    log.info(start + f"deleted {n_deleted} of {counts['dest']} rows "
+                     f"({counts['src']} source rows)")
+    return n_deleted
+
+
 def commit_destdb() -> None:
     """
     Execute a ``COMMIT`` on the destination database, and reset row counts.
     """
-    config.commit_dest_db()
+    with MultiTimerContext(timer, TIMING_COMMIT):
+        config.commit_dest_db()
 
 
 def commit_admindb() -> None:
@@ -292,6 +576,36 @@ def commit_admindb() -> None:
 # Opt-out
 # =============================================================================
 
+_OPT_OUT_PIDS = None  # type: Optional[Set[str]]
+_OPT_OUT_MPIDS = None  # type: Optional[Set[str]]
+
+
+def load_opt_outs() -> None:
+    """
+    Reads the PIDs and MPIDs of all patients opting out from the admin
+    database into memory, for :func:`opting_out_pid` and
+    :func:`opting_out_mpid`. (They are compared as strings, since PIDs may
+    arrive as integers or strings.)
+    """
+    global _OPT_OUT_PIDS, _OPT_OUT_MPIDS
+    session = config.admindb.session
+    _OPT_OUT_PIDS = set(str(pid) for pid in OptOutPid.all_values(session))
+    _OPT_OUT_MPIDS = set(str(mpid)
+                         for mpid in OptOutMpid.all_values(session))
+    log.info(f"Loaded opt-outs: {len(_OPT_OUT_PIDS)} by PID, "
+             f"{len(_OPT_OUT_MPIDS)} by MPID")
+
+
+def forget_opt_outs() -> None:
+    """
+    Discards our in-memory copy of the opt-outs (e.g. because they have
+    changed); they'll be reloaded when next needed.
+    """
+    global _OPT_OUT_PIDS, _OPT_OUT_MPIDS
+    _OPT_OUT_PIDS = None
+    _OPT_OUT_MPIDS = None
+
+
 def opting_out_pid(pid: Union[int, str]) -> bool:
     """
     Does this patient wish to opt out?
@@ -301,7 +615,9 @@ def opting_out_pid(pid: Union[int, str]) -> bool:
     """
     if pid is None:
         return False
-    return OptOutPid.opting_out(config.admindb.session, pid)
+    if _OPT_OUT_PIDS is None:
+        load_opt_outs()
+    return str(pid) in _OPT_OUT_PIDS
 
 
 def opting_out_mpid(mpid: Union[int, str]) -> bool:
@@ -313,7 +629,9 @@ def opting_out_mpid(mpid: Union[int, str]) -> bool:
     """
     if mpid is None:
         return False
-    return OptOutMpid.opting_out(config.admindb.session, mpid)
+    if _OPT_OUT_MPIDS is None:
+        load_opt_outs()
+    return str(mpid) in _OPT_OUT_MPIDS
 
 
 def gen_optout_rids() -> Generator[str, None, None]:
@@ -338,6 +656,194 @@ def gen_optout_rids() -> Generator[str, None, None]:
         yield row[0]
 
 
+# =============================================================================
+# Progress ledger, for resuming interrupted runs
+# =============================================================================
+# Units of work (batches of patients; blocks or shares of non-patient tables)
+# are marked as started in the admin database before any of their data is
+# written, and as completed once that data has been committed. When resuming,
+# completed units are skipped, and any destination data for units that were
+# started but not completed is deleted before they're processed again.
+
+def get_dd_hash(db_table_pairs: Iterable[Tuple[str, str]],
+                free_text_limit: int = None,
+                exclude_scrubbed_fields: bool = False) -> str:
+    """
+    Returns a hash of the data dictionary rows that :func:`process_table`
+    uses for some source tables, so we can tell whether work done on a
+    previous occasion used the same data dictionary.
+
+    Args:
+        db_table_pairs: tuples ``source_db_name, source_table``
+        free_text_limit: as per :func:`process_table`
+        exclude_scrubbed_fields: as per :func:`process_table`
+    """
+    return config.hash_object([
+        ddr.get_tsv()
+        for d, t in db_table_pairs
+        for ddr in get_ddrows_to_process(
+            d, t,
+            free_text_limit=free_text_limit,
+            exclude_scrubbed_fields=exclude_scrubbed_fields)
+    ])
+
+
+def forget_progress_for_table(srcdbname: str, src_table: str) -> None:
+    """
+    Forgets the work done on a source table, according to the progress
+    ledger, because its destination data has been deleted. For a patient
+    table, that means forgetting all patients.
+
+    Args:
+        srcdbname: name (as per the data dictionary) of the source database
+        src_table: name of the source table
+    """
+    session = config.admindb.session
+    if src_table in config.dd.get_src_tables_with_patient_info(srcdbname):
+        session.query(PatientProgress).delete(synchronize_session=False)
+    else:
+        session.query(NonPatientProgress).filter(
+            NonPatientProgress.src_db == srcdbname,
+            NonPatientProgress.src_table == src_table
+        ).delete(synchronize_session=False)
+    commit_admindb()
+
+
+def delete_dest_rows_for_patients(rids: List[str]) -> None:
+    """
+    Deletes all destination data for some patients.
+
+    Args:
+        rids: research IDs (RIDs) of the patients
+    """
+    log.info(f"Deleting destination data for {len(rids)} patient(s) whose "
+             f"processing was interrupted or is out of date")
+    ridfield = config.research_id_fieldname
+    for dest_table_name in config.dd.get_dest_tables_with_patient_info():
+        dest_table = config.dd.get_dest_sqla_table(
+            dest_table_name,
+            config.timefield,
+            config.add_mrid_wherever_rid_added)
+        config.destdb.session.execute(
+            dest_table.delete().where(column(ridfield).in_(rids)))
+    commit_destdb()
+
+
+def delete_dest_rows_for_nonpatient_unit(sourcedbname: str,
+                                         sourcetable: str,
+                                         intpkname: str = None,
+                                         pk_range: Tuple[int, int] = None,
+                                         tasknum: int = 0,
+                                         ntasks: int = 1) -> None:
+    """
+    Deletes the destination data for a unit of work on a non-patient table
+    (see :func:`process_nonpatient_unit`).
+
+    Args:
+        sourcedbname: name (as per the data dictionary) of the source database
+        sourcetable: name of the source table
+        intpkname: name of the integer PK column in the source table, if one
+            exists
+        pk_range: as per :func:`process_table`
+        tasknum: as per :func:`process_table`
+        ntasks: as per :func:`process_table`
+    """
+    ddrows = get_ddrows_to_process(sourcedbname, sourcetable)
+    if not ddrows:
+        return
+    dest_table_name = ddrows[0].dest_table
+    dest_table = config.dd.get_dest_sqla_table(
+        dest_table_name, config.timefield, config.add_mrid_wherever_rid_added)
+    query = dest_table.delete()
+    if pk_range is not None or ntasks > 1:
+        dest_pk_names = [ddr.dest_field for ddr in ddrows
+                         if ddr.src_field == intpkname and not ddr.omit]
+        if not dest_pk_names:
+            raise ValueError(
+                f"Can't resume: processing of {sourcedbname}.{sourcetable} "
+                f"was interrupted, and its PK ({intpkname}) isn't copied to "
+                f"the destination, so its partial data can't be identified; "
+                f"run again without --resume")
+        pkcol = dest_table.columns[dest_pk_names[0]]
+        if pk_range is not None:
+            query = query.where(pkcol >= pk_range[0]).where(
+                pkcol < pk_range[1])
+        else:
+            query = query.where(pkcol % ntasks == tasknum)
+    log.info(f"Deleting destination data in {dest_table_name} from "
+             f"{sourcedbname}.{sourcetable} (PK range {pk_range}, task "
+             f"{tasknum} of {ntasks}), whose processing was interrupted or "
+             f"is out of date")
+    config.destdb.session.execute(query)
+    commit_destdb()
+
+
+def start_patient_batch(
+        patients: List[Tuple[Patient, bool]],
+        dd_hash: str,
+        resume: bool = False) -> Tuple[List[Tuple[Patient, bool]],
+                                       List[PatientProgress]]:
+    """
+    Marks a batch of patients as started, in the progress ledger.
+
+    If we are resuming an interrupted run, patients that have already been
+    completed (with the same scrubber and data dictionary) are removed from
+    the batch, and any destination data for patients that were started but
+    not completed (or were completed differently) is deleted, so that they
+    can be processed again from scratch.
+
+    Args:
+        patients: as per :func:`process_patient_batch`
+        dd_hash: hash of the data dictionary rows for patient tables; see
+            :func:`get_dd_hash`
+        resume: resume an interrupted run?
+
+    Returns:
+        tuple: ``patients, records``, where ``patients`` are those still to
+        be processed (as per :func:`process_patient_batch`) and ``records``
+        are their :class:`crate_anon.anonymise.models.PatientProgress`
+        records, for :func:`finish_patient_batch`
+    """
+    session = config.admindb.session
+    existing = PatientProgress.get_many(
+        session, [patient.pid for patient, _ in patients])
+    if resume and existing:
+        todo = []  # type: List[Tuple[Patient, bool]]
+        redo_rids = []  # type: List[str]
+        for patient, incremental in patients:
+            record = existing.get(str(patient.pid))
+            if record is not None:
+                if (record.completed and
+                        record.scrubber_hash == patient.scrubber_hash and
+                        record.dd_hash == dd_hash):
+                    log.debug(f"PID {patient.pid}: already processed")
+                    continue
+                redo_rids.append(patient.rid)
+            todo.append((patient, incremental))
+        if redo_rids:
+            delete_dest_rows_for_patients(redo_rids)
+        patients = todo
+    records = PatientProgress.mark_started(
+        session, existing,
+        [(patient.pid, patient.scrubber_hash) for patient, _ in patients],
+        dd_hash)
+    commit_admindb()
+    return patients, records
+
+
+def finish_patient_batch(records: List[PatientProgress]) -> None:
+    """
+    Commits the destination data for a batch of patients, then marks them as
+    completed in the progress ledger.
+
+    Args:
+        records: as returned by :func:`start_patient_batch`
+    """
+    commit_destdb()
+    PatientProgress.mark_completed(records)
+    commit_admindb()
+
+
 # =============================================================================
 # Functions for getting PIDs from restricted set
 # =============================================================================
@@ -768,7 +1274,8 @@ def get_pids_from_field_limits(field: str, low: int, high: int) -> List[Any]:
 def gen_patient_ids(
         tasknum: int = 0,
         ntasks: int = 1,
-        specified_pids: List[Any] = None) -> Generator[int, None, None]:
+        specified_pids: List[Any] = None,
+        all_pids: List[Any] = None) -> Generator[int, None, None]:
     """
     Generate patient IDs.
 
@@ -776,6 +1283,10 @@ def gen_patient_ids(
         tasknum: task number of this process (for dividing up work)
         ntasks: total number of processes (for dividing up work)
         specified_pids: optional list of PIDs to restrict ourselves to
+        all_pids: optional list of all PIDs in the source database, from
+            :func:`fetch_all_patient_ids`, to save scanning the source
+            database again (e.g. for each unit of work from a work
+            coordinator)
 
     Yields:
         integer patient IDs (PIDs)
@@ -788,13 +1299,6 @@ def gen_patient_ids(
     assert 0 <= tasknum < ntasks
 
     pid_is_integer = config.pidtype_is_integer
-    distribute_by_hash = ntasks > 1 and not pid_is_integer
-
-    # If we're going to define based on >1 table, we need to keep track of
-    # what we've processed. However, if we only have one table, we don't.
-    # We can't use the mapping table easily (*), because it leads to thread/
-    # process locking for database access. So we use a set.
-    # (*) if not patient_id_exists_in_mapping_db(admindb, patient_id): ...
 
     # Debug option?
     if config.debug_pid_list:
@@ -816,6 +1320,49 @@ def gen_patient_ids(
         return
 
     # Otherwise do it properly:
+    if all_pids is not None:
+        # Same division of work as the database query would give.
+        pids = (
+            pid for pid in all_pids
+            if (is_my_job_by_int(int(pid), tasknum=tasknum, ntasks=ntasks)
+                if pid_is_integer else
+                is_my_job_by_hash(pid, tasknum=tasknum, ntasks=ntasks))
+        )
+    else:
+        pids = _gen_source_patient_ids(tasknum, ntasks)
+    n_found = 0
+    debuglimit = config.debug_max_n_patients
+    for patient_id in pids:
+        n_found += 1
+        yield patient_id
+
+        # Too many?
+        if 0 < debuglimit <= n_found:
+            log.warning(
+                f"Not fetching more than {debuglimit} patients (in total "
+                f"for this process) due to debug_max_n_patients limit")
+            return
+
+
+def _gen_source_patient_ids(
+        tasknum: int = 0,
+        ntasks: int = 1) -> Generator[Union[int, str], None, None]:
+    """
+    Generates the distinct patient IDs in the source database(s) that are our
+    job, for :func:`gen_patient_ids`.
+
+    Args:
+        tasknum: task number of this process (for dividing up work)
+        ntasks: total number of processes (for dividing up work)
+    """
+    pid_is_integer = config.pidtype_is_integer
+    distribute_by_hash = ntasks > 1 and not pid_is_integer
+
+    # If we're going to define based on >1 table, we need to keep track of
+    # what we've processed. However, if we only have one table, we don't.
+    # We can't use the mapping table easily (*), because it leads to thread/
+    # process locking for database access. So we use a set.
+    # (*) if not patient_id_exists_in_mapping_db(admindb, patient_id): ...
     keeping_track = config.dd.n_definers > 1
     processed_ids = set()  # used only if keeping_track is True
     # ... POTENTIAL FOR MEMORY PROBLEM WITH V. BIG DB
@@ -824,8 +1371,6 @@ def gen_patient_ids(
     # need to generate the IDs and stash them in a temporary table, then
     # work through that. However, a few million patients should be fine
     # for a Python set on realistic computers.
-    n_found = 0
-    debuglimit = config.debug_max_n_patients
     for ddr in config.dd.rows:
         if not ddr.defines_primary_pids:
             continue
@@ -842,41 +1387,49 @@ def gen_patient_ids(
             query = query.where(pidcol % ntasks == tasknum)
         result = session.execute(query)
         log.debug(f"Looking for patient IDs in {ddr.src_table}.{ddr.src_field}")  # noqa
-        for row in result:
-            # Extract ID
-            patient_id = row[0]
-
-            # Duff?
-            if patient_id is None:
-                log.warning("Patient ID is NULL")
-                continue
+        try:
+            for row in result:
+                # Extract ID
+                patient_id = row[0]
 
-            # Operating on non-integer PIDs and not our job?
-            if distribute_by_hash and not is_my_job_by_hash(
-                    patient_id, tasknum=tasknum, ntasks=ntasks):
-                continue
+                # Duff?
+                if patient_id is None:
+                    log.warning("Patient ID is NULL")
+                    continue
 
-            # Duplicate?
-            if keeping_track:
-                # Consider, for non-integer PIDs, storing the hash64 instead
-                # of the raw value.
-                if patient_id in processed_ids:
-                    # we've done this one already; skip it this time
+                # Operating on non-integer PIDs and not our job?
+                if distribute_by_hash and not is_my_job_by_hash(
+                        patient_id, tasknum=tasknum, ntasks=ntasks):
                     continue
-                processed_ids.add(patient_id)
 
-            # Valid one
-            log.debug(f"Found patient id: {patient_id}")
-            n_found += 1
-            yield patient_id
+                # Duplicate?
+                if keeping_track:
+                    # Consider, for non-integer PIDs, storing the hash64
+                    # instead of the raw value.
+                    if patient_id in processed_ids:
+                        # we've done this one already; skip it this time
+                        continue
+                    processed_ids.add(patient_id)
+
+                # Valid one
+                log.debug(f"Found patient id: {patient_id}")
+                yield patient_id
+        finally:
+            # e.g. if our caller stops early because of a debugging limit
+            result.close()  # http://docs.sqlalchemy.org/en/latest/core/connections.html  # noqa
+
 
-            # Too many?
-            if 0 < debuglimit <= n_found:
-                log.warning(
-                    f"Not fetching more than {debuglimit} patients (in total "
-                    f"for this process) due to debug_max_n_patients limit")
-                result.close()  # http://docs.sqlalchemy.org/en/latest/core/connections.html  # noqa
-                return
+def fetch_all_patient_ids() -> List[Union[int, str]]:
+    """
+    Fetches all the (distinct) patient IDs in the source database(s), for
+    :func:`gen_patient_ids`, so that a process working through many units of
+    work needn't scan the source database for each one. (The list is held in
+    memory; see the comments in :func:`_gen_source_patient_ids`.)
+    """
+    log.info("Fetching all patient IDs")
+    pids = list(_gen_source_patient_ids())
+    log.info(f"... found {len(pids)} patient IDs")
+    return pids
 
 
 def estimate_count_patients() -> int:
@@ -906,7 +1459,10 @@ def gen_rows(dbname: str,
              intpkname: str = None,
              tasknum: int = 0,
              ntasks: int = 1,
-             debuglimit: int = 0) -> Generator[List[Any], None, None]:
+             debuglimit: int = 0,
+             order_by_pk: bool = False,
+             pk_range: Tuple[int, int] = None) -> Generator[List[Any],
+                                                            None, None]:
     """
     Generates rows from a source table:
     - ... each row being a list of values
@@ -914,7 +1470,11 @@ def gen_rows(dbname: str,
     - ... optionally restricted to a single patient
 
     If the table has a PK and we're operating in a multitasking situation,
-    generate just the rows for this task (thread/process).
+    generate just the rows for this task (thread/process), by PK modulus.
+    Non-patient tables with an integer PK are usually divided by PK range
+    instead (see :func:`gen_int_pk_blocks`), unless the
+    ``nonpatient_pk_block_size`` config option is 0; use ``pk_range`` to read
+    one block.
 
     Args:
         dbname: name (as per the data dictionary) of the source database
@@ -926,28 +1486,49 @@ def gen_rows(dbname: str,
         tasknum: task number of this process (for dividing up work)
         ntasks: total number of processes (for dividing up work)
         debuglimit: if specified, the maximum number of rows to process
+        order_by_pk: return rows in order of ``intpkname`` (otherwise, rows
+            are not ordered, except for non-patient tables read by PK range,
+            which are always in PK order)
+        pk_range: tuple ``pk_lo, pk_hi``; if specified, read only rows with
+            ``pk_lo <= pk < pk_hi`` (where ``pk`` is the ``intpkname``
+            column), in PK order, via :func:`gen_rows_by_int_pk_block`; the
+            ``tasknum`` and ``ntasks`` arguments are then ignored
 
     Yields:
         lists, each representing one row and containing values for each of the
         ``sourcefields``
     """
     t = config.sources[dbname].metadata.tables[sourcetable]
-    q = select([column(c) for c in sourcefields]).select_from(t)
-    # not ordered
-
-    # Restrict to one patient?
-    if pid is not None:
-        pidcol_name = config.dd.get_pid_name(dbname, sourcetable)
-        q = q.where(column(pidcol_name) == pid)
+    cols = [column(c) for c in sourcefields]
+    if pk_range is not None:
+        # Block of a non-patient table with an integer PK: use index-friendly
+        # PK range scans (and these rows are always in PK order).
+        result = gen_rows_by_int_pk_block(
+            dbname, sourcetable, cols, intpkname, pk_range,
+            pagesize=config.chunksize)
     else:
-        # For non-patient tables: divide up rows across tasks?
-        if intpkname is not None and ntasks > 1:
-            q = q.where(column(intpkname) % ntasks == tasknum)
-            # This does not require a user-defined PK to be unique. But other
-            # constraints do: see delete_dest_rows_with_no_src_row().
+        q = select(cols).select_from(t)
+        if order_by_pk and intpkname is not None:
+            q = q.order_by(column(intpkname))
+        # ... otherwise not ordered
+
+        # Restrict to one patient?
+        if pid is not None:
+            pidcol_name = config.dd.get_pid_name(dbname, sourcetable)
+            q = q.where(column(pidcol_name) == pid)
+        else:
+            # For non-patient tables: divide up rows across tasks?
+            if intpkname is not None and ntasks > 1:
+                q = q.where(column(intpkname) % ntasks == tasknum)
+                # This does not require a user-defined PK to be unique. But
+                # other constraints do: see
+                # delete_dest_rows_with_no_src_row().
+        srccfg = config.sources[dbname].srccfg
+        result = gen_result_rows(config.sources[dbname].session, q,
+                                 stream_results=srccfg.stream_results,
+                                 fetch_size=srccfg.fetch_size)
 
     db_table_tuple = (dbname, sourcetable)
-    result = config.sources[dbname].session.execute(q)
     for row in result:
         if 0 < debuglimit <= config.rows_inserted_per_table[db_table_tuple]:
             if not config.warned_re_limits[db_table_tuple]:
@@ -965,16 +1546,183 @@ def gen_rows(dbname: str,
         config.rows_inserted_per_table[db_table_tuple] += 1
 
 
+def gen_int_pk_blocks(
+        dbname: str,
+        sourcetable: str,
+        intpkname: str,
+        tasknum: int = 0,
+        ntasks: int = 1,
+        blocksize: int = DEFAULT_NONPATIENT_PK_BLOCK_SIZE) \
+        -> Generator[Tuple[int, int], None, None]:
+    """
+    Generates the blocks of PK values in a source table with an integer PK
+    that one task should process (with rows to read from via
+    :func:`gen_rows_by_int_pk_block`).
+
+    The PK values are divided into contiguous blocks of ``blocksize`` values
+    (block ``b`` being ``b * blocksize <= pk < (b + 1) * blocksize``), and
+    task ``k`` of ``n`` takes the blocks for which ``b % n == k``. That's
+    deterministic, so all tasks agree on the division without consulting
+    each other (or the table's current PK range). Each task reads only its
+    own blocks, using range conditions on the PK (which can use its index),
+    rather than scanning the whole table as ``WHERE pk % n = k`` would.
+
+    Empty stretches of PK space are skipped with ``SELECT MIN(pk) ... WHERE
+    pk >= x``, so only blocks containing rows are generated.
+
+    Args:
+        dbname: name (as per the data dictionary) of the source database
+        sourcetable: name of the source table
+        intpkname: name of the integer PK column
+        tasknum: task number of this process (for dividing up work)
+        ntasks: total number of processes (for dividing up work)
+        blocksize: number of PK values per block
+
+    Yields:
+        tuples ``pk_lo, pk_hi``, meaning ``pk_lo <= pk < pk_hi``, in order
+    """
+    session = config.sources[dbname].session
+    t = config.sources[dbname].metadata.tables[sourcetable]
+    pkcol = column(intpkname)
+    from_pk = None  # type: Optional[int]
+    while True:
+        # Find the next row at or after from_pk (an index seek).
+        minq = select([func.min(pkcol)]).select_from(t)
+        if from_pk is not None:
+            minq = minq.where(pkcol >= from_pk)
+        next_pk = session.execute(minq).scalar()
+        if next_pk is None:
+            return  # no more rows
+        block = next_pk // blocksize
+        blocks_to_ours = (tasknum - block) % ntasks
+        if blocks_to_ours:
+            # That row is in another task's block; skip to our next block.
+            from_pk = (block + blocks_to_ours) * blocksize
+            continue
+        yield block * blocksize, (block + 1) * blocksize
+        from_pk = (block + ntasks) * blocksize
+
+
+def gen_rows_by_int_pk_block(
+        dbname: str,
+        sourcetable: str,
+        cols: List[ColumnElement],
+        intpkname: str,
+        pk_range: Tuple[int, int],
+        pagesize: int = DEFAULT_CHUNKSIZE) -> Generator[List[Any],
+                                                        None, None]:
+    """
+    Generates rows from a block of a source table with an integer PK, in PK
+    order (see :func:`gen_int_pk_blocks`).
+
+    Rows are fetched in pages of ``pagesize`` with keyset pagination
+    (``WHERE pk >= next ORDER BY pk LIMIT pagesize``). The PK needn't be
+    unique here: rows sharing the last PK value of a full page are fetched
+    separately, so none are missed or duplicated.
+
+    Args:
+        dbname: name (as per the data dictionary) of the source database
+        sourcetable: name of the source table
+        cols: columns to fetch
+        intpkname: name of the integer PK column
+        pk_range: tuple ``pk_lo, pk_hi``, meaning ``pk_lo <= pk < pk_hi``
+        pagesize: maximum number of rows to fetch per query
+
+    Yields:
+        rows, each containing values for ``cols``
+    """
+    session = config.sources[dbname].session
+    t = config.sources[dbname].metadata.tables[sourcetable]
+    pkcol = column(intpkname)
+    q = select(cols + [pkcol]).select_from(t)  # PK appended, as last column
+    lower, block_end = pk_range  # inclusive, exclusive
+    while True:
+        page = session.execute(
+            q.where(pkcol >= lower)
+            .where(pkcol < block_end)
+            .order_by(pkcol)
+            .limit(pagesize)
+        ).fetchall()
+        if len(page) < pagesize:
+            for row in page:
+                yield row[:-1]
+            return
+        last_pk = page[-1][-1]
+        for row in page:
+            if row[-1] != last_pk:
+                yield row[:-1]
+        for row in session.execute(q.where(pkcol == last_pk)):
+            yield row[:-1]
+        lower = last_pk + 1
+
+
+def gen_rows_for_patients(
+        dbname: str,
+        sourcetable: str,
+        sourcefields: Iterable[str],
+        pids: List[Union[int, str]],
+        debuglimit: int = 0) -> Generator[Tuple[Union[int, str], List[Any]],
+                                          None, None]:
+    """
+    Generates rows from a source table for several patients at once, using a
+    single ``WHERE pid IN (...)`` query. This is the multi-patient equivalent
+    of :func:`gen_rows`, and shares its debugging row limits.
+
+    Args:
+        dbname: name (as per the data dictionary) of the source database
+        sourcetable: name of the source table
+        sourcefields: names of fields in the source table
+        pids: patient IDs (PIDs)
+        debuglimit: if specified, the maximum number of rows to process
+
+    Yields:
+        tuples ``pid, row``, where ``pid`` is the PID value from the source
+        table and ``row`` is a list containing values for each of the
+        ``sourcefields``
+    """
+    t = config.sources[dbname].metadata.tables[sourcetable]
+    pidcol_name = config.dd.get_pid_name(dbname, sourcetable)
+    q = (
+        select([column(c) for c in sourcefields] + [column(pidcol_name)])
+        .select_from(t)
+        .where(column(pidcol_name).in_(pids))
+    )
+    # not ordered
+
+    db_table_tuple = (dbname, sourcetable)
+    result = config.sources[dbname].session.execute(q)
+    for row in result:
+        if 0 < debuglimit <= config.rows_inserted_per_table[db_table_tuple]:
+            if not config.warned_re_limits[db_table_tuple]:
+                log.warning(
+                    f"Table {dbname}.{sourcetable}: not fetching more than "
+                    f"{debuglimit} rows (in total for this process) "
+                    f"due to debugging limits")
+                config.warned_re_limits[db_table_tuple] = True
+            result.close()
+            return
+        config.notify_src_bytes_read(sys.getsizeof(row))  # ... approximate!
+        values = list(row)
+        yield values[-1], values[:-1]
+        config.rows_inserted_per_table[db_table_tuple] += 1
+
+
 def count_rows(dbname: str,
                sourcetable: str,
-               pid: Union[int, str] = None) -> int:
+               pid: Union[int, str] = None,
+               intpkname: str = None,
+               pk_range: Tuple[int, int] = None) -> int:
     """
-    Count the number of rows in a table for a given PID.
+    Count the number of rows in a table for a given PID (or in a block of PK
+    values).
 
     Args:
         dbname: name (as per the data dictionary) of the source database
         sourcetable: name of the source table
         pid: patient ID (PID)
+        intpkname: name of the integer PK column, if ``pk_range`` is used
+        pk_range: tuple ``pk_lo, pk_hi``, to count only rows with
+            ``pk_lo <= pk < pk_hi``
 
     Returns:
         the number of records
@@ -986,7 +1734,11 @@ def count_rows(dbname: str,
     if pid is not None:
         pidcol_name = config.dd.get_pid_name(dbname, sourcetable)
         query = query.where(column(pidcol_name) == pid)
-    return session.execute(query).scalar()
+    if pk_range is not None:
+        pkcol = column(intpkname)
+        query = query.where(pkcol >= pk_range[0]).where(pkcol < pk_range[1])
+    with MultiTimerContext(timer, TIMING_COUNT_ROWS):
+        return session.execute(query).scalar()
 
 
 def gen_index_row_sets_by_table(
@@ -1061,7 +1813,8 @@ def gen_nonpatient_tables_with_int_pk() -> Generator[Tuple[str, str, str],
 
 def gen_pks(srcdbname: str,
             tablename: str,
-            pkname: str) -> Generator[int, None, None]:
+            pkname: str,
+            order_by_pk: bool = False) -> Generator[int, None, None]:
     """
     Generate PK values from a table.
 
@@ -1069,6 +1822,7 @@ def gen_pks(srcdbname: str,
         srcdbname: name (as per the data dictionary) of the database
         tablename: name of the table
         pkname: name of the PK column
+        order_by_pk: yield them in ascending order (skipping any NULLs)?
 
     Yields:
         int: each primary key
@@ -1076,8 +1830,11 @@ def gen_pks(srcdbname: str,
     db = config.sources[srcdbname]
     t = db.metadata.tables[tablename]
     q = select([column(pkname)]).select_from(t)
-    result = db.session.execute(q)
-    for row in result:
+    if order_by_pk:
+        q = q.where(column(pkname).isnot(None)).order_by(column(pkname))
+    for row in gen_result_rows(db.session, q,
+                               stream_results=db.srccfg.stream_results,
+                               fetch_size=db.srccfg.fetch_size):
         yield row[0]
 
 
@@ -1088,6 +1845,355 @@ def gen_pks(srcdbname: str,
 # - KEY THREADING RULE: ALL THREADS MUST HAVE FULLY INDEPENDENT DATABASE
 #   CONNECTIONS.
 
+def get_ddrows_to_process(
+        sourcedbname: str,
+        sourcetable: str,
+        free_text_limit: int = None,
+        exclude_scrubbed_fields: bool = False) -> List[DataDictionaryRow]:
+    """
+    Returns the data dictionary rows (in order) for the source fields that
+    :func:`process_table` needs to read from a source table. The source
+    fields that are fetched correspond one-to-one with these rows.
+
+    Args:
+        sourcedbname:
+            name (as per the data dictionary) of the source database
+        sourcetable:
+            name of the source table
+        free_text_limit:
+            as per :func:`process_table`
+        exclude_scrubbed_fields:
+            as per :func:`process_table`
+
+    Returns:
+        a list of :class:`crate_anon.anonymise.ddr.DataDictionaryRow`
+        objects; empty if there is nothing to process
+    """
+    ddrows = config.dd.get_rows_for_src_table(sourcedbname, sourcetable)
+    if all(ddr.omit for ddr in ddrows):
+        return []
+    addhash = any(ddr.add_src_hash for ddr in ddrows)
+    # If addhash or constant is true AND we are not omitting all rows, then
+    # the non-omitted rows will include the source PK (by the data dictionary's
+    # validation process).
+    ddrows = [ddr for ddr in ddrows
+              if (
+                  (not ddr.omit) or  # used for data
+                  (addhash and ddr.scrub_src) or  # used for hash
+                  ddr.inclusion_values or  # used for filter
+                  ddr.exclusion_values  # used for filter
+              )]
+    # Exclude all text fields over a chosen length
+    if free_text_limit is not None:
+        ddrows = [ddr for ddr in ddrows
+                  if (ddr.src_textlength is None) or
+                  (ddr.src_textlength <= free_text_limit)]
+    # Exclude all scrubbed fields if requested
+    if exclude_scrubbed_fields:
+        ddrows = [ddr for ddr in ddrows
+                  if (not ddr.src_is_textual) or (not ddr.being_scrubbed)]
+    return ddrows
+
+
+def get_dest_values(row: List[Any],
+                    ddrows: List[DataDictionaryRow],
+                    patient: Union[Patient, DetachedPatient, None],
+                    timefield: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    Applies data dictionary rules (inclusion/exclusion, PID encryption, alter
+    methods including scrubbing) to a source row, to give the values for the
+    destination row. This is the CPU-intensive part of :func:`process_table`.
+
+    Args:
+        row: source values, corresponding to ``ddrows``
+        ddrows: data dictionary rows, as per :func:`get_ddrows_to_process`
+        patient: the patient, or ``None`` for non-patient tables
+        timefield: name of the destination "time processed" field, if any
+
+    Returns:
+        a dictionary mapping destination column names to values, or ``None``
+        if the row is to be skipped
+    """
+    destvalues = {}  # type: Dict[str, Any]
+    skip_row = False
+    for i, ddr in enumerate(ddrows):
+        value = row[i]
+        if ddr.skip_row_by_value(value):
+            # log.debug("skipping row based on inclusion/exclusion values")
+            skip_row = True
+            break  # skip row
+        # NOTE: would be most efficient if ddrows were ordered with
+        # inclusion/exclusion fields first. (Not yet done automatically.)
+        if ddr.omit:
+            continue  # skip column
+
+        if ddr.primary_pid:
+            assert(value == patient.pid)
+            value = patient.rid
+        elif ddr.master_pid:
+            value = config.encrypt_master_pid(value)
+
+        for alter_method in ddr.alter_methods:
+            value, skiprow = alter_method.alter(
+                value=value, ddr=ddr, row=row,
+                ddrows=ddrows, patient=patient)
+            if skiprow:
+                break  # from alter method loop
+
+        if skip_row:
+            break  # from data dictionary row (field) loop
+
+        destvalues[ddr.dest_field] = value
+
+        if timefield:
+            destvalues[timefield] = datetime.utcnow()
+
+    if skip_row:
+        return None
+    return destvalues
+
+
+# -----------------------------------------------------------------------------
+# Worker processes for altering/scrubbing rows
+# -----------------------------------------------------------------------------
+
+_WORKER_POOL = None  # type: Optional[ProcessPoolExecutor]
+
+
+def get_worker_pool() -> Optional[ProcessPoolExecutor]:
+    """
+    Returns our pool of worker processes for altering/scrubbing rows, creating
+    it if necessary, or ``None`` if we're not using one (see the
+    ``scrub_worker_processes`` config option).
+
+    The workers are forked from this process (whatever the platform's default
+    start method), so they inherit our config and data dictionary (they don't
+    reload or reflect anything, and they never use our database connections).
+    """
+    global _WORKER_POOL
+    if _WORKER_POOL is None and config.scrub_worker_processes > 0:
+        log.info(f"Starting {config.scrub_worker_processes} worker "
+                 f"processes for altering/scrubbing")
+        _WORKER_POOL = ProcessPoolExecutor(
+            max_workers=config.scrub_worker_processes,
+            mp_context=multiprocessing.get_context("fork"))
+    return _WORKER_POOL
+
+
+def shutdown_worker_pool() -> None:
+    """
+    Shuts down our pool of worker processes, if we have one.
+    """
+    global _WORKER_POOL
+    if _WORKER_POOL is not None:
+        _WORKER_POOL.shutdown()
+        _WORKER_POOL = None
+
+
+_WORKER_PATIENTS = OrderedDict()  # type: OrderedDict[Tuple[str, str], DetachedPatient]  # noqa
+
+
+def _get_patient_in_worker(key: Tuple[str, str],
+                           pickled_patient: bytes) -> DetachedPatient:
+    """
+    Runs in a worker process: returns the patient whose pickled copy we've
+    been sent (see :meth:`crate_anon.anonymise.patient.Patient.get_detached_pickle`).
+
+    Each worker keeps the patients of the current batch (see the
+    ``patients_per_extraction_batch`` config option), as the same patients
+    come round again for each table. So a patient is unpickled, and their
+    scrubber compiled, once per worker, not once per chunk of rows.
+
+    Args:
+        key: tuple ``pid, scrubber_hash`` identifying the patient
+        pickled_patient: the pickled
+            :class:`crate_anon.anonymise.patient.DetachedPatient`
+    """  # noqa
+    patient = _WORKER_PATIENTS.get(key)
+    if patient is None:
+        patient = pickle.loads(pickled_patient)  # type: DetachedPatient
+        patient.attach_shared_objects()
+        _WORKER_PATIENTS[key] = patient
+        while len(_WORKER_PATIENTS) > config.patients_per_extraction_batch:
+            _WORKER_PATIENTS.popitem(last=False)  # discard oldest
+    else:
+        _WORKER_PATIENTS.move_to_end(key)
+    return patient
+
+
+def _get_dest_values_in_worker(
+        sourcedbname: str,
+        sourcetable: str,
+        patient_key: Optional[Tuple[str, str]],
+        pickled_patient: Optional[bytes],
+        free_text_limit: Optional[int],
+        exclude_scrubbed_fields: bool,
+        rows: List[List[Any]]) -> List[Optional[Dict[str, Any]]]:
+    """
+    Runs in a worker process: applies :func:`get_dest_values` to a chunk of
+    source rows from one table (and, for patient tables, one patient; see
+    :func:`_get_patient_in_worker`).
+    """
+    ddrows = get_ddrows_to_process(
+        sourcedbname, sourcetable,
+        free_text_limit=free_text_limit,
+        exclude_scrubbed_fields=exclude_scrubbed_fields)
+    patient = (
+        _get_patient_in_worker(patient_key, pickled_patient)
+        if patient_key is not None else None
+    )
+    config.text_extractor.detach_from_database()
+    timefield = config.timefield
+    return [get_dest_values(row, ddrows, patient, timefield) for row in rows]
+
+
+def gen_dest_values_via_pool(
+        pool: ProcessPoolExecutor,
+        rows_with_hashes: Iterable[Tuple[List[Any], Optional[str]]],
+        sourcedbname: str,
+        sourcetable: str,
+        patient: Optional[Patient],
+        free_text_limit: Optional[int],
+        exclude_scrubbed_fields: bool) \
+        -> Generator[Tuple[Optional[Dict[str, Any]], Optional[str]],
+                     None, None]:
+    """
+    The equivalent of calling :func:`get_dest_values` for each row, but with
+    the work done by our worker processes, in chunks of rows. Meanwhile, we
+    carry on reading source rows. The number of chunks in progress is
+    bounded, as is memory use. Results are yielded in the original order.
+
+    Args:
+        pool: the worker pool
+        rows_with_hashes: iterable of tuples ``row, srchash``
+        sourcedbname: name of the source database
+        sourcetable: name of the source table
+        patient: the patient, or ``None`` for non-patient tables
+        free_text_limit: as per :func:`process_table`
+        exclude_scrubbed_fields: as per :func:`process_table`
+
+    Yields:
+        tuples ``destvalues, srchash``, where ``destvalues`` is as returned
+        by :func:`get_dest_values`
+    """
+    chunksize = config.rows_per_worker_task
+    max_pending = 2 * config.scrub_worker_processes
+    patient_key = None  # type: Optional[Tuple[str, str]]
+    pickled_patient = None  # type: Optional[bytes]
+    if patient is not None:
+        # Pickled once per patient, not once per chunk.
+        patient_key = (str(patient.pid), patient.scrubber_hash)
+        pickled_patient = patient.get_detached_pickle()
+    pending = deque()  # type: Deque[Tuple[Future, List[Optional[str]]]]
+
+    def submit(rows_: List[List[Any]]) -> Future:
+        return pool.submit(
+            _get_dest_values_in_worker,
+            sourcedbname, sourcetable, patient_key, pickled_patient,
+            free_text_limit, exclude_scrubbed_fields, rows_)
+
+    rows = []  # type: List[List[Any]]
+    hashes = []  # type: List[Optional[str]]
+    for row, srchash in rows_with_hashes:
+        rows.append(row)
+        hashes.append(srchash)
+        if len(rows) >= chunksize:
+            pending.append((submit(rows), hashes))
+            rows = []  # type: List[List[Any]]
+            hashes = []  # type: List[Optional[str]]
+            while len(pending) >= max_pending:
+                future, chunk_hashes = pending.popleft()
+                with MultiTimerContext(timer, TIMING_WAIT_FOR_WORKERS):
+                    results = future.result()
+                yield from zip(results, chunk_hashes)
+    if rows:
+        pending.append((submit(rows), hashes))
+    while pending:
+        future, chunk_hashes = pending.popleft()
+        with MultiTimerContext(timer, TIMING_WAIT_FOR_WORKERS):
+            results = future.result()
+        yield from zip(results, chunk_hashes)
+
+
+# -----------------------------------------------------------------------------
+# Text extraction in advance
+# -----------------------------------------------------------------------------
+
+def gen_rows_with_text_prefetched(
+        rows_with_hashes: Iterable[Tuple[List[Any], Optional[str]]],
+        ddrows: List[DataDictionaryRow]) \
+        -> Generator[Tuple[List[Any], Optional[str]], None, None]:
+    """
+    Starts text extraction (see
+    :class:`crate_anon.anonymise.text_extraction.TextExtractor`) for each
+    source row's documents as the row arrives, and yields each row once its
+    documents are ready. Rows whose extraction is slow are held back while
+    later rows carry on; the number of rows waiting is bounded.
+
+    Only fields whose first alter method extracts text are handled in advance
+    (for any others, text is extracted as usual, when the row is processed).
+
+    Args:
+        rows_with_hashes: iterable of tuples ``row, srchash``
+        ddrows: data dictionary rows, as per :func:`get_ddrows_to_process`
+
+    Yields:
+        tuples ``row, srchash``, not necessarily in the original order
+    """
+    text_extractor = config.text_extractor
+    if not text_extractor.in_subprocesses:
+        yield from rows_with_hashes
+        return
+    extractors = [
+        (i, ddr.alter_methods[0]) for i, ddr in enumerate(ddrows)
+        if (not ddr.omit and ddr.alter_methods and
+            ddr.alter_methods[0].extract_text)
+    ]
+    if not extractors:
+        yield from rows_with_hashes
+        return
+    max_pending = 2 * config.text_extraction_processes
+    waiting = []  # type: List[Tuple[List[Any], Optional[str], List[Future]]]
+
+    def gen_ready(block: bool) -> Generator[Tuple[List[Any], Optional[str]],
+                                            None, None]:
+        # Yields rows whose extractions are complete (waiting for at least
+        # one, if block is True), removing them from the waiting list.
+        nonlocal waiting
+        if block:
+            with MultiTimerContext(timer, TIMING_WAIT_FOR_TEXT):
+                wait([f for _, _, futures in waiting for f in futures],
+                     return_when=FIRST_COMPLETED)
+        still_waiting = []
+        for row_, srchash_, futures in waiting:
+            if all(f.done() for f in futures):
+                yield row_, srchash_
+            else:
+                still_waiting.append((row_, srchash_, futures))
+        waiting = still_waiting
+
+    try:
+        for row, srchash in rows_with_hashes:
+            futures = []  # type: List[Future]
+            for i, alter_method in extractors:
+                source = alter_method.get_extraction_source(
+                    row[i], row, ddrows)
+                if source is not None:
+                    future = text_extractor.prefetch(*source)
+                    if future is not None:
+                        futures.append(future)
+            if not futures:
+                yield row, srchash
+                continue
+            waiting.append((row, srchash, futures))
+            yield from gen_ready(block=len(waiting) >= max_pending)
+        while waiting:
+            yield from gen_ready(block=True)
+    finally:
+        # Anything prefetched but unused (e.g. rows skipped by value).
+        text_extractor.discard_prefetched()
+
+
 def process_table(sourcedbname: str,
                   sourcetable: str,
                   patient: Patient = None,
@@ -1096,7 +2202,9 @@ def process_table(sourcedbname: str,
                   tasknum: int = 0,
                   ntasks: int = 1,
                   free_text_limit: int = None,
-                  exclude_scrubbed_fields: bool = False) -> None:
+                  exclude_scrubbed_fields: bool = False,
+                  source_rows: List[List[Any]] = None,
+                  pk_range: Tuple[int, int] = None) -> None:
     """
     Process a table. This can either be a patient table (in which case the
     patient's scrubber is applied and only rows for that patient are processed)
@@ -1122,8 +2230,22 @@ def process_table(sourcedbname: str,
             If specified, any text field longer than this will be excluded
         exclude_scrubbed_fields:
             Exclude all text fields which are being scrubbed.
+        source_rows:
+            Optional list of source rows (for this patient) that have already
+            been fetched, e.g. by :func:`gen_rows_for_patients`; each row
+            contains values for the fields given by
+            :func:`get_ddrows_to_process`, in order. If this is ``None``, the
+            rows are fetched from the source database.
+        pk_range:
+            For non-patient tables with an integer PK: optional tuple
+            ``pk_lo, pk_hi``, to process only the block of rows with
+            ``pk_lo <= pk < pk_hi`` (see :func:`gen_int_pk_blocks`). The
+            ``tasknum`` and ``ntasks`` arguments are then ignored.
     """
     start = f"process_table: {sourcedbname}.{sourcetable}:"
+    start_time = time.perf_counter()
+    rows_written_before = config.dest_rows_written
+    peak_memory_before = get_peak_memory_bytes()
     pid = None if patient is None else patient.pid
     log.debug(f"{start} pid={pid}, incremental={incremental}")
 
@@ -1137,30 +2259,13 @@ def process_table(sourcedbname: str,
         debuglimit = 0
 
     ddrows = config.dd.get_rows_for_src_table(sourcedbname, sourcetable)
-    if all(ddr.omit for ddr in ddrows):
-        return
     addhash = any(ddr.add_src_hash for ddr in ddrows)
     addtrid = any(ddr.primary_pid and not ddr.omit for ddr in ddrows)
     constant = any(ddr.constant for ddr in ddrows)
-    # If addhash or constant is true AND we are not omitting all rows, then
-    # the non-omitted rows will include the source PK (by the data dictionary's
-    # validation process).
-    ddrows = [ddr for ddr in ddrows
-              if (
-                  (not ddr.omit) or  # used for data
-                  (addhash and ddr.scrub_src) or  # used for hash
-                  ddr.inclusion_values or  # used for filter
-                  ddr.exclusion_values  # used for filter
-              )]
-    # Exclude all text fields over a chosen length
-    if free_text_limit is not None:
-        ddrows = [ddr for ddr in ddrows
-                  if (ddr.src_textlength is None) or
-                  (ddr.src_textlength <= free_text_limit)]
-    # Exclude all scrubbed fields if requested
-    if exclude_scrubbed_fields:
-        ddrows = [ddr for ddr in ddrows
-                  if (not ddr.src_is_textual) or (not ddr.being_scrubbed)]
+    ddrows = get_ddrows_to_process(
+        sourcedbname, sourcetable,
+        free_text_limit=free_text_limit,
+        exclude_scrubbed_fields=exclude_scrubbed_fields)
     if not ddrows:
         # No columns to process at all.
         return
@@ -1176,85 +2281,122 @@ def process_table(sourcedbname: str,
             src_pk_name = ddr.src_field
             dest_pk_name = ddr.dest_field
         sourcefields.append(ddr.src_field)
-    srchash = None
     timefield = config.timefield
     add_mrid_wherever_rid_added = config.add_mrid_wherever_rid_added
     mrid_fieldname = config.master_research_id_fieldname
     sqla_table = config.dd.get_dest_sqla_table(dest_table, timefield,
                                                add_mrid_wherever_rid_added)
-    session = config.destdb.session
+
+    # Incremental change detection: find out what the destination already
+    # has in bulk, rather than with a query per row.
+    dest_lookup = None  # type: Optional[DestinationHashLookup]
+    order_by_pk = False
+    if incremental and (addhash or constant) and dest_pk_name:
+        if patient is not None:
+            rid_dest_names = [ddr.dest_field for ddr in ddrows
+                              if ddr.primary_pid and not ddr.omit]
+            if rid_dest_names:
+                dest_lookup = DestinationHashLookup(
+                    dest_table, dest_pk_name, with_hash=addhash,
+                    where=[column(rid_dest_names[0]) == patient.rid])
+            # ... otherwise, we can't identify this patient's destination
+            # records; use per-row queries.
+        elif intpkname is not None:
+            # Potentially a big table; read both sides in PK order.
+            where = []  # type: List[ColumnElement]
+            if pk_range is not None:
+                where.append(column(dest_pk_name) >= pk_range[0])
+                where.append(column(dest_pk_name) < pk_range[1])
+            elif ntasks > 1:
+                where.append(column(dest_pk_name) % ntasks == tasknum)
+            dest_lookup = DestinationHashLookup(
+                dest_table, dest_pk_name, with_hash=addhash,
+                where=where, paged=True, chunksize=config.chunksize)
+            order_by_pk = True
+        else:
+            dest_lookup = DestinationHashLookup(
+                dest_table, dest_pk_name, with_hash=addhash)
 
     # Count what we'll do, so we can give a better indication of progress
-    count = count_rows(sourcedbname, sourcetable, pid)
+    if source_rows is None:
+        count = count_rows(sourcedbname, sourcetable, pid,
+                           intpkname=intpkname, pk_range=pk_range)
+        source_rows = gen_timed(
+            gen_rows(sourcedbname, sourcetable, sourcefields,
+                     pid, debuglimit=debuglimit,
+                     intpkname=intpkname, tasknum=tasknum,
+                     ntasks=ntasks, order_by_pk=order_by_pk,
+                     pk_range=pk_range),
+            timer, TIMING_GEN_ROWS)
+    else:
+        count = len(source_rows)
     n = 0
     recnum = tasknum or 0
 
-    # Process the rows
-    for row in gen_rows(sourcedbname, sourcetable, sourcefields,
-                        pid, debuglimit=debuglimit,
-                        intpkname=intpkname, tasknum=tasknum, ntasks=ntasks):
-        n += 1
-        if n % config.report_every_n_rows == 0:
-            log.info(
-                f"{start} processing record {recnum + 1}/{count}"
-                f"{' for this patient' if pid is not None else ''} "
-                f"({config.overall_progress()})")
-        recnum += ntasks or 1
-        if addhash:
-            srchash = config.hash_object(row)
-            if incremental and identical_record_exists_by_hash(
-                    dest_table, dest_pk_name, row[pkfield_index], srchash):
-                log.debug(
-                    f"... ... skipping unchanged record (identical by hash): "
-                    f"{sourcedbname}.{sourcetable}.{src_pk_name} = "
-                    f"(destination) {dest_table}.{dest_pk_name} = "
-                    f"{row[pkfield_index]}")
-                continue
-        if constant:
-            if incremental and identical_record_exists_by_pk(
-                    dest_table, dest_pk_name, row[pkfield_index]):
-                log.debug(
-                    f"... ... skipping unchanged record (identical by PK and "
-                    f"marked as constant): "
-                    f"{sourcedbname}.{sourcetable}.{src_pk_name} = "
-                    f"(destination) {dest_table}.{dest_pk_name} = "
-                    f"{row[pkfield_index]}")
-                continue
-        destvalues = {}  # type: Dict[str, Any]
-        skip_row = False
-        for i, ddr in enumerate(ddrows):
-            value = row[i]
-            if ddr.skip_row_by_value(value):
-                # log.debug("skipping row based on inclusion/exclusion values")
-                skip_row = True
-                break  # skip row
-            # NOTE: would be most efficient if ddrows were ordered with
-            # inclusion/exclusion fields first. (Not yet done automatically.)
-            if ddr.omit:
-                continue  # skip column
-
-            if ddr.primary_pid:
-                assert(value == patient.pid)
-                value = patient.rid
-            elif ddr.master_pid:
-                value = config.encrypt_master_pid(value)
-
-            for alter_method in ddr.alter_methods:
-                value, skiprow = alter_method.alter(
-                    value=value, ddr=ddr, row=row,
-                    ddrows=ddrows, patient=patient)
-                if skiprow:
-                    break  # from alter method loop
-
-            if skip_row:
-                break  # from data dictionary row (field) loop
-
-            destvalues[ddr.dest_field] = value
-
-            if timefield:
-                destvalues[timefield] = datetime.utcnow()
-
-        if skip_row or not destvalues:
+    def gen_rows_to_process() -> Generator[Tuple[List[Any], Optional[str]],
+                                           None, None]:
+        # Yields tuples (row, srchash) for source rows that need processing.
+        nonlocal n, recnum
+        for row_ in source_rows:
+            n += 1
+            if n % config.report_every_n_rows == 0:
+                log.info(
+                    f"{start} processing record {recnum + 1}/{count}"
+                    f"{' for this patient' if pid is not None else ''} "
+                    f"({config.overall_progress()})")
+            recnum += ntasks or 1
+            srchash_ = None  # type: Optional[str]
+            if addhash:
+                srchash_ = config.hash_object(row_)
+                if incremental and (
+                        dest_lookup.identical_record_exists_by_hash(
+                            row_[pkfield_index], srchash_)
+                        if dest_lookup else
+                        identical_record_exists_by_hash(
+                            dest_table, dest_pk_name, row_[pkfield_index],
+                            srchash_)):
+                    log.debug(
+                        f"... ... skipping unchanged record (identical by "
+                        f"hash): "
+                        f"{sourcedbname}.{sourcetable}.{src_pk_name} = "
+                        f"(destination) {dest_table}.{dest_pk_name} = "
+                        f"{row_[pkfield_index]}")
+                    continue
+            if constant:
+                if incremental and (
+                        dest_lookup.identical_record_exists_by_pk(
+                            row_[pkfield_index])
+                        if dest_lookup else
+                        identical_record_exists_by_pk(
+                            dest_table, dest_pk_name, row_[pkfield_index])):
+                    log.debug(
+                        f"... ... skipping unchanged record (identical by PK "
+                        f"and marked as constant): "
+                        f"{sourcedbname}.{sourcetable}.{src_pk_name} = "
+                        f"(destination) {dest_table}.{dest_pk_name} = "
+                        f"{row_[pkfield_index]}")
+                    continue
+            yield row_, srchash_
+
+    # Process the rows: alter/scrub them (here, or in our worker processes),
+    # and write them.
+    pool = get_worker_pool()
+    if pool is None:
+        gen_dest_values = (
+            (get_dest_values(row, ddrows, patient, timefield), srchash)
+            for row, srchash in gen_rows_with_text_prefetched(
+                gen_rows_to_process(), ddrows)
+        )
+    else:
+        gen_dest_values = gen_dest_values_via_pool(
+            pool, gen_rows_to_process(),
+            sourcedbname=sourcedbname,
+            sourcetable=sourcetable,
+            patient=patient,
+            free_text_limit=free_text_limit,
+            exclude_scrubbed_fields=exclude_scrubbed_fields)
+    for destvalues, srchash in gen_dest_values:
+        if not destvalues:
             continue  # next row
 
         if addhash:
@@ -1264,22 +2406,53 @@ def process_table(sourcedbname: str,
             if add_mrid_wherever_rid_added:
                 destvalues[mrid_fieldname] = patient.mrid
 
-        q = sqla_table.insert_on_duplicate().values(destvalues)
-        session.execute(q)
-
-        # Trigger an early commit?
-        config.notify_dest_db_transaction(
-            n_rows=1, n_bytes=sys.getsizeof(destvalues))  # ... approximate!
-        # ... quicker than e.g. len(repr(...)), as judged by a timeit() call.
+        # Insert, possibly as part of a multi-row batch. This may also
+        # trigger an early commit.
+        with MultiTimerContext(timer, TIMING_INSERT):
+            config.insert_dest_row(sqla_table, destvalues,
+                                   full_run=not incremental)
 
     log.debug(f"{start} finished: pid={pid}")
     commit_destdb()
+    _TIMINGS.add_table(
+        sourcedbname, sourcetable,
+        seconds=time.perf_counter() - start_time,
+        rows_read=n,
+        rows_written=config.dest_rows_written - rows_written_before,
+        peak_memory_before=peak_memory_before,
+        peak_memory_after=get_peak_memory_bytes())
+    if patient is None and pk_range is None:
+        log_table_peak_memory(sourcedbname, sourcetable)
+    # ... for blocks, process_nonpatient_tables() reports after the last.
+
+
+def log_table_peak_memory(sourcedbname: str, sourcetable: str) -> None:
+    """
+    Reports the peak memory use of this process, and how much it grew while
+    processing a source table.
+
+    Args:
+        sourcedbname: name (as per the data dictionary) of the source database
+        sourcetable: name of the source table
+    """
+    tabletiming = _TIMINGS.get_table(sourcedbname, sourcetable)
+    if tabletiming is None or tabletiming.peak_memory_bytes is None:
+        return
+    log.info(
+        f"process_table: {sourcedbname}.{sourcetable}: peak memory use "
+        f"{sizeof_fmt(tabletiming.peak_memory_bytes)} "
+        f"(up {sizeof_fmt(tabletiming.memory_growth_bytes)} during this "
+        f"table)")
 
 
 def create_indexes(tasknum: int = 0, ntasks: int = 1) -> None:
     """
     Create indexes for the destination tables.
 
+    The indexes for this process's tables are built largest table first, and
+    on several tables at once if ``index_build_connections`` says so; see
+    :mod:`crate_anon.anonymise.indexing`.
+
     Args:
         tasknum: task number of this process (for dividing up work)
         ntasks: total number of processes (for dividing up work)
@@ -1287,11 +2460,12 @@ def create_indexes(tasknum: int = 0, ntasks: int = 1) -> None:
     log.info(SEP + "Create indexes")
     engine = config.get_destdb_engine_outside_transaction()
     mssql = engine.dialect.name == 'mssql'
-    mssql_fulltext_columns_by_table = []  # type: List[List[Column]]
+    tables = []  # type: List[TableIndexJobs]
     for (tablename, tablerows) in gen_index_row_sets_by_table(tasknum=tasknum,
                                                               ntasks=ntasks):
         sqla_table = config.dd.get_dest_sqla_table(
             tablename, config.timefield, config.add_mrid_wherever_rid_added)
+        jobs = []  # type: List[IndexJob]
         mssql_fulltext_columns = []  # type: List[Column]
         for tr in tablerows:
             sqla_column = sqla_table.columns[tr.dest_field]
@@ -1302,28 +2476,181 @@ def create_indexes(tasknum: int = 0, ntasks: int = 1) -> None:
                 # columns; see below
                 mssql_fulltext_columns.append(sqla_column)
             else:
-                add_index(engine=engine,
-                          sqla_column=sqla_column,
-                          unique=(tr.index is INDEX.UNIQUE),
-                          fulltext=fulltext,
-                          length=tr.indexlen)
+                jobs.append(IndexJob(sqla_column=sqla_column,
+                                     unique=(tr.index is INDEX.UNIQUE),
+                                     fulltext=fulltext,
+                                     length=tr.indexlen))
             # Extra indexes for TRID, MRID?
             if tr.primary_pid:
-                add_index(engine, sqla_table.columns[config.trid_fieldname],
-                          unique=(tr.index is INDEX.UNIQUE))
+                jobs.append(IndexJob(
+                    sqla_table.columns[config.trid_fieldname],
+                    unique=(tr.index is INDEX.UNIQUE)))
                 if config.add_mrid_wherever_rid_added:
-                    add_index(
-                        engine,
+                    jobs.append(IndexJob(
                         sqla_table.columns[config.master_research_id_fieldname],  # noqa
                         unique=False  # see docs
-                    )
+                    ))
+        # Special processing for SQL Server FULLTEXT indexes, if any; do this
+        # after the table's other indexes.
         if mssql_fulltext_columns:
-            mssql_fulltext_columns_by_table.append(mssql_fulltext_columns)
-    # Special processing for SQL Server FULLTEXT indexes, if any:
-    for multiple_sqla_columns in mssql_fulltext_columns_by_table:
-        add_index(engine=engine,
-                  multiple_sqla_columns=multiple_sqla_columns,
-                  fulltext=True)
+            jobs.append(IndexJob(multiple_sqla_columns=mssql_fulltext_columns,
+                                 fulltext=True))
+        tables.append(TableIndexJobs(
+            tablename, jobs, n_rows=get_approx_n_rows(engine, tablename)))
+    engine.dispose()
+    for job, seconds in build_indexes(
+            tables,
+            engine_factory=config.get_destdb_engine_outside_transaction,
+            n_connections=config.index_build_connections,
+            options=config.index_build_options):
+        _TIMINGS.add_index(str(job), seconds)
+
+
+def build_patients(pids: List[Union[int, str]],
+                   incremental: bool = False) -> List[Tuple[Patient, bool]]:
+    """
+    Builds :class:`crate_anon.anonymise.patient.Patient` objects (and thus
+    their scrubbers) for a batch of patients, skipping any that we should not
+    process.
+
+    If there is more than one patient, their ``scrub_src`` values are fetched
+    for the whole batch at once, via a
+    :class:`crate_anon.anonymise.patient.ScrubSourcePrefetcher`. Likewise,
+    their admin database records (PID/RID/TRID mappings) are fetched or
+    created together, and their new scrubber hashes saved with a single
+    ``COMMIT``.
+
+    Args:
+        pids: patient IDs (PIDs); patients opting out by PID should already
+            have been removed
+        incremental: perform an incremental update, rather than a full run?
+
+    Returns:
+        a list of tuples ``patient, incremental`` suitable for
+        :func:`process_patient_batch`
+    """
+    prefetcher = ScrubSourcePrefetcher(
+        pids,
+        max_xref_cache_entries=config.thirdparty_xref_cache_max_entries
+    ) if len(pids) > 1 else None
+    infos = PatientInfo.get_or_create_many(config.admindb.session, pids)
+    patients = []  # type: List[Tuple[Patient, bool]]
+    for pid in pids:
+        # Gather scrubbing information for a patient.
+        with MultiTimerContext(timer, TIMING_BUILD_PATIENT):
+            patient = Patient(pid, prefetcher=prefetcher,
+                              info=infos[str(pid)])
+
+        if patient.mandatory_scrubbers_unfulfilled:
+            log.warning(
+                f"Skipping patient with PID={pid} as the following scrub_src "
+                f"fields are required and had no data: "
+                f"{patient.mandatory_scrubbers_unfulfilled}")
+            continue
+
+        # Opt out based on MPID?
+        if opting_out_mpid(patient.mpid):
+            log.info(f"... PID {pid}: opt out based on MPID")
+            continue
+
+        patient_unchanged = patient.is_unchanged()
+        if incremental:
+            if patient_unchanged:
+                log.debug(f"PID {pid}: scrubber unchanged; "
+                          f"may save some time")
+            else:
+                log.debug(f"PID {pid}: scrubber new or changed; "
+                          f"reprocessing in full")
+
+        patients.append((patient, incremental and patient_unchanged))
+    commit_admindb()  # save the scrubber hashes
+    if prefetcher is not None:
+        log.debug(
+            f"Third-party scrub_src cache: "
+            f"{prefetcher.n_xref_cache_hits} hits, "
+            f"{prefetcher.n_xref_cache_misses} misses")
+    return patients
+
+
+def process_patient_batch(patients: List[Tuple[Patient, bool]],
+                          free_text_limit: int = None,
+                          exclude_scrubbed_fields: bool = False) -> None:
+    """
+    Processes all patient tables for a batch of patients.
+
+    If there is more than one patient, each source table is read once for the
+    whole batch (with ``WHERE pid IN (...)``) and the rows are dispatched to
+    each patient in memory, rather than being read with a query (plus a count
+    query) per patient. Each patient's rows are then processed exactly as
+    they would be individually, with that patient's scrubber and RID/TRID.
+    So all the batch's rows for one table are held in memory at once; see the
+    ``patients_per_extraction_batch`` config option.
+
+    Args:
+        patients: list of tuples ``patient, incremental``, where ``patient``
+            is a :class:`crate_anon.anonymise.patient.Patient` and
+            ``incremental`` is a boolean saying whether that patient's data
+            can be processed incrementally (see :func:`process_table`)
+        free_text_limit: as per :func:`process_table`
+        exclude_scrubbed_fields: as per :func:`process_table`
+    """
+    if not patients:
+        return
+    batched = len(patients) > 1
+    pids = [patient.pid for patient, _ in patients]
+    # For each source database/table...
+    for d in config.dd.get_source_databases():
+        log.debug(f"Patients {pids}, processing database: {d}")
+        for t in config.dd.get_patient_src_tables_with_active_dest(d):
+            log.debug(f"Patients {pids}, processing table {d}.{t}")
+            rows_by_pid = None  # type: Optional[Dict[str, List[List[Any]]]]
+            if batched:
+                ddrows = get_ddrows_to_process(
+                    d, t,
+                    free_text_limit=free_text_limit,
+                    exclude_scrubbed_fields=exclude_scrubbed_fields)
+                if not ddrows:
+                    continue
+                srccfg = config.sources[d].srccfg
+                debuglimit = (
+                    srccfg.debug_row_limit
+                    if matches_tabledef(t, srccfg.debug_limited_tables)
+                    else 0
+                )
+                rows_by_pid = defaultdict(list)
+                fetch_start = time.perf_counter()
+                peak_memory_before = get_peak_memory_bytes()
+                for pid, row in gen_timed(
+                        gen_rows_for_patients(
+                            d, t, [ddr.src_field for ddr in ddrows], pids,
+                            debuglimit=debuglimit),
+                        timer, TIMING_GEN_ROWS):
+                    # PIDs from different sources may differ in Python type
+                    # (e.g. int versus str); the database compares them for
+                    # us in the one-patient query, so we match on str here.
+                    rows_by_pid[str(pid)].append(row)
+                _TIMINGS.add_table(d, t,
+                                   seconds=time.perf_counter() - fetch_start,
+                                   calls=0,
+                                   peak_memory_before=peak_memory_before,
+                                   peak_memory_after=get_peak_memory_bytes())
+            for patient, incremental in patients:
+                try:
+                    process_table(
+                        d, t,
+                        patient=patient,
+                        incremental=incremental,
+                        free_text_limit=free_text_limit,
+                        exclude_scrubbed_fields=exclude_scrubbed_fields,
+                        source_rows=(
+                            rows_by_pid.get(str(patient.pid), [])
+                            if batched else None
+                        ))
+                except Exception:
+                    log.critical("Error whilst processing - "
+                                 f"db: {d} table: {t}, "
+                                 f"patient id: {patient.pid}")
+                    raise
 
 
 def patient_processing_fn(tasknum: int = 0,
@@ -1331,14 +2658,19 @@ def patient_processing_fn(tasknum: int = 0,
                           incremental: bool = False,
                           specified_pids: List[int] = None,
                           free_text_limit: int = None,
-                          exclude_scrubbed_fields: bool = False) -> None:
+                          exclude_scrubbed_fields: bool = False,
+                          resume: bool = False,
+                          all_pids: List[Union[int, str]] = None) -> None:
     """
     Main function to anonymise patient data.
 
     - Iterate through patient IDs;
     - build the scrubber for each patient;
-    - process source data for that patient, scrubbing it;
-    - insert the patient into the mapping table in the admin database.
+    - process source data for that patient, scrubbing it (possibly in
+      batches of several patients; see :func:`process_patient_batch`);
+    - insert the patient into the mapping table in the admin database;
+    - record each batch of patients in the progress ledger (see
+      :func:`start_patient_batch`).
 
     Args:
         tasknum: task number of this process (for dividing up work)
@@ -1347,11 +2679,40 @@ def patient_processing_fn(tasknum: int = 0,
         specified_pids: if specified, restrict to specific PIDs
         free_text_limit: as per :func:`process_table`
         exclude_scrubbed_fields: as per :func:`process_table`
+        resume: resume an interrupted run, skipping patients already
+            processed?
+        all_pids: as per :func:`gen_patient_ids`
     """
-    n_patients = estimate_count_patients() // ntasks
+    if all_pids is not None:
+        n_patients = len(all_pids) // ntasks
+    else:
+        n_patients = estimate_count_patients() // ntasks
+    batch_size = config.patients_per_extraction_batch
+    pid_batch = []  # type: List[Union[int, str]]
     i = 0
+    n_skipped = 0
+    dd_hash = get_dd_hash(
+        [(d, t)
+         for d in config.dd.get_source_databases()
+         for t in config.dd.get_patient_src_tables_with_active_dest(d)],
+        free_text_limit=free_text_limit,
+        exclude_scrubbed_fields=exclude_scrubbed_fields)
+
+    def process_pid_batch(pids: List[Union[int, str]]) -> None:
+        nonlocal n_skipped
+        built = build_patients(pids, incremental=incremental)
+        patients, records = start_patient_batch(built, dd_hash,
+                                                resume=resume)
+        n_skipped += len(built) - len(patients)
+        process_patient_batch(
+            patients,
+            free_text_limit=free_text_limit,
+            exclude_scrubbed_fields=exclude_scrubbed_fields)
+        finish_patient_batch(records)
+
     for pid in gen_patient_ids(tasknum, ntasks,
-                               specified_pids=specified_pids):
+                               specified_pids=specified_pids,
+                               all_pids=all_pids):
         # gen_patient_ids() assigns the work to the appropriate thread/process
         # Check for an abort signal once per patient processed
         i += 1
@@ -1367,46 +2728,17 @@ def patient_processing_fn(tasknum: int = 0,
         # MPID information won't be present until we scan all the fields (which
         # we do as we build the scrubber).
 
-        # Gather scrubbing information for a patient. (Will save.)
-        patient = Patient(pid)
-
-        if patient.mandatory_scrubbers_unfulfilled:
-            log.warning(
-                f"Skipping patient with PID={pid} as the following scrub_src "
-                f"fields are required and had no data: "
-                f"{patient.mandatory_scrubbers_unfulfilled}")
-            continue
-
-        # Opt out based on MPID?
-        if opting_out_mpid(patient.mpid):
-            log.info("... opt out based on MPID")
-            continue
-
-        patient_unchanged = patient.is_unchanged()
-        if incremental:
-            if patient_unchanged:
-                log.debug("Scrubber unchanged; may save some time")
-            else:
-                log.debug("Scrubber new or changed; reprocessing in full")
-
-        # For each source database/table...
-        for d in config.dd.get_source_databases():
-            log.debug(f"Patient {pid}, processing database: {d}")
-            for t in config.dd.get_patient_src_tables_with_active_dest(d):
-                log.debug(f"Patient {pid}, processing table {d}.{t}")
-                try:
-                    process_table(
-                        d, t,
-                        patient=patient,
-                        incremental=(incremental and patient_unchanged),
-                        free_text_limit=free_text_limit,
-                        exclude_scrubbed_fields=exclude_scrubbed_fields)
-                except Exception:
-                    log.critical("Error whilst processing - "
-                                 f"db: {d} table: {t}, patient id: {pid}")
-                    raise
+        pid_batch.append(pid)
+        if len(pid_batch) >= batch_size:
+            process_pid_batch(pid_batch)
+            pid_batch = []  # type: List[Union[int, str]]
+    if pid_batch:
+        process_pid_batch(pid_batch)  # remainder
 
     commit_destdb()
+    if resume:
+        log.info(f"Resuming: skipped {n_skipped} patient(s) already "
+                 f"processed")
 
 
 def wipe_destination_data_for_opt_out_patients(report_every: int = 1000,
@@ -1503,7 +2835,8 @@ def wipe_destination_data_for_opt_out_patients(report_every: int = 1000,
 
 
 def drop_remake(incremental: bool = False,
-                skipdelete: bool = False) -> None:
+                skipdelete: bool = False,
+                resume: bool = False) -> None:
     """
     Drop and rebuild (a) mapping table, (b) destination tables.
 
@@ -1514,10 +2847,14 @@ def drop_remake(incremental: bool = False,
         skipdelete:
             For incremental updates, skip deletion of rows present in the
             destination but not the source
+        resume:
+            We are resuming an interrupted run: don't drop anything (or
+            forget the progress made so far), whether or not the run is
+            incremental.
     """
     log.info(SEP + "Creating database structure +/- deleting dead data")
     engine = config.admindb.engine
-    if not incremental:
+    if not incremental and not resume:
         log.info("Dropping admin tables except opt-out")
         # not OptOut
 
@@ -1525,6 +2862,12 @@ def drop_remake(incremental: bool = False,
         PatientInfo.__table__.drop(engine, checkfirst=True)
         # noinspection PyUnresolvedReferences
         TridRecord.__table__.drop(engine, checkfirst=True)
+    if not resume:
+        log.info("Dropping progress records from any previous run")
+        # noinspection PyUnresolvedReferences
+        PatientProgress.__table__.drop(engine, checkfirst=True)
+        # noinspection PyUnresolvedReferences
+        NonPatientProgress.__table__.drop(engine, checkfirst=True)
     log.info("Creating admin tables")
     # noinspection PyUnresolvedReferences
     OptOutPid.__table__.create(engine, checkfirst=True)
@@ -1534,8 +2877,16 @@ def drop_remake(incremental: bool = False,
     PatientInfo.__table__.create(engine, checkfirst=True)
     # noinspection PyUnresolvedReferences
     TridRecord.__table__.create(engine, checkfirst=True)
+    # noinspection PyUnresolvedReferences
+    TextExtractionCacheRecord.__table__.create(engine, checkfirst=True)
+    # noinspection PyUnresolvedReferences
+    ScrubberRegexCacheRecord.__table__.create(engine, checkfirst=True)
+    # noinspection PyUnresolvedReferences
+    PatientProgress.__table__.create(engine, checkfirst=True)
+    # noinspection PyUnresolvedReferences
+    NonPatientProgress.__table__.create(engine, checkfirst=True)
 
-    wipe_and_recreate_destination_db(incremental=incremental)
+    wipe_and_recreate_destination_db(incremental=incremental or resume)
     if skipdelete or not incremental:
         return
     for d in config.dd.get_source_databases():
@@ -1658,23 +3009,133 @@ def setup_opt_out(incremental: bool = False) -> None:
         OptOutMpid.add(adminsession, mpid)
 
     adminsession.commit()
+    forget_opt_outs()
 
     if incremental:
         wipe_destination_data_for_opt_out_patients()
 
 
+def check_nonpatient_layout(sourcedbname: str,
+                            sourcetable: str,
+                            layout: str) -> None:
+    """
+    Before resuming work on a non-patient table, checks that the units of
+    work recorded for it in the progress ledger were laid out as ours will be
+    (see :func:`process_nonpatient_tables`). If not (e.g. because
+    ``nonpatient_pk_block_size`` or the number of processes has changed),
+    the old and new units overlap, so we can't tell what's been done; we
+    refuse to carry on.
+
+    Args:
+        sourcedbname: name (as per the data dictionary) of the source database
+        sourcetable: name of the source table
+        layout: how we are dividing the table into units of work
+
+    Raises:
+        :exc:`ValueError` if the layouts differ
+    """
+    others = NonPatientProgress.get_other_layouts(
+        config.admindb.session, sourcedbname, sourcetable, layout)
+    if others:
+        raise ValueError(
+            f"Can't resume: {sourcedbname}.{sourcetable} was divided into "
+            f"units of work as {others}, but would now be divided as "
+            f"{layout!r} (has nonpatient_pk_block_size, or the number of "
+            f"processes, changed?); resume with the original settings, or "
+            f"run again without --resume")
+
+
+def process_nonpatient_unit(sourcedbname: str,
+                            sourcetable: str,
+                            layout: str,
+                            intpkname: str = None,
+                            pk_range: Tuple[int, int] = None,
+                            tasknum: int = 0,
+                            ntasks: int = 1,
+                            incremental: bool = False,
+                            free_text_limit: int = None,
+                            exclude_scrubbed_fields: bool = False,
+                            resume: bool = False) -> None:
+    """
+    Processes a unit of work on a non-patient table (a block of PK values, a
+    share of the table by PK modulus, or the whole table), recording it in
+    the progress ledger.
+
+    If we are resuming an interrupted run, this skips the unit if it's been
+    completed already (with the same data dictionary), or deletes any
+    destination data from a previous attempt at it first.
+
+    Args:
+        sourcedbname: as per :func:`process_table`
+        sourcetable: as per :func:`process_table`
+        layout: how the table is divided into units of work (see
+            :func:`process_nonpatient_tables`)
+        intpkname: as per :func:`process_table`
+        pk_range: as per :func:`process_table`
+        tasknum: as per :func:`process_table`
+        ntasks: as per :func:`process_table`
+        incremental: as per :func:`process_table`
+        free_text_limit: as per :func:`process_table`
+        exclude_scrubbed_fields: as per :func:`process_table`
+        resume: resume an interrupted run?
+    """
+    session = config.admindb.session
+    dd_hash = get_dd_hash(
+        [(sourcedbname, sourcetable)],
+        free_text_limit=free_text_limit,
+        exclude_scrubbed_fields=exclude_scrubbed_fields)
+    record = NonPatientProgress.get_unit(
+        session, sourcedbname, sourcetable,
+        pk_range=pk_range, tasknum=tasknum, ntasks=ntasks)
+    if resume and record is not None:
+        if record.completed and record.dd_hash == dd_hash:
+            log.debug(f"{sourcedbname}.{sourcetable}, PK range {pk_range}, "
+                      f"task {tasknum} of {ntasks}: already processed")
+            return
+        delete_dest_rows_for_nonpatient_unit(
+            sourcedbname, sourcetable, intpkname=intpkname,
+            pk_range=pk_range, tasknum=tasknum, ntasks=ntasks)
+    record = NonPatientProgress.mark_started(
+        session, record, sourcedbname, sourcetable, dd_hash, layout,
+        pk_range=pk_range, tasknum=tasknum, ntasks=ntasks)
+    commit_admindb()
+    try:
+        # noinspection PyTypeChecker
+        process_table(sourcedbname, sourcetable, patient=None,
+                      incremental=incremental,
+                      intpkname=intpkname, tasknum=tasknum, ntasks=ntasks,
+                      free_text_limit=free_text_limit,
+                      exclude_scrubbed_fields=exclude_scrubbed_fields,
+                      pk_range=pk_range)
+    except Exception:
+        log.critical(f"Error whilst processing - db: {sourcedbname} "
+                     f"table: {sourcetable} PK range: {pk_range}")
+        raise
+    commit_destdb()
+    record.mark_completed()
+    commit_admindb()
+
+
 def process_nonpatient_tables(tasknum: int = 0,
                               ntasks: int = 1,
                               incremental: bool = False,
                               free_text_limit: int = None,
-                              exclude_scrubbed_fields: bool = False) -> None:
+                              exclude_scrubbed_fields: bool = False,
+                              resume: bool = False) -> None:
     """
     Copies all non-patient tables.
 
-    - If they have an integer PK, the work may be parallelized.
+    - If they have an integer PK, the work may be parallelized (by blocks of
+      PK values; see :func:`gen_int_pk_blocks`).
     - If not, whole tables are assigned to different processes in parallel
       mode.
 
+    Each block (or table) is a unit of work for the progress ledger; see
+    :func:`process_nonpatient_unit`. Its "layout" records how the table was
+    divided up: ``pk_blocks:<blocksize>``, ``pk_modulus:<ntasks>``, or
+    ``whole_table``; when resuming, it must match the previous run's (see
+    :func:`check_nonpatient_layout`).
+
     Args:
         tasknum:
             task number of this process (for dividing up work)
@@ -1686,6 +3147,8 @@ def process_nonpatient_tables(tasknum: int = 0,
             as per :func:`process_table`
         exclude_scrubbed_fields:
             as per :func:`process_table`
+        resume:
+            resume an interrupted run, skipping work already done?
 
     """
     log.info(SEP + "Non-patient tables: (a) with integer PK")
@@ -1693,17 +3156,33 @@ def process_nonpatient_tables(tasknum: int = 0,
         log.info(
             f"Processing non-patient table {d}.{t} (PK: {pkname}) "
             f"({config.overall_progress()})...")
-        try:
-            # noinspection PyTypeChecker
-            process_table(d, t, patient=None,
-                          incremental=incremental,
-                          intpkname=pkname, tasknum=tasknum, ntasks=ntasks,
-                          free_text_limit=free_text_limit,
-                          exclude_scrubbed_fields=exclude_scrubbed_fields)
-        except Exception:
-            log.critical(f"Error whilst processing - db: {d} table: {t}")
-            raise
-        commit_destdb()
+        if config.nonpatient_pk_block_size > 0:
+            layout = f"pk_blocks:{config.nonpatient_pk_block_size}"
+        else:
+            layout = f"pk_modulus:{ntasks}"
+        if resume:
+            check_nonpatient_layout(d, t, layout)
+        if config.nonpatient_pk_block_size > 0:
+            # We've parallelized by assigning different blocks to different
+            # processes; each block is processed in single-task mode.
+            for pk_range in gen_int_pk_blocks(
+                    d, t, pkname, tasknum=tasknum, ntasks=ntasks,
+                    blocksize=config.nonpatient_pk_block_size):
+                process_nonpatient_unit(
+                    d, t, layout, intpkname=pkname, pk_range=pk_range,
+                    incremental=incremental,
+                    free_text_limit=free_text_limit,
+                    exclude_scrubbed_fields=exclude_scrubbed_fields,
+                    resume=resume)
+            log_table_peak_memory(d, t)
+        else:
+            process_nonpatient_unit(
+                d, t, layout, intpkname=pkname, tasknum=tasknum,
+                ntasks=ntasks,
+                incremental=incremental,
+                free_text_limit=free_text_limit,
+                exclude_scrubbed_fields=exclude_scrubbed_fields,
+                resume=resume)
     log.info(SEP + "Non-patient tables: (b) without integer PK")
     for (d, t) in gen_nonpatient_tables_without_int_pk(tasknum=tasknum,
                                                        ntasks=ntasks):
@@ -1713,17 +3192,15 @@ def process_nonpatient_tables(tasknum: int = 0,
         # Force this into single-task mode, i.e. we have already parallelized
         # by assigning different tables to different processes; don't split
         # the work within a single table.
-        try:
-            # noinspection PyTypeChecker
-            process_table(d, t, patient=None,
-                          incremental=incremental,
-                          intpkname=None, tasknum=0, ntasks=1,
-                          free_text_limit=free_text_limit,
-                          exclude_scrubbed_fields=exclude_scrubbed_fields)
-        except Exception:
-            log.critical(f"Error whilst processing - db: {d} table: {t}")
-            raise
-        commit_destdb()
+        layout = "whole_table"
+        if resume:
+            check_nonpatient_layout(d, t, layout)
+        process_nonpatient_unit(
+            d, t, layout, intpkname=None, tasknum=0, ntasks=1,
+            incremental=incremental,
+            free_text_limit=free_text_limit,
+            exclude_scrubbed_fields=exclude_scrubbed_fields,
+            resume=resume)
 
 
 def process_patient_tables(tasknum: int = 0,
@@ -1731,7 +3208,9 @@ def process_patient_tables(tasknum: int = 0,
                            incremental: bool = False,
                            specified_pids: List[int] = None,
                            free_text_limit: int = None,
-                           exclude_scrubbed_fields: bool = False) -> None:
+                           exclude_scrubbed_fields: bool = False,
+                           resume: bool = False,
+                           all_pids: List[Union[int, str]] = None) -> None:
     """
     Process all patient tables, optionally in a parallel-processing fashion.
 
@@ -1750,6 +3229,10 @@ def process_patient_tables(tasknum: int = 0,
             as per :func:`process_table`
         exclude_scrubbed_fields:
             as per :func:`process_table`
+        resume:
+            resume an interrupted run, skipping patients already processed?
+        all_pids:
+            as per :func:`gen_patient_ids`
 
     """
     # We'll use multiple destination tables, so commit right at the end.
@@ -1763,7 +3246,9 @@ def process_patient_tables(tasknum: int = 0,
                           incremental=incremental,
                           specified_pids=specified_pids,
                           free_text_limit=free_text_limit,
-                          exclude_scrubbed_fields=exclude_scrubbed_fields)
+                          exclude_scrubbed_fields=exclude_scrubbed_fields,
+                          resume=resume,
+                          all_pids=all_pids)
 
     if ntasks > 1:
         log.info(f"Process {tasknum}: FINISHED ANONYMISATION")
@@ -1829,7 +3314,12 @@ def anonymise(draftdd: bool = False,
               reportevery: int = DEFAULT_REPORT_EVERY,
               echo: bool = False,
               debugscrubbers: bool = False,
-              savescrubbers: bool = False) -> None:
+              savescrubbers: bool = False,
+              processcluster: str = "",
+              coordinator: str = None,
+              timing: bool = False,
+              timing_json: str = "",
+              resume: bool = False) -> None:
     """
     Main entry point for anonymisation.
 
@@ -1900,6 +3390,30 @@ def anonymise(draftdd: bool = False,
             Saves sensitive scrubbing information in admin database, for
             debugging
 
+        processcluster:
+            Process cluster name (e.g. ``PATIENT``), identifying this process
+            to a work coordinator.
+        coordinator:
+            Address (``host:port``) of a work coordinator (see
+            :mod:`crate_anon.anonymise.coordinator`), from which to fetch
+            units of patient/non-patient table work, rather than dividing
+            the work statically via ``process`` and ``nprocesses``.
+
+        timing:
+            Report a breakdown of where time was spent, at the end.
+        timing_json:
+            Filename to which to write a machine-readable (JSON) summary of
+            time spent per phase, per source table, and in the timed parts of
+            the code. Any ``{process}`` or ``{processcluster}`` in the name is
+            replaced by the process number or cluster name (so that different
+            processes write to different files).
+
+        resume:
+            Resume an interrupted run: don't drop anything, skip work that
+            the progress ledger in the admin database shows was completed
+            (with the same data dictionary, and for patients, the same
+            scrubber), and redo the rest.
+
     """
     # Validate args
     if nprocesses < 1:
@@ -1973,41 +3487,109 @@ def anonymise(draftdd: bool = False,
 
     log.info(BIGSEP + "Starting")
     start = get_now_utc_pendulum()
+    timer.set_timing(timing or bool(timing_json), reset=True)
+    _TIMINGS.reset()
+
+    if resume:
+        log.info("Resuming a previous run")
 
     # 1. Drop/remake tables. Single-tasking only.
     if dropremake or everything:
-        drop_remake(incremental=incremental, skipdelete=skipdelete)
+        with _TIMINGS.phase("drop_remake", timer):
+            drop_remake(incremental=incremental, skipdelete=skipdelete,
+                        resume=resume)
 
     # 2. Deal with opt-outs
+    #    (When resuming, the destination may already contain data from
+    #    patients who have opted out since, even in a full run.)
     if optout or everything:
-        setup_opt_out(incremental=incremental)
-
-    # 3. Tables with patient info.
-    #    Process PER PATIENT, across all tables, because we have to synthesize
-    #    information to scrub across the entirety of that patient's record.
-    if patienttables or everything:
-        process_patient_tables(tasknum=process,
-                               ntasks=nprocesses,
-                               incremental=incremental,
-                               specified_pids=pids,
-                               free_text_limit=free_text_limit,
-                               exclude_scrubbed_fields=exclude_scrubbed_fields)
-
-    # 4. Tables without any patient ID (e.g. lookup tables). Process PER TABLE.
-    if nonpatienttables or everything:
-        process_nonpatient_tables(
-            tasknum=process,
-            ntasks=nprocesses,
-            incremental=incremental,
-            free_text_limit=free_text_limit,
-            exclude_scrubbed_fields=exclude_scrubbed_fields)
+        with _TIMINGS.phase("opt_out", timer):
+            setup_opt_out(incremental=incremental or resume)
+
+    # The worker pool (if any) is used for steps 3 and 4; make sure it's
+    # shut down even if something goes wrong.
+    try:
+        # 3. Tables with patient info.
+        #    Process PER PATIENT, across all tables, because we have to
+        #    synthesize information to scrub across the entirety of that
+        #    patient's record.
+        #    (With a work coordinator, we may do several units of work here.)
+        if patienttables or everything:
+            with _TIMINGS.phase("patient_tables", timer):
+                # With a coordinator, we may be handed many units; find the
+                # patients once, rather than once per unit.
+                all_pids = (
+                    fetch_all_patient_ids()
+                    if coordinator and pids is None
+                    and not config.debug_pid_list
+                    else None
+                )
+                for tasknum, ntasks in gen_work_units(
+                        processcluster, process, nprocesses,
+                        coordinator_address=coordinator,
+                        get_n_rows_written=lambda: config.dest_rows_written):
+                    process_patient_tables(
+                        tasknum=tasknum,
+                        ntasks=ntasks,
+                        incremental=incremental,
+                        specified_pids=pids,
+                        free_text_limit=free_text_limit,
+                        exclude_scrubbed_fields=exclude_scrubbed_fields,
+                        resume=resume,
+                        all_pids=all_pids)
+
+        # 4. Tables without any patient ID (e.g. lookup tables). Process PER
+        #    TABLE.
+        if nonpatienttables or everything:
+            with _TIMINGS.phase("nonpatient_tables", timer):
+                for tasknum, ntasks in gen_work_units(
+                        processcluster, process, nprocesses,
+                        coordinator_address=coordinator,
+                        get_n_rows_written=lambda: config.dest_rows_written):
+                    process_nonpatient_tables(
+                        tasknum=tasknum,
+                        ntasks=ntasks,
+                        incremental=incremental,
+                        free_text_limit=free_text_limit,
+                        exclude_scrubbed_fields=exclude_scrubbed_fields,
+                        resume=resume)
+    finally:
+        shutdown_worker_pool()
+
+    text_extractor = config.text_extractor
+    text_extractor.shutdown()
+    if text_extractor.n_extractions or text_extractor.n_cache_hits:
+        log.info(f"Text extraction: {text_extractor}")
+    if config.scrubber_regex_cache:
+        regex_cache = config.compiled_regex_cache
+        regex_cache.evict()
+        log.info(f"Scrubber regex cache: {regex_cache}")
+    for id_desc, hasher in (("PID", config.primary_pid_hasher),
+                            ("MPID", config.master_pid_hasher)):
+        if isinstance(hasher, CachingHasher):
+            log.info(f"{id_desc} hash cache: {hasher}")
+    commit_admindb()  # e.g. for the text extraction and regex caches
 
     # 5. Indexes. ALWAYS FASTEST TO DO THIS LAST. Process PER TABLE.
     if index or everything:
-        create_indexes(tasknum=process, ntasks=nprocesses)
+        with _TIMINGS.phase("indexes", timer):
+            create_indexes(tasknum=process, ntasks=nprocesses)
 
     log.info(BIGSEP + "Finished")
     end = get_now_utc_pendulum()
     time_taken = end - start
     log.info(f"Time taken: {time_taken.total_seconds()} seconds")
+
+    if timing_json:
+        _TIMINGS.write_json(
+            timing_json.format(process=process,
+                               processcluster=processcluster),
+            timer,
+            processcluster=processcluster,
+            process=process,
+            nprocesses=nprocesses,
+            incremental=incremental,
+            resume=resume)
+    if timing:
+        timer.report()
     # config.dd.debug_cache_hits()
@@ -130,6 +130,12 @@ def inner_main() -> None:
         "--skipdelete", dest="skipdelete", action="store_true",
         help="For incremental updates, skip deletion of rows present in the "
              "destination but not the source")
+    mode_options.add_argument(
+        "--resume", action="store_true",
+        help="Resume a run that was interrupted: don't drop anything, skip "
+             "patients and non-patient table blocks that were completed "
+             "(with the same scrubber and data dictionary), and redo the "
+             "rest")
 
     action_options = parser.add_argument_group(
         "Action options (default is to do all, but if any are specified, "
@@ -193,6 +199,12 @@ def inner_main() -> None:
     processing_options.add_argument(
         "--processcluster", default="",
         help="Process cluster name (used as part of log name)")
+    processing_options.add_argument(
+        "--coordinator",
+        help="For multiprocess mode: address (host:port) of a work "
+             "coordinator from which to fetch units of work, rather than "
+             "dividing work according to --process/--nprocesses (used by "
+             "crate_anonymise_multiprocess --coordinate)")
     processing_options.add_argument(
         "--skip_dd_check", action="store_true",
         help="Skip data dictionary validity check")
@@ -222,6 +234,15 @@ def inner_main() -> None:
              "for debugging")
     debugging_options.add_argument(
         "--echo", action="store_true", help="Echo SQL")
+    debugging_options.add_argument(
+        "--timing", action="store_true",
+        help="Show detailed timing breakdown")
+    debugging_options.add_argument(
+        "--timing_json",
+        help="Write a machine-readable (JSON) summary of time spent per "
+             "phase, per source table, and in the timed parts of the code, "
+             "to this file. Any '{process}' or '{processcluster}' in the "
+             "filename is replaced by the process number or cluster name.")
 
     args = parser.parse_args()
 
@@ -296,6 +317,11 @@ def inner_main() -> None:
         echo=args.echo,
         debugscrubbers=args.debugscrubbers,
         savescrubbers=args.savescrubbers,
+        processcluster=args.processcluster,
+        coordinator=args.coordinator,
+        timing=args.timing,
+        timing_json=args.timing_json,
+        resume=args.resume,
     )
 
 
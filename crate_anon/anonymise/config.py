@@ -102,28 +102,60 @@ from sqlalchemy.dialects.mssql.base import dialect as mssql_dialect
 from sqlalchemy.dialects.mysql.base import dialect as mysql_dialect
 from sqlalchemy.engine.base import Engine
 from sqlalchemy.engine.interfaces import Dialect
+from sqlalchemy.schema import Table
 from sqlalchemy.sql.sqltypes import TypeEngine
 
 from crate_anon.anonymise.constants import (
     ANON_CONFIG_ENV_VAR,
     DEFAULT_CHUNKSIZE,
+    DEFAULT_INDEX_BUILD_CONNECTIONS,
     DEFAULT_REPORT_EVERY,
     DEFAULT_MAX_ROWS_BEFORE_COMMIT,
     DEFAULT_MAX_BYTES_BEFORE_COMMIT,
+    DEFAULT_MAX_BYTES_PER_INSERT_BATCH,
+    DEFAULT_MAX_ROWS_PER_BULK_LOAD,
+    DEFAULT_MAX_ROWS_PER_INSERT_BATCH,
+    DEFAULT_MAX_ROWS_PER_ORPHAN_DELETE,
+    DEFAULT_NONPATIENT_PK_BLOCK_SIZE,
+    DEFAULT_PATIENTS_PER_EXTRACTION_BATCH,
+    DEFAULT_PID_HASH_CACHE_MAX_ENTRIES,
+    DEFAULT_ROWS_PER_WORKER_TASK,
+    DEFAULT_SCRUB_WORKER_PROCESSES,
+    DEFAULT_SCRUBBER_REGEX_CACHE_MAX_ENTRIES,
+    DEFAULT_TEXT_EXTRACTION_CACHE_MAX_CHARS,
+    DEFAULT_TEXT_EXTRACTION_MAX_MEMORY_MB,
+    DEFAULT_TEXT_EXTRACTION_PROCESSES,
+    DEFAULT_TEXT_EXTRACTION_TIMEOUT_S,
+    DEFAULT_THIRDPARTY_XREF_CACHE_MAX_ENTRIES,
     DEMO_CONFIG,
     SEP,
 )
 from crate_anon.anonymise.dd import DataDictionary
+from crate_anon.anonymise.indexing import (
+    IndexBuildOptions,
+    MYSQL_INDEX_ALGORITHMS,
+)
 from crate_anon.anonymise.scrub import (
     NonspecificScrubber,
+    ScrubberRegexCache,
     WordList,
 )
+from crate_anon.anonymise.text_extraction import TextExtractor
+from crate_anon.common.bulk_load import BulkLoader
 from crate_anon.common.constants import RUNNING_WITHOUT_CONFIG
 from crate_anon.common.extendedconfigparser import (
     ConfigSection,
     ExtendedConfigParser,
 )
-from crate_anon.common.sql import TransactionSizeLimiter
+from crate_anon.common.hashing import (
+    make_caching_hasher,
+    make_prekeyed_hasher,
+)
+from crate_anon.common.sql import (
+    BatchedInserter,
+    DEFAULT_FETCH_SIZE,
+    TransactionSizeLimiter,
+)
 
 if TYPE_CHECKING:
     from crate_anon.anonymise.dbholder import DatabaseHolder
@@ -261,6 +293,12 @@ class DatabaseSafeConfig(object):
         self.debug_row_limit = cfg.opt_int('debug_row_limit', 0)
         self.debug_limited_tables = cfg.opt_multiline('debug_limited_tables')
 
+        self.stream_results = cfg.opt_bool('stream_results', False)
+        self.fetch_size = cfg.opt_int('fetch_size', DEFAULT_FETCH_SIZE)
+        if self.fetch_size < 1:
+            raise ValueError(f"fetch_size < 1, nonsensical "
+                             f"(config section [{section}])")
+
         self.ddgen_patient_opt_out_fields = cfg.opt_multiline(
             'ddgen_patient_opt_out_fields')
 
@@ -526,6 +564,8 @@ class Config(object):
         for hasher_name in _extra_hash_config_section_names:
             self.extra_hashers[hasher_name] = get_extra_hasher(parser,
                                                                hasher_name)
+        self.pid_hash_cache_max_entries = cfg.opt_int(
+            'pid_hash_cache_max_entries', DEFAULT_PID_HASH_CACHE_MAX_ENTRIES)
         # Load encryption keys and create hashers
         dummyhash = make_hasher(self.hash_method, "dummysalt")
         encrypted_length = dummyhash.output_length()
@@ -537,18 +577,24 @@ class Config(object):
 
         if not self.per_table_patient_id_encryption_phrase:
             raise ValueError("Missing per_table_patient_id_encryption_phrase")
-        self.primary_pid_hasher = make_hasher(
-            self.hash_method, self.per_table_patient_id_encryption_phrase)
+        self.primary_pid_hasher = make_caching_hasher(
+            make_prekeyed_hasher(make_hasher(
+                self.hash_method,
+                self.per_table_patient_id_encryption_phrase)),
+            max_entries=self.pid_hash_cache_max_entries)
 
         if not self.master_patient_id_encryption_phrase:
             raise ValueError("Missing master_patient_id_encryption_phrase")
-        self.master_pid_hasher = make_hasher(
-            self.hash_method, self.master_patient_id_encryption_phrase)
+        self.master_pid_hasher = make_caching_hasher(
+            make_prekeyed_hasher(make_hasher(
+                self.hash_method,
+                self.master_patient_id_encryption_phrase)),
+            max_entries=self.pid_hash_cache_max_entries)
 
         if not self.change_detection_encryption_phrase:
             raise ValueError("Missing change_detection_encryption_phrase")
-        self.change_detection_hasher = make_hasher(
-            self.hash_method, self.change_detection_encryption_phrase)
+        self.change_detection_hasher = make_prekeyed_hasher(make_hasher(
+            self.hash_method, self.change_detection_encryption_phrase))
 
         # ---------------------------------------------------------------------
         # Text extraction
@@ -562,6 +608,18 @@ class Config(object):
             'extract_text_extensions_prohibited')
         self.extract_text_plain = cfg.opt_bool('extract_text_plain', True)
         self.extract_text_width = cfg.opt_int('extract_text_width', 80)
+        self.text_extraction_processes = cfg.opt_int(
+            'text_extraction_processes', DEFAULT_TEXT_EXTRACTION_PROCESSES)
+        self.text_extraction_timeout_s = cfg.opt_int(
+            'text_extraction_timeout_s', DEFAULT_TEXT_EXTRACTION_TIMEOUT_S)
+        self.text_extraction_max_memory_mb = cfg.opt_int(
+            'text_extraction_max_memory_mb',
+            DEFAULT_TEXT_EXTRACTION_MAX_MEMORY_MB)
+        self.text_extraction_cache = cfg.opt_bool(
+            'text_extraction_cache', False)
+        self.text_extraction_cache_max_chars = cfg.opt_int(
+            'text_extraction_cache_max_chars',
+            DEFAULT_TEXT_EXTRACTION_CACHE_MAX_CHARS)
 
         # ---------------------------------------------------------------------
         # Anonymisation
@@ -593,6 +651,13 @@ class Config(object):
             'anonymise_numbers_at_numeric_boundaries_only', True)
         self.anonymise_strings_at_word_boundaries_only = cfg.opt_bool(
             'anonymise_strings_at_word_boundaries_only', True)
+        self.anonymise_exact_strings_with_flashtext = cfg.opt_bool(
+            'anonymise_exact_strings_with_flashtext', False)
+        self.scrubber_regex_cache = cfg.opt_bool(
+            'scrubber_regex_cache', False)
+        self.scrubber_regex_cache_max_entries = cfg.opt_int(
+            'scrubber_regex_cache_max_entries',
+            DEFAULT_SCRUBBER_REGEX_CACHE_MAX_ENTRIES)
 
         self.scrub_string_suffixes = cfg.opt_multiline('scrub_string_suffixes')
         cfg.require_absent(
@@ -675,8 +740,46 @@ class Config(object):
             'max_rows_before_commit', DEFAULT_MAX_ROWS_BEFORE_COMMIT)
         self.max_bytes_before_commit = cfg.opt_int(
             'max_bytes_before_commit', DEFAULT_MAX_BYTES_BEFORE_COMMIT)
+        self.max_rows_per_insert_batch = cfg.opt_int(
+            'max_rows_per_insert_batch', DEFAULT_MAX_ROWS_PER_INSERT_BATCH)
+        self.max_bytes_per_insert_batch = cfg.opt_int(
+            'max_bytes_per_insert_batch', DEFAULT_MAX_BYTES_PER_INSERT_BATCH)
+        self.bulk_load_full_runs = cfg.opt_bool('bulk_load_full_runs', False)
+        self.max_rows_per_bulk_load = cfg.opt_int(
+            'max_rows_per_bulk_load', DEFAULT_MAX_ROWS_PER_BULK_LOAD)
         self.temporary_tablename = cfg.opt_str(
             'temporary_tablename')
+        self.delete_orphans_by_merge = cfg.opt_bool(
+            'delete_orphans_by_merge', False)
+        self.max_rows_per_orphan_delete = cfg.opt_int(
+            'max_rows_per_orphan_delete', DEFAULT_MAX_ROWS_PER_ORPHAN_DELETE)
+
+        # Source database access
+        self.patients_per_extraction_batch = cfg.opt_int(
+            'patients_per_extraction_batch',
+            DEFAULT_PATIENTS_PER_EXTRACTION_BATCH)
+        self.thirdparty_xref_cache_max_entries = cfg.opt_int(
+            'thirdparty_xref_cache_max_entries',
+            DEFAULT_THIRDPARTY_XREF_CACHE_MAX_ENTRIES)
+        self.nonpatient_pk_block_size = cfg.opt_int(
+            'nonpatient_pk_block_size', DEFAULT_NONPATIENT_PK_BLOCK_SIZE)
+
+        # Worker processes for altering/scrubbing
+        self.scrub_worker_processes = cfg.opt_int(
+            'scrub_worker_processes', DEFAULT_SCRUB_WORKER_PROCESSES)
+        self.rows_per_worker_task = cfg.opt_int(
+            'rows_per_worker_task', DEFAULT_ROWS_PER_WORKER_TASK)
+
+        # Building indexes in the destination database
+        self.index_build_connections = cfg.opt_int(
+            'index_build_connections', DEFAULT_INDEX_BUILD_CONNECTIONS)
+        self.index_build_options = IndexBuildOptions(
+            mssql_online=cfg.opt_bool('mssql_index_online', False),
+            mssql_sort_in_tempdb=cfg.opt_bool('mssql_index_sort_in_tempdb',
+                                              False),
+            mssql_maxdop=cfg.opt_int('mssql_index_maxdop', 0),
+            mysql_algorithm=cfg.opt_str('mysql_index_algorithm'),
+        )
 
         # ---------------------------------------------------------------------
         # Databases
@@ -718,6 +821,21 @@ class Config(object):
                 max_bytes_before_commit=self.max_bytes_before_commit,
                 max_rows_before_commit=self.max_rows_before_commit
             )
+            self._dest_inserter = BatchedInserter(
+                session=self.destdb.session,
+                max_rows_per_batch=self.max_rows_per_insert_batch,
+                max_bytes_per_batch=self.max_bytes_per_insert_batch,
+                insert_on_duplicate=True,
+                transaction_limiter=self._destdb_transaction_limiter
+            )
+            self._dest_bulk_loader = None  # type: Optional[BulkLoader]
+            if self.bulk_load_full_runs and open_databases:
+                self._dest_bulk_loader = BulkLoader(
+                    session=self.destdb.session,
+                    max_rows_per_batch=self.max_rows_per_bulk_load,
+                    replace_duplicates=True,  # as for insert_on_duplicate
+                    transaction_limiter=self._destdb_transaction_limiter
+                )
 
         if RUNNING_WITHOUT_CONFIG:
             self.admindb = None  # type: Optional[DatabaseHolder]
@@ -730,6 +848,9 @@ class Config(object):
             if not self.admindb:
                 raise ValueError("Admin database misconfigured")
 
+        self.text_extractor = TextExtractor(self)
+        self.compiled_regex_cache = ScrubberRegexCache(self)
+
         self.sources = {}  # type: Dict[str, DatabaseHolder]
         self.src_dialects = {}  # type: Dict[str, Dialect]
         for sourcedb_name in source_database_cfg_sections:
@@ -785,6 +906,7 @@ class Config(object):
 
         self._src_bytes_read = 0
         self._dest_bytes_written = 0
+        self._dest_rows_written = 0
         self._echo = False
 
     def get_destdb_engine_outside_transaction(
@@ -825,6 +947,14 @@ class Config(object):
             f"{sizeof_fmt(self._dest_bytes_written)} written"
         )
 
+    @property
+    def dest_rows_written(self) -> int:
+        """
+        The number of rows written (or queued for writing) to the destination
+        database by this process, via :func:`insert_dest_row`.
+        """
+        return self._dest_rows_written
+
     def load_dd(self, check_against_source_db: bool = True) -> None:
         """
         Loads the data dictionary (DD) into the config.
@@ -905,9 +1035,61 @@ class Config(object):
                 "replace_third_party_info_with, and "
                 "replace_nonspecific_info_with should all be distinct")
 
+        # Destination database writes
+        if self.max_rows_per_insert_batch < 1:
+            raise ValueError("max_rows_per_insert_batch < 1, nonsensical")
+        if self.max_bytes_per_insert_batch < 0:
+            raise ValueError("max_bytes_per_insert_batch < 0, nonsensical")
+        if self.max_rows_per_bulk_load < 1:
+            raise ValueError("max_rows_per_bulk_load < 1, nonsensical")
+        if self.max_rows_per_orphan_delete < 1:
+            raise ValueError("max_rows_per_orphan_delete < 1, nonsensical")
+
+        # Source database access
+        if self.patients_per_extraction_batch < 1:
+            raise ValueError("patients_per_extraction_batch < 1, nonsensical")
+        if self.thirdparty_xref_cache_max_entries < 0:
+            raise ValueError(
+                "thirdparty_xref_cache_max_entries < 0, nonsensical")
+        if self.nonpatient_pk_block_size < 0:
+            raise ValueError("nonpatient_pk_block_size < 0, nonsensical")
+
+        # Text extraction
+        if self.text_extraction_processes < 0:
+            raise ValueError("text_extraction_processes < 0, nonsensical")
+        if self.text_extraction_timeout_s < 0:
+            raise ValueError("text_extraction_timeout_s < 0, nonsensical")
+        if self.text_extraction_max_memory_mb < 0:
+            raise ValueError("text_extraction_max_memory_mb < 0, nonsensical")
+        if self.text_extraction_cache_max_chars < 0:
+            raise ValueError(
+                "text_extraction_cache_max_chars < 0, nonsensical")
+
+        # Worker processes for altering/scrubbing
+        if self.scrub_worker_processes < 0:
+            raise ValueError("scrub_worker_processes < 0, nonsensical")
+        if self.rows_per_worker_task < 1:
+            raise ValueError("rows_per_worker_task < 1, nonsensical")
+
+        # Building indexes in the destination database
+        if self.index_build_connections < 1:
+            raise ValueError("index_build_connections < 1, nonsensical")
+        if self.index_build_options.mssql_maxdop < 0:
+            raise ValueError("mssql_index_maxdop < 0, nonsensical")
+        if (self.index_build_options.mysql_algorithm not in
+                MYSQL_INDEX_ALGORITHMS):
+            raise ValueError(
+                f"mysql_index_algorithm must be one of "
+                f"{MYSQL_INDEX_ALGORITHMS[1:]}, or blank")
+
         # Regex
+        if self.pid_hash_cache_max_entries < 0:
+            raise ValueError("pid_hash_cache_max_entries < 0, nonsensical")
         if self.string_max_regex_errors < 0:
             raise ValueError("string_max_regex_errors < 0, nonsensical")
+        if self.scrubber_regex_cache_max_entries < 0:
+            raise ValueError(
+                "scrubber_regex_cache_max_entries < 0, nonsensical")
         if self.min_string_length_for_errors < 1:
             raise ValueError("min_string_length_for_errors < 1, nonsensical")
         if self.min_string_length_to_scrub_with < 1:
@@ -1030,8 +1212,10 @@ class Config(object):
 
     def commit_dest_db(self) -> None:
         """
-        Executes a ``COMMIT`` on the destination database.
+        Writes any buffered destination rows, then executes a ``COMMIT`` on
+        the destination database.
         """
+        self.flush_dest_rows()
         self._destdb_transaction_limiter.commit()
 
     def notify_src_bytes_read(self, n_bytes: int) -> None:
@@ -1057,10 +1241,50 @@ class Config(object):
             n_rows: the number of rows written
             n_bytes: the number of bytes written
         """
+        self.flush_dest_rows()
         self._destdb_transaction_limiter.notify(n_rows=n_rows, n_bytes=n_bytes)
         # ... may trigger a commit
         self._dest_bytes_written += n_bytes
 
+    def flush_dest_rows(self) -> None:
+        """
+        Writes any buffered destination rows (without committing).
+        """
+        self._dest_inserter.flush()
+        if self._dest_bulk_loader:
+            self._dest_bulk_loader.flush()
+
+    def insert_dest_row(self, sqla_table: Table,
+                        values: Dict[str, Any],
+                        full_run: bool = False) -> None:
+        """
+        Inserts (or, under MySQL, upserts) a row into a destination table.
+
+        The row may be buffered and written later as part of a multi-row batch;
+        see the ``max_rows_per_insert_batch`` and ``max_bytes_per_insert_batch``
+        config options, and
+        :class:`crate_anon.common.sql.BatchedInserter`. For full
+        (non-incremental) runs, the ``bulk_load_full_runs`` option may say to
+        use a :class:`crate_anon.common.bulk_load.BulkLoader` instead. Batches
+        are counted towards our
+        :class:`crate_anon.common.sql.TransactionSizeLimiter` as they are
+        written, and are always written before a ``COMMIT`` via
+        :func:`commit_dest_db`.
+
+        Args:
+            sqla_table: SQLAlchemy Table for the destination table
+            values: dictionary mapping column names to values
+            full_run: is this part of a full (non-incremental) run?
+        """
+        n_bytes = sys.getsizeof(values)  # ... approximate!
+        # ... quicker than e.g. len(repr(...)), as judged by a timeit() call.
+        if full_run and self._dest_bulk_loader:
+            self._dest_bulk_loader.insert(sqla_table, values, n_bytes=n_bytes)
+        else:
+            self._dest_inserter.insert(sqla_table, values, n_bytes=n_bytes)
+        self._dest_bytes_written += n_bytes
+        self._dest_rows_written += 1
+
     def extract_text_extension_permissible(self, extension: str) -> bool:
         """
         Is this file extension (e.g. ``.doc``, ``.txt``) one that the config
@@ -72,6 +72,7 @@ DEFAULT_CHUNKSIZE = 100000  # 100k
 # =============================================================================
 
 ANON_CONFIG_ENV_VAR = 'CRATE_ANON_CONFIG'
+COORDINATOR_AUTHKEY_ENV_VAR = 'CRATE_ANON_COORDINATOR_AUTHKEY'
 
 
 # =============================================================================
@@ -79,9 +80,25 @@ ANON_CONFIG_ENV_VAR = 'CRATE_ANON_CONFIG'
 # =============================================================================
 
 DATEFORMAT_ISO8601 = "%Y-%m-%dT%H:%M:%S%z"  # e.g. 2013-07-24T20:04:07+0100
+DEFAULT_INDEX_BUILD_CONNECTIONS = 1  # i.e. one index at a time
 DEFAULT_INDEX_LEN = 20  # for data types where it's mandatory
 DEFAULT_MAX_ROWS_BEFORE_COMMIT = 1000
 DEFAULT_MAX_BYTES_BEFORE_COMMIT = 80 * 1024 * 1024
+DEFAULT_MAX_ROWS_PER_INSERT_BATCH = 1  # i.e. one INSERT per row
+DEFAULT_MAX_BYTES_PER_INSERT_BATCH = 0  # i.e. no byte limit
+DEFAULT_MAX_ROWS_PER_BULK_LOAD = 10000
+DEFAULT_MAX_ROWS_PER_ORPHAN_DELETE = 1000
+DEFAULT_PATIENTS_PER_EXTRACTION_BATCH = 1  # i.e. one patient at a time
+DEFAULT_NONPATIENT_PK_BLOCK_SIZE = 100000  # 100k PK values
+DEFAULT_PID_HASH_CACHE_MAX_ENTRIES = 100000
+DEFAULT_THIRDPARTY_XREF_CACHE_MAX_ENTRIES = 10000
+DEFAULT_SCRUB_WORKER_PROCESSES = 0  # i.e. alter/scrub in the main process
+DEFAULT_ROWS_PER_WORKER_TASK = 100
+DEFAULT_SCRUBBER_REGEX_CACHE_MAX_ENTRIES = 10000
+DEFAULT_TEXT_EXTRACTION_PROCESSES = 0  # i.e. extract text in this process
+DEFAULT_TEXT_EXTRACTION_TIMEOUT_S = 0  # i.e. no time limit
+DEFAULT_TEXT_EXTRACTION_MAX_MEMORY_MB = 0  # i.e. no memory limit
+DEFAULT_TEXT_EXTRACTION_CACHE_MAX_CHARS = 1000000
 
 LONGTEXT = "LONGTEXT"
 
@@ -224,6 +241,8 @@ change_detection_encryption_phrase = YETANOTHER
 
 extra_hash_config_sections =
 
+pid_hash_cache_max_entries = {DEFAULT_PID_HASH_CACHE_MAX_ENTRIES}
+
 # -----------------------------------------------------------------------------
 # Text extraction
 # -----------------------------------------------------------------------------
@@ -236,6 +255,12 @@ extract_text_plain = False
 
 extract_text_width = 80
 
+text_extraction_processes = {DEFAULT_TEXT_EXTRACTION_PROCESSES}
+text_extraction_timeout_s = {DEFAULT_TEXT_EXTRACTION_TIMEOUT_S}
+text_extraction_max_memory_mb = {DEFAULT_TEXT_EXTRACTION_MAX_MEMORY_MB}
+text_extraction_cache = False
+text_extraction_cache_max_chars = {DEFAULT_TEXT_EXTRACTION_CACHE_MAX_CHARS}
+
 # -----------------------------------------------------------------------------
 # Anonymisation
 # -----------------------------------------------------------------------------
@@ -272,6 +297,10 @@ anonymise_dates_at_word_boundaries_only = True
 anonymise_numbers_at_word_boundaries_only = False
 anonymise_numbers_at_numeric_boundaries_only = True
 anonymise_strings_at_word_boundaries_only = True
+anonymise_exact_strings_with_flashtext = False
+
+scrubber_regex_cache = False
+scrubber_regex_cache_max_entries = {DEFAULT_SCRUBBER_REGEX_CACHE_MAX_ENTRIES}
 
 # -----------------------------------------------------------------------------
 # Output fields and formatting
@@ -294,8 +323,14 @@ ddgen_append_source_info_to_comment = True
 
 max_rows_before_commit = {DEFAULT_MAX_ROWS_BEFORE_COMMIT}
 max_bytes_before_commit = {DEFAULT_MAX_BYTES_BEFORE_COMMIT}
+max_rows_per_insert_batch = {DEFAULT_MAX_ROWS_PER_INSERT_BATCH}
+max_bytes_per_insert_batch = {DEFAULT_MAX_BYTES_PER_INSERT_BATCH}
+bulk_load_full_runs = False
+max_rows_per_bulk_load = {DEFAULT_MAX_ROWS_PER_BULK_LOAD}
 
 temporary_tablename = _temp_table
+delete_orphans_by_merge = False
+max_rows_per_orphan_delete = {DEFAULT_MAX_ROWS_PER_ORPHAN_DELETE}
 
 # -----------------------------------------------------------------------------
 # Choose databases (defined in their own sections).
@@ -309,6 +344,31 @@ destination_database = my_destination_database
 
 admin_database = my_admin_database
 
+# -----------------------------------------------------------------------------
+# Source database access
+# -----------------------------------------------------------------------------
+
+patients_per_extraction_batch = {DEFAULT_PATIENTS_PER_EXTRACTION_BATCH}
+thirdparty_xref_cache_max_entries = {DEFAULT_THIRDPARTY_XREF_CACHE_MAX_ENTRIES}
+nonpatient_pk_block_size = {DEFAULT_NONPATIENT_PK_BLOCK_SIZE}
+
+# -----------------------------------------------------------------------------
+# Worker processes for altering/scrubbing, within each anonymiser process
+# -----------------------------------------------------------------------------
+
+scrub_worker_processes = {DEFAULT_SCRUB_WORKER_PROCESSES}
+rows_per_worker_task = {DEFAULT_ROWS_PER_WORKER_TASK}
+
+# -----------------------------------------------------------------------------
+# Building indexes in the destination database
+# -----------------------------------------------------------------------------
+
+index_build_connections = {DEFAULT_INDEX_BUILD_CONNECTIONS}
+mssql_index_online = False
+mssql_index_sort_in_tempdb = False
+mssql_index_maxdop = 0
+mysql_index_algorithm =
+
 # -----------------------------------------------------------------------------
 # PROCESSING OPTIONS, TO LIMIT DATA QUANTITY FOR TESTING
 # -----------------------------------------------------------------------------
@@ -455,6 +515,13 @@ ddgen_convert_odd_chars_to_underscore = True
 debug_row_limit =
 debug_limited_tables =
 
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # READING FROM THE SOURCE DATABASE
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+stream_results = False
+fetch_size = 1000
+
 # -----------------------------------------------------------------------------
 # Source database example 2
 # -----------------------------------------------------------------------------
@@ -630,6 +697,22 @@ ddgen_binary_to_text_field_pairs =
     LONGTEXT=LONGTEXT,
     DEFAULT_MAX_ROWS_BEFORE_COMMIT=DEFAULT_MAX_ROWS_BEFORE_COMMIT,
     DEFAULT_MAX_BYTES_BEFORE_COMMIT=DEFAULT_MAX_BYTES_BEFORE_COMMIT,
+    DEFAULT_MAX_ROWS_PER_INSERT_BATCH=DEFAULT_MAX_ROWS_PER_INSERT_BATCH,
+    DEFAULT_MAX_BYTES_PER_INSERT_BATCH=DEFAULT_MAX_BYTES_PER_INSERT_BATCH,
+    DEFAULT_MAX_ROWS_PER_BULK_LOAD=DEFAULT_MAX_ROWS_PER_BULK_LOAD,
+    DEFAULT_MAX_ROWS_PER_ORPHAN_DELETE=DEFAULT_MAX_ROWS_PER_ORPHAN_DELETE,
+    DEFAULT_PATIENTS_PER_EXTRACTION_BATCH=DEFAULT_PATIENTS_PER_EXTRACTION_BATCH,  # noqa
+    DEFAULT_NONPATIENT_PK_BLOCK_SIZE=DEFAULT_NONPATIENT_PK_BLOCK_SIZE,
+    DEFAULT_PID_HASH_CACHE_MAX_ENTRIES=DEFAULT_PID_HASH_CACHE_MAX_ENTRIES,
+    DEFAULT_THIRDPARTY_XREF_CACHE_MAX_ENTRIES=DEFAULT_THIRDPARTY_XREF_CACHE_MAX_ENTRIES,  # noqa
+    DEFAULT_SCRUB_WORKER_PROCESSES=DEFAULT_SCRUB_WORKER_PROCESSES,
+    DEFAULT_ROWS_PER_WORKER_TASK=DEFAULT_ROWS_PER_WORKER_TASK,
+    DEFAULT_SCRUBBER_REGEX_CACHE_MAX_ENTRIES=DEFAULT_SCRUBBER_REGEX_CACHE_MAX_ENTRIES,  # noqa
+    DEFAULT_INDEX_BUILD_CONNECTIONS=DEFAULT_INDEX_BUILD_CONNECTIONS,
+    DEFAULT_TEXT_EXTRACTION_PROCESSES=DEFAULT_TEXT_EXTRACTION_PROCESSES,
+    DEFAULT_TEXT_EXTRACTION_TIMEOUT_S=DEFAULT_TEXT_EXTRACTION_TIMEOUT_S,
+    DEFAULT_TEXT_EXTRACTION_MAX_MEMORY_MB=DEFAULT_TEXT_EXTRACTION_MAX_MEMORY_MB,  # noqa
+    DEFAULT_TEXT_EXTRACTION_CACHE_MAX_CHARS=DEFAULT_TEXT_EXTRACTION_CACHE_MAX_CHARS,  # noqa
     DECISION=DECISION,
     VERSION=CRATE_VERSION,
     VERSION_DATE=CRATE_VERSION_DATE,
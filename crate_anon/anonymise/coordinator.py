@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+
+"""
+crate_anon/anonymise/coordinator.py
+
+===============================================================================
+
+    Copyright (C) 2015-2021 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+**Dynamic allocation of work to anonymiser processes.**
+
+Normally, each of ``n`` anonymiser processes takes a fixed share of the work:
+process ``k`` handles the patients for which ``pid % n == k``, and the
+non-patient table rows for which ``pk % n == k``. If one share takes much
+longer than the others (e.g. because it contains a patient with a huge
+record), the other processes sit idle at the end of the run.
+
+Instead, the work can be divided into many more "work units" than there are
+processes (unit ``k`` of ``m`` being exactly the share that process ``k`` of
+``m`` would have had), and a coordinator (in the launching process) can hand
+out units one at a time, from a queue, to whichever process is idle. The
+coordinator is served on a local socket by a
+:class:`multiprocessing.managers.BaseManager`, and also keeps track of each
+process's throughput, and of which units have been finished (so that the
+launcher can tell if any work was lost, e.g. to a process that crashed).
+
+"""
+
+import binascii
+import logging
+import os
+import threading
+import time
+from collections import deque
+from multiprocessing.managers import BaseManager
+from typing import Callable, Deque, Dict, Generator, List, Optional, Tuple
+
+from crate_anon.anonymise.constants import COORDINATOR_AUTHKEY_ENV_VAR
+
+log = logging.getLogger(__name__)
+
+
+# =============================================================================
+# Work units and their coordinator
+# =============================================================================
+
+class WorkerStats(object):
+    """
+    Progress of one anonymiser process, as reported to the
+    :class:`WorkCoordinator`.
+    """
+    def __init__(self) -> None:
+        self.first_unit_start = None  # type: Optional[float]
+        self.n_units_done = 0
+        self.n_rows_written = 0
+        self.current_unit = None  # type: Optional[int]
+
+    def rows_per_second(self, now: float) -> float:
+        """
+        Mean number of destination rows written per second, since this
+        process took its first unit.
+        """
+        if self.first_unit_start is None or now <= self.first_unit_start:
+            return 0.0
+        return self.n_rows_written / (now - self.first_unit_start)
+
+
+class WorkCoordinator(object):
+    """
+    Hands out work units, for one or more "clusters" of anonymiser processes
+    (e.g. ``PATIENT``, ``NONPATIENT``), to whichever process asks next.
+
+    Each unit is a tuple ``unitnum, nunits``, to be used as the ``tasknum,
+    ntasks`` arguments to the normal anonymiser functions.
+
+    This object lives in the launching process; anonymiser processes talk to
+    it via a proxy (see :func:`serve_coordinator` and
+    :func:`connect_to_coordinator`). Its methods are thread-safe.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._queues = {}  # type: Dict[str, Deque[int]]
+        self._nunits = {}  # type: Dict[str, int]
+        self._stats = {}  # type: Dict[Tuple[str, int], WorkerStats]
+        self._stop_reports = threading.Event()
+
+    def add_units(self, cluster: str, nunits: int) -> None:
+        """
+        Queues up all the work units (numbered ``0`` to ``nunits - 1``) for a
+        cluster of processes.
+        """
+        with self._lock:
+            self._queues[cluster] = deque(range(nunits))
+            self._nunits[cluster] = nunits
+
+    def next_unit(self, cluster: str,
+                  worker: int) -> Optional[Tuple[int, int]]:
+        """
+        Called by an anonymiser process when it is ready for more work.
+
+        Args:
+            cluster: the process cluster name
+            worker: the process number, within its cluster
+
+        Returns:
+            a tuple ``unitnum, nunits``, or ``None`` if there's no more work
+        """
+        with self._lock:
+            stats = self._stats.setdefault((cluster, worker), WorkerStats())
+            if stats.first_unit_start is None:
+                stats.first_unit_start = time.time()
+            queue = self._queues.get(cluster)
+            if not queue:
+                stats.current_unit = None
+                return None
+            unitnum = queue.popleft()
+            stats.current_unit = unitnum
+            return unitnum, self._nunits[cluster]
+
+    def unit_done(self, cluster: str, worker: int,
+                  n_rows_written: int) -> None:
+        """
+        Called by an anonymiser process when it has finished its current unit.
+
+        Args:
+            cluster: the process cluster name
+            worker: the process number, within its cluster
+            n_rows_written: number of destination rows written for the unit
+        """
+        with self._lock:
+            stats = self._stats.setdefault((cluster, worker), WorkerStats())
+            stats.n_units_done += 1
+            stats.n_rows_written += n_rows_written
+            stats.current_unit = None
+
+    def progress_report(self) -> str:
+        """
+        Returns a (multi-line) description of progress so far.
+        """
+        now = time.time()
+        lines = []
+        with self._lock:
+            for cluster in sorted(self._queues.keys()):
+                lines.append(
+                    f"{cluster}: {len(self._queues[cluster])} of "
+                    f"{self._nunits[cluster]} work units not yet started")
+            for (cluster, worker), stats in sorted(self._stats.items()):
+                current = (
+                    f"on unit {stats.current_unit}"
+                    if stats.current_unit is not None else "idle/finished"
+                )
+                lines.append(
+                    f"... {cluster} process {worker}: "
+                    f"{stats.n_units_done} units done, "
+                    f"{stats.n_rows_written} rows written "
+                    f"({stats.rows_per_second(now):.1f} rows/s), {current}")
+        return "\n".join(lines)
+
+    def get_unfinished_units(self) -> List[Tuple[str, int]]:
+        """
+        Returns the work units, as tuples ``cluster, unitnum``, that have not
+        been finished: those not yet handed out, and those handed out but not
+        reported as done (e.g. because the process working on them crashed).
+        """
+        with self._lock:
+            unfinished = [
+                (cluster, unitnum)
+                for cluster, queue in self._queues.items()
+                for unitnum in queue
+            ] + [
+                (cluster, stats.current_unit)
+                for (cluster, _), stats in self._stats.items()
+                if stats.current_unit is not None
+            ]
+        return sorted(unfinished)
+
+    def start_progress_reports(self, interval_s: float) -> None:
+        """
+        Starts a background thread that logs our progress report every
+        ``interval_s`` seconds, until :meth:`stop_progress_reports` is called.
+        """
+        def report() -> None:
+            while not self._stop_reports.wait(interval_s):
+                log.info(f"Progress:\n{self.progress_report()}")
+
+        threading.Thread(target=report, daemon=True).start()
+
+    def stop_progress_reports(self) -> None:
+        """
+        Stops the reports started by :meth:`start_progress_reports`.
+        """
+        self._stop_reports.set()
+
+
+# =============================================================================
+# Serving the coordinator, and connecting to it
+# =============================================================================
+
+class _CoordinatorServerManager(BaseManager):
+    """
+    Manager that serves our :class:`WorkCoordinator`.
+    """
+    pass
+
+
+class _CoordinatorClientManager(BaseManager):
+    """
+    Manager that connects to a :class:`_CoordinatorServerManager`.
+    """
+    pass
+
+
+_CoordinatorClientManager.register("get_coordinator")
+
+
+def serve_coordinator(coordinator: WorkCoordinator) -> str:
+    """
+    Serves a :class:`WorkCoordinator` on a local socket, from a background
+    thread of this process.
+
+    A random authentication key is generated and placed in the environment
+    variable ``CRATE_ANON_COORDINATOR_AUTHKEY``, so that child processes
+    inherit it.
+
+    Returns:
+        the address, as ``host:port``, to pass to the anonymiser processes
+    """
+    authkey = os.urandom(32)
+    os.environ[COORDINATOR_AUTHKEY_ENV_VAR] = binascii.hexlify(
+        authkey).decode("ascii")
+    _CoordinatorServerManager.register("get_coordinator",
+                                       callable=lambda: coordinator)
+    manager = _CoordinatorServerManager(address=("127.0.0.1", 0),
+                                        authkey=authkey)
+    server = manager.get_server()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.address
+    log.info(f"Work coordinator listening on {host}:{port}")
+    return f"{host}:{port}"
+
+
+def connect_to_coordinator(address: str) -> WorkCoordinator:
+    """
+    Connects to a :class:`WorkCoordinator` served by
+    :func:`serve_coordinator`, using the authentication key from the
+    environment.
+
+    Args:
+        address: ``host:port``
+
+    Returns:
+        a proxy for the coordinator
+    """
+    host, port = address.rsplit(":", 1)
+    authkey_hex = os.environ.get(COORDINATOR_AUTHKEY_ENV_VAR)
+    if not authkey_hex:
+        raise ValueError(f"Environment variable {COORDINATOR_AUTHKEY_ENV_VAR} "
+                         f"not set; can't connect to work coordinator")
+    manager = _CoordinatorClientManager(
+        address=(host, int(port)),
+        authkey=binascii.unhexlify(authkey_hex))
+    manager.connect()
+    # noinspection PyUnresolvedReferences
+    return manager.get_coordinator()
+
+
+def gen_work_units(cluster: str,
+                   process: int,
+                   nprocesses: int,
+                   coordinator_address: str = None,
+                   get_n_rows_written: Callable[[], int] = None) \
+        -> Generator[Tuple[int, int], None, None]:
+    """
+    Generates the work for an anonymiser process, as tuples ``tasknum,
+    ntasks``.
+
+    Without a coordinator, that is just our static share, ``process,
+    nprocesses``. With one, we ask it for units until there are none left,
+    telling it when we've finished each one.
+
+    Args:
+        cluster: the process cluster name, e.g. ``PATIENT``
+        process: our process number, within the cluster
+        nprocesses: number of processes in the cluster
+        coordinator_address: ``host:port`` of the coordinator, or ``None``
+        get_n_rows_written: function returning the total number of
+            destination rows this process has written (for reporting
+            throughput to the coordinator)
+    """
+    if not coordinator_address:
+        yield process, nprocesses
+        return
+    coordinator = connect_to_coordinator(coordinator_address)
+    while True:
+        unit = coordinator.next_unit(cluster, process)
+        if unit is None:
+            return
+        unitnum, nunits = unit
+        log.info(f"Work unit {unitnum} (numbered from zero) of {nunits}")
+        rows_before = get_n_rows_written() if get_n_rows_written else 0
+        yield unitnum, nunits
+        rows_after = get_n_rows_written() if get_n_rows_written else 0
+        coordinator.unit_done(cluster, process, rows_after - rows_before)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+"""
+crate_anon/anonymise/indexing.py
+
+===============================================================================
+
+    Copyright (C) 2015-2021 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+**Building indexes on the destination database.**
+
+The indexes for each destination table are built one after another (two index
+builds on the same table would usually block each other anyway), but
+different tables can be indexed at the same time, each on its own database
+connection. The largest tables are started first, so that the longest builds
+don't end up running on their own at the end.
+
+Some databases also accept options that make a single index build faster,
+such as ``SORT_IN_TEMPDB`` and ``MAXDOP`` for SQL Server; see
+:class:`IndexBuildOptions`.
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+from typing import Callable, List, Optional, Tuple
+
+from cardinal_pythonlib.sqlalchemy.core_query import count_star
+from cardinal_pythonlib.sqlalchemy.dialect import SqlaDialectName
+from cardinal_pythonlib.sqlalchemy.schema import add_index, index_exists
+from sqlalchemy.engine.base import Engine
+from sqlalchemy.schema import Column, CreateIndex, DDL, Index
+from sqlalchemy.sql import text
+
+log = logging.getLogger(__name__)
+
+MYSQL_INDEX_ALGORITHMS = ("", "DEFAULT", "INPLACE", "COPY")
+
+
+# =============================================================================
+# IndexBuildOptions
+# =============================================================================
+
+class IndexBuildOptions(object):
+    """
+    Database-specific options for building (normal or unique, but not
+    full-text) indexes.
+    """
+    def __init__(self,
+                 mssql_online: bool = False,
+                 mssql_sort_in_tempdb: bool = False,
+                 mssql_maxdop: int = 0,
+                 mysql_algorithm: str = "") -> None:
+        """
+        Args:
+            mssql_online:
+                SQL Server: build indexes with ``ONLINE = ON`` (which requires
+                the Enterprise edition)?
+            mssql_sort_in_tempdb:
+                SQL Server: build indexes with ``SORT_IN_TEMPDB = ON``?
+            mssql_maxdop:
+                SQL Server: if non-zero, the maximum number of processors to
+                use for each index build (``MAXDOP``).
+            mysql_algorithm:
+                MySQL: if specified, the ``ALGORITHM`` to use (``DEFAULT``,
+                ``INPLACE``, or ``COPY``).
+        """
+        self.mssql_online = mssql_online
+        self.mssql_sort_in_tempdb = mssql_sort_in_tempdb
+        self.mssql_maxdop = mssql_maxdop
+        self.mysql_algorithm = (mysql_algorithm or "").upper()
+
+    def get_sql_suffix(self, dialect_name: str) -> str:
+        """
+        Returns the SQL to append to ``CREATE INDEX`` for our options, for the
+        given SQLAlchemy dialect (or a blank string if there is none).
+        """
+        if dialect_name == SqlaDialectName.MSSQL:
+            options = []  # type: List[str]
+            if self.mssql_online:
+                options.append("ONLINE = ON")
+            if self.mssql_sort_in_tempdb:
+                options.append("SORT_IN_TEMPDB = ON")
+            if self.mssql_maxdop:
+                options.append(f"MAXDOP = {self.mssql_maxdop}")
+            if options:
+                return f" WITH ({', '.join(options)})"
+        elif dialect_name == SqlaDialectName.MYSQL:
+            if self.mysql_algorithm:
+                return f" ALGORITHM = {self.mysql_algorithm}"
+        return ""
+
+
+# =============================================================================
+# IndexJob, TableIndexJobs
+# =============================================================================
+
+class IndexJob(object):
+    """
+    An index to build. The arguments are as for
+    :func:`cardinal_pythonlib.sqlalchemy.schema.add_index`.
+    """
+    def __init__(self,
+                 sqla_column: Column = None,
+                 multiple_sqla_columns: List[Column] = None,
+                 unique: bool = False,
+                 fulltext: bool = False,
+                 length: int = None) -> None:
+        self.sqla_column = sqla_column
+        self.multiple_sqla_columns = multiple_sqla_columns
+        self.unique = unique
+        self.fulltext = fulltext
+        self.length = length
+        columns = ([sqla_column] if sqla_column is not None
+                   else multiple_sqla_columns)
+        self.tablename = columns[0].table.name
+        self.colnames = [c.name for c in columns]
+
+    def __str__(self) -> str:
+        kind = (" (full-text)" if self.fulltext
+                else " (unique)" if self.unique else "")
+        return f"{self.tablename}({', '.join(self.colnames)}){kind}"
+
+    def build(self, engine: Engine,
+              options: IndexBuildOptions = None) -> None:
+        """
+        Builds the index, unless it exists already.
+
+        Args:
+            engine: SQLAlchemy :class:`Engine` for the destination database,
+                not using transactions
+            options: any database-specific options
+        """
+        suffix = (options.get_sql_suffix(engine.dialect.name) if options
+                  else "")
+        if self.fulltext or not suffix:
+            add_index(engine=engine,
+                      sqla_column=self.sqla_column,
+                      multiple_sqla_columns=self.multiple_sqla_columns,
+                      unique=self.unique,
+                      fulltext=self.fulltext,
+                      length=self.length)
+            return
+        # As for add_index(), but with our options:
+        idxname = f"_idx_{self.sqla_column.name}"
+        if index_exists(engine, self.tablename, idxname):
+            log.info(f"Skipping creation of index {idxname} on "
+                     f"table {self.tablename}; already exists")
+            return
+        index = Index(idxname, self.sqla_column, unique=self.unique,
+                      mysql_length=self.length)
+        sql = str(CreateIndex(index).compile(dialect=engine.dialect)) + suffix
+        log.info(f"Creating index {idxname} on table {self.tablename}, "
+                 f"column {self.sqla_column.name}: {sql}")
+        DDL(sql, bind=engine).execute()
+
+
+class TableIndexJobs(object):
+    """
+    The indexes to build for one destination table, which we build one after
+    another, in order.
+    """
+    def __init__(self, tablename: str, jobs: List[IndexJob],
+                 n_rows: int = 0) -> None:
+        """
+        Args:
+            tablename: destination table name
+            jobs: the indexes to build
+            n_rows: (approximate) number of rows in the table, used to
+                decide which tables to index first
+        """
+        self.tablename = tablename
+        self.jobs = jobs
+        self.n_rows = n_rows
+
+
+# =============================================================================
+# Planning and building
+# =============================================================================
+
+def get_approx_n_rows(engine: Engine, tablename: str) -> int:
+    """
+    Returns the approximate number of rows in a table, from the database's
+    statistics if we know how to read them (which is much quicker than
+    counting), or by counting them otherwise.
+    """
+    dialect_name = engine.dialect.name
+    n = None  # type: Optional[int]
+    if dialect_name == SqlaDialectName.MYSQL:
+        n = engine.execute(text(
+            "SELECT table_rows FROM information_schema.tables "
+            "WHERE table_schema = DATABASE() AND table_name = :tablename"
+        ), tablename=tablename).scalar()
+    elif dialect_name == SqlaDialectName.MSSQL:
+        n = engine.execute(text(
+            "SELECT SUM(rows) FROM sys.partitions "
+            "WHERE object_id = OBJECT_ID(:tablename) AND index_id IN (0, 1)"
+        ), tablename=tablename).scalar()
+    elif dialect_name == SqlaDialectName.POSTGRES:
+        n = engine.execute(text(
+            "SELECT reltuples FROM pg_class WHERE relname = :tablename"
+        ), tablename=tablename).scalar()
+        # ... -1 if the table has never been analysed
+        if n is not None and n < 0:
+            n = None
+    if n is None:
+        n = count_star(engine, tablename)
+    return int(n)
+
+
+def build_indexes(
+        tables: List[TableIndexJobs],
+        engine_factory: Callable[[], Engine],
+        n_connections: int = 1,
+        options: IndexBuildOptions = None) -> List[Tuple[IndexJob, float]]:
+    """
+    Builds indexes: those for the largest table first, and those for
+    different tables concurrently, on up to ``n_connections`` database
+    connections.
+
+    Args:
+        tables: the indexes to build, by table
+        engine_factory: function returning a new SQLAlchemy :class:`Engine`
+            for the destination database, not using transactions; we use one
+            per table, and dispose of it afterwards
+        n_connections: maximum number of tables to index at once
+        options: any database-specific options
+
+    Returns:
+        a list of tuples ``job, seconds`` (the time taken to build each
+        index), table by table, largest table first
+    """
+
+    def build_table(t: TableIndexJobs) -> List[Tuple[IndexJob, float]]:
+        timings = []  # type: List[Tuple[IndexJob, float]]
+        engine = engine_factory()
+        try:
+            for job in t.jobs:
+                start = time.perf_counter()
+                job.build(engine, options)
+                seconds = time.perf_counter() - start
+                log.info(f"Index on {job}: {seconds:.3f} s")
+                timings.append((job, seconds))
+        finally:
+            engine.dispose()
+        return timings
+
+    tables = sorted(tables, key=lambda t: t.n_rows, reverse=True)
+    log.info(f"Building indexes for {len(tables)} table(s), using up to "
+             f"{n_connections} connection(s)")
+    results = []  # type: List[Tuple[IndexJob, float]]
+    if n_connections <= 1:
+        for table in tables:
+            results.extend(build_table(table))
+    else:
+        # Threads are fine: the work is done by the database.
+        with ThreadPoolExecutor(max_workers=n_connections) as executor:
+            # The executor starts tasks in the order submitted, so each
+            # connection that becomes free moves on to the largest remaining
+            # table.
+            futures = [executor.submit(build_table, table)
+                       for table in tables]
+            for future in futures:
+                results.extend(future.result())
+    return results
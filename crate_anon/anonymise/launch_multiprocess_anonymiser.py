@@ -55,6 +55,10 @@ from cardinal_pythonlib.subproc import (
     run_multiple_processes,
 )
 
+from crate_anon.anonymise.coordinator import (
+    serve_coordinator,
+    WorkCoordinator,
+)
 from crate_anon.version import CRATE_VERSION, CRATE_VERSION_DATE
 
 log = logging.getLogger(__name__)
@@ -62,6 +66,8 @@ log = logging.getLogger(__name__)
 ANONYMISER = 'crate_anon.anonymise.anonymise_cli'
 
 CPUCOUNT = multiprocessing.cpu_count()
+DEFAULT_UNITS_PER_PROCESS = 10
+DEFAULT_PROGRESS_INTERVAL_S = 60
 
 
 # =============================================================================
@@ -84,6 +90,23 @@ def main() -> None:
         "--nproc", "-n", nargs="?", type=int, default=CPUCOUNT,
         help="Number of processes "
              "(default is the number of CPUs on this machine)")
+    parser.add_argument(
+        "--coordinate", action="store_true",
+        help="Hand out work to the patient/non-patient processes dynamically, "
+             "in small units, as each process becomes free (rather than "
+             "giving each process a fixed share at the start)")
+    parser.add_argument(
+        "--units_per_process", type=int, default=DEFAULT_UNITS_PER_PROCESS,
+        help="With --coordinate: number of work units per process")
+    parser.add_argument(
+        "--progress_interval", type=float,
+        default=DEFAULT_PROGRESS_INTERVAL_S,
+        help="With --coordinate: interval (in seconds) at which to report "
+             "each process's progress")
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="Resume a run that was interrupted, skipping work that was "
+             "completed (passed to every stage; see crate_anonymise --help)")
     parser.add_argument(
         '--verbose', '-v', action='store_true',
         help="Be verbose")
@@ -93,7 +116,11 @@ def main() -> None:
     rootlogger = logging.getLogger()
     configure_logger_for_colour(rootlogger, level=loglevel)
 
-    common_options = ["-v"] * (1 if args.verbose else 0) + unknownargs
+    common_options = (
+        ["-v"] * (1 if args.verbose else 0) +
+        ["--resume"] * (1 if args.resume else 0) +
+        unknownargs
+    )
 
     log.debug(f"common_options: {common_options}")
 
@@ -142,6 +169,20 @@ def main() -> None:
     # won't fly (for n processes it wants to see processes numbered from 0 to
     # n - 1 inclusive).
 
+    # If we're coordinating, processes fetch units of work (each unit being
+    # "task k of m", for some m that's bigger than the number of processes)
+    # from us as they go.
+    coordinator = WorkCoordinator() if args.coordinate else None
+    coordinator_options = []  # type: List[str]
+    if coordinator is not None:
+        coordinator.add_units(
+            "PATIENT", nprocesses_patient * args.units_per_process)
+        coordinator.add_units(
+            "NONPATIENT", nprocesses_nonpatient * args.units_per_process)
+        address = serve_coordinator(coordinator)
+        coordinator_options = [f'--coordinator={address}']
+        coordinator.start_progress_reports(args.progress_interval)
+
     # (a) patient tables
     args_list = []  # type: List[List[str]]
     for procnum in range(nprocesses_patient):
@@ -152,7 +193,7 @@ def main() -> None:
             f'--nprocesses={nprocesses_patient}',
             f'--process={procnum}',
             '--skip_dd_check'
-        ] + common_options
+        ] + coordinator_options + common_options
         args_list.append(procargs)
     for procnum in range(nprocesses_nonpatient):
         procargs = [
@@ -162,10 +203,23 @@ def main() -> None:
             f'--nprocesses={nprocesses_nonpatient}',
             f'--process={procnum}',
             '--skip_dd_check'
-        ] + common_options
+        ] + coordinator_options + common_options
         args_list.append(procargs)
     run_multiple_processes(args_list)  # Wait for them all to finish
 
+    if coordinator is not None:
+        coordinator.stop_progress_reports()
+        log.info(f"Final progress:\n{coordinator.progress_report()}")
+        # The processes all exited cleanly, but check that no work was lost
+        # along the way.
+        unfinished = coordinator.get_unfinished_units()
+        if unfinished:
+            log.critical(
+                f"{len(unfinished)} work unit(s) were not finished, as "
+                f"(cluster, unit) pairs: {unfinished}; not building indexes. "
+                f"Rerun with --resume to finish the job.")
+            sys.exit(1)
+
     time_middle = time.time()
 
     # -------------------------------------------------------------------------
@@ -38,16 +38,24 @@ To create a SQLAlchemy ORM programmatically:
 - http://stackoverflow.com/questions/2574105/sqlalchemy-dynamic-mapping/2575016#2575016
 """  # noqa
 
+import datetime
 import logging
 import random
-from typing import Optional, TYPE_CHECKING, Union
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING, Union
 
 from cardinal_pythonlib.sqlalchemy.orm_query import exists_orm
 from sqlalchemy import (
+    BigInteger,
     Column,
+    DateTime,
+    Index,
+    Integer,
+    LargeBinary,
     MetaData,
+    String,
     Text,
 )
+from sqlalchemy.dialects.mysql import LONGBLOB, LONGTEXT
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm.exc import NoResultFound
@@ -143,6 +151,43 @@ class PatientInfo(AdminBase):
         "_raw_scrubber_tp", Text,
         comment="Raw third-party scrubber (for debugging only)")
 
+    @classmethod
+    def get_or_create_many(
+            cls,
+            session: Session,
+            pids: List[Union[int, str]]) -> Dict[str, "PatientInfo"]:
+        """
+        Fetches the :class:`PatientInfo` objects for several patients,
+        creating (with their RIDs and TRIDs) any that don't yet exist, using
+        a few queries for the whole lot rather than several per patient. New
+        objects are committed before returning.
+
+        Args:
+            session: SQLAlchemy database session for the secret admin database
+            pids: patient ID (PID) values
+
+        Returns:
+            dictionary mapping ``str(pid)`` to :class:`PatientInfo`
+        """
+        if not pids:
+            return {}
+        infos = {
+            str(info.pid): info
+            for info in session.query(cls).filter(cls.pid.in_(pids))
+        }  # type: Dict[str, PatientInfo]
+        missing = [pid for pid in pids if str(pid) not in infos]
+        if missing:
+            trids = TridRecord.get_trids(session, missing)
+            for pid in missing:
+                # noinspection PyArgumentList
+                info = cls(pid=pid, trid=trids[str(pid)])
+                info.ensure_rid()
+                session.add(info)
+                infos[str(pid)] = info
+            session.commit()
+            # prompt commit after insert operations, to ensure no locks
+        return infos
+
     def ensure_rid(self) -> None:
         """
         Ensure that :attr:`rid` is a hashed version of :attr:`pid`.
@@ -237,6 +282,49 @@ class TridRecord(AdminBase):
         except NoResultFound:
             return cls.new_trid(session, pid)
 
+    @classmethod
+    def get_trids(cls,
+                  session: Session,
+                  pids: List[Union[int, str]]) -> Dict[str, int]:
+        """
+        As for :meth:`get_trid`, but for several PIDs at once. Existing TRIDs
+        are fetched with one query, and new ones are inserted together (in a
+        savepoint). If any new TRID clashes with an existing one, we fall back
+        to :meth:`get_trid` for each of the PIDs that needed a new TRID.
+
+        Args:
+            session: SQLAlchemy database session for the secret admin database
+            pids: patient ID (PID) values
+
+        Returns:
+            dictionary mapping ``str(pid)`` to integer TRID
+        """
+        trids = {
+            str(pid): trid
+            for pid, trid in session.query(cls.pid, cls.trid).filter(
+                cls.pid.in_(pids))
+        }  # type: Dict[str, int]
+        missing = [pid for pid in pids if str(pid) not in trids]
+        if not missing:
+            return trids
+        candidates = set()
+        while len(candidates) < len(missing):
+            candidates.add(random.randint(1, MAX_TRID))
+        new_trids = dict(zip((str(pid) for pid in missing), candidates))
+        session.begin_nested()
+        try:
+            for pid in missing:
+                # noinspection PyArgumentList
+                session.add(cls(pid=pid, trid=new_trids[str(pid)]))
+            session.commit()  # may raise IntegrityError
+            trids.update(new_trids)
+        except IntegrityError:
+            session.rollback()
+            log.debug("TRID clash in bulk creation; creating individually")
+            for pid in missing:
+                trids[str(pid)] = cls.get_trid(session, pid)
+        return trids
+
     @classmethod
     def new_trid(cls, session: Session, pid: Union[int, str]) -> int:
         """
@@ -288,6 +376,16 @@ class OptOutPid(AdminBase):
         """
         return exists_orm(session, cls, cls.pid == pid)
 
+    @classmethod
+    def all_values(cls, session: Session) -> List[Union[int, str]]:
+        """
+        Returns all the PID values of patients opting out.
+
+        Args:
+            session: SQLAlchemy database session for the secret admin database
+        """
+        return [row[0] for row in session.query(cls.pid)]
+
     @classmethod
     def add(cls, session: Session, pid: Union[int, str]) -> None:
         """
@@ -331,6 +429,16 @@ class OptOutMpid(AdminBase):
         """
         return exists_orm(session, cls, cls.mpid == mpid)
 
+    @classmethod
+    def all_values(cls, session: Session) -> List[Union[int, str]]:
+        """
+        Returns all the MPID values of patients opting out.
+
+        Args:
+            session: SQLAlchemy database session for the secret admin database
+        """
+        return [row[0] for row in session.query(cls.mpid)]
+
     @classmethod
     def add(cls, session: Session, mpid: Union[int, str]) -> None:
         """
@@ -344,3 +452,397 @@ class OptOutMpid(AdminBase):
         # noinspection PyArgumentList
         newthing = cls(mpid=mpid)
         session.merge(newthing)
+
+
+class TextExtractionCacheRecord(AdminBase):
+    """
+    Caches text extracted from documents (see
+    :mod:`crate_anon.anonymise.text_extraction`), keyed by a hash of the
+    document and the text extraction settings, so that documents that haven't
+    changed needn't be processed again.
+    """
+    __tablename__ = 'text_extraction_cache'
+    __table_args__ = TABLE_KWARGS
+
+    key = Column(
+        'key', String(64),
+        primary_key=True,
+        comment="SHA-256 hash (hex) of document and text extraction settings")
+    text = Column(
+        'text', Text().with_variant(LONGTEXT(), 'mysql'),
+        comment="Text extracted from the document")
+
+    @classmethod
+    def get_text(cls, session: Session, key: str) -> Optional[str]:
+        """
+        Returns previously extracted text, or ``None``.
+
+        Args:
+            session: SQLAlchemy database session for the secret admin database
+            key: document key
+        """
+        row = session.query(cls.text).filter(cls.key == key).first()
+        return row[0] if row is not None else None
+
+    @classmethod
+    def save_text(cls, session: Session, key: str, text: Optional[str]) -> None:
+        """
+        Stores extracted text.
+
+        Args:
+            session: SQLAlchemy database session for the secret admin database
+            key: document key
+            text: the text
+        """
+        # noinspection PyArgumentList
+        session.merge(cls(key=key, text=text or ""))
+
+
+class ScrubberRegexCacheRecord(AdminBase):
+    """
+    Caches the compiled regexes of patients' scrubbers (see
+    :class:`crate_anon.anonymise.scrub.ScrubberRegexCache`), so that a later
+    run needn't compile them again if the scrubber hasn't changed.
+    """
+    __tablename__ = 'scrubber_regex_cache'
+    __table_args__ = TABLE_KWARGS
+
+    key = Column(
+        'key', String(64),
+        primary_key=True,
+        comment="SHA-256 hash (hex) of scrubber hash, regex settings and "
+                "regex module version")
+    regexes = Column(
+        'regexes', LargeBinary().with_variant(LONGBLOB(), 'mysql'),
+        comment="Compiled patient and third-party regexes (pickled)")
+    when_last_used_utc = Column(
+        'when_last_used_utc', DateTime,
+        index=True,
+        comment="Date/time these regexes were last used (UTC)")
+
+    @classmethod
+    def get_regexes(cls, session: Session, key: str) -> Optional[bytes]:
+        """
+        Returns previously stored (pickled) regexes, or ``None``, noting that
+        they've been used.
+
+        Args:
+            session: SQLAlchemy database session for the secret admin database
+            key: scrubber key
+        """
+        record = session.query(cls).get(key)
+        if record is None:
+            return None
+        record.when_last_used_utc = datetime.datetime.utcnow()
+        return record.regexes
+
+    @classmethod
+    def save_regexes(cls, session: Session, key: str, regexes: bytes) -> None:
+        """
+        Stores (pickled) regexes.
+
+        Args:
+            session: SQLAlchemy database session for the secret admin database
+            key: scrubber key
+            regexes: the pickled regexes
+        """
+        # noinspection PyArgumentList
+        session.merge(cls(key=key, regexes=regexes,
+                          when_last_used_utc=datetime.datetime.utcnow()))
+
+    @classmethod
+    def evict(cls, session: Session, max_entries: int) -> int:
+        """
+        Deletes the least recently used records beyond ``max_entries``.
+
+        Args:
+            session: SQLAlchemy database session for the secret admin database
+            max_entries: number of records to keep
+
+        Returns:
+            the number of records deleted
+        """
+        cutoff = (
+            session.query(cls.when_last_used_utc).
+            order_by(cls.when_last_used_utc.desc()).
+            offset(max_entries).
+            limit(1).
+            scalar()
+        )  # the most recently used record that we don't want
+        if cutoff is None:
+            return 0
+        return (
+            session.query(cls).
+            filter(cls.when_last_used_utc <= cutoff).
+            delete(synchronize_session=False)
+        )
+
+
+class PatientProgress(AdminBase):
+    """
+    Records progress through an anonymisation run, per patient, so that an
+    interrupted run can be resumed (see the ``--resume`` option). A patient
+    is marked as started before its data is written, and as completed once
+    that data has been committed, along with the hashes of its scrubber and
+    of the data dictionary rows used; if either changes, the patient is
+    reprocessed on resumption.
+    """
+    __tablename__ = 'progress_patient'
+    __table_args__ = TABLE_KWARGS
+
+    pid = Column(
+        'pid', config.pidtype,
+        primary_key=True, autoincrement=False,
+        comment="Patient ID (PID) (PK)")
+    scrubber_hash = Column(
+        'scrubber_hash', config.SqlTypeEncryptedPid,
+        comment="Scrubber hash when processed")
+    dd_hash = Column(
+        'dd_hash', config.SqlTypeEncryptedPid,
+        comment="Hash of data dictionary rows used for patient tables")
+    when_completed_utc = Column(
+        'when_completed_utc', DateTime,
+        comment="Time processing was completed (UTC); NULL if started but "
+                "not completed")
+
+    @property
+    def completed(self) -> bool:
+        """
+        Was processing of this patient completed?
+        """
+        return self.when_completed_utc is not None
+
+    @classmethod
+    def get_many(cls,
+                 session: Session,
+                 pids: List[Union[int, str]]) -> Dict[str, "PatientProgress"]:
+        """
+        Fetches the progress records for several patients.
+
+        Args:
+            session: SQLAlchemy database session for the secret admin database
+            pids: patient ID (PID) values
+
+        Returns:
+            dictionary mapping ``str(pid)`` to :class:`PatientProgress`, for
+            those patients that have a record
+        """
+        if not pids:
+            return {}
+        return {
+            str(p.pid): p
+            for p in session.query(cls).filter(cls.pid.in_(pids))
+        }
+
+    @classmethod
+    def mark_started(cls,
+                     session: Session,
+                     records: Dict[str, "PatientProgress"],
+                     pids_and_scrubber_hashes: List[Tuple[Union[int, str],
+                                                          str]],
+                     dd_hash: str) -> List["PatientProgress"]:
+        """
+        Marks several patients as started (but not completed).
+
+        Args:
+            session: SQLAlchemy database session for the secret admin database
+            records: existing records, as returned by :meth:`get_many`
+            pids_and_scrubber_hashes: list of tuples ``pid, scrubber_hash``
+            dd_hash: hash of the data dictionary rows in use
+
+        Returns:
+            the records, which can be passed to :meth:`mark_completed`
+        """
+        result = []  # type: List[PatientProgress]
+        for pid, scrubber_hash in pids_and_scrubber_hashes:
+            p = records.get(str(pid))
+            if p is None:
+                # noinspection PyArgumentList
+                p = cls(pid=pid)
+                session.add(p)
+            p.scrubber_hash = scrubber_hash
+            p.dd_hash = dd_hash
+            p.when_completed_utc = None
+            result.append(p)
+        return result
+
+    @classmethod
+    def mark_completed(cls, records: List["PatientProgress"]) -> None:
+        """
+        Marks several patients as completed.
+
+        Args:
+            records: as returned by :meth:`mark_started`
+        """
+        now = datetime.datetime.utcnow()
+        for p in records:
+            p.when_completed_utc = now
+
+
+class NonPatientProgress(AdminBase):
+    """
+    Records progress through an anonymisation run for non-patient tables, so
+    that an interrupted run can be resumed (see the ``--resume`` option).
+    Each record represents a unit of work on a source table: a block of
+    integer PK values (``pk_lo <= pk < pk_hi``), or the share of a table
+    whose PK modulo ``ntasks`` is ``tasknum``, or (with ``ntasks`` of 1 and
+    no PK range) the whole table. It is marked as started before data is
+    written, and as completed once that data has been committed, along with a
+    hash of the data dictionary rows used.
+
+    Each record also notes how its table was divided into units (its
+    "layout", e.g. ``pk_blocks:1000`` for blocks of 1000 PK values), since
+    units from different layouts overlap, so can't be resumed together.
+    """
+    __tablename__ = 'progress_nonpatient'
+    __table_args__ = (
+        Index('_idx_progress_nonpatient_table', 'src_db', 'src_table'),
+        TABLE_KWARGS,
+    )
+
+    id = Column(
+        'id', Integer,
+        primary_key=True, autoincrement=True,
+        comment="Arbitrary PK")
+    src_db = Column(
+        'src_db', String(255), nullable=False,
+        comment="Source database name (as per the data dictionary)")
+    src_table = Column(
+        'src_table', String(255), nullable=False,
+        comment="Source table name")
+    pk_lo = Column(
+        'pk_lo', BigInteger,
+        comment="Lowest PK value in this unit (inclusive), if a PK block")
+    pk_hi = Column(
+        'pk_hi', BigInteger,
+        comment="Highest PK value in this unit (exclusive), if a PK block")
+    tasknum = Column(
+        'tasknum', Integer, nullable=False,
+        comment="If not a PK block: PK modulo ntasks for this unit")
+    ntasks = Column(
+        'ntasks', Integer, nullable=False,
+        comment="If not a PK block: number of tasks dividing the table")
+    layout = Column(
+        'layout', String(50), nullable=False,
+        comment="How the table was divided into units of work (e.g. "
+                "'pk_blocks:1000', 'pk_modulus:4', 'whole_table')")
+    dd_hash = Column(
+        'dd_hash', config.SqlTypeEncryptedPid,
+        comment="Hash of data dictionary rows used for this table")
+    when_completed_utc = Column(
+        'when_completed_utc', DateTime,
+        comment="Time processing was completed (UTC); NULL if started but "
+                "not completed")
+
+    @property
+    def completed(self) -> bool:
+        """
+        Was this unit of work completed?
+        """
+        return self.when_completed_utc is not None
+
+    @classmethod
+    def get_unit(cls,
+                 session: Session,
+                 src_db: str,
+                 src_table: str,
+                 pk_range: Tuple[int, int] = None,
+                 tasknum: int = 0,
+                 ntasks: int = 1) -> Optional["NonPatientProgress"]:
+        """
+        Fetches the progress record for a unit of work, if there is one.
+
+        Args:
+            session: SQLAlchemy database session for the secret admin database
+            src_db: source database name
+            src_table: source table name
+            pk_range: tuple ``pk_lo, pk_hi`` for a PK block
+            tasknum: if not a PK block, PK modulo ``ntasks`` for this unit
+            ntasks: if not a PK block, number of tasks dividing the table
+        """
+        pk_lo, pk_hi = pk_range or (None, None)
+        if pk_range is not None:
+            tasknum, ntasks = 0, 1
+        # noinspection PyComparisonWithNone
+        return (
+            session.query(cls)
+            .filter(cls.src_db == src_db)
+            .filter(cls.src_table == src_table)
+            .filter(cls.pk_lo == pk_lo)  # becomes IS NULL for None
+            .filter(cls.pk_hi == pk_hi)
+            .filter(cls.tasknum == tasknum)
+            .filter(cls.ntasks == ntasks)
+            .first()
+        )
+
+    @classmethod
+    def get_other_layouts(cls,
+                          session: Session,
+                          src_db: str,
+                          src_table: str,
+                          layout: str) -> List[str]:
+        """
+        Returns the layouts, other than ``layout``, of the units of work
+        recorded for a table.
+
+        Args:
+            session: SQLAlchemy database session for the secret admin database
+            src_db: source database name
+            src_table: source table name
+            layout: the layout we're using now
+        """
+        return sorted(
+            other for other, in
+            session.query(cls.layout).distinct()
+            .filter(cls.src_db == src_db)
+            .filter(cls.src_table == src_table)
+            .filter(cls.layout != layout)
+        )
+
+    @classmethod
+    def mark_started(cls,
+                     session: Session,
+                     record: Optional["NonPatientProgress"],
+                     src_db: str,
+                     src_table: str,
+                     dd_hash: str,
+                     layout: str,
+                     pk_range: Tuple[int, int] = None,
+                     tasknum: int = 0,
+                     ntasks: int = 1) -> "NonPatientProgress":
+        """
+        Marks a unit of work as started (but not completed).
+
+        Args:
+            session: SQLAlchemy database session for the secret admin database
+            record: the existing record, as returned by :meth:`get_unit`
+            src_db: source database name
+            src_table: source table name
+            dd_hash: hash of the data dictionary rows in use
+            layout: how the table is divided into units of work
+            pk_range: as for :meth:`get_unit`
+            tasknum: as for :meth:`get_unit`
+            ntasks: as for :meth:`get_unit`
+
+        Returns:
+            the record, for :meth:`mark_completed`
+        """
+        if record is None:
+            pk_lo, pk_hi = pk_range or (None, None)
+            if pk_range is not None:
+                tasknum, ntasks = 0, 1
+            # noinspection PyArgumentList
+            record = cls(src_db=src_db, src_table=src_table,
+                         pk_lo=pk_lo, pk_hi=pk_hi,
+                         tasknum=tasknum, ntasks=ntasks)
+            session.add(record)
+        record.layout = layout
+        record.dd_hash = dd_hash
+        record.when_completed_utc = None
+        return record
+
+    def mark_completed(self) -> None:
+        """
+        Marks this unit of work as completed.
+        """
+        self.when_completed_utc = datetime.datetime.utcnow()
@@ -29,18 +29,28 @@ like ID values and scrubbers.**
 
 """
 
+from collections import OrderedDict
 import logging
-from typing import AbstractSet, Any, Generator, List, Union
+import pickle
+from typing import (AbstractSet, Any, Dict, Generator, Iterable, List,
+                    Optional, Tuple, Union)
 
+from cardinal_pythonlib.timing import MultiTimerContext, timer
 from sqlalchemy.sql import column, select, table
 
 from crate_anon.anonymise.config_singleton import config
-from crate_anon.anonymise.constants import SCRUBSRC
+from crate_anon.anonymise.constants import (
+    DEFAULT_THIRDPARTY_XREF_CACHE_MAX_ENTRIES,
+    SCRUBSRC,
+)
 from crate_anon.anonymise.models import PatientInfo
 from crate_anon.anonymise.scrub import PersonalizedScrubber
+from crate_anon.common.sql import gen_result_rows
 
 log = logging.getLogger(__name__)
 
+TIMING_BUILD_SCRUBBER = "build_scrubber"
+
 
 # =============================================================================
 # Generate identifiable values for a patient
@@ -50,7 +60,8 @@ def gen_all_values_for_patient(
         dbname: str,
         tablename: str,
         fields: List[str],
-        pid: Union[int, str]) -> Generator[List[Any], None, None]:
+        pid: Union[int, str],
+        allow_streaming: bool = True) -> Generator[List[Any], None, None]:
     """
     Generate all sensitive (``scrub_src``) values for a given patient, from a
     given source table. Used to build the scrubber.
@@ -61,6 +72,9 @@ def gen_all_values_for_patient(
         tablename: source table
         fields: list of source fields containing ``scrub_src`` information
         pid: patient ID
+        allow_streaming: may we stream results (if the source database is
+            configured to)? Say no if the caller will use the same database
+            session while iterating.
 
     Yields:
          rows, where each row is a list of values that matches ``fields``.
@@ -78,12 +92,178 @@ def gen_all_values_for_patient(
         where(column(cfg.ddgen_per_table_pid_field) == pid).
         select_from(table(tablename))
     )
-    result = session.execute(query)
-    for row in result:
+    for row in gen_result_rows(
+            session, query,
+            stream_results=allow_streaming and cfg.stream_results,
+            fetch_size=cfg.fetch_size):
         log.debug(f"... yielding row: {row}")
         yield row
 
 
+def gen_all_values_for_patients(
+        dbname: str,
+        tablename: str,
+        fields: List[str],
+        pids: List[Union[int, str]]) \
+        -> Generator[Tuple[Union[int, str], List[Any]], None, None]:
+    """
+    Generate all sensitive (``scrub_src``) values for several patients at
+    once, from a given source table, using a single ``WHERE pid IN (...)``
+    query. The multi-patient equivalent of
+    :func:`gen_all_values_for_patient`.
+
+    Args:
+
+        dbname: source database name
+        tablename: source table
+        fields: list of source fields containing ``scrub_src`` information
+        pids: patient IDs
+
+    Yields:
+         tuples ``pid, row``, where ``pid`` is the PID value from the source
+         table and ``row`` is a list of values that matches ``fields``.
+    """
+    cfg = config.sources[dbname].srccfg
+    if not cfg.ddgen_per_table_pid_field:
+        return
+    log.debug(
+        f"gen_all_values_for_patients: {len(pids)} PIDs, "
+        f"table {dbname}.{tablename}, fields: {','.join(fields)}")
+    session = config.sources[dbname].session
+    pidcol = column(cfg.ddgen_per_table_pid_field)
+    query = (
+        select([column(f) for f in fields] + [pidcol]).
+        where(pidcol.in_(pids)).
+        select_from(table(tablename))
+    )
+    for row in gen_result_rows(session, query,
+                               stream_results=cfg.stream_results,
+                               fetch_size=cfg.fetch_size):
+        values = list(row)
+        yield values[-1], values[:-1]
+
+
+# =============================================================================
+# Prefetch identifiable values for a block of patients
+# =============================================================================
+
+class ScrubSourcePrefetcher(object):
+    """
+    Provides ``scrub_src`` values (as per :func:`gen_all_values_for_patient`)
+    for a block of patients, fetching them with one query per source table for
+    the whole block, rather than one query per table per patient.
+
+    Values for other patients (typically relatives, found via third-party
+    cross-references; see ``SCRUBSRC.THIRDPARTY_XREF_PID``) are fetched
+    individually, but cached, so that e.g. a family member shared by several
+    patients in the block is only looked up once. That cache is bounded (least
+    recently used entries are discarded first).
+
+    Use one of these per block of patients, then throw it away.
+    """
+    def __init__(self,
+                 pids: Iterable[Union[int, str]],
+                 max_xref_cache_entries: int =
+                 DEFAULT_THIRDPARTY_XREF_CACHE_MAX_ENTRIES) -> None:
+        """
+        Args:
+            pids: the PIDs of the patients in this block
+            max_xref_cache_entries: maximum number of ``(table, PID)`` entries
+                to cache for patients outside the block (see the
+                ``thirdparty_xref_cache_max_entries`` config option)
+        """
+        self._pids = list(pids)
+        # PIDs may differ in Python type between sources (e.g. int versus
+        # str); the database compares them for us in the one-patient query,
+        # so we match on str here.
+        self._pid_strs = set(str(pid) for pid in self._pids)
+        self._block_values = {}  # type: Dict[Tuple[str, str], Dict[str, List[List[Any]]]]  # noqa
+        self._xref_cache = OrderedDict()  # type: OrderedDict[Tuple[str, str, str], List[List[Any]]]  # noqa
+        self._max_xref_cache_entries = max_xref_cache_entries
+        self.n_xref_cache_hits = 0
+        self.n_xref_cache_misses = 0
+
+    def gen_values(
+            self,
+            dbname: str,
+            tablename: str,
+            fields: List[str],
+            pid: Union[int, str]) -> Generator[List[Any], None, None]:
+        """
+        Generate all sensitive (``scrub_src``) values for a given patient, from
+        a given source table. As for :func:`gen_all_values_for_patient`.
+
+        ``fields`` should be the same for every call for a given table.
+        """
+        pid_str = str(pid)
+        if pid_str in self._pid_strs:
+            # One of our block.
+            tablekey = (dbname, tablename)
+            if tablekey not in self._block_values:
+                values_by_pid = {}  # type: Dict[str, List[List[Any]]]
+                for row_pid, row in gen_all_values_for_patients(
+                        dbname, tablename, fields, self._pids):
+                    values_by_pid.setdefault(str(row_pid), []).append(row)
+                self._block_values[tablekey] = values_by_pid
+            yield from self._block_values[tablekey].get(pid_str, [])
+            return
+        # Someone else.
+        cachekey = (dbname, tablename, pid_str)
+        rows = self._xref_cache.get(cachekey)
+        if rows is None:
+            self.n_xref_cache_misses += 1
+            rows = list(gen_all_values_for_patient(
+                dbname, tablename, fields, pid))
+            self._xref_cache[cachekey] = rows
+            if len(self._xref_cache) > self._max_xref_cache_entries:
+                self._xref_cache.popitem(last=False)  # discard oldest
+        else:
+            self.n_xref_cache_hits += 1
+            self._xref_cache.move_to_end(cachekey)
+        yield from rows
+
+
+# =============================================================================
+# DetachedPatient, a picklable copy of a patient's IDs and scrubber
+# =============================================================================
+
+class DetachedPatient(object):
+    """
+    A copy of the parts of a :class:`Patient` needed to process that
+    patient's source rows (the patient's IDs and scrubber), with no database
+    access, which can be pickled and sent to a worker process. It provides the
+    same attributes/methods as :class:`Patient` for those purposes.
+
+    The recipient must call :meth:`attach_shared_objects` before scrubbing;
+    see :meth:`crate_anon.anonymise.scrub.PersonalizedScrubber.__getstate__`.
+    """
+    def __init__(self, patient: "Patient") -> None:
+        """
+        Args:
+            patient: the :class:`Patient` to copy
+        """
+        self.pid = patient.pid
+        self.mpid = patient.mpid
+        self.rid = patient.rid
+        self.mrid = patient.mrid
+        self.trid = patient.trid
+        self.scrubber = patient.scrubber
+
+    def attach_shared_objects(self) -> None:
+        """
+        Reattach our scrubber to the config-wide objects it shares.
+        """
+        self.scrubber.attach_shared_objects(
+            allowlist=config.allowlist,
+            nonspecific_scrubber=config.nonspecific_scrubber)
+
+    def scrub(self, text: str) -> str:
+        """
+        As for :meth:`Patient.scrub`.
+        """
+        return self.scrubber.scrub(text)
+
+
 # =============================================================================
 # Patient class, which hosts the patient-specific scrubber
 # =============================================================================
@@ -94,7 +274,9 @@ class Patient(object):
     scrubbers.
     """
 
-    def __init__(self, pid: Union[int, str], debug: bool = False) -> None:
+    def __init__(self, pid: Union[int, str], debug: bool = False,
+                 prefetcher: ScrubSourcePrefetcher = None,
+                 info: PatientInfo = None) -> None:
         """
         Build the scrubber based on data dictionary information, found via
         our singleton :class:`crate_anon.anonymise.config.Config`.
@@ -102,12 +284,24 @@ class Patient(object):
         Args:
             pid: integer or string (usually integer) patient identifier
             debug: turn on scrubber debugging?
-        """
+            prefetcher: optional :class:`ScrubSourcePrefetcher` (for a block
+                of patients including this one) to provide source values
+            info: optional :class:`crate_anon.anonymise.models.PatientInfo`
+                for this patient, already fetched/created (e.g. via
+                :meth:`crate_anon.anonymise.models.PatientInfo.get_or_create_many`).
+                If this is given, the caller is responsible for committing
+                the admin database session, to save the scrubber hash;
+                otherwise, we commit it.
+        """  # noqa
         self._pid = pid
+        self._prefetcher = prefetcher
+        self._detached_pickle = None  # type: Optional[bytes]
         self._session = config.admindb.session
 
         # Fetch or create PatientInfo object
-        self._info = self._session.query(PatientInfo).get(pid)
+        self._info = info
+        if self._info is None:
+            self._info = self._session.query(PatientInfo).get(pid)
         if self._info is None:
             self._info = PatientInfo(pid=pid)
             self._info.ensure_rid()
@@ -140,6 +334,9 @@ class Patient(object):
             string_max_regex_errors=config.string_max_regex_errors,
             allowlist=config.allowlist,
             alternatives=config.phrase_alternative_words,
+            flashtext_exact_words=config.anonymise_exact_strings_with_flashtext,
+            regex_cache=(config.compiled_regex_cache
+                         if config.scrubber_regex_cache else None),
         )
         # Database
         # Construction. We go through all "scrub-from" fields in the data
@@ -149,15 +346,18 @@ class Patient(object):
         self._db_table_pair_list = config.dd.get_scrub_from_db_table_pairs()
         self._mandatory_scrubbers_unfulfilled = \
             config.dd.get_mandatory_scrubber_sigs().copy()
-        self._build_scrubber(pid,
-                             depth=0,
-                             max_depth=config.thirdparty_xref_max_depth)
+        with MultiTimerContext(timer, TIMING_BUILD_SCRUBBER):
+            self._build_scrubber(pid,
+                                 depth=0,
+                                 max_depth=config.thirdparty_xref_max_depth)
         self._unchanged = self.scrubber_hash == self._info.scrubber_hash
         self._info.set_scrubber_info(self.scrubber)
-        self._session.commit()
-        # Commit immediately, because other processes may need this table
-        # promptly. Otherwise, might get:
-        #   Deadlock found when trying to get lock; try restarting transaction
+        if info is None:
+            self._session.commit()
+            # Commit immediately, because other processes may need this table
+            # promptly. Otherwise, might get:
+            #   Deadlock found when trying to get lock; try restarting
+            #   transaction
 
     def _build_scrubber(self,
                         pid: Union[int, str],
@@ -205,8 +405,16 @@ class Patient(object):
             # -----------------------------------------------------------------
             # Collect the actual patient-specific values for this table.
             # -----------------------------------------------------------------
-            for values in gen_all_values_for_patient(src_db, src_table,
-                                                     fields, pid):
+            if self._prefetcher is not None:
+                all_values = self._prefetcher.gen_values(
+                    src_db, src_table, fields, pid)
+            else:
+                all_values = gen_all_values_for_patient(
+                    src_db, src_table, fields, pid,
+                    allow_streaming=not any(recurse))
+                # ... if we recurse, we query the source database again
+                # whilst reading this result
+            for values in all_values:
                 for i, val in enumerate(values):
                     # ---------------------------------------------------------
                     # Add a value to the scrubber
@@ -307,6 +515,29 @@ class Patient(object):
         """
         return self.scrubber.scrub(text)
 
+    def detached(self) -> DetachedPatient:
+        """
+        Returns a :class:`DetachedPatient` copy of this patient, e.g. for a
+        worker process.
+        """
+        return DetachedPatient(self)
+
+    def get_detached_pickle(self) -> bytes:
+        """
+        Returns a pickled :class:`DetachedPatient` copy of this patient, for
+        worker processes. It's made once, and re-used for every batch of this
+        patient's rows that we send.
+
+        If we have a regex cache, we build our scrubber's regexes first (from
+        the cache, if possible), so that they are sent too, and the workers
+        needn't compile them.
+        """
+        if self._detached_pickle is None:
+            if self.scrubber.regex_cache is not None:
+                self.scrubber.build_regexes()
+            self._detached_pickle = pickle.dumps(self.detached())
+        return self._detached_pickle
+
     def is_unchanged(self) -> bool:
         """
         Has the scrubber changed, compared to the previous hashed version in
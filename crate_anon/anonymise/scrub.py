@@ -30,10 +30,13 @@ crate_anon/anonymise/scrub.py
 
 from collections import OrderedDict
 import datetime
+import hashlib
+import io
 import logging
+import pickle
 import string
-from typing import (Any, Dict, Iterable, Generator, List, Optional, Pattern,
-                    Set, Tuple, Union)
+from typing import (Any, Dict, Iterable, Generator, List, Match, Optional,
+                    Pattern, Set, Tuple, TYPE_CHECKING, Union)
 
 from cardinal_pythonlib.datetimefunc import coerce_to_datetime
 from cardinal_pythonlib.hash import GenericHasher
@@ -42,6 +45,7 @@ from cardinal_pythonlib.sql.validation import (
     is_sqltype_text_over_one_char,
 )
 from cardinal_pythonlib.text import get_unicode_characters
+import regex
 # from flashtext import KeywordProcessor
 from crate_anon.common.bugfix_flashtext import KeywordProcessorFixed
 # ... temp bugfix
@@ -63,6 +67,9 @@ from crate_anon.common.stringfunc import (
     reduce_to_alphanumeric,
 )
 
+if TYPE_CHECKING:
+    from crate_anon.anonymise.config import Config
+
 log = logging.getLogger(__name__)
 
 
@@ -404,6 +411,119 @@ class NonspecificScrubber(ScrubberBase):
         self._regex_built = True
 
 
+# =============================================================================
+# Cache of compiled regexes for PersonalizedScrubber
+# =============================================================================
+
+class _RegexUnpickler(pickle.Unpickler):
+    """
+    Unpickles compiled ``regex`` patterns (or ``None``), and nothing else.
+    """
+    def find_class(self, module: str, name: str) -> Any:
+        if (module, name) in (("regex._regex", "compile"),
+                              ("_regex", "compile")):
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f"Not a compiled regex: {module}.{name}")
+
+
+class ScrubberRegexCache(object):
+    """
+    A cache of the compiled patient and third-party regexes of
+    :class:`PersonalizedScrubber` objects, in the admin database (see
+    :class:`crate_anon.anonymise.models.ScrubberRegexCacheRecord`), keyed by
+    the scrubber's hash. So a later run needn't compile the regexes again for
+    a scrubber that hasn't changed; e.g. in an incremental run, for a patient
+    with new source rows but no new identifiers.
+
+    Compiled ``regex`` patterns are pickled in their compiled form, so
+    loading one is much faster than compiling it (particularly with fuzzy
+    matching).
+
+    Least recently used entries beyond ``scrubber_regex_cache_max_entries``
+    are discarded by :meth:`evict`.
+    """
+    def __init__(self, config: "Config") -> None:
+        """
+        Args:
+            config: a :class:`crate_anon.anonymise.config.Config`
+        """
+        self.config = config
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def __str__(self) -> str:
+        n_requests = self.n_hits + self.n_misses
+        hit_pct = 100 * self.n_hits / n_requests if n_requests else 0
+        return (f"{self.n_hits} hits, {self.n_misses} misses "
+                f"({hit_pct:.1f}% hit rate)")
+
+    @staticmethod
+    def get_key(scrubber: "PersonalizedScrubber") -> str:
+        """
+        Returns the cache key for a scrubber: a hash of its own hash, the
+        settings that affect its regexes but not its hash, and the version of
+        the ``regex`` module (which defines the compiled form).
+        """
+        h = hashlib.sha256()
+        h.update(repr((
+            scrubber.get_hash(),
+            scrubber.anonymise_numbers_at_numeric_boundaries_only,
+            scrubber.alternatives,
+            regex.__version__,
+        )).encode("utf8"))
+        return h.hexdigest()
+
+    def get(self, key: str) \
+            -> Optional[Tuple[Optional[Pattern[str]], Optional[Pattern[str]]]]:
+        """
+        Returns a tuple ``patient_regex, third_party_regex`` for this key, or
+        ``None`` if we don't have it.
+        """
+        # delayed import (models imports our config)
+        from crate_anon.anonymise.models import ScrubberRegexCacheRecord
+        pickled = ScrubberRegexCacheRecord.get_regexes(
+            self.config.admindb.session, key)
+        regexes = None
+        if pickled is not None:
+            try:
+                regexes = _RegexUnpickler(io.BytesIO(pickled)).load()
+            except (pickle.UnpicklingError, TypeError, ValueError) as e:
+                log.warning(f"Ignoring bad scrubber regex cache entry: {e}")
+        if regexes is None:
+            self.n_misses += 1
+        else:
+            self.n_hits += 1
+        return regexes
+
+    def put(self,
+            key: str,
+            re_patient: Optional[Pattern[str]],
+            re_tp: Optional[Pattern[str]]) -> None:
+        """
+        Stores the regexes for this key.
+        """
+        # delayed import (models imports our config)
+        from crate_anon.anonymise.models import ScrubberRegexCacheRecord
+        ScrubberRegexCacheRecord.save_regexes(
+            self.config.admindb.session, key,
+            pickle.dumps((re_patient, re_tp)))
+
+    def evict(self) -> None:
+        """
+        Discards the least recently used entries, beyond
+        ``scrubber_regex_cache_max_entries`` (if that's not 0).
+        """
+        max_entries = self.config.scrubber_regex_cache_max_entries
+        if not max_entries:
+            return
+        # delayed import (models imports our config)
+        from crate_anon.anonymise.models import ScrubberRegexCacheRecord
+        n_deleted = ScrubberRegexCacheRecord.evict(
+            self.config.admindb.session, max_entries)
+        if n_deleted:
+            log.info(f"Discarded {n_deleted} scrubber regex cache entries")
+
+
 # =============================================================================
 # PersonalizedScrubber
 # =============================================================================
@@ -429,6 +549,8 @@ class PersonalizedScrubber(ScrubberBase):
                  allowlist: WordList = None,
                  alternatives: List[List[str]] = None,
                  nonspecific_scrubber: NonspecificScrubber = None,
+                 flashtext_exact_words: bool = False,
+                 regex_cache: ScrubberRegexCache = None,
                  debug: bool = False) -> None:
         """
         Args:
@@ -478,6 +600,16 @@ class PersonalizedScrubber(ScrubberBase):
             nonspecific_scrubber:
                 :class:`NonspecificScrubber` to apply (after the more specific
                 scrubbers) to remove information that is generic
+            flashtext_exact_words:
+                Scrub words that are to be matched exactly (with no
+                typographical errors permitted) using FlashText, rather than
+                as part of our big regexes? Only applies to words (not
+                phrases, codes, numbers, or dates, whose matching is more
+                flexible), and only if
+                ``anonymise_strings_at_word_boundaries_only`` is set.
+            regex_cache:
+                optional :class:`ScrubberRegexCache`, to re-use compiled
+                regexes from an earlier run
             debug:
                 show the final scrubber regex text as we compile our regexes
         """
@@ -503,6 +635,10 @@ class PersonalizedScrubber(ScrubberBase):
         self.allowlist = allowlist
         self.alternatives = alternatives
         self.nonspecific_scrubber = nonspecific_scrubber
+        self.flashtext_exact_words = (
+            flashtext_exact_words and anonymise_strings_at_word_boundaries_only
+        )
+        self.regex_cache = regex_cache
         self.debug = debug
 
         # Regex information
@@ -517,6 +653,22 @@ class PersonalizedScrubber(ScrubberBase):
         # ... list of tuples: (patient?, type, value)
         # ... used for get_raw_info(); since we've made the order important,
         #     we should detect changes in order here as well
+
+        # FlashText information
+        self.ft_patient = None  # type: Optional[KeywordProcessorFixed]
+        self.ft_tp = None  # type: Optional[KeywordProcessorFixed]
+        self.ft_patient_keywords = []  # type: List[str]
+        self.ft_tp_keywords = []  # type: List[str]
+        self.ft_patient_elements = set()  # type: Set[str]
+        self.ft_tp_elements = set()  # type: Set[str]
+        # ... regex elements that are handled by FlashText instead; they stay
+        #     in re_patient_elements/re_tp_elements, so the regex strings
+        #     (e.g. as saved in the admin database) are unchanged.
+        self.re_patient_all = None  # type: Optional[Pattern[str]]
+        self.re_tp_all = None  # type: Optional[Pattern[str]]
+        # ... regexes with all the elements, FlashText ones included; built
+        #     only if needed (see _scrub_part).
+        self._cached_hash = None  # type: Optional[str]
         self.clear_cache()
 
     def clear_cache(self) -> None:
@@ -525,6 +677,37 @@ class PersonalizedScrubber(ScrubberBase):
         """
         self.regexes_built = False
 
+    def __getstate__(self) -> Dict[str, Any]:
+        """
+        For pickling, e.g. to send to a worker process.
+
+        Compiled regexes and FlashText processors are pickled if they have
+        been built (a compiled regex is pickled in its compiled form, so that
+        is much quicker than compiling it again); otherwise, the recipient
+        builds them when needed.
+
+        The config-wide objects that we share with all other scrubbers (the
+        allowlist and nonspecific scrubber) are not pickled, as they may be
+        large; the recipient must reattach its own copies, via
+        :meth:`attach_shared_objects`. Nor is our regex cache, which uses the
+        admin database.
+        """
+        state = self.__dict__.copy()
+        for attr in ("allowlist", "nonspecific_scrubber", "regex_cache"):
+            state[attr] = None
+        return state
+
+    def attach_shared_objects(
+            self,
+            allowlist: Optional[WordList],
+            nonspecific_scrubber: Optional[NonspecificScrubber]) -> None:
+        """
+        Reattaches config-wide objects after unpickling; see
+        :meth:`__getstate__`. They must be equivalent to the originals.
+        """
+        self.allowlist = allowlist
+        self.nonspecific_scrubber = nonspecific_scrubber
+
     @staticmethod
     def get_scrub_method(datatype_long: str,
                          scrub_method: Optional[SCRUBMETHOD]) -> SCRUBMETHOD:
@@ -573,13 +756,19 @@ class PersonalizedScrubber(ScrubberBase):
         new_tuple = (patient, scrub_method, repr(value))
         if new_tuple not in self.elements_tuplelist:
             self.elements_tuplelist.append(new_tuple)
+            self._cached_hash = None
         # Note: object reference
         r = self.re_patient_elements if patient else self.re_tp_elements
 
         if scrub_method is SCRUBMETHOD.DATE:
             elements = self.get_elements_date(value)
         elif scrub_method is SCRUBMETHOD.WORDS:
-            elements = self.get_elements_words(value)
+            elements = self.get_elements_words(
+                value,
+                flashtext_keywords=(self.ft_patient_keywords if patient
+                                    else self.ft_tp_keywords),
+                flashtext_elements=(self.ft_patient_elements if patient
+                                    else self.ft_tp_elements))
         elif scrub_method is SCRUBMETHOD.PHRASE:
             elements = self.get_elements_phrase(value)
         elif scrub_method is SCRUBMETHOD.NUMERIC:
@@ -612,10 +801,20 @@ class PersonalizedScrubber(ScrubberBase):
                 self.anonymise_dates_at_word_boundaries_only)
         )
 
-    def get_elements_words(self, value: str) -> List[str]:
+    def get_elements_words(
+            self,
+            value: str,
+            flashtext_keywords: List[str] = None,
+            flashtext_elements: Set[str] = None) -> List[str]:
         """
         Returns a list of regex elements for a given string that contains
         textual words.
+
+        If ``flashtext_keywords`` and ``flashtext_elements`` are given and we
+        are using FlashText for exact words, then the keywords for any such
+        words are appended to ``flashtext_keywords``, and their regex elements
+        are added to ``flashtext_elements`` (as they are handled by
+        FlashText).
         """
         elements = []  # type: List[str]
         for s in get_anon_fragments_from_string(str(value)):
@@ -635,13 +834,25 @@ class PersonalizedScrubber(ScrubberBase):
                 max_errors = self.string_max_regex_errors
             else:
                 max_errors = 0
-            elements.extend(get_string_regex_elements(
+            word_elements = get_string_regex_elements(
                 s,
                 self.scrub_string_suffixes,
                 max_errors=max_errors,
                 at_word_boundaries_only=(
                     self.anonymise_strings_at_word_boundaries_only)
-            ))
+            )
+            elements.extend(word_elements)
+            if (flashtext_keywords is not None and
+                    flashtext_elements is not None and
+                    self.flashtext_exact_words and
+                    max_errors == 0 and
+                    all(c in FLASHTEXT_WORD_CHARACTERS for c in s)):
+                # FlashText's idea of a word boundary matches the regex one
+                # (\b) for these characters.
+                flashtext_keywords.append(s)
+                flashtext_keywords.extend(
+                    s + suffix for suffix in self.scrub_string_suffixes)
+                flashtext_elements.update(word_elements)
         return elements
 
     def get_elements_phrase(self, value: Any) -> List[str]:
@@ -722,10 +933,33 @@ class PersonalizedScrubber(ScrubberBase):
 
     def build_regexes(self) -> None:
         """
-        Compile our regexes.
+        Compile our regexes (or fetch them from our cache) and any FlashText
+        processors.
         """
-        self.re_patient = get_regex_from_elements(self.re_patient_elements)
-        self.re_tp = get_regex_from_elements(self.re_tp_elements)
+        cache_key = None  # type: Optional[str]
+        cached = None
+        if self.regex_cache is not None:
+            cache_key = self.regex_cache.get_key(self)
+            cached = self.regex_cache.get(cache_key)
+        if cached is not None:
+            self.re_patient, self.re_tp = cached
+        else:
+            self.re_patient = get_regex_from_elements([
+                e for e in self.re_patient_elements
+                if e not in self.ft_patient_elements
+            ])
+            self.re_tp = get_regex_from_elements([
+                e for e in self.re_tp_elements
+                if e not in self.ft_tp_elements
+            ])
+            if self.regex_cache is not None:
+                self.regex_cache.put(cache_key, self.re_patient, self.re_tp)
+        self.ft_patient = self._get_flashtext_processor(
+            self.ft_patient_keywords, self.replacement_text_patient)
+        self.ft_tp = self._get_flashtext_processor(
+            self.ft_tp_keywords, self.replacement_text_third_party)
+        self.re_patient_all = None
+        self.re_tp_all = None
         self.regexes_built = True
         # Note that the regexes themselves may be None even if they have
         # been built.
@@ -733,6 +967,22 @@ class PersonalizedScrubber(ScrubberBase):
             log.debug(f"Patient scrubber: {self.get_patient_regex_string()}")
             log.debug(f"Third party scrubber: {self.get_tp_regex_string()}")
 
+    @staticmethod
+    def _get_flashtext_processor(
+            keywords: List[str],
+            replacement: str) -> Optional[KeywordProcessorFixed]:
+        """
+        Returns a FlashText processor to replace all the keywords with the
+        replacement text, or ``None`` if there are no keywords.
+        """
+        if not keywords:
+            return None
+        processor = KeywordProcessorFixed(case_sensitive=False)
+        processor.set_non_word_boundaries(FLASHTEXT_WORD_CHARACTERS)
+        for keyword in keywords:
+            processor.add_keyword(keyword, replacement)
+        return processor
+
     def scrub(self, text: str) -> Optional[str]:
         # docstring in parent class
         if text is None:
@@ -742,15 +992,90 @@ class PersonalizedScrubber(ScrubberBase):
 
         if self.nonspecific_scrubber:
             text = self.nonspecific_scrubber.scrub(text)
-        if self.re_patient:
-            text = self.re_patient.sub(self.replacement_text_patient, text)
-        if self.re_tp:
-            text = self.re_tp.sub(self.replacement_text_third_party, text)
+        text = self._scrub_part(text, patient=True)
+        text = self._scrub_part(text, patient=False)
         return text
 
+    def _scrub_part(self, text: str, patient: bool) -> str:
+        """
+        Scrubs patient or third-party information from text.
+
+        If some words are handled by FlashText, the result must be the same as
+        from a single regex with all the elements. That's so unless something
+        matched by the (remaining) regex overlaps one of the FlashText words;
+        e.g. the phrase "12 Smith Road" and the word "Smith" (FlashText would
+        replace "Smith" first, and then the phrase would no longer match; or,
+        run the other way round, the results would depend on the order in
+        which elements were added). In that case, we use a regex with all the
+        elements instead. Since FlashText keywords are single runs of word
+        characters, it is enough to look for keywords within each regex match,
+        extended to whole words.
+        """
+        if patient:
+            regex_ = self.re_patient
+            processor = self.ft_patient
+            replacement = self.replacement_text_patient
+        else:
+            regex_ = self.re_tp
+            processor = self.ft_tp
+            replacement = self.replacement_text_third_party
+        if not processor:
+            return regex_.sub(replacement, text) if regex_ else text
+        if regex_:
+            matches = list(regex_.finditer(text))
+            if any(self._match_contains_keyword(text, m, processor)
+                   for m in matches):
+                return self._get_regex_with_all_elements(patient).sub(
+                    replacement, text)
+            # Replace the regex matches, as regex_.sub() would (but without
+            # searching again).
+            parts = []  # type: List[str]
+            pos = 0
+            for m in matches:
+                parts.append(text[pos:m.start()])
+                parts.append(m.expand(replacement))
+                pos = m.end()
+            parts.append(text[pos:])
+            text = "".join(parts)
+        return processor.replace_keywords(text)
+
+    @staticmethod
+    def _match_contains_keyword(text: str,
+                                match: Match,
+                                processor: KeywordProcessorFixed) -> bool:
+        """
+        Does a regex match (extended to whole words) contain any FlashText
+        keyword?
+        """
+        start, end = match.span()
+        while start > 0 and text[start - 1] in FLASHTEXT_WORD_CHARACTERS:
+            start -= 1
+        while end < len(text) and text[end] in FLASHTEXT_WORD_CHARACTERS:
+            end += 1
+        return bool(processor.extract_keywords(text[start:end]))
+
+    def _get_regex_with_all_elements(self, patient: bool) -> Pattern[str]:
+        """
+        Returns (building it if necessary) the patient or third-party regex
+        with all the elements, including those otherwise handled by FlashText.
+        """
+        if patient:
+            if self.re_patient_all is None:
+                self.re_patient_all = get_regex_from_elements(
+                    self.re_patient_elements)
+            return self.re_patient_all
+        if self.re_tp_all is None:
+            self.re_tp_all = get_regex_from_elements(self.re_tp_elements)
+        return self.re_tp_all
+
     def get_hash(self) -> str:
         # docstring in parent class
-        return self.hasher.hash(self.get_raw_info())
+        # Our settings are fixed, and the config-wide objects that we share
+        # are equivalent in any process (see attach_shared_objects), so only
+        # a change to our elements (see add_value) invalidates this.
+        if not self._cached_hash:
+            self._cached_hash = self.hasher.hash(self.get_raw_info())
+        return self._cached_hash
 
     def get_raw_info(self) -> Dict[str, Any]:
         """
@@ -787,6 +1112,11 @@ class PersonalizedScrubber(ScrubberBase):
              else None),
             ('elements', self.elements_tuplelist),
         )
+        if self.flashtext_exact_words:
+            # Only added if set, so that existing scrubber hashes are
+            # unaffected (FlashText and regex word boundaries can differ
+            # slightly, so a change of method should trigger re-scrubbing).
+            d += (('flashtext_exact_words', True), )
         return OrderedDict(d)
 
 
@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+
+"""
+crate_anon/anonymise/tests/anonymise_tests.py
+
+===============================================================================
+
+    Copyright (C) 2015-2021 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+"""
+
+from collections import defaultdict
+import logging
+import pickle
+from typing import Dict, List, Tuple
+from unittest import mock, TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import Column, MetaData, Table
+from sqlalchemy.sql import column
+from sqlalchemy.sql.sqltypes import Integer, String
+
+# Importing the anonymiser creates its config singleton, which needs a config
+# file unless we say otherwise. We patch in what we need below.
+with mock.patch("crate_anon.anonymise.config.RUNNING_WITHOUT_CONFIG", True):
+    from crate_anon.anonymise import anonymise
+    from crate_anon.anonymise.anonymise import (
+        _get_patient_in_worker,
+        check_nonpatient_layout,
+        DestinationHashLookup,
+        fetch_all_patient_ids,
+        gen_int_pk_blocks,
+        gen_patient_ids,
+        gen_rows_by_int_pk_block,
+        gen_rows_for_patients,
+        finish_patient_batch,
+        process_nonpatient_tables,
+        process_nonpatient_unit,
+        start_patient_batch,
+    )
+    from crate_anon.anonymise.models import (
+        admin_meta,
+        NonPatientProgress,
+        PatientProgress,
+    )
+    from crate_anon.anonymise.patient import DetachedPatient
+
+
+class DestinationHashLookupTests(TestCase):
+    def setUp(self) -> None:
+        self.engine = create_engine("sqlite://")
+        metadata = MetaData()
+        t = Table("dest", metadata,
+                  Column("pk", Integer, primary_key=True),
+                  Column("src_hash", String(64)),
+                  Column("rid", String(64)))
+        metadata.create_all(self.engine)
+        # PKs 0, 3, 6, ..., 57; hashes "h0", "h3", ...; two patients.
+        self.engine.execute(t.insert(), [
+            {"pk": pk, "src_hash": f"h{pk}", "rid": f"r{pk % 2}"}
+            for pk in range(0, 60, 3)
+        ])
+        self.session = sessionmaker(bind=self.engine)()
+        self.executed = 0
+        real_execute = self.session.execute
+
+        def counting_execute(*args, **kwargs):
+            self.executed += 1
+            return real_execute(*args, **kwargs)
+
+        self.session.execute = counting_execute
+        config = mock.Mock(source_hash_fieldname="src_hash",
+                           destdb=mock.Mock(session=self.session))
+        patcher = mock.patch.object(anonymise, "config", config)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.session.close)
+
+    def make_lookup(self, **kwargs) -> DestinationHashLookup:
+        return DestinationHashLookup("dest", "pk", with_hash=True, **kwargs)
+
+    def test_unpaged(self) -> None:
+        lookup = self.make_lookup()
+        self.assertEqual(self.executed, 1)
+        for pk in range(60):
+            exists = pk % 3 == 0
+            self.assertEqual(lookup.identical_record_exists_by_pk(pk), exists)
+            self.assertEqual(
+                lookup.identical_record_exists_by_hash(pk, f"h{pk}"), exists)
+            self.assertFalse(lookup.identical_record_exists_by_hash(pk, "x"))
+        self.assertEqual(self.executed, 1)
+
+    def test_unpaged_where(self) -> None:
+        lookup = self.make_lookup(where=[column("rid") == "r1"])
+        self.assertTrue(lookup.identical_record_exists_by_pk(3))
+        self.assertFalse(lookup.identical_record_exists_by_pk(6))
+
+    def test_without_hash(self) -> None:
+        lookup = DestinationHashLookup("dest", "pk", with_hash=False)
+        self.assertTrue(lookup.identical_record_exists_by_pk(57))
+        self.assertFalse(lookup.identical_record_exists_by_pk(58))
+        with self.assertRaises(AssertionError):
+            lookup.identical_record_exists_by_hash(57, "h57")
+
+    def test_paged_across_page_boundaries(self) -> None:
+        lookup = self.make_lookup(paged=True, chunksize=4)
+        self.assertEqual(self.executed, 0)
+        for pk in range(70):
+            exists = pk % 3 == 0 and pk < 60
+            self.assertEqual(
+                lookup.identical_record_exists_by_hash(pk, f"h{pk}"), exists,
+                f"pk={pk}")
+        # 20 rows, 4 per page: 5 full pages and one (empty) final page; no
+        # queries once the table is exhausted.
+        self.assertEqual(self.executed, 6)
+
+    def test_paged_skips_unasked_stretches(self) -> None:
+        lookup = self.make_lookup(paged=True, chunksize=2)
+        self.assertTrue(lookup.identical_record_exists_by_pk(0))
+        self.assertTrue(lookup.identical_record_exists_by_pk(45))
+        self.assertTrue(lookup.identical_record_exists_by_pk(48))
+        self.assertEqual(self.executed, 2)
+
+    def test_paged_out_of_order_falls_back(self) -> None:
+        lookup = self.make_lookup(paged=True, chunksize=4)
+        self.assertTrue(lookup.identical_record_exists_by_hash(30, "h30"))
+        self.assertEqual(self.executed, 1)
+        # Earlier PKs, no longer in memory, are answered by per-row queries.
+        self.assertTrue(lookup.identical_record_exists_by_hash(3, "h3"))
+        self.assertFalse(lookup.identical_record_exists_by_hash(3, "x"))
+        self.assertFalse(lookup.identical_record_exists_by_pk(4))
+        self.assertEqual(self.executed, 4)
+        # ... and it carries on from memory for later ones.
+        self.assertTrue(lookup.identical_record_exists_by_hash(33, "h33"))
+        self.assertEqual(self.executed, 4)
+
+
+class GenIntPkBlocksTests(TestCase):
+    # PKs either side of each block edge (blocksize 10), a gap, and a
+    # negative PK; "pk" need not be unique, so 20 appears twice.
+    PKS = [-1, 0, 9, 10, 19, 20, 20, 21, 55, 99, 100, 1000]
+
+    def setUp(self) -> None:
+        engine = create_engine("sqlite://")
+        metadata = MetaData()
+        self.t = Table("things", metadata,
+                       Column("id", Integer, primary_key=True),
+                       Column("pk", Integer))
+        metadata.create_all(engine)
+        engine.execute(self.t.insert(), [{"id": i, "pk": pk}
+                                         for i, pk in enumerate(self.PKS)])
+        self.session = sessionmaker(bind=engine)()
+        self.addCleanup(self.session.close)
+        config = mock.Mock(
+            sources={"db": mock.Mock(session=self.session,
+                                     metadata=metadata)})
+        patcher = mock.patch.object(anonymise, "config", config)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def blocks(self, tasknum: int = 0, ntasks: int = 1,
+               blocksize: int = 10) -> List[Tuple[int, int]]:
+        return list(gen_int_pk_blocks("db", "things", "pk", tasknum=tasknum,
+                                      ntasks=ntasks, blocksize=blocksize))
+
+    def rows(self, pk_range: Tuple[int, int],
+             pagesize: int) -> List[int]:
+        return [row[0] for row in gen_rows_by_int_pk_block(
+            "db", "things", [column("id")], "pk", pk_range,
+            pagesize=pagesize)]
+
+    def test_single_task(self) -> None:
+        # Only blocks containing rows; edges are inclusive-exclusive.
+        self.assertEqual(self.blocks(), [
+            (-10, 0), (0, 10), (10, 20), (20, 30), (50, 60), (90, 100),
+            (100, 110), (1000, 1010),
+        ])
+
+    def test_blocksize_one(self) -> None:
+        self.assertEqual(self.blocks(blocksize=1),
+                         [(pk, pk + 1) for pk in sorted(set(self.PKS))])
+
+    def test_tasks_divide_blocks(self) -> None:
+        all_blocks = self.blocks()
+        for ntasks in (2, 3, 7):
+            by_task = [self.blocks(tasknum, ntasks) for tasknum in
+                       range(ntasks)]
+            for tasknum, blocks in enumerate(by_task):
+                self.assertTrue(all((lo // 10) % ntasks == tasknum
+                                    for lo, _ in blocks))
+            self.assertEqual(sorted(sum(by_task, [])), all_blocks)
+
+    def test_task_with_no_blocks(self) -> None:
+        # Blocks -1, 0, 1, 2, 5, 9, 10, 100; none is 3 (mod 11).
+        self.assertEqual(self.blocks(tasknum=3, ntasks=11), [])
+
+    def test_empty_table(self) -> None:
+        self.session.execute(self.t.delete())
+        self.assertEqual(self.blocks(), [])
+
+    def test_rows_by_block(self) -> None:
+        for pagesize in (1, 2, 3, 100):
+            ids = []  # type: List[int]
+            for pk_range in self.blocks():
+                ids.extend(self.rows(pk_range, pagesize))
+            # Every row once, in PK order (ties in either order).
+            self.assertEqual(sorted(ids), list(range(len(self.PKS))))
+            self.assertEqual([self.PKS[i] for i in ids], sorted(self.PKS))
+
+    def test_rows_at_block_edges(self) -> None:
+        self.assertEqual(self.rows((10, 20), pagesize=1), [3, 4])
+        self.assertEqual(sorted(self.rows((20, 30), pagesize=1)), [5, 6, 7])
+        self.assertEqual(self.rows((30, 50), pagesize=1), [])
+
+
+class GenRowsForPatientsTests(TestCase):
+    def setUp(self) -> None:
+        engine = create_engine("sqlite://")
+        metadata = MetaData()
+        t = Table("notes", metadata,
+                  Column("pk", Integer, primary_key=True),
+                  Column("pid", Integer),
+                  Column("note", String(50)))
+        metadata.create_all(engine)
+        engine.execute(t.insert(), [
+            {"pk": pk, "pid": pk % 4, "note": f"note {pk}"}
+            for pk in range(20)
+        ])
+        session = sessionmaker(bind=engine)()
+        self.addCleanup(session.close)
+        self.config = mock.Mock(
+            sources={"db": mock.Mock(session=session, metadata=metadata)},
+            rows_inserted_per_table=defaultdict(int),
+            warned_re_limits=defaultdict(bool),
+        )
+        self.config.dd.get_pid_name.return_value = "pid"
+        patcher = mock.patch.object(anonymise, "config", self.config)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_rows_tagged_with_pid(self) -> None:
+        rows = sorted(gen_rows_for_patients("db", "notes", ["pk", "note"],
+                                            pids=[1, 3, 99]))
+        self.assertEqual(rows, sorted(
+            (pk % 4, [pk, f"note {pk}"]) for pk in range(20) if pk % 2
+        ))
+        self.assertEqual(self.config.rows_inserted_per_table[("db", "notes")],
+                         10)
+        self.config.dd.get_pid_name.assert_called_with("db", "notes")
+
+    def test_no_matching_patients(self) -> None:
+        self.assertEqual(
+            list(gen_rows_for_patients("db", "notes", ["pk"], pids=[99])), [])
+
+    def test_debug_limit(self) -> None:
+        # The limit is per table, shared with earlier calls (as for gen_rows).
+        with self.assertLogs(level=logging.WARNING) as logging_cm:
+            first = list(gen_rows_for_patients("db", "notes", ["pk"],
+                                               pids=[0, 1], debuglimit=6))
+            second = list(gen_rows_for_patients("db", "notes", ["pk"],
+                                                pids=[2, 3], debuglimit=6))
+        self.assertEqual(len(first), 6)
+        self.assertEqual(second, [])
+        self.assertEqual(len(logging_cm.output), 1)
+        self.assertIn("debugging limits", logging_cm.output[0])
+
+
+class GenPatientIdsTests(TestCase):
+    def setUp(self) -> None:
+        engine = create_engine("sqlite://")
+        metadata = MetaData()
+        t = Table("notes", metadata,
+                  Column("pk", Integer, primary_key=True),
+                  Column("pid", Integer))
+        metadata.create_all(engine)
+        engine.execute(t.insert(), [{"pk": pk, "pid": pk % 7 + 1}
+                                    for pk in range(30)])
+        session = sessionmaker(bind=engine)()
+        self.addCleanup(session.close)
+        self.config = mock.Mock(
+            sources={"db": mock.Mock(session=session)},
+            pidtype_is_integer=True,
+            debug_pid_list=[],
+            debug_max_n_patients=0,
+        )
+        self.config.dd.n_definers = 1
+        self.config.dd.rows = [mock.Mock(defines_primary_pids=True,
+                                         src_db="db",
+                                         src_table="notes",
+                                         src_field="pid")]
+        patcher = mock.patch.object(anonymise, "config", self.config)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_all_pids_divided_as_by_database(self) -> None:
+        all_pids = fetch_all_patient_ids()
+        self.assertEqual(sorted(all_pids), [1, 2, 3, 4, 5, 6, 7])
+        for ntasks in (1, 2, 4):
+            for tasknum in range(ntasks):
+                from_db = list(gen_patient_ids(tasknum, ntasks))
+                with mock.patch.object(self.config, "sources", {}):
+                    # ... no database needed
+                    from_list = list(gen_patient_ids(tasknum, ntasks,
+                                                     all_pids=all_pids))
+                self.assertEqual(sorted(from_list), sorted(from_db))
+
+    def test_all_pids_debug_limit(self) -> None:
+        self.config.debug_max_n_patients = 2
+        with self.assertLogs(level=logging.WARNING):
+            pids = list(gen_patient_ids(all_pids=[1, 2, 3, 4]))
+        self.assertEqual(pids, [1, 2])
+
+
+class WorkerPatientTests(TestCase):
+    def setUp(self) -> None:
+        patcher = mock.patch.object(
+            anonymise, "config",
+            mock.Mock(patients_per_extraction_batch=2))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(anonymise, "_WORKER_PATIENTS",
+                                    anonymise.OrderedDict())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.n_attached = 0
+
+    def make_pickle(self, pid: int) -> bytes:
+        patient = DetachedPatient.__new__(DetachedPatient)
+        patient.pid = pid
+        return pickle.dumps(patient)
+
+    def get(self, pid: int) -> DetachedPatient:
+        def attach(patient: DetachedPatient) -> None:
+            self.n_attached += 1
+
+        with mock.patch.object(DetachedPatient, "attach_shared_objects",
+                               attach):
+            return _get_patient_in_worker((str(pid), "hash"),
+                                          self.make_pickle(pid))
+
+    def test_unpickled_once_per_batch(self) -> None:
+        p1 = self.get(1)
+        p2 = self.get(2)
+        self.assertEqual((p1.pid, p2.pid), (1, 2))
+        # The same patients come round again, e.g. for the next table.
+        self.assertIs(self.get(1), p1)
+        self.assertIs(self.get(2), p2)
+        self.assertEqual(self.n_attached, 2)
+        # The next batch pushes out the oldest.
+        self.get(3)
+        self.assertIs(self.get(2), p2)
+        self.assertIsNot(self.get(1), p1)
+        self.assertEqual(self.n_attached, 4)
+
+
+class ResumeTests(TestCase):
+    def setUp(self) -> None:
+        engine = create_engine("sqlite://")
+        admin_meta.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.addCleanup(self.session.close)
+        self.config = mock.Mock(admindb=mock.Mock(session=self.session),
+                                nonpatient_pk_block_size=10)
+        self.mocks = {}  # type: Dict[str, mock.Mock]
+        for name, value in (
+                ("config", self.config),
+                ("get_dd_hash", mock.Mock(return_value="dd")),
+                ("process_table", mock.Mock()),
+                ("delete_dest_rows_for_nonpatient_unit", mock.Mock()),
+                ("delete_dest_rows_for_patients", mock.Mock()),
+                ("log_table_peak_memory", mock.Mock())):
+            patcher = mock.patch.object(anonymise, name, value)
+            self.mocks[name] = patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def patient(pid: int, scrubber_hash: str = "s") -> mock.Mock:
+        return mock.Mock(pid=pid, rid=f"r{pid}", scrubber_hash=scrubber_hash)
+
+    def completed_pids(self) -> List[int]:
+        return sorted(p.pid for p in self.session.query(PatientProgress)
+                      if p.completed)
+
+    def test_interrupted_patient_batch(self) -> None:
+        p1, p2, p3, p4 = [self.patient(pid) for pid in (1, 2, 3, 4)]
+        # One batch finished; the next interrupted (not finished).
+        _, records = start_patient_batch([(p1, False)], "dd")
+        finish_patient_batch(records)
+        start_patient_batch([(p2, False), (p3, False)], "dd")
+        self.assertEqual(self.completed_pids(), [1])
+
+        # Resuming: patient 1 is skipped; 2 and 3 are deleted and redone.
+        todo, records = start_patient_batch(
+            [(p1, False), (p2, False), (p3, False), (p4, False)], "dd",
+            resume=True)
+        self.assertEqual([p.pid for p, _ in todo], [2, 3, 4])
+        self.mocks["delete_dest_rows_for_patients"].assert_called_once_with(
+            ["r2", "r3"])
+        finish_patient_batch(records)
+        self.assertEqual(self.completed_pids(), [1, 2, 3, 4])
+
+        # A changed scrubber means redoing a completed patient, too.
+        todo, _ = start_patient_batch(
+            [(self.patient(1, "changed"), False), (p2, False)], "dd",
+            resume=True)
+        self.assertEqual([p.pid for p, _ in todo], [1])
+
+    def test_interrupted_nonpatient_unit(self) -> None:
+        process_table = self.mocks["process_table"]
+        delete = self.mocks["delete_dest_rows_for_nonpatient_unit"]
+        process_table.side_effect = RuntimeError("interrupted")
+        with self.assertLogs(level=logging.CRITICAL):
+            with self.assertRaises(RuntimeError):
+                process_nonpatient_unit("db", "t", "pk_blocks:10",
+                                        intpkname="pk", pk_range=(0, 10))
+        process_table.side_effect = None
+        record = NonPatientProgress.get_unit(self.session, "db", "t",
+                                             pk_range=(0, 10))
+        self.assertFalse(record.completed)
+        self.assertEqual(record.layout, "pk_blocks:10")
+
+        # Resuming: the partial data is deleted, and the unit redone.
+        process_nonpatient_unit("db", "t", "pk_blocks:10", intpkname="pk",
+                                pk_range=(0, 10), resume=True)
+        delete.assert_called_once_with("db", "t", intpkname="pk",
+                                       pk_range=(0, 10), tasknum=0, ntasks=1)
+        self.assertEqual(process_table.call_count, 2)
+        self.assertTrue(NonPatientProgress.get_unit(
+            self.session, "db", "t", pk_range=(0, 10)).completed)
+
+        # Resuming again: nothing to do.
+        process_nonpatient_unit("db", "t", "pk_blocks:10", intpkname="pk",
+                                pk_range=(0, 10), resume=True)
+        self.assertEqual(process_table.call_count, 2)
+        self.assertEqual(delete.call_count, 1)
+
+    def test_changed_layout(self) -> None:
+        process_nonpatient_unit("db", "t", "pk_blocks:10", intpkname="pk",
+                                pk_range=(0, 10))
+        check_nonpatient_layout("db", "t", "pk_blocks:10")
+        check_nonpatient_layout("db", "other", "pk_blocks:20")
+        with self.assertRaises(ValueError):
+            check_nonpatient_layout("db", "t", "pk_blocks:20")
+
+        # The check happens before any work on the table.
+        self.config.nonpatient_pk_block_size = 20
+        with mock.patch.object(anonymise,
+                               "gen_nonpatient_tables_with_int_pk",
+                               return_value=[("db", "t", "pk")]), \
+                mock.patch.object(anonymise, "gen_int_pk_blocks",
+                                  return_value=[(0, 20)]):
+            with self.assertRaises(ValueError):
+                process_nonpatient_tables(resume=True)
+        self.assertEqual(self.mocks["process_table"].call_count, 1)
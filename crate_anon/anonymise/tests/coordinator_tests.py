@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""
+crate_anon/anonymise/tests/coordinator_tests.py
+
+===============================================================================
+
+    Copyright (C) 2015-2021 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+"""
+
+from unittest import mock, TestCase
+
+from crate_anon.anonymise.coordinator import gen_work_units, WorkCoordinator
+
+
+class WorkCoordinatorTests(TestCase):
+    def setUp(self) -> None:
+        self.coordinator = WorkCoordinator()
+        self.coordinator.add_units("PATIENT", 3)
+        self.coordinator.add_units("NONPATIENT", 1)
+
+    def test_units_handed_out_once(self) -> None:
+        self.assertEqual(self.coordinator.next_unit("PATIENT", 0), (0, 3))
+        self.assertEqual(self.coordinator.next_unit("PATIENT", 1), (1, 3))
+        self.assertEqual(self.coordinator.next_unit("PATIENT", 0), (2, 3))
+        self.assertIsNone(self.coordinator.next_unit("PATIENT", 1))
+
+    def test_all_finished(self) -> None:
+        for cluster in ("PATIENT", "NONPATIENT"):
+            while self.coordinator.next_unit(cluster, 0) is not None:
+                self.coordinator.unit_done(cluster, 0, n_rows_written=10)
+        self.assertEqual(self.coordinator.get_unfinished_units(), [])
+        self.assertIn("PATIENT process 0: 3 units done, 30 rows written",
+                      self.coordinator.progress_report())
+
+    def test_unfinished_units(self) -> None:
+        # Process 0 finishes a unit; process 1 takes one and then dies.
+        self.coordinator.next_unit("PATIENT", 0)
+        self.coordinator.unit_done("PATIENT", 0, n_rows_written=5)
+        self.coordinator.next_unit("PATIENT", 1)
+        self.assertEqual(self.coordinator.get_unfinished_units(), [
+            ("NONPATIENT", 0), ("PATIENT", 1), ("PATIENT", 2),
+        ])
+
+
+class GenWorkUnitsTests(TestCase):
+    def test_without_coordinator(self) -> None:
+        self.assertEqual(list(gen_work_units("PATIENT", 2, 4)), [(2, 4)])
+
+    def test_abandoned_unit_not_marked_done(self) -> None:
+        coordinator = WorkCoordinator()
+        coordinator.add_units("PATIENT", 2)
+        with mock.patch(
+                "crate_anon.anonymise.coordinator.connect_to_coordinator",
+                return_value=coordinator):
+            units = gen_work_units("PATIENT", 0, 1,
+                                   coordinator_address="127.0.0.1:1")
+            self.assertEqual(next(units), (0, 2))
+            self.assertEqual(next(units), (1, 2))
+            # e.g. an exception while processing unit 1
+            units.close()
+        self.assertEqual(coordinator.get_unfinished_units(), [("PATIENT", 1)])
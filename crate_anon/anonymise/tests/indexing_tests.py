@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""
+crate_anon/anonymise/tests/indexing_tests.py
+
+===============================================================================
+
+    Copyright (C) 2015-2021 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+"""
+
+import os
+from tempfile import TemporaryDirectory
+from typing import Dict, List
+from unittest import TestCase
+
+from cardinal_pythonlib.sqlalchemy.dialect import SqlaDialectName
+from cardinal_pythonlib.sqlalchemy.schema import index_exists
+from sqlalchemy import create_engine
+from sqlalchemy.engine.base import Engine
+from sqlalchemy.schema import Column, MetaData, Table
+from sqlalchemy.sql.sqltypes import Integer, String
+
+from crate_anon.anonymise.indexing import (
+    build_indexes,
+    get_approx_n_rows,
+    IndexBuildOptions,
+    IndexJob,
+    TableIndexJobs,
+)
+
+
+class IndexBuildOptionsTests(TestCase):
+    def test_sql_suffix(self) -> None:
+        self.assertEqual(IndexBuildOptions().get_sql_suffix(
+            SqlaDialectName.MSSQL), "")
+        self.assertEqual(
+            IndexBuildOptions(
+                mssql_sort_in_tempdb=True, mssql_maxdop=4
+            ).get_sql_suffix(SqlaDialectName.MSSQL),
+            " WITH (SORT_IN_TEMPDB = ON, MAXDOP = 4)")
+        options = IndexBuildOptions(mssql_online=True,
+                                    mysql_algorithm="inplace")
+        self.assertEqual(options.get_sql_suffix(SqlaDialectName.MSSQL),
+                         " WITH (ONLINE = ON)")
+        self.assertEqual(options.get_sql_suffix(SqlaDialectName.MYSQL),
+                         " ALGORITHM = INPLACE")
+        self.assertEqual(options.get_sql_suffix(SqlaDialectName.SQLITE), "")
+
+
+class BuildIndexesTests(TestCase):
+    """
+    Builds indexes on a SQLite database. (SQLite index names are unique
+    across the database, hence the different column names in each table.)
+    """
+    def setUp(self) -> None:
+        self.tempdir = TemporaryDirectory()
+        self.url = "sqlite:///" + os.path.join(self.tempdir.name, "dest.db")
+        engine = self.make_engine()
+        metadata = MetaData()
+        self.tables = {}  # type: Dict[str, Table]
+        for tablename, n_rows in (("small", 2), ("big", 20), ("medium", 10)):
+            t = Table(tablename, metadata,
+                      Column("pk", Integer, primary_key=True),
+                      Column(f"{tablename}_rid", String(32)),
+                      Column(f"{tablename}_trid", Integer))
+            t.create(engine)
+            engine.execute(t.insert(), [
+                {"pk": i, f"{tablename}_rid": f"r{i}", f"{tablename}_trid": i}
+                for i in range(n_rows)
+            ])
+            self.tables[tablename] = t
+        engine.dispose()
+
+    def tearDown(self) -> None:
+        self.tempdir.cleanup()
+
+    def make_engine(self) -> Engine:
+        return create_engine(self.url)
+
+    def assert_indexes_exist(self, engine: Engine) -> None:
+        for tablename in self.tables:
+            for suffix in ("rid", "trid"):
+                self.assertTrue(index_exists(
+                    engine, tablename, f"_idx_{tablename}_{suffix}"))
+
+    def make_plan(self, engine: Engine) -> List[TableIndexJobs]:
+        return [
+            TableIndexJobs(
+                tablename,
+                [IndexJob(t.columns[f"{tablename}_rid"]),
+                 IndexJob(t.columns[f"{tablename}_trid"], unique=True)],
+                n_rows=get_approx_n_rows(engine, tablename))
+            for tablename, t in self.tables.items()
+        ]
+
+    def test_serial(self) -> None:
+        engine = self.make_engine()
+        results = build_indexes(self.make_plan(engine),
+                                engine_factory=self.make_engine)
+        self.assertEqual([str(job) for job, _ in results], [
+            "big(big_rid)", "big(big_trid) (unique)",
+            "medium(medium_rid)", "medium(medium_trid) (unique)",
+            "small(small_rid)", "small(small_trid) (unique)",
+        ])
+        self.assert_indexes_exist(engine)
+        # Again: existing indexes are skipped.
+        self.assertEqual(len(build_indexes(self.make_plan(engine),
+                                           engine_factory=self.make_engine)),
+                         6)
+
+    def test_parallel(self) -> None:
+        engine = self.make_engine()
+        results = build_indexes(self.make_plan(engine),
+                                engine_factory=self.make_engine,
+                                n_connections=2)
+        self.assertEqual(len(results), 6)
+        self.assert_indexes_exist(engine)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+"""
+crate_anon/anonymise/tests/models_tests.py
+
+===============================================================================
+
+    Copyright (C) 2015-2021 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+"""
+
+import datetime
+from typing import List
+from unittest import mock, TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# The models' column types come from the config singleton, which needs a
+# config file unless we say otherwise.
+with mock.patch("crate_anon.anonymise.config.RUNNING_WITHOUT_CONFIG", True):
+    from crate_anon.anonymise import models
+    from crate_anon.anonymise.models import (
+        admin_meta,
+        PatientInfo,
+        ScrubberRegexCacheRecord,
+        TridRecord,
+    )
+
+
+class PatientInfoGetOrCreateManyTests(TestCase):
+    def setUp(self) -> None:
+        engine = create_engine("sqlite://")
+        admin_meta.create_all(engine)
+        self.sessionmaker = sessionmaker(bind=engine)
+        self.session = self.sessionmaker()
+        self.addCleanup(self.session.close)
+        patcher = mock.patch.object(
+            models, "config",
+            mock.Mock(encrypt_primary_pid=lambda pid: f"rid{pid}"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Patient 1 is fully known; patient 2 has only a TRID (e.g. from an
+        # interrupted run); patients 3 and 4 are new.
+        # noinspection PyArgumentList
+        self.session.add(PatientInfo(pid=1, rid="old1", trid=111))
+        # noinspection PyArgumentList
+        self.session.add(TridRecord(pid=1, trid=111))
+        # noinspection PyArgumentList
+        self.session.add(TridRecord(pid=2, trid=222))
+        self.session.commit()
+
+    def test_empty(self) -> None:
+        self.assertEqual(PatientInfo.get_or_create_many(self.session, []), {})
+
+    def test_mixed_existing_and_new(self) -> None:
+        infos = PatientInfo.get_or_create_many(self.session, [3, 1, 2, 4])
+        self.assertEqual(sorted(infos.keys()), ["1", "2", "3", "4"])
+        self.assertEqual(
+            {k: (info.pid, info.rid) for k, info in infos.items()},
+            {"1": (1, "old1"), "2": (2, "rid2"), "3": (3, "rid3"),
+             "4": (4, "rid4")})
+        # Existing TRIDs are kept; new ones are distinct and remembered.
+        self.assertEqual(infos["1"].trid, 111)
+        self.assertEqual(infos["2"].trid, 222)
+        trids = [info.trid for info in infos.values()]
+        self.assertEqual(len(set(trids)), 4)
+
+        # Everything has been committed.
+        other = self.sessionmaker()
+        self.addCleanup(other.close)
+        self.assertEqual(
+            sorted(other.query(PatientInfo.pid, PatientInfo.trid)),
+            sorted((int(k), info.trid) for k, info in infos.items()))
+        self.assertEqual(
+            sorted(other.query(TridRecord.pid, TridRecord.trid)),
+            sorted((int(k), info.trid) for k, info in infos.items()))
+
+        # A second call finds them all, and creates nothing.
+        again = PatientInfo.get_or_create_many(self.session, [1, 2, 3, 4])
+        for k, info in again.items():
+            self.assertEqual((info.pid, info.rid, info.trid),
+                             (infos[k].pid, infos[k].rid, infos[k].trid))
+        self.assertEqual(other.query(PatientInfo).count(), 4)
+
+    def test_trid_clash(self) -> None:
+        # The first candidate TRID for a new patient is already taken, so
+        # the bulk insert fails and we fall back to one at a time.
+        with mock.patch("crate_anon.anonymise.models.random.randint",
+                        side_effect=[222, 333]):
+            infos = PatientInfo.get_or_create_many(self.session, [1, 3])
+        self.assertEqual(infos["1"].trid, 111)
+        self.assertEqual(infos["3"].trid, 333)
+        self.assertEqual(self.session.query(PatientInfo).count(), 2)
+
+
+class ScrubberRegexCacheRecordTests(TestCase):
+    def setUp(self) -> None:
+        engine = create_engine("sqlite://")
+        admin_meta.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.addCleanup(self.session.close)
+        for n, key in enumerate(["a", "b", "c", "d"]):
+            # noinspection PyArgumentList
+            self.session.add(ScrubberRegexCacheRecord(
+                key=key, regexes=b"x",
+                when_last_used_utc=datetime.datetime(2020, 1, 1 + n)))
+        self.session.commit()
+
+    def keys(self) -> List[str]:
+        return sorted(k for k, in self.session.query(
+            ScrubberRegexCacheRecord.key))
+
+    def test_get_marks_used(self) -> None:
+        self.assertEqual(
+            ScrubberRegexCacheRecord.get_regexes(self.session, "a"), b"x")
+        self.assertIsNone(
+            ScrubberRegexCacheRecord.get_regexes(self.session, "z"))
+        self.assertEqual(ScrubberRegexCacheRecord.evict(self.session, 2), 2)
+        self.assertEqual(self.keys(), ["a", "d"])
+
+    def test_evict(self) -> None:
+        self.assertEqual(ScrubberRegexCacheRecord.evict(self.session, 4), 0)
+        self.assertEqual(ScrubberRegexCacheRecord.evict(self.session, 3), 1)
+        self.assertEqual(self.keys(), ["b", "c", "d"])
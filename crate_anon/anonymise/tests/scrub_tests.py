@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+
+"""
+crate_anon/anonymise/tests/scrub_tests.py
+
+===============================================================================
+
+    Copyright (C) 2015-2021 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+"""
+
+import logging
+import os
+import pickle
+from unittest import mock, TestCase
+
+from cardinal_pythonlib.hash import make_hasher
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from crate_anon.anonymise import scrub
+from crate_anon.anonymise.constants import SCRUBMETHOD
+from crate_anon.anonymise.scrub import (
+    NonspecificScrubber,
+    PersonalizedScrubber,
+    ScrubberRegexCache,
+    WordList,
+)
+
+# The models' column types come from the config singleton, which needs a
+# config file unless we say otherwise.
+with mock.patch("crate_anon.anonymise.config.RUNNING_WITHOUT_CONFIG", True):
+    from crate_anon.anonymise.models import ScrubberRegexCacheRecord
+
+
+NOTE_PARAGRAPH = (
+    "Reviewed Mr John Smith (DOB 14/03/1961) in clinic today with his "
+    "daughter Mary Jones. He lives at 42 Privet Drive, Little Whinging, "
+    "CB2 0QQ, and can be reached on 01223 123456. NHS number 9876543210. "
+    "He reports low mood for the last 4-5 years, poor sleep and reduced "
+    "appetite; he has lost about 6 kg since March 2020. His GP, Dr Brown, "
+    "started sertraline 50 mg in 2019, which he stopped after 3 weeks. "
+    "Mary says that he has been more withdrawn since his wife's death. "
+    "No thoughts of self-harm. Plan: review in 6 weeks; letter to GP.\n"
+)
+
+
+class PersonalizedScrubberTests(TestCase):
+    def setUp(self) -> None:
+        self.hasher = make_hasher("HMAC_MD5", "dummy_key")
+        self.nonspecific_scrubber = NonspecificScrubber(
+            replacement_text="[~~~]",
+            hasher=self.hasher,
+            denylist=WordList(words=["Whinging"],
+                              replacement_text="[~~~]",
+                              hasher=self.hasher),
+            scrub_all_numbers_of_n_digits=[10],
+            scrub_all_uk_postcodes=True,
+        )
+
+    def make_scrubber(self) -> PersonalizedScrubber:
+        scrubber = PersonalizedScrubber(
+            replacement_text_patient="[__PPP__]",
+            replacement_text_third_party="[__TTT__]",
+            hasher=self.hasher,
+            nonspecific_scrubber=self.nonspecific_scrubber,
+            scrub_string_suffixes=["s"],
+            string_max_regex_errors=1,
+            min_string_length_for_errors=4,
+        )
+        scrubber.add_value("John Smith", SCRUBMETHOD.WORDS)
+        scrubber.add_value("1961-03-14", SCRUBMETHOD.DATE)
+        scrubber.add_value("42 Privet Drive", SCRUBMETHOD.PHRASE)
+        scrubber.add_value("01223 123456", SCRUBMETHOD.NUMERIC)
+        scrubber.add_value("Mary Jones", SCRUBMETHOD.WORDS, patient=False)
+        return scrubber
+
+    def test_scrub(self) -> None:
+        result = self.make_scrubber().scrub(NOTE_PARAGRAPH)
+        for fragment in ("[__PPP__]", "[__TTT__]", "[~~~]"):
+            self.assertIn(fragment, result)
+        for fragment in ("Smith", "Mary", "Privet", "CB2", "9876543210",
+                         "Whinging"):
+            self.assertNotIn(fragment, result)
+
+    def test_hash_cached_until_changed(self) -> None:
+        scrubber = self.make_scrubber()
+        first = scrubber.get_hash()
+        self.assertEqual(first, self.hasher.hash(scrubber.get_raw_info()))
+        scrubber.add_value("John Smith", SCRUBMETHOD.WORDS)  # already there
+        self.assertEqual(scrubber.get_hash(), first)
+        scrubber.add_value("Mr Bean", SCRUBMETHOD.WORDS)
+        self.assertNotEqual(scrubber.get_hash(), first)
+        self.assertEqual(scrubber.get_hash(),
+                         self.hasher.hash(scrubber.get_raw_info()))
+
+
+class PersonalizedScrubberFlashTextTests(TestCase):
+    """
+    Compares :class:`PersonalizedScrubber` with and without FlashText for
+    exactly-matched words.
+    """
+    TEXTS = [
+        NOTE_PARAGRAPH,
+        # Case
+        "JOHN SMITH, john smith, jOhN sMiTh, Smiths, SMITHS.",
+        # Word boundaries
+        "Johnny Smithers; xJohn; John_Smith; John2; 2John; (John); "
+        "John's; John-Smith; Smith.John; Smithss",
+        # Overlapping terms, patient and third party
+        "Ann, Anna, Annabel, Annabels, Anne, Anna Ann Annabel, AnnAnna, "
+        "Annabel Smith-Annabel, Smithson, Smithsons, Ann Smithson.",
+        # Accented letters are word characters to both
+        "Jöhn, Johné, Annà, àAnn, naïve Ann",
+        # Phrases, numbers and codes containing words
+        "Lives at 12 Smith Road, 12 smith road, 12 Smiths Road, Smith Road.",
+        "John Street Hospital; John Street; Street Hospital John.",
+        "Call 01223 123456 or 01223-123456; bed 123456, 123456.",
+        "Postcode CB2 1AB, cb21ab, CB2; ward CB2.",
+        "Anna lives in Smithson Close, close to Smithson.",
+        "",
+    ]
+
+    def setUp(self) -> None:
+        self.hasher = make_hasher("HMAC_MD5", "dummy_key")
+
+    def make_scrubber(self, flashtext: bool,
+                      words_first: bool = True) -> PersonalizedScrubber:
+        scrubber = PersonalizedScrubber(
+            replacement_text_patient="[__PPP__]",
+            replacement_text_third_party="[__TTT__]",
+            hasher=self.hasher,
+            scrub_string_suffixes=["s"],
+            string_max_regex_errors=0,
+            flashtext_exact_words=flashtext,
+        )
+        words = [
+            ("John Smith", SCRUBMETHOD.WORDS, True),
+            ("Ann Annabel", SCRUBMETHOD.WORDS, True),
+            ("Bed 123456", SCRUBMETHOD.WORDS, True),
+            ("Ward CB2", SCRUBMETHOD.WORDS, True),
+            ("Anna", SCRUBMETHOD.WORDS, False),
+            ("Smithson", SCRUBMETHOD.WORDS, False),
+        ]
+        others = [
+            ("12 Smith Road", SCRUBMETHOD.PHRASE, True),
+            ("John Street Hospital", SCRUBMETHOD.PHRASE, True),
+            ("01223 123456", SCRUBMETHOD.NUMERIC, True),
+            ("CB2 1AB", SCRUBMETHOD.CODE, True),
+            ("Smithson Close", SCRUBMETHOD.PHRASE, False),
+        ]
+        values = words + others if words_first else others + words
+        for value, scrub_method, patient in values:
+            scrubber.add_value(value, scrub_method, patient=patient)
+        return scrubber
+
+    def test_same_results(self) -> None:
+        # Regex elements are tried in the order they were added, so check
+        # both orders.
+        for words_first in (True, False):
+            regex_scrubber = self.make_scrubber(flashtext=False,
+                                                words_first=words_first)
+            ft_scrubber = self.make_scrubber(flashtext=True,
+                                             words_first=words_first)
+            for text in self.TEXTS:
+                self.assertEqual(ft_scrubber.scrub(text),
+                                 regex_scrubber.scrub(text),
+                                 f"words_first={words_first}, text={text!r}")
+            # Check FlashText did the work.
+            self.assertIsNotNone(ft_scrubber.ft_patient)
+            self.assertIsNotNone(ft_scrubber.ft_tp)
+            self.assertIsNone(regex_scrubber.ft_patient)
+
+    def test_expected_results(self) -> None:
+        scrubber = self.make_scrubber(flashtext=True)
+        self.assertEqual(
+            scrubber.scrub("JOHN smiths met Anna, Annabel and xAnn."),
+            "[__PPP__] [__PPP__] met [__TTT__], [__PPP__] and xAnn.")
+        self.assertEqual(scrubber.scrub("Lives at 12 Smith Road."),
+                         "Lives at [__PPP__].")
+        self.assertEqual(
+            self.make_scrubber(flashtext=True, words_first=False).scrub(
+                "John Street Hospital"),
+            "[__PPP__]")
+
+    def test_full_regex_only_if_needed(self) -> None:
+        scrubber = self.make_scrubber(flashtext=True)
+        scrubber.scrub("John met Anna at 01224 999999, Smith Road.")
+        self.assertIsNone(scrubber.re_patient_all)
+        self.assertIsNone(scrubber.re_tp_all)
+        scrubber.scrub("Lives at 12 Smith Road.")
+        self.assertIsNotNone(scrubber.re_patient_all)
+        self.assertIsNone(scrubber.re_tp_all)
+
+    def test_hash_differs(self) -> None:
+        self.assertNotEqual(
+            self.make_scrubber(flashtext=False).get_hash(),
+            self.make_scrubber(flashtext=True).get_hash()
+        )
+
+
+class ScrubberRegexCacheTests(TestCase):
+    def setUp(self) -> None:
+        self.hasher = make_hasher("HMAC_MD5", "dummy_key")
+        engine = create_engine("sqlite://")
+        ScrubberRegexCacheRecord.__table__.create(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.addCleanup(self.session.close)
+        self.config = mock.Mock(
+            admindb=mock.Mock(session=self.session),
+            scrubber_regex_cache_max_entries=0)
+
+    def make_scrubber(self, cache: ScrubberRegexCache,
+                      name: str = "John Smith") -> PersonalizedScrubber:
+        scrubber = PersonalizedScrubber(
+            replacement_text_patient="[__PPP__]",
+            replacement_text_third_party="[__TTT__]",
+            hasher=self.hasher,
+            string_max_regex_errors=1,
+            min_string_length_for_errors=4,
+            regex_cache=cache,
+        )
+        scrubber.add_value(name, SCRUBMETHOD.WORDS)
+        scrubber.add_value("42 Privet Drive", SCRUBMETHOD.PHRASE)
+        scrubber.add_value("Mary Jones", SCRUBMETHOD.WORDS, patient=False)
+        return scrubber
+
+    def test_reused_in_later_run(self) -> None:
+        first_run = ScrubberRegexCache(self.config)
+        expected = self.make_scrubber(first_run).scrub(NOTE_PARAGRAPH)
+        self.assertEqual((first_run.n_hits, first_run.n_misses), (0, 1))
+        self.session.commit()
+
+        second_run = ScrubberRegexCache(self.config)
+        with mock.patch.object(scrub, "get_regex_from_elements") as compile_:
+            result = self.make_scrubber(second_run).scrub(NOTE_PARAGRAPH)
+        compile_.assert_not_called()
+        self.assertEqual(result, expected)
+        self.assertEqual((second_run.n_hits, second_run.n_misses), (1, 0))
+        self.assertEqual(str(second_run), "1 hits, 0 misses (100.0% hit rate)")
+
+        # A different scrubber isn't found.
+        self.make_scrubber(second_run, name="Jim Smith").build_regexes()
+        self.assertEqual((second_run.n_hits, second_run.n_misses), (1, 1))
+        self.assertEqual(self.session.query(ScrubberRegexCacheRecord).count(),
+                         2)
+
+    def test_key_covers_settings_outside_scrubber_hash(self) -> None:
+        cache = ScrubberRegexCache(self.config)
+        scrubber = self.make_scrubber(cache)
+        key = cache.get_key(scrubber)
+        scrubber.alternatives = [["street", "st"]]
+        self.assertNotEqual(cache.get_key(scrubber), key)
+
+    def test_only_regexes_unpickled(self) -> None:
+        cache = ScrubberRegexCache(self.config)
+        scrubber = self.make_scrubber(cache)
+        key = cache.get_key(scrubber)
+        ScrubberRegexCacheRecord.save_regexes(
+            self.session, key, pickle.dumps((os.getcwd, None)))
+        with self.assertLogs(level=logging.WARNING) as logging_cm:
+            self.assertIsNone(cache.get(key))
+        self.assertIn("Not a compiled regex", logging_cm.output[0])
+        self.assertEqual(cache.n_misses, 1)
+
+    def test_compiled_regexes_pickled(self) -> None:
+        scrubber = self.make_scrubber(ScrubberRegexCache(self.config))
+        expected = scrubber.scrub(NOTE_PARAGRAPH)
+        copy = pickle.loads(pickle.dumps(scrubber))
+        self.assertIsNone(copy.regex_cache)
+        with mock.patch.object(scrub, "get_regex_from_elements") as compile_:
+            self.assertEqual(copy.scrub(NOTE_PARAGRAPH), expected)
+        compile_.assert_not_called()
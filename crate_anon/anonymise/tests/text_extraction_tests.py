@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+"""
+crate_anon/anonymise/tests/text_extraction_tests.py
+
+===============================================================================
+
+    Copyright (C) 2015-2021 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+"""
+
+import logging
+from typing import List
+from unittest import mock, TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from crate_anon.anonymise.text_extraction import TextExtractor
+
+# The admin database models' column types come from the config singleton,
+# which needs a config file unless we say otherwise.
+with mock.patch("crate_anon.anonymise.config.RUNNING_WITHOUT_CONFIG", True):
+    from crate_anon.anonymise.models import (
+        admin_meta,
+        TextExtractionCacheRecord,
+    )
+
+TEXT = b"Some text."
+NOT_A_DOCX = b"Not a DOCX file."
+
+
+class TextExtractorTests(TestCase):
+    def setUp(self) -> None:
+        engine = create_engine("sqlite://")
+        admin_meta.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.addCleanup(self.session.close)
+
+    def make_extractor(self, processes: int = 0,
+                       max_chars: int = 0) -> TextExtractor:
+        config = mock.Mock(
+            admindb=mock.Mock(session=self.session),
+            extract_text_plain=True,
+            extract_text_width=80,
+            text_extraction_processes=processes,
+            text_extraction_timeout_s=0,
+            text_extraction_max_memory_mb=0,
+            text_extraction_cache=True,
+            text_extraction_cache_max_chars=max_chars,
+        )
+        extractor = TextExtractor(config)
+        self.addCleanup(extractor.shutdown)
+        return extractor
+
+    def cached_texts(self) -> List[str]:
+        return [text for text, in self.session.query(
+            TextExtractionCacheRecord.text)]
+
+    def test_cache_miss_then_hit(self) -> None:
+        first = self.make_extractor()
+        self.assertEqual(first.extract(None, TEXT, ".txt"),
+                         ("Some text.", True))
+        self.assertEqual((first.n_extractions, first.n_cache_hits), (1, 0))
+        self.assertEqual(self.cached_texts(), ["Some text."])
+
+        second = self.make_extractor()
+        with mock.patch.object(second, "_run",
+                               side_effect=AssertionError("not cached")):
+            self.assertEqual(second.extract(None, TEXT, ".txt"),
+                             ("Some text.", True))
+        self.assertEqual((second.n_extractions, second.n_cache_hits), (0, 1))
+
+    def test_prefetch_uses_cached_text(self) -> None:
+        self.make_extractor().extract(None, TEXT, ".txt")
+        extractor = self.make_extractor(processes=2)
+        with mock.patch.object(
+                TextExtractionCacheRecord, "get_text",
+                wraps=TextExtractionCacheRecord.get_text) as get_text:
+            self.assertIsNone(extractor.prefetch(None, TEXT, ".txt"))
+            self.assertEqual(extractor.extract(None, TEXT, ".txt"),
+                             ("Some text.", True))
+        # The cache is queried once, by prefetch(), not again by extract().
+        self.assertEqual(get_text.call_count, 1)
+        self.assertEqual(extractor.n_cache_hits, 1)
+
+    def test_prefetch_in_child_process(self) -> None:
+        extractor = self.make_extractor(processes=2)
+        future = extractor.prefetch(None, TEXT, ".txt")
+        self.assertEqual(future.result(), ("Some text.", True))
+        with mock.patch.object(extractor, "_run",
+                               side_effect=AssertionError("not prefetched")):
+            self.assertEqual(extractor.extract(None, TEXT, ".txt"),
+                             ("Some text.", True))
+        self.assertEqual(extractor.n_extractions, 1)
+        self.assertEqual(self.cached_texts(), ["Some text."])
+
+    def test_extraction_failure(self) -> None:
+        extractor = self.make_extractor()
+        with self.assertLogs(level=logging.ERROR):
+            self.assertEqual(extractor.extract(None, NOT_A_DOCX, ".docx"),
+                             (None, False))
+        self.assertEqual(self.cached_texts(), [])
+
+    def test_extraction_failure_in_child_process(self) -> None:
+        extractor = self.make_extractor(processes=1)
+        extractor.prefetch(None, NOT_A_DOCX, ".docx")
+        self.assertEqual(extractor.extract(None, NOT_A_DOCX, ".docx"),
+                         (None, False))
+        self.assertEqual(self.cached_texts(), [])
+
+    def test_long_text_not_cached(self) -> None:
+        extractor = self.make_extractor(max_chars=5)
+        self.assertEqual(extractor.extract(None, TEXT, ".txt"),
+                         ("Some text.", True))
+        self.assertEqual(self.cached_texts(), [])
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+"""
+crate_anon/anonymise/tests/timing_tests.py
+
+===============================================================================
+
+    Copyright (C) 2015-2021 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+"""
+
+import datetime
+import json
+import os
+from tempfile import TemporaryDirectory
+from typing import Generator
+from unittest import mock, TestCase
+
+from cardinal_pythonlib.timing import MultiTimer
+
+from crate_anon.anonymise.timing import (
+    AnonymiserTimings,
+    gen_timed,
+    get_timer_totals,
+)
+
+
+class FakeClock(object):
+    """
+    Stands in for both clocks that the timers use.
+    """
+    def __init__(self) -> None:
+        self.seconds = 0.0
+
+    def advance(self, seconds: float) -> None:
+        self.seconds += seconds
+
+    def perf_counter(self) -> float:
+        return self.seconds
+
+    def now(self) -> datetime.datetime:
+        return (datetime.datetime(2000, 1, 1) +
+                datetime.timedelta(seconds=self.seconds))
+
+
+class TimingTestCase(TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        for target, fn in (
+                ("cardinal_pythonlib.timing.get_now_utc_pendulum",
+                 self.clock.now),
+                ("crate_anon.anonymise.timing.time.perf_counter",
+                 self.clock.perf_counter)):
+            patcher = mock.patch(target, fn)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.multitimer = MultiTimer()
+
+
+class GenTimedTests(TimingTestCase):
+    def test_times_only_fetching(self) -> None:
+        def slow_source() -> Generator[str, None, None]:
+            for item in ("a", "b"):
+                self.clock.advance(1)
+                yield item
+            self.clock.advance(1)
+
+        items = []
+        for item in gen_timed(slow_source(), self.multitimer, "fetch"):
+            self.clock.advance(10)  # caller's work: not counted
+            items.append(item)
+        self.assertEqual(items, ["a", "b"])
+        # Three fetches (the last finding nothing more), one second each.
+        self.assertEqual(get_timer_totals(self.multitimer),
+                         {"fetch": {"seconds": 3.0, "count": 3}})
+
+    def test_empty(self) -> None:
+        self.assertEqual(list(gen_timed([], self.multitimer, "fetch")), [])
+        self.assertEqual(get_timer_totals(self.multitimer)["fetch"]["count"],
+                         1)
+
+
+class AnonymiserTimingsTests(TimingTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.timings = AnonymiserTimings()
+
+    def test_phases_accumulate(self) -> None:
+        with self.timings.phase("a"):
+            self.clock.advance(2)
+        with self.timings.phase("b", self.multitimer):
+            self.clock.advance(3)
+        with self.assertRaises(ValueError):
+            with self.timings.phase("a"):
+                self.clock.advance(1)
+                raise ValueError
+        self.assertEqual(self.timings.phases, {"a": 3.0, "b": 3.0})
+        self.assertEqual(get_timer_totals(self.multitimer),
+                         {"b": {"seconds": 3.0, "count": 1}})
+
+    def test_tables(self) -> None:
+        self.assertIsNone(self.timings.get_table("db", "t"))
+        self.timings.add_table("db", "t", 1.5, rows_read=10, rows_written=8,
+                               peak_memory_before=100, peak_memory_after=150)
+        self.timings.add_table("db", "t", 0.5, rows_read=2, rows_written=2,
+                               calls=3,
+                               peak_memory_before=150, peak_memory_after=150)
+        tt = self.timings.add_table("db", "t", 1.0)
+        self.assertIs(self.timings.get_table("db", "t"), tt)
+        self.assertEqual(tt.as_dict(), {
+            "seconds": 3.0,
+            "calls": 5,
+            "rows_read": 12,
+            "rows_written": 10,
+            "peak_memory_bytes": 150,
+            "memory_growth_bytes": 50,
+        })
+        self.assertIsNone(self.timings.add_table(
+            "db", "other", 1.0).peak_memory_bytes)
+
+    def test_indexes_accumulate(self) -> None:
+        self.timings.add_index("t.x", 1.0)
+        self.timings.add_index("t.x", 2.0)
+        self.timings.add_index("t.y", 0.5)
+        self.assertEqual(self.timings.indexes, {"t.x": 3.0, "t.y": 0.5})
+
+    def test_reset(self) -> None:
+        self.clock.advance(5)
+        with self.timings.phase("a"):
+            self.clock.advance(1)
+        self.timings.add_table("db", "t", 1.0)
+        self.timings.add_index("t.x", 1.0)
+        self.timings.reset()
+        self.clock.advance(2)
+        self.assertEqual(self.timings.as_dict(), {
+            "total_seconds": 2.0, "phases": {}, "tables": {}, "indexes": {},
+        })
+
+    def test_write_json(self) -> None:
+        with self.timings.phase("patient_tables", self.multitimer):
+            self.clock.advance(4)
+            self.timings.add_table("db", "t", 4.0, rows_read=1)
+        self.timings.add_index("t.x", 1.0)
+        self.clock.advance(1)
+        with TemporaryDirectory() as tempdir:
+            filename = os.path.join(tempdir, "timing.json")
+            self.timings.write_json(filename, self.multitimer, process=2)
+            with open(filename) as f:
+                d = json.load(f)
+        self.assertEqual(list(d.keys()), [
+            "process", "total_seconds", "phases", "tables", "indexes",
+            "timers",
+        ])
+        self.assertEqual(d["process"], 2)
+        self.assertEqual(d["total_seconds"], 5.0)
+        self.assertEqual(d["phases"], {"patient_tables": 4.0})
+        self.assertEqual(d["tables"]["db.t"]["rows_read"], 1)
+        self.assertEqual(d["indexes"], {"t.x": 1.0})
+        self.assertEqual(d["timers"],
+                         {"patient_tables": {"seconds": 4.0, "count": 1}})
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+
+"""
+crate_anon/anonymise/text_extraction.py
+
+===============================================================================
+
+    Copyright (C) 2015-2021 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+**Text extraction from documents (files or BLOBs), for the anonymiser.**
+
+Extracting text (e.g. from PDF, DOCX, RTF files) can be slow, and sometimes
+external converters hang or use a great deal of memory. The
+:class:`TextExtractor` can:
+
+- run each extraction in a separate child process (a fresh Python
+  interpreter, running this module), with a time limit and a memory limit;
+- run several of these at once, in advance of their results being needed
+  (see :meth:`TextExtractor.prefetch`), so that the anonymiser can carry on
+  with other rows meanwhile;
+- cache extracted text in the admin database, keyed by a hash of the
+  document's content (and our text extraction settings), so that unchanged
+  documents need not be extracted again in later runs. Note that this text is
+  raw, i.e. not scrubbed.
+
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import subprocess
+import sys
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional, Tuple, TYPE_CHECKING
+
+from cardinal_pythonlib.extract_text import (
+    document_to_text,
+    TextProcessingConfig,
+)
+
+if TYPE_CHECKING:
+    from crate_anon.anonymise.config import Config
+
+log = logging.getLogger(__name__)
+
+
+# =============================================================================
+# Extraction in a child process
+# =============================================================================
+
+def _extract_text(filename: Optional[str],
+                  blob: Optional[bytes],
+                  extension: Optional[str],
+                  plain: bool,
+                  width: int) -> Tuple[Optional[str], bool]:
+    """
+    Extracts text from a file or BLOB.
+
+    Returns:
+        tuple: ``text, extracted``
+    """
+    try:
+        textconfig = TextProcessingConfig(plain=plain, width=width)
+        text = document_to_text(filename=filename,
+                                blob=blob,
+                                extension=extension,
+                                config=textconfig)
+    except Exception as e:
+        # Runtime error
+        traceback.print_exc()  # full details, please
+        log.error(f"Caught exception from document_to_text: {e}")
+        return None, False
+    return text, True
+
+
+def _extract_text_in_child() -> None:
+    """
+    Runs in a child process (see :func:`extract_text_in_subprocess`): reads
+    its arguments, pickled, from stdin; applies a memory limit; extracts text
+    via :func:`_extract_text`; and writes the result, pickled, to stdout.
+    """
+    max_memory_mb, args = pickle.load(sys.stdin.buffer)
+    out = sys.stdout.buffer
+    sys.stdout = sys.stderr  # keep anything else away from our result
+    if max_memory_mb > 0:
+        import resource  # delayed import; Unix only
+        limit = max_memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        # ... inherited by any converter processes that we launch, too
+    try:
+        result = _extract_text(*args)
+    except MemoryError:
+        log.error(f"Text extraction exceeded memory limit of "
+                  f"{max_memory_mb} Mb")
+        result = None, False
+    pickle.dump(result, out)
+    out.flush()
+
+
+def extract_text_in_subprocess(filename: Optional[str],
+                               blob: Optional[bytes],
+                               extension: Optional[str],
+                               plain: bool,
+                               width: int,
+                               timeout_s: float = 0,
+                               max_memory_mb: int = 0) \
+        -> Tuple[Optional[str], bool]:
+    """
+    Extracts text from a file or BLOB in a child process, which is killed if
+    it takes too long.
+
+    The child is a new Python interpreter running this module, rather than a
+    fork of this process: we are called from several threads at once (see
+    :class:`TextExtractor`), and forking a multithreaded process can leave
+    the child deadlocked (e.g. on a lock held by another thread at the time).
+
+    Args:
+        filename: filename, or ``None``
+        blob: BLOB, or ``None``
+        extension: file extension (including ".")
+        plain: as per :class:`cardinal_pythonlib.extract_text.TextProcessingConfig`
+        width: as per :class:`cardinal_pythonlib.extract_text.TextProcessingConfig`
+        timeout_s: time limit in seconds (0 for none)
+        max_memory_mb: limit on the child process's address space, in Mb (0
+            for none)
+
+    Returns:
+        tuple: ``text, extracted``
+    """  # noqa
+    proc = subprocess.Popen(
+        [sys.executable, "-m", __name__],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    data = pickle.dumps(
+        (max_memory_mb, (filename, blob, extension, plain, width)))
+    try:
+        stdout, _ = proc.communicate(data,
+                                     timeout=timeout_s if timeout_s > 0
+                                     else None)
+    except subprocess.TimeoutExpired:
+        log.error(f"Text extraction timed out after {timeout_s} s "
+                  f"(filename={filename!r}, extension={extension!r}); "
+                  f"abandoning it")
+        proc.kill()
+        proc.communicate()
+        return None, False
+    try:
+        return pickle.loads(stdout)
+    except Exception:
+        # The child died without sending anything (or anything useful).
+        log.error(f"Text extraction process failed (exit code "
+                  f"{proc.returncode})")
+        return None, False
+
+
+# =============================================================================
+# TextExtractor
+# =============================================================================
+
+class TextExtractor(object):
+    """
+    Extracts text from documents for the anonymiser, according to its config
+    (see the ``text_extraction_*`` config options), possibly in child
+    processes, in advance, and/or via a cache.
+    """
+    def __init__(self, config: "Config") -> None:
+        """
+        Args:
+            config: a :class:`crate_anon.anonymise.config.Config`
+        """
+        self.config = config
+        self.use_db_cache = config.text_extraction_cache
+        self._executor = None  # type: Optional[ThreadPoolExecutor]
+        self._prefetched = {}  # type: Dict[str, Future]
+        self._prefetched_from_cache = {}  # type: Dict[str, str]
+        self.n_cache_hits = 0
+        self.n_extractions = 0
+
+    def __str__(self) -> str:
+        return (f"{self.n_extractions} extractions, "
+                f"{self.n_cache_hits} cache hits")
+
+    @property
+    def in_subprocesses(self) -> bool:
+        """
+        Do we extract text in child processes?
+        """
+        return self.config.text_extraction_processes > 0
+
+    def detach_from_database(self) -> None:
+        """
+        Stop using the admin database cache. Call this in worker processes,
+        which must not use their parent's database connections.
+        """
+        self.use_db_cache = False
+
+    def get_key(self,
+                filename: Optional[str],
+                blob: Optional[bytes],
+                extension: Optional[str]) -> str:
+        """
+        Returns a key for a document: a hash of its contents (for BLOBs), or
+        its name, size and modification time (for files, to save reading them
+        twice), plus our text extraction settings.
+        """
+        h = hashlib.sha256()
+        h.update(repr((extension,
+                       self.config.extract_text_plain,
+                       self.config.extract_text_width)).encode("utf8"))
+        if blob is not None:
+            h.update(b"blob:")
+            h.update(blob)
+        else:
+            st = os.stat(filename)
+            h.update(repr(("file", os.path.abspath(filename),
+                           st.st_size, st.st_mtime_ns)).encode("utf8"))
+        return h.hexdigest()
+
+    def _run(self,
+             filename: Optional[str],
+             blob: Optional[bytes],
+             extension: Optional[str]) -> Tuple[Optional[str], bool]:
+        """
+        Extracts text, here or in a child process.
+        """
+        args = (filename, blob, extension,
+                self.config.extract_text_plain,
+                self.config.extract_text_width)
+        if self.in_subprocesses:
+            return extract_text_in_subprocess(
+                *args,
+                timeout_s=self.config.text_extraction_timeout_s,
+                max_memory_mb=self.config.text_extraction_max_memory_mb)
+        return _extract_text(*args)
+
+    def _get_from_db_cache(self, key: str) -> Optional[str]:
+        """
+        Returns previously extracted text from the admin database, or
+        ``None``.
+        """
+        if not self.use_db_cache:
+            return None
+        # delayed import (models imports our config)
+        from crate_anon.anonymise.models import TextExtractionCacheRecord
+        return TextExtractionCacheRecord.get_text(
+            self.config.admindb.session, key)
+
+    def _save_to_db_cache(self, key: str, text: Optional[str]) -> None:
+        """
+        Saves extracted text to the admin database, unless it's too long (see
+        ``text_extraction_cache_max_chars``).
+        """
+        if not self.use_db_cache:
+            return
+        max_chars = self.config.text_extraction_cache_max_chars
+        if 0 < max_chars < len(text or ""):
+            return
+        # delayed import (models imports our config)
+        from crate_anon.anonymise.models import TextExtractionCacheRecord
+        TextExtractionCacheRecord.save_text(
+            self.config.admindb.session, key, text)
+
+    def prefetch(self,
+                 filename: Optional[str],
+                 blob: Optional[bytes],
+                 extension: Optional[str]) -> Optional[Future]:
+        """
+        Starts extracting text from a document in the background (if we are
+        configured to use child processes), so that a subsequent call to
+        :meth:`extract` for the same document will be quick. If the text is
+        in the cache, we hold on to it for :meth:`extract` instead.
+
+        Returns:
+            a :class:`Future` that completes when the text is available, or
+            ``None`` if there's nothing to wait for
+        """
+        if not self.in_subprocesses:
+            return None
+        key = self.get_key(filename, blob, extension)
+        if key in self._prefetched:
+            return self._prefetched[key]
+        if key in self._prefetched_from_cache:
+            return None
+        text = self._get_from_db_cache(key)
+        if text is not None:
+            self._prefetched_from_cache[key] = text
+            return None
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.config.text_extraction_processes)
+            # Each thread waits on one child process at a time.
+        future = self._executor.submit(self._run, filename, blob, extension)
+        self._prefetched[key] = future
+        return future
+
+    def extract(self,
+                filename: Optional[str],
+                blob: Optional[bytes],
+                extension: Optional[str]) -> Tuple[Optional[str], bool]:
+        """
+        Extracts text from a file or BLOB, using a prefetched result or the
+        cache if possible.
+
+        Returns:
+            tuple: ``text, extracted``
+        """
+        key = None  # type: Optional[str]
+        if (self.use_db_cache or self._prefetched or
+                self._prefetched_from_cache):
+            key = self.get_key(filename, blob, extension)
+        future = self._prefetched.pop(key, None) if key else None
+        if future is not None:
+            text, extracted = future.result()
+        else:
+            if key in self._prefetched_from_cache:
+                text = self._prefetched_from_cache.pop(key)
+            else:
+                text = self._get_from_db_cache(key) if key else None
+            if text is not None:
+                self.n_cache_hits += 1
+                return text, True
+            text, extracted = self._run(filename, blob, extension)
+        self.n_extractions += 1
+        if extracted and key:
+            self._save_to_db_cache(key, text)
+        return text, extracted
+
+    def discard_prefetched(self) -> None:
+        """
+        Forgets about any prefetched results that haven't been collected by
+        :meth:`extract`.
+        """
+        self._prefetched.clear()
+        self._prefetched_from_cache.clear()
+
+    def shutdown(self) -> None:
+        """
+        Stops our background threads, if any.
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self.discard_prefetched()
+
+
+if __name__ == "__main__":
+    _extract_text_in_child()
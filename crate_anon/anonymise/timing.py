@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+"""
+crate_anon/anonymise/timing.py
+
+===============================================================================
+
+    Copyright (C) 2015-2021 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+**Timing (and memory) summaries for the anonymiser.**
+
+The anonymiser's hot paths are timed with the global
+:class:`cardinal_pythonlib.timing.MultiTimer` (``timer``), as for the NLP
+manager; that gives a breakdown of where time goes, for the ``--timing``
+report. In addition, :class:`AnonymiserTimings` records wall-clock time per
+phase of the run, per source table (plus peak memory use per table), and per
+destination index built, and can write all of these to a JSON file, for
+comparing runs.
+
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import logging
+import time
+from typing import Any, Dict, Generator, Iterable, Optional, TypeVar
+
+from cardinal_pythonlib.timing import MultiTimer, MultiTimerContext
+
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+# =============================================================================
+# Helper functions
+# =============================================================================
+
+def gen_timed(iterable: Iterable[T],
+              multitimer: MultiTimer,
+              name: str) -> Generator[T, None, None]:
+    """
+    Yields from ``iterable``, timing only the fetching of each item (not the
+    caller's work between items) with the named timer.
+    """
+    iterator = iter(iterable)
+    while True:
+        with MultiTimerContext(multitimer, name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def get_timer_totals(multitimer: MultiTimer) -> Dict[str, Dict[str, Any]]:
+    """
+    Returns the totals from a :class:`cardinal_pythonlib.timing.MultiTimer`
+    (which doesn't offer them publicly), as a dictionary mapping timer name
+    to a dictionary with keys ``seconds`` and ``count``.
+    """
+    # noinspection PyProtectedMember
+    return OrderedDict(
+        (name, {"seconds": duration.total_seconds(),
+                "count": multitimer._count[name]})
+        for name, duration in multitimer._totaldurations.items()
+    )
+
+
+# =============================================================================
+# AnonymiserTimings
+# =============================================================================
+
+class TableTiming(object):
+    """
+    Time spent on, rows handled for, and memory used while processing, one
+    source table.
+    """
+    def __init__(self) -> None:
+        self.seconds = 0.0
+        self.calls = 0
+        self.rows_read = 0
+        self.rows_written = 0
+        self.peak_memory_bytes = None  # type: Optional[int]
+        self.memory_growth_bytes = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return OrderedDict([
+            ("seconds", self.seconds),
+            ("calls", self.calls),
+            ("rows_read", self.rows_read),
+            ("rows_written", self.rows_written),
+            ("peak_memory_bytes", self.peak_memory_bytes),
+            ("memory_growth_bytes", self.memory_growth_bytes),
+        ])
+
+
+class AnonymiserTimings(object):
+    """
+    Wall-clock time per phase of an anonymiser run, per source table, and per
+    destination index.
+    """
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.phases = OrderedDict()  # type: Dict[str, float]
+        self.tables = OrderedDict()  # type: Dict[str, TableTiming]
+        self.indexes = OrderedDict()  # type: Dict[str, float]
+
+    def reset(self) -> None:
+        """
+        Start again.
+        """
+        self.start = time.perf_counter()
+        self.phases.clear()
+        self.tables.clear()
+        self.indexes.clear()
+
+    @contextmanager
+    def phase(self, name: str,
+              multitimer: MultiTimer = None) -> Generator[None, None, None]:
+        """
+        Context manager to time a phase of the run (adding to any previous
+        time for the same phase). If ``multitimer`` is given, the phase is
+        timed by it too, so that its report accounts for the time within the
+        phase that isn't covered by more specific timers.
+        """
+        phase_start = time.perf_counter()
+        try:
+            if multitimer is None:
+                yield
+            else:
+                with MultiTimerContext(multitimer, name):
+                    yield
+        finally:
+            self.phases[name] = (self.phases.get(name, 0.0) +
+                                 time.perf_counter() - phase_start)
+
+    @staticmethod
+    def _table_key(dbname: str, tablename: str) -> str:
+        return f"{dbname}.{tablename}"
+
+    def get_table(self, dbname: str,
+                  tablename: str) -> Optional[TableTiming]:
+        """
+        Returns the :class:`TableTiming` for a source table, if we have one.
+        """
+        return self.tables.get(self._table_key(dbname, tablename))
+
+    def add_table(self,
+                  dbname: str,
+                  tablename: str,
+                  seconds: float,
+                  rows_read: int = 0,
+                  rows_written: int = 0,
+                  calls: int = 1,
+                  peak_memory_before: int = None,
+                  peak_memory_after: int = None) -> TableTiming:
+        """
+        Records some work on a source table.
+
+        Args:
+            dbname: source database name
+            tablename: source table name
+            seconds: time taken
+            rows_read: number of source rows read
+            rows_written: number of destination rows written
+            calls: number of calls (e.g. one per patient) this represents
+            peak_memory_before: peak memory use of the process (in bytes, as
+                per :func:`crate_anon.common.memsize.get_peak_memory_bytes`)
+                before the work
+            peak_memory_after: peak memory use of the process after the work
+
+        Returns:
+            the :class:`TableTiming` for this table, so far
+        """
+        key = self._table_key(dbname, tablename)
+        tt = self.tables.get(key)
+        if tt is None:
+            tt = self.tables[key] = TableTiming()
+        tt.seconds += seconds
+        tt.calls += calls
+        tt.rows_read += rows_read
+        tt.rows_written += rows_written
+        if peak_memory_after is not None:
+            tt.peak_memory_bytes = max(tt.peak_memory_bytes or 0,
+                                       peak_memory_after)
+            if peak_memory_before is not None:
+                tt.memory_growth_bytes += peak_memory_after - peak_memory_before
+        return tt
+
+    def add_index(self, description: str, seconds: float) -> None:
+        """
+        Records the time taken to build a destination index.
+        """
+        self.indexes[description] = (self.indexes.get(description, 0.0) +
+                                     seconds)
+
+    def as_dict(self, multitimer: MultiTimer = None,
+                **extra: Any) -> Dict[str, Any]:
+        """
+        Returns everything as a JSON-serializable dictionary, including the
+        totals from ``multitimer``, if given, and any ``extra`` information
+        (e.g. the process number).
+        """
+        d = OrderedDict(extra)
+        d["total_seconds"] = time.perf_counter() - self.start
+        d["phases"] = OrderedDict(self.phases)
+        d["tables"] = OrderedDict(
+            (k, v.as_dict()) for k, v in self.tables.items())
+        d["indexes"] = OrderedDict(self.indexes)
+        if multitimer is not None:
+            d["timers"] = get_timer_totals(multitimer)
+        return d
+
+    def write_json(self, filename: str, multitimer: MultiTimer = None,
+                   **extra: Any) -> None:
+        """
+        Writes everything to a JSON file; see :meth:`as_dict`.
+        """
+        log.info(f"Writing timing summary to {filename}")
+        with open(filename, "w") as f:
+            json.dump(self.as_dict(multitimer, **extra), f, indent=4)
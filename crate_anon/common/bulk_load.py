@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+
+"""
+crate_anon/common/bulk_load.py
+
+===============================================================================
+
+    Copyright (C) 2015-2021 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+**Loading many rows into database tables, using the database's bulk-loading
+mechanism where we can.**
+
+:class:`BulkLoader` has the same interface as
+:class:`crate_anon.common.sql.BatchedInserter`, but is meant for filling
+tables with a large number of rows:
+
+- MySQL: rows are written to a temporary tab-separated file, which is loaded
+  with ``LOAD DATA LOCAL INFILE``. (The server must permit this, via its
+  ``local_infile`` setting, and so must the client; with the PyMySQL or
+  mysqlclient drivers, add ``local_infile=1`` to the database URL.) With
+  ``LOCAL``, MySQL skips rows with duplicate keys, and adjusts values that
+  don't fit their columns, with warnings rather than errors; so if a load
+  gives any warnings, we raise an error (as an ``INSERT`` would have done).
+- PostgreSQL, via psycopg2: likewise, loaded with ``COPY ... FROM STDIN``.
+- SQL Server, via pyodbc: rows are inserted with one "executemany" call per
+  batch, using pyodbc's ``fast_executemany`` mode (which sends the rows as
+  parameter arrays, as the ``bcp`` tool does).
+- Anything else: rows are inserted with one "executemany" call per batch.
+
+Values go through the same SQLAlchemy type conversions as they would for an
+``INSERT``, and are written to files in the same way as the database drivers
+would write them into SQL. Any row containing a value that we can't write to a
+file in that way (e.g. binary data for MySQL) is inserted normally instead,
+after the rows before it.
+
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import datetime
+from decimal import Decimal
+import logging
+import math
+import os
+import tempfile
+from typing import (Any, BinaryIO, Callable, Dict, Generator, List,
+                    Optional)
+
+from cardinal_pythonlib.sqlalchemy.dialect import SqlaDialectName
+from sqlalchemy import event
+from sqlalchemy.engine.interfaces import Dialect
+from sqlalchemy.orm.session import Session
+from sqlalchemy.schema import Table
+
+from crate_anon.common.sql import TransactionSizeLimiter
+
+log = logging.getLogger(__name__)
+
+
+# =============================================================================
+# Writing values to files
+# =============================================================================
+
+# Tab-separated text, with backslash escapes and \N for NULL, is the default
+# format for both MySQL's LOAD DATA and PostgreSQL's COPY.
+
+_NULL = b"\\N"
+_TEXT_ESCAPES = (
+    (b"\\", b"\\\\"),  # must be first
+    (b"\t", b"\\t"),
+    (b"\n", b"\\n"),
+    (b"\r", b"\\r"),
+)
+_MYSQL_TEXT_ESCAPES = _TEXT_ESCAPES + (
+    (b"\x00", b"\\0"),
+)
+
+
+def _escape(b: bytes, escapes: tuple) -> bytes:
+    for raw, escaped in escapes:
+        if raw in b:
+            b = b.replace(raw, escaped)
+    return b
+
+
+def _number_to_bytes(value: Any) -> bytes:
+    """
+    Writes a number as a driver would (or raises :exc:`TypeError` for values
+    such as infinity that we shouldn't write).
+    """
+    if isinstance(value, int):  # booleans are handled by our callers
+        return str(value).encode("ascii")
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            raise TypeError(f"Non-finite float: {value!r}")
+        return repr(value).encode("ascii")
+    if isinstance(value, Decimal):
+        if not value.is_finite():
+            raise TypeError(f"Non-finite Decimal: {value!r}")
+        return format(value, "f").encode("ascii")
+    raise TypeError(f"Not a number: {value!r}")
+
+
+def mysql_field_to_bytes(value: Any) -> bytes:
+    """
+    Converts a Python value to a field of a MySQL ``LOAD DATA`` file, in the
+    same way that the MySQL drivers convert values to SQL literals; raises
+    :exc:`TypeError` for values we can't convert.
+    """
+    if value is None:
+        return _NULL
+    if isinstance(value, str):
+        return _escape(value.encode("utf-8"), _MYSQL_TEXT_ESCAPES)
+    if isinstance(value, bool):
+        return b"1" if value else b"0"
+    if isinstance(value, (int, float, Decimal)):
+        return _number_to_bytes(value)
+    # As for pymysql.converters (which, like MySQL, ignores time zones):
+    if isinstance(value, datetime.datetime):
+        fmt = ("{0.year:04}-{0.month:02}-{0.day:02} "
+               "{0.hour:02}:{0.minute:02}:{0.second:02}")
+        if value.microsecond:
+            fmt += ".{0.microsecond:06}"
+        return fmt.format(value).encode("ascii")
+    if isinstance(value, datetime.date):
+        return value.isoformat().encode("ascii")
+    if isinstance(value, datetime.time):
+        fmt = "{0.hour:02}:{0.minute:02}:{0.second:02}"
+        if value.microsecond:
+            fmt += ".{0.microsecond:06}"
+        return fmt.format(value).encode("ascii")
+    # Binary data can't safely share a file with text in a declared character
+    # set, so it's inserted the ordinary way.
+    raise TypeError(f"Can't write {type(value)} to a MySQL LOAD DATA file")
+
+
+def postgres_field_to_bytes(value: Any) -> bytes:
+    """
+    Converts a Python value to a field of a PostgreSQL ``COPY`` file (in text
+    format), in the same way that psycopg2 converts values to SQL literals;
+    raises :exc:`TypeError` for values we can't convert.
+    """
+    if value is None:
+        return _NULL
+    if isinstance(value, str):
+        return _escape(value.encode("utf-8"), _TEXT_ESCAPES)
+    if isinstance(value, bool):
+        return b"t" if value else b"f"
+    if isinstance(value, (int, float, Decimal)):
+        return _number_to_bytes(value)
+    if isinstance(value, (datetime.datetime, datetime.time)):
+        if value.tzinfo is not None:
+            # psycopg2 sends time zones, which PostgreSQL may then convert
+            # (e.g. for a column without a time zone); COPY would ignore them.
+            raise TypeError(f"Can't write {value!r} to a COPY file")
+        return value.isoformat().encode("ascii")
+    if isinstance(value, datetime.date):
+        return value.isoformat().encode("ascii")
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return b"\\\\x" + bytes(value).hex().encode("ascii")
+    raise TypeError(f"Can't write {type(value)} to a PostgreSQL COPY file")
+
+
+# =============================================================================
+# BulkLoader
+# =============================================================================
+
+# noinspection PyUnusedLocal
+def _set_fast_executemany(conn: Any, cursor: Any, statement: str,
+                          parameters: Any, context: Any,
+                          executemany: bool) -> None:
+    """
+    SQLAlchemy ``before_cursor_execute`` listener that switches on pyodbc's
+    ``fast_executemany`` mode for "executemany" calls.
+    """
+    if executemany:
+        cursor.fast_executemany = True
+
+
+class _TableBatch(object):
+    """
+    Rows waiting to be loaded into one table; all have the same columns.
+    """
+    def __init__(self, sqla_table: Table, colnames: List[str],
+                 dialect: Dialect, use_file: bool) -> None:
+        self.sqla_table = sqla_table
+        self.colnames = colnames
+        self.colname_set = frozenset(colnames)
+        # The conversions SQLAlchemy would apply for an INSERT:
+        self.processors = []  # type: List[Optional[Callable[[Any], Any]]]
+        for colname in colnames:
+            column = sqla_table.columns.get(colname)
+            self.processors.append(
+                None if column is None
+                else column.type.dialect_impl(dialect).bind_processor(dialect)
+            )
+        self.rows = []  # type: List[Dict[str, Any]]
+        self.n_rows = 0
+        self.n_bytes = 0
+        self.filename = None  # type: Optional[str]
+        self.file = None  # type: Optional[BinaryIO]
+        if use_file:
+            self.file = tempfile.NamedTemporaryFile(
+                prefix=f"crate_{sqla_table.name}_", suffix=".tsv",
+                delete=False)
+            self.filename = self.file.name
+
+    def get_line(self, values: Dict[str, Any],
+                 field_to_bytes: Callable[[Any], bytes]) -> bytes:
+        """
+        Returns a file line for the row (or raises :exc:`TypeError`).
+        """
+        fields = []  # type: List[bytes]
+        for colname, processor in zip(self.colnames, self.processors):
+            value = values[colname]
+            if processor is not None and value is not None:
+                value = processor(value)
+            fields.append(field_to_bytes(value))
+        return b"\t".join(fields) + b"\n"
+
+    def close(self) -> None:
+        """
+        Closes and deletes our file, if we have one.
+        """
+        if self.file is not None:
+            self.file.close()  # no harm if already closed
+            os.remove(self.filename)
+            self.file = None
+
+
+class BulkLoader(object):
+    """
+    Class to buffer rows destined for one or more database tables, and load
+    them in large batches, as fast as the database will let us; see above.
+
+    The interface is as for :class:`crate_anon.common.sql.BatchedInserter`,
+    and so are the rules: rows for each table are loaded in the order they
+    were offered, all rows in a batch must have the same columns, and callers
+    must call :meth:`flush` before committing other than via a
+    :class:`crate_anon.common.sql.TransactionSizeLimiter` that we notify.
+    """
+    METHOD_MYSQL_LOAD_DATA = "LOAD DATA LOCAL INFILE"
+    METHOD_POSTGRES_COPY = "COPY FROM STDIN"
+    METHOD_MSSQL_FAST_EXECUTEMANY = "executemany (pyodbc fast_executemany)"
+    METHOD_EXECUTEMANY = "executemany"
+
+    def __init__(self,
+                 session: Session,
+                 max_rows_per_batch: int = 10000,
+                 replace_duplicates: bool = False,
+                 transaction_limiter: TransactionSizeLimiter = None) -> None:
+        """
+        Args:
+            session:
+                SQLAlchemy database Session
+            max_rows_per_batch:
+                load a table's batch once it contains this many rows
+            replace_duplicates:
+                under MySQL, replace any existing rows with the same keys (as
+                for ``INSERT ... ON DUPLICATE KEY UPDATE``; see
+                :class:`crate_anon.common.sql.BatchedInserter`)
+            transaction_limiter:
+                optional :class:`TransactionSizeLimiter` to notify of rows and
+                bytes written
+        """
+        self._session = session
+        self._max_rows_per_batch = max(1, max_rows_per_batch or 1)
+        self._replace_duplicates = replace_duplicates
+        self._transaction_limiter = transaction_limiter
+        self._batches = OrderedDict()  # type: Dict[str, _TableBatch]
+
+        self._dialect = session.get_bind().dialect
+        dialect_name = self._dialect.name
+        driver = self._dialect.driver
+        self._field_to_bytes = None  # type: Optional[Callable[[Any], bytes]]
+        if dialect_name == SqlaDialectName.MYSQL:
+            self.method = self.METHOD_MYSQL_LOAD_DATA
+            self._field_to_bytes = mysql_field_to_bytes
+        elif dialect_name == SqlaDialectName.POSTGRES and driver == "psycopg2":
+            self.method = self.METHOD_POSTGRES_COPY
+            self._field_to_bytes = postgres_field_to_bytes
+        elif dialect_name == SqlaDialectName.MSSQL and driver == "pyodbc":
+            self.method = self.METHOD_MSSQL_FAST_EXECUTEMANY
+        else:
+            self.method = self.METHOD_EXECUTEMANY
+        log.debug(f"Bulk loading via {self.method}")
+
+    def insert(self, sqla_table: Table, values: Dict[str, Any],
+               n_bytes: int = 0) -> None:
+        """
+        Buffer a row for loading, loading the table's batch if it is full.
+
+        Args:
+            sqla_table: SQLAlchemy Table to insert into
+            values: dictionary mapping column names to values
+            n_bytes: (approximate) size of the row, in bytes
+        """
+        tablename = sqla_table.name
+        batch = self._batches.get(tablename)
+        if batch is not None and values.keys() != batch.colname_set:
+            self.flush_table(tablename)
+            batch = None
+        if batch is None:
+            batch = self._batches[tablename] = _TableBatch(
+                sqla_table, list(values.keys()), self._dialect,
+                use_file=self._field_to_bytes is not None)
+        if batch.file is not None:
+            try:
+                line = batch.get_line(values, self._field_to_bytes)
+            except TypeError as e:
+                # Insert this row the ordinary way, after those before it.
+                log.debug(f"Table {tablename}: not bulk-loading a row: {e}")
+                self.flush_table(tablename)
+                self._executemany(sqla_table, [values])
+                self._notify(n_rows=1, n_bytes=n_bytes)
+                return
+            batch.file.write(line)
+        else:
+            batch.rows.append(values)
+        batch.n_rows += 1
+        batch.n_bytes += n_bytes
+        if batch.n_rows >= self._max_rows_per_batch:
+            self.flush_table(tablename)
+
+    def flush_table(self, tablename: str) -> None:
+        """
+        Load any rows buffered for one table.
+
+        Args:
+            tablename: name of the table
+        """
+        batch = self._batches.pop(tablename, None)
+        if batch is None:
+            return
+        try:
+            if not batch.n_rows:
+                return
+            if self.method == self.METHOD_MYSQL_LOAD_DATA:
+                self._mysql_load_data(batch)
+            elif self.method == self.METHOD_POSTGRES_COPY:
+                self._postgres_copy(batch)
+            else:
+                self._executemany(batch.sqla_table, batch.rows)
+        finally:
+            batch.close()
+        self._notify(n_rows=batch.n_rows, n_bytes=batch.n_bytes)
+
+    def flush(self) -> None:
+        """
+        Load all buffered rows, for all tables.
+        """
+        for tablename in list(self._batches.keys()):
+            self.flush_table(tablename)
+
+    @property
+    def n_rows_pending(self) -> int:
+        """
+        The number of rows buffered but not yet loaded.
+        """
+        return sum(batch.n_rows for batch in self._batches.values())
+
+    # -------------------------------------------------------------------------
+    # Internals
+    # -------------------------------------------------------------------------
+
+    def _notify(self, n_rows: int, n_bytes: int) -> None:
+        if self._transaction_limiter:
+            self._transaction_limiter.notify(n_rows=n_rows, n_bytes=n_bytes)
+            # ... may trigger a commit
+
+    def _quoted_columns(self, batch: _TableBatch) -> str:
+        preparer = self._dialect.identifier_preparer
+        return ", ".join(preparer.quote(c) for c in batch.colnames)
+
+    @contextmanager
+    def _raw_cursor(self) -> Generator[Any, None, None]:
+        # Via the DBAPI connection that the session is using, so we are part
+        # of the same transaction, and SQLAlchemy doesn't interpret the SQL.
+        dbapi_connection = self._session.connection().connection
+        cursor = dbapi_connection.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+    def _mysql_load_data(self, batch: _TableBatch) -> None:
+        batch.file.close()
+        filename = batch.filename.replace("\\", "\\\\").replace("'", "\\'")
+        table = self._dialect.identifier_preparer.format_table(
+            batch.sqla_table)
+        sql = (
+            f"LOAD DATA LOCAL INFILE '{filename}' "
+            f"{'REPLACE ' if self._replace_duplicates else ''}"
+            f"INTO TABLE {table} "
+            f"CHARACTER SET utf8mb4 "
+            f"FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' "
+            f"LINES TERMINATED BY '\\n' "
+            f"({self._quoted_columns(batch)})"
+        )
+        with self._raw_cursor() as cursor:
+            cursor.execute(sql)
+            cursor.execute("SHOW COUNT(*) WARNINGS")
+            n_warnings = cursor.fetchone()[0]
+            if n_warnings:
+                cursor.execute("SHOW WARNINGS LIMIT 5")
+                examples = [row[2] for row in cursor.fetchall()]
+        if n_warnings:
+            raise RuntimeError(
+                f"Loading {batch.n_rows} rows into {table} via LOAD DATA "
+                f"gave {n_warnings} warning(s), e.g. {examples}; rows have "
+                f"been skipped or altered")
+
+    def _postgres_copy(self, batch: _TableBatch) -> None:
+        table = self._dialect.identifier_preparer.format_table(
+            batch.sqla_table)
+        sql = (
+            f"COPY {table} ({self._quoted_columns(batch)}) FROM STDIN "
+            f"WITH (FORMAT text, ENCODING 'UTF8')"
+        )
+        batch.file.flush()
+        batch.file.seek(0)
+        with self._raw_cursor() as cursor:
+            cursor.copy_expert(sql, batch.file)
+
+    def _executemany(self, sqla_table: Table,
+                     rows: List[Dict[str, Any]]) -> None:
+        if self._replace_duplicates:
+            # noinspection PyUnresolvedReferences
+            statement = sqla_table.insert_on_duplicate()
+        else:
+            statement = sqla_table.insert()
+        if self.method == self.METHOD_MSSQL_FAST_EXECUTEMANY:
+            # Just for this call, on our connection (not via the dialect's
+            # flag, which is shared with any other connections).
+            connection = self._session.connection()
+            event.listen(connection, "before_cursor_execute",
+                         _set_fast_executemany)
+            try:
+                self._session.execute(statement, rows)
+            finally:
+                event.remove(connection, "before_cursor_execute",
+                             _set_fast_executemany)
+        else:
+            self._session.execute(statement, rows)
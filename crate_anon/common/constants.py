@@ -109,6 +109,8 @@ class EnvVar(object):
     KCL_KCONNECT_DIR = "KCL_KCONNECT_DIR"
     MEDEX_HOME = "MEDEX_HOME"
     PATH = "PATH"
+    RUN_BENCHMARKS = "CRATE_RUN_BENCHMARKS"
+    # ... set this to run the (slow) benchmark tests too.
     RUN_WITHOUT_CONFIG = "CRATE_RUN_WITHOUT_LOCAL_SETTINGS"
 
 
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+"""
+crate_anon/common/hashing.py
+
+===============================================================================
+
+    Copyright (C) 2015-2021 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+**Faster HMAC hashing, for hashing many small things with the same key.**
+
+:class:`cardinal_pythonlib.hash.GenericHmacHasher` creates a new HMAC object,
+from the key, for every value hashed. Setting up an HMAC involves hashing the
+(padded) key twice, which, for short inputs such as source rows or patient
+IDs, is a substantial part of the work. Here, we key an HMAC object once and
+copy it for each value. The results are identical.
+
+(The other part of the work, for source rows, is serializing the row, which we
+do with :func:`repr`. A canonical, type-tagged binary serialization, built
+value by value in Python, is slower than the C implementation of :func:`repr`
+for typical rows, and would change every existing source row hash, so we
+don't use one.)
+
+We can also cache hashes (see :class:`CachingHasher`), for values such as
+patient IDs that are hashed repeatedly.
+
+"""
+
+from collections import OrderedDict
+import hmac
+from typing import Any, Dict
+
+from cardinal_pythonlib.hash import GenericHasher, GenericHmacHasher
+
+
+# =============================================================================
+# PrekeyedHmacHasher
+# =============================================================================
+
+class PrekeyedHmacHasher(GenericHasher):
+    """
+    Wraps a :class:`cardinal_pythonlib.hash.GenericHmacHasher`, producing
+    exactly the same hashes, but faster.
+    """
+    def __init__(self, hasher: GenericHmacHasher) -> None:
+        """
+        Args:
+            hasher: the HMAC hasher to emulate
+        """
+        self.hasher = hasher
+        self._template = hmac.new(key=hasher.key_bytes,
+                                  digestmod=hasher.digestmod)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """
+        For pickling (e.g. as part of a scrubber sent to a worker process).
+        HMAC objects can't be pickled; the recipient rebuilds ours.
+        """
+        return {"hasher": self.hasher}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state["hasher"])
+
+    def hash(self, raw: Any) -> str:
+        """
+        Returns the hex digest of a HMAC-encoded version of the input, as
+        for :meth:`cardinal_pythonlib.hash.GenericHmacHasher.hash`.
+        """
+        hmac_obj = self._template.copy()
+        hmac_obj.update(str(raw).encode("utf-8"))
+        return hmac_obj.hexdigest()
+
+    def output_length(self) -> int:
+        # docstring in parent class
+        return self.hasher.output_length()
+
+
+def make_prekeyed_hasher(hasher: GenericHasher) -> GenericHasher:
+    """
+    Returns a faster equivalent of ``hasher`` if we have one (see
+    :class:`PrekeyedHmacHasher`), or ``hasher`` itself otherwise.
+    """
+    if isinstance(hasher, GenericHmacHasher):
+        return PrekeyedHmacHasher(hasher)
+    return hasher
+
+
+# =============================================================================
+# CachingHasher
+# =============================================================================
+
+class CachingHasher(GenericHasher):
+    """
+    Wraps another hasher, remembering the hashes of the most recently hashed
+    ``max_entries`` values (with least-recently-used eviction).
+
+    Values are cached by their string form, which is what is hashed, so e.g.
+    ``1`` and ``"1"`` share an entry.
+    """
+    def __init__(self, hasher: GenericHasher, max_entries: int) -> None:
+        """
+        Args:
+            hasher: the hasher to use for values not in the cache
+            max_entries: maximum number of hashes to keep
+        """
+        self.hasher = hasher
+        self.max_entries = max_entries
+        self._cache = OrderedDict()  # type: OrderedDict[str, str]
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """
+        For pickling. We don't send our cache (or statistics) with us.
+        """
+        return {"hasher": self.hasher, "max_entries": self.max_entries}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state["hasher"], state["max_entries"])
+
+    def hash(self, raw: Any) -> str:
+        """
+        Returns the hash of ``raw``, from the cache if possible.
+        """
+        key = str(raw)
+        hashed = self._cache.get(key)
+        if hashed is not None:
+            self.n_hits += 1
+            self._cache.move_to_end(key)
+            return hashed
+        self.n_misses += 1
+        hashed = self.hasher.hash(key)
+        self._cache[key] = hashed
+        if len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)  # discard oldest
+        return hashed
+
+    def output_length(self) -> int:
+        # docstring in parent class
+        return self.hasher.output_length()
+
+    def __str__(self) -> str:
+        n_requests = self.n_hits + self.n_misses
+        hit_pct = 100 * self.n_hits / n_requests if n_requests else 0
+        return (
+            f"{self.n_hits} hits, {self.n_misses} misses "
+            f"({hit_pct:.1f}% hit rate); "
+            f"{len(self._cache)}/{self.max_entries} entries"
+        )
+
+
+def make_caching_hasher(hasher: GenericHasher,
+                        max_entries: int) -> GenericHasher:
+    """
+    Returns a :class:`CachingHasher` wrapping ``hasher``, or, if
+    ``max_entries`` is 0 (meaning "no cache"), ``hasher`` itself.
+    """
+    if max_entries <= 0:
+        return hasher
+    return CachingHasher(hasher, max_entries)
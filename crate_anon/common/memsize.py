@@ -24,16 +24,23 @@ crate_anon/common/memsize.py
 
 ===============================================================================
 
-Calculate the size of objects in memory (fast).
+Calculate the size of objects in memory (fast), and the peak memory use of
+this process.
 
 From https://stackoverflow.com/questions/449560/how-do-i-determine-the-size-of-an-object-in-python
 
 """  # noqa
 
 from gc import get_referents
+import sys
 from sys import getsizeof
 from types import ModuleType, FunctionType
-from typing import Any, List, Set
+from typing import Any, List, Optional, Set
+
+try:
+    import resource
+except ImportError:  # e.g. Windows
+    resource = None
 
 # Custom objects know their class.
 # Function objects seem to know way too much, including modules.
@@ -72,3 +79,15 @@ def getsize(obj: Any, assume_none_denied: bool = False) -> int:
                     need_referents.append(obj)
         objects = get_referents(*need_referents)
     return size
+
+
+def get_peak_memory_bytes() -> Optional[int]:
+    """
+    Returns the peak resident set size (RSS) of this process so far, in bytes,
+    or ``None`` if the operating system doesn't tell us (e.g. Windows).
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes; macOS reports bytes.
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
@@ -32,7 +32,8 @@ from collections import OrderedDict
 import functools
 import logging
 import re
-from typing import Any, Dict, Iterable, List, Tuple, Union, Optional
+from typing import (Any, Callable, Dict, Generator, Iterable, List, Tuple,
+                    Union, Optional)
 
 from cardinal_pythonlib.json.serialize import (
     METHOD_PROVIDES_INIT_KWARGS,
@@ -61,8 +62,11 @@ from sqlalchemy import inspect
 from sqlalchemy.dialects.mssql.base import MS_2012_VERSION
 from sqlalchemy.engine.base import Engine
 from sqlalchemy.engine.interfaces import Dialect
+from sqlalchemy.engine.result import RowProxy
+from sqlalchemy.exc import DatabaseError
 from sqlalchemy.orm.session import Session
 from sqlalchemy.schema import Column, Table
+from sqlalchemy.sql.expression import Executable, select
 
 from crate_anon.common.stringfunc import get_spec_match_regex
 
@@ -81,6 +85,8 @@ SqlArgsTupleType = Tuple[str, List[Any]]
 
 TIMING_COMMIT = "commit"
 
+DEFAULT_FETCH_SIZE = 1000  # rows per fetch, when streaming results
+
 SQL_OPS_VALUE_UNNECESSARY = ['IS NULL', 'IS NOT NULL']
 SQL_OPS_MULTIPLE_VALUES = ['IN', 'NOT IN']
 
@@ -1541,6 +1547,118 @@ class ViewMaker(object):
             self.record_lookup_table_keyfield(t, k)
 
 
+# =============================================================================
+# Reading results
+# =============================================================================
+
+def gen_result_rows(session: Session,
+                    query: Executable,
+                    stream_results: bool = False,
+                    fetch_size: int = DEFAULT_FETCH_SIZE) \
+        -> Generator[RowProxy, None, None]:
+    """
+    Executes a query and yields its result rows.
+
+    Many database drivers (e.g. for MySQL) fetch the entire result set into
+    client memory when a query is executed, which is a problem for very large
+    tables. With ``stream_results``, we ask SQLAlchemy for a server-side
+    cursor, where the dialect supports one (e.g. MySQL via ``mysqldb`` or
+    ``pymysql``; PostgreSQL via ``psycopg2``), and fetch rows in batches of
+    ``fetch_size``, so that memory use is bounded. Other dialects (e.g. SQL
+    Server via ``pyodbc``) fetch from an ordinary cursor, in the same
+    batches.
+
+    While a server-side cursor is open, some drivers cannot execute other
+    queries on the same connection, so don't use the session for anything
+    else until the generator is exhausted or closed.
+
+    Closing the generator (e.g. with ``.close()``, or by garbage collection)
+    closes the result.
+
+    Args:
+        session: SQLAlchemy database session
+        query: SELECT query
+        stream_results: stream results (see above)?
+        fetch_size: number of rows per batch, when streaming
+    """
+    if stream_results:
+        query = query.execution_options(stream_results=True)
+    result = session.execute(query)
+    try:
+        if stream_results:
+            while True:
+                rows = result.fetchmany(fetch_size)
+                if not rows:
+                    break
+                yield from rows
+        else:
+            yield from result
+    finally:
+        result.close()
+
+
+def gen_unique_values_by_keyset(session: Session,
+                                table: Table,
+                                colname: str,
+                                pagesize: int) -> Generator[Any, None, None]:
+    """
+    Yields all values of a unique (e.g. PK) column, in ascending order, a page
+    of ``pagesize`` at a time, with keyset pagination (``WHERE col > last
+    ORDER BY col LIMIT n``).
+
+    Each page is fetched in full before its values are yielded, so the caller
+    may use the session in between (e.g. to delete rows it has already seen,
+    which doesn't disturb the pagination).
+
+    Args:
+        session: SQLAlchemy database session
+        table: SQLAlchemy Table
+        colname: name of the unique column
+        pagesize: number of values per query
+    """
+    col = table.columns[colname]
+    q = select([col]).order_by(col).limit(pagesize)
+    last = None
+    while True:
+        page_q = q if last is None else q.where(col > last)
+        values = [row[0] for row in session.execute(page_q).fetchall()]
+        yield from values
+        if len(values) < pagesize:
+            return
+        last = values[-1]
+
+
+def gen_sorted_difference(values: Iterable[Any],
+                          exclude: Iterable[Any]) -> Generator[Any, None, None]:
+    """
+    Yields each item of ``values`` that isn't in ``exclude``, where both are
+    in ascending order (e.g. from ``ORDER BY`` queries). This is a merge, so
+    neither needs to be held in memory. Duplicates are allowed.
+
+    Raises:
+        :exc:`ValueError` if either is found to be out of order, since the
+        result would then be wrong.
+    """
+    exclude_iter = iter(exclude)
+    sentinel = object()
+    ex = next(exclude_iter, sentinel)
+    prev_value = sentinel
+    for value in values:
+        if prev_value is not sentinel and value < prev_value:
+            raise ValueError(
+                f"Values out of order: {prev_value!r} then {value!r}")
+        prev_value = value
+        while ex is not sentinel and ex < value:
+            next_ex = next(exclude_iter, sentinel)
+            if next_ex is not sentinel and next_ex < ex:
+                raise ValueError(
+                    f"Values to exclude out of order: {ex!r} then "
+                    f"{next_ex!r}")
+            ex = next_ex
+        if ex is sentinel or value != ex:
+            yield value
+
+
 # =============================================================================
 # TransactionSizeLimiter
 # =============================================================================
@@ -1551,7 +1669,8 @@ class TransactionSizeLimiter(object):
     """
     def __init__(self, session: Session,
                  max_rows_before_commit: int = None,
-                 max_bytes_before_commit: int = None) -> None:
+                 max_bytes_before_commit: int = None,
+                 before_commit: Callable[[], None] = None) -> None:
         """
         Args:
             session: SQLAlchemy database Session
@@ -1559,10 +1678,15 @@ class TransactionSizeLimiter(object):
                 triggering a COMMIT? ``None`` for no limit.
             max_bytes_before_commit: how many bytes should we insert before
                 triggering a COMMIT? ``None`` for no limit.
+            before_commit: optional function to call before every COMMIT,
+                e.g. to write rows buffered by a :class:`BatchedInserter`
+                (which may notify us in turn).
         """
         self._session = session
         self._max_rows_before_commit = max_rows_before_commit
         self._max_bytes_before_commit = max_bytes_before_commit
+        self._before_commit = before_commit
+        self._in_before_commit = False
         self._bytes_in_transaction = 0
         self._rows_in_transaction = 0
 
@@ -1572,6 +1696,12 @@ class TransactionSizeLimiter(object):
 
         (Measures some timing information, too.)
         """
+        if self._before_commit and not self._in_before_commit:
+            self._in_before_commit = True
+            try:
+                self._before_commit()
+            finally:
+                self._in_before_commit = False
         with MultiTimerContext(timer, TIMING_COMMIT):
             self._session.commit()
         self._bytes_in_transaction = 0
@@ -1614,6 +1744,181 @@ class TransactionSizeLimiter(object):
             self.commit()
 
 
+# =============================================================================
+# BatchedInserter
+# =============================================================================
+
+class BatchedInserter(object):
+    """
+    Class to buffer rows destined for one or more database tables, and write
+    them in batches -- one "executemany" call per batch, rather than one
+    ``INSERT`` statement (and one database round trip) per row.
+
+    - Rows are buffered per table. Rows for a given table are written in the
+      order they were offered, so the end result is the same as inserting them
+      one at a time.
+    - All rows in a batch must have the same columns (an "executemany" call
+      compiles its statement once). If a row arrives with a different set of
+      columns from those already buffered for its table, the buffer for that
+      table is flushed first.
+    - If a :class:`TransactionSizeLimiter` is supplied, it is notified of each
+      batch as it is written, so may trigger a ``COMMIT``. Callers must call
+      :meth:`flush` before committing by any other route.
+    - Optionally, a batch that fails with a database error can be retried one
+      row at a time, so that only the offending rows are lost (and logged).
+      The batch, and each retried row, is written within a ``SAVEPOINT``, so
+      a failure undoes just that write (including any rows of the batch that
+      went in before the failure), not the rest of the transaction.
+    """
+    def __init__(self,
+                 session: Session,
+                 max_rows_per_batch: int = 1,
+                 max_bytes_per_batch: int = None,
+                 insert_on_duplicate: bool = False,
+                 transaction_limiter: TransactionSizeLimiter = None,
+                 skip_failed_rows: bool = False) -> None:
+        """
+        Args:
+            session:
+                SQLAlchemy database Session
+            max_rows_per_batch:
+                write a table's batch once it contains this many rows; 1 (or
+                less) means "write every row immediately"
+            max_bytes_per_batch:
+                write a table's batch once it contains (approximately) this
+                many bytes; ``None`` (or 0) for no limit
+            insert_on_duplicate:
+                use ``INSERT ... ON DUPLICATE KEY UPDATE`` (under MySQL) via
+                the ``insert_on_duplicate`` method that
+                :func:`cardinal_pythonlib.sqlalchemy.insert_on_duplicate.monkeypatch_TableClause`
+                adds to SQLAlchemy tables, rather than a plain ``INSERT``
+            transaction_limiter:
+                optional :class:`TransactionSizeLimiter` to notify of rows and
+                bytes written
+            skip_failed_rows:
+                if writing a batch raises a database error, write its rows
+                one at a time instead, logging and skipping any that fail
+                (rather than raising); this needs a database that supports
+                ``SAVEPOINT``
+        """  # noqa
+        self._session = session
+        self._max_rows_per_batch = max(1, max_rows_per_batch or 1)
+        self._max_bytes_per_batch = max_bytes_per_batch or None
+        self._insert_on_duplicate = insert_on_duplicate
+        self._transaction_limiter = transaction_limiter
+        self._skip_failed_rows = skip_failed_rows
+        self._tables = OrderedDict()  # type: Dict[str, Table]
+        self._rows = {}  # type: Dict[str, List[Dict[str, Any]]]
+        self._bytes = {}  # type: Dict[str, int]
+
+    def insert(self, sqla_table: Table, values: Dict[str, Any],
+               n_bytes: int = 0) -> None:
+        """
+        Buffer a row for insertion, writing the table's batch if it is full.
+
+        Args:
+            sqla_table: SQLAlchemy Table to insert into
+            values: dictionary mapping column names to values
+            n_bytes: (approximate) size of the row, in bytes
+        """
+        tablename = sqla_table.name
+        rows = self._rows.get(tablename)
+        if rows and rows[0].keys() != values.keys():
+            self.flush_table(tablename)
+            rows = None
+        if not rows:
+            self._tables[tablename] = sqla_table
+            rows = self._rows[tablename] = []
+            self._bytes[tablename] = 0
+        rows.append(values)
+        self._bytes[tablename] += n_bytes
+        if (len(rows) >= self._max_rows_per_batch or
+                (self._max_bytes_per_batch is not None and
+                 self._bytes[tablename] >= self._max_bytes_per_batch)):
+            self.flush_table(tablename)
+
+    def flush_table(self, tablename: str) -> None:
+        """
+        Write any rows buffered for one table.
+
+        Args:
+            tablename: name of the table
+        """
+        rows = self._rows.pop(tablename, None)
+        n_bytes = self._bytes.pop(tablename, 0)
+        sqla_table = self._tables.pop(tablename, None)
+        if not rows:
+            return
+        if self._insert_on_duplicate:
+            # noinspection PyUnresolvedReferences
+            statement = sqla_table.insert_on_duplicate()
+        else:
+            statement = sqla_table.insert()
+        if not self._skip_failed_rows:
+            self._session.execute(statement, rows)
+        else:
+            try:
+                self._execute_in_savepoint(statement, rows)
+            except DatabaseError as e:
+                if len(rows) == 1:
+                    log.error(e)
+                else:
+                    self._write_rows_singly(tablename, statement, rows)
+        if self._transaction_limiter:
+            self._transaction_limiter.notify(n_rows=len(rows),
+                                             n_bytes=n_bytes)
+            # ... may trigger a commit
+
+    def _execute_in_savepoint(
+            self, statement: Executable,
+            params: Union[Dict[str, Any], List[Dict[str, Any]]]) -> None:
+        """
+        Executes a statement within a ``SAVEPOINT``. If it fails, the
+        savepoint is rolled back (undoing any rows of a batch that were
+        written before the failure) and the error is re-raised; the rest of
+        the transaction survives, so we can carry on. (Without this, some
+        databases, such as PostgreSQL, refuse any further statements in a
+        transaction that has had an error.)
+        """
+        savepoint = self._session.begin_nested()
+        try:
+            self._session.execute(statement, params)
+        except DatabaseError:
+            savepoint.rollback()
+            raise
+        savepoint.commit()
+
+    def _write_rows_singly(self, tablename: str, statement: Executable,
+                           rows: List[Dict[str, Any]]) -> None:
+        """
+        Writes rows one at a time, having failed to write them as a batch,
+        logging and skipping any that fail.
+        """
+        n_failed = 0
+        for row in rows:
+            try:
+                self._execute_in_savepoint(statement, row)
+            except DatabaseError as e:
+                log.error(e)
+                n_failed += 1
+        log.error(f"Insert into {tablename!r} failed for {n_failed} of "
+                  f"{len(rows)} rows in batch")
+
+    def flush(self) -> None:
+        """
+        Write all buffered rows, for all tables.
+        """
+        for tablename in list(self._tables.keys()):
+            self.flush_table(tablename)
+
+    @property
+    def n_rows_pending(self) -> int:
+        """
+        The number of rows buffered but not yet written.
+        """
+        return sum(len(rows) for rows in self._rows.values())
+
+
 # =============================================================================
 # Specification matching
 # =============================================================================
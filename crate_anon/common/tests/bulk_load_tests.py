@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+"""
+crate_anon/common/tests/bulk_load_tests.py
+
+===============================================================================
+
+    Copyright (C) 2015-2021 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+"""
+
+import datetime
+from decimal import Decimal
+import os
+import re
+from typing import Any, BinaryIO, List, Tuple
+from unittest import mock, TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy.dialects.mysql.pymysql import MySQLDialect_pymysql
+from sqlalchemy.dialects.postgresql.psycopg2 import PGDialect_psycopg2
+from sqlalchemy.engine.interfaces import Dialect
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import Column, MetaData, Table
+from sqlalchemy.sql.sqltypes import DateTime, Integer, String, Text
+
+from crate_anon.common.bulk_load import (
+    BulkLoader,
+    mysql_field_to_bytes,
+    postgres_field_to_bytes,
+)
+from crate_anon.common.sql import BatchedInserter
+
+
+class FieldToBytesTests(TestCase):
+    def test_mysql(self) -> None:
+        f = mysql_field_to_bytes
+        self.assertEqual(f(None), b"\\N")
+        self.assertEqual(f("\\N"), b"\\\\N")
+        self.assertEqual(f("a\tb\nc\rd\\e\x00"), b"a\\tb\\nc\\rd\\\\e\\0")
+        self.assertEqual(f("Déjà vu"), "Déjà vu".encode("utf-8"))
+        self.assertEqual(f(True), b"1")
+        self.assertEqual(f(-42), b"-42")
+        self.assertEqual(f(0.1), b"0.1")
+        self.assertEqual(f(Decimal("1E+2")), b"100")
+        self.assertEqual(f(datetime.datetime(2020, 1, 2, 3, 4, 5)),
+                         b"2020-01-02 03:04:05")
+        self.assertEqual(f(datetime.datetime(2020, 1, 2, 3, 4, 5, 6)),
+                         b"2020-01-02 03:04:05.000006")
+        self.assertEqual(f(datetime.date(2020, 1, 2)), b"2020-01-02")
+        for bad in (b"\x00\xff", float("inf"), Decimal("NaN"), object()):
+            with self.assertRaises(TypeError):
+                f(bad)
+
+    def test_postgres(self) -> None:
+        f = postgres_field_to_bytes
+        self.assertEqual(f(None), b"\\N")
+        self.assertEqual(f("a\tb\nc\\d"), b"a\\tb\\nc\\\\d")
+        self.assertEqual(f(False), b"f")
+        self.assertEqual(f(b"\x00\xff"), b"\\\\x00ff")
+        self.assertEqual(f(datetime.datetime(2020, 1, 2, 3, 4, 5)),
+                         b"2020-01-02T03:04:05")
+        with self.assertRaises(TypeError):
+            f(datetime.datetime(2020, 1, 2, tzinfo=datetime.timezone.utc))
+
+
+class BulkLoaderTests(TestCase):
+    """
+    Checks that :class:`BulkLoader` writes the same rows as
+    :class:`BatchedInserter` (via "executemany", here, under SQLite).
+    """
+    def setUp(self) -> None:
+        self.engine = create_engine("sqlite://")
+        metadata = MetaData()
+        self.tables = [
+            Table(f"t{i}", metadata,
+                  Column("pk", Integer, primary_key=True),
+                  Column("name", String(50)),
+                  Column("note", Text),
+                  Column("when", DateTime))
+            for i in range(2)
+        ]
+        metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+    def tearDown(self) -> None:
+        self.session.close()
+
+    @staticmethod
+    def make_rows():
+        for pk in range(25):
+            row = {"pk": pk, "name": f"name {pk}", "note": "a\tb\nc\\N",
+                   "when": datetime.datetime(2020, 1, 2, 3, 4, pk)}
+            if pk % 10 == 9:
+                del row["note"]  # a different set of columns
+            yield row
+
+    def test_same_rows(self) -> None:
+        loader = BulkLoader(self.session, max_rows_per_batch=7)
+        self.assertEqual(loader.method, BulkLoader.METHOD_EXECUTEMANY)
+        inserter = BatchedInserter(self.session, max_rows_per_batch=7)
+        for row in self.make_rows():
+            loader.insert(self.tables[0], row)
+            inserter.insert(self.tables[1], dict(row))
+        self.assertEqual(loader.n_rows_pending, 5)  # rows 20-24
+        loader.flush()
+        inserter.flush()
+        self.assertEqual(loader.n_rows_pending, 0)
+        self.session.commit()
+        contents = [
+            self.session.execute(t.select().order_by(t.c.pk)).fetchall()
+            for t in self.tables
+        ]
+        self.assertEqual(len(contents[0]), 25)
+        self.assertEqual(contents[0], contents[1])
+
+    def test_fast_executemany_just_for_bulk_load(self) -> None:
+        # We can't use pyodbc here, but we can check that its flag would be
+        # set for our "executemany" calls, and no others.
+        executemany_flags = []  # type: List[bool]
+
+        # noinspection PyUnusedLocal
+        def set_fast_executemany(conn: Any, cursor: Any, statement: str,
+                                 parameters: Any, context: Any,
+                                 executemany: bool) -> None:
+            executemany_flags.append(executemany)
+
+        loader = BulkLoader(self.session, max_rows_per_batch=5)
+        loader.method = BulkLoader.METHOD_MSSQL_FAST_EXECUTEMANY
+        with mock.patch(
+                "crate_anon.common.bulk_load._set_fast_executemany",
+                set_fast_executemany):
+            for pk in range(5):
+                loader.insert(self.tables[0], {"pk": pk})
+            self.assertEqual(executemany_flags, [True])
+            self.session.execute(self.tables[1].insert(),
+                                 [{"pk": 1}, {"pk": 2}])
+        self.assertEqual(executemany_flags, [True])
+        self.assertEqual(
+            self.session.execute(self.tables[0].count()).scalar(), 5)
+
+
+class FakeCursor(object):
+    """
+    Stands in for a MySQL or PostgreSQL DBAPI cursor, noting what's executed
+    and the contents of any files loaded.
+    """
+    def __init__(self, n_warnings: int = 0) -> None:
+        self.n_warnings = n_warnings
+        self.executed = []  # type: List[str]
+        self.loaded = []  # type: List[bytes]
+        self.filenames = []  # type: List[str]
+
+    def execute(self, sql: str) -> None:
+        self.executed.append(sql)
+        m = re.match(r"LOAD DATA LOCAL INFILE '(.*?)'", sql)
+        if m:
+            self.filenames.append(m.group(1))
+            with open(m.group(1), "rb") as f:
+                self.loaded.append(f.read())
+
+    def fetchone(self) -> Tuple[int]:
+        return self.n_warnings,
+
+    def fetchall(self) -> List[Tuple[str, int, str]]:
+        return [("Warning", 1062, "Duplicate entry '1' for key 'PRIMARY'")]
+
+    def copy_expert(self, sql: str, file: BinaryIO) -> None:
+        self.executed.append(sql)
+        self.loaded.append(file.read())
+
+    def close(self) -> None:
+        pass
+
+
+class BulkLoaderDialectTests(TestCase):
+    """
+    Checks what :class:`BulkLoader` sends to MySQL and PostgreSQL, via fake
+    DBAPI cursors.
+    """
+    def setUp(self) -> None:
+        self.table = Table("t", MetaData(),
+                           Column("pk", Integer, primary_key=True),
+                           Column("note", Text),
+                           Column("when", DateTime))
+        self.rows = [
+            {"pk": 1, "note": "a\tb", "when": None},
+            {"pk": 2, "note": None,
+             "when": datetime.datetime(2020, 1, 2, 3, 4, 5)},
+        ]
+
+    @staticmethod
+    def make_session(dialect: Dialect, cursor: FakeCursor) -> mock.Mock:
+        session = mock.Mock()
+        session.get_bind.return_value = mock.Mock(dialect=dialect)
+        session.connection.return_value.connection.cursor.return_value = \
+            cursor
+        return session
+
+    def load(self, dialect: Dialect, cursor: FakeCursor,
+             **kwargs: Any) -> BulkLoader:
+        loader = BulkLoader(self.make_session(dialect, cursor), **kwargs)
+        for row in self.rows:
+            loader.insert(self.table, row)
+        loader.flush()
+        return loader
+
+    def test_mysql(self) -> None:
+        cursor = FakeCursor()
+        loader = self.load(MySQLDialect_pymysql(), cursor,
+                           replace_duplicates=True)
+        self.assertEqual(loader.method, BulkLoader.METHOD_MYSQL_LOAD_DATA)
+        self.assertEqual(cursor.loaded, [
+            b"1\ta\\tb\t\\N\n"
+            b"2\t\\N\t2020-01-02 03:04:05\n"
+        ])
+        self.assertIn(" REPLACE INTO TABLE t ", cursor.executed[0])
+        self.assertTrue(cursor.executed[0].endswith("(pk, note, `when`)"))
+        self.assertEqual(cursor.executed[1:], ["SHOW COUNT(*) WARNINGS"])
+        self.assertFalse(os.path.exists(cursor.filenames[0]))
+
+    def test_mysql_warnings(self) -> None:
+        cursor = FakeCursor(n_warnings=1)
+        with self.assertRaises(RuntimeError) as cm:
+            self.load(MySQLDialect_pymysql(), cursor)
+        self.assertIn("Duplicate entry", str(cm.exception))
+        self.assertNotIn("REPLACE", cursor.executed[0])
+        self.assertEqual(cursor.executed[2], "SHOW WARNINGS LIMIT 5")
+        self.assertFalse(os.path.exists(cursor.filenames[0]))
+
+    def test_postgres(self) -> None:
+        cursor = FakeCursor()
+        loader = self.load(PGDialect_psycopg2(), cursor)
+        self.assertEqual(loader.method, BulkLoader.METHOD_POSTGRES_COPY)
+        self.assertEqual(cursor.executed, [
+            'COPY t (pk, note, "when") FROM STDIN '
+            "WITH (FORMAT text, ENCODING 'UTF8')"
+        ])
+        self.assertEqual(cursor.loaded, [
+            b"1\ta\\tb\t\\N\n"
+            b"2\t\\N\t2020-01-02T03:04:05\n"
+        ])
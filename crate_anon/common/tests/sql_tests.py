@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+"""
+crate_anon/common/tests/sql_tests.py
+
+===============================================================================
+
+    Copyright (C) 2015-2021 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+"""
+
+import logging
+from typing import Any, Dict, List
+from unittest import mock, TestCase
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.base import Connection
+from sqlalchemy.engine.result import ResultProxy
+from sqlalchemy.exc import DatabaseError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import Column, MetaData, Table
+from sqlalchemy.sql import select
+from sqlalchemy.sql.sqltypes import Integer
+
+from crate_anon.common.sql import (
+    BatchedInserter,
+    gen_result_rows,
+    gen_sorted_difference,
+    gen_unique_values_by_keyset,
+    TransactionSizeLimiter,
+)
+
+
+class SortedDifferenceTests(TestCase):
+    def test_difference(self) -> None:
+        def diff(values, exclude):
+            return list(gen_sorted_difference(values, exclude))
+
+        self.assertEqual(diff([1, 2, 3, 5, 8], [2, 3, 4, 8, 9]), [1, 5])
+        self.assertEqual(diff([1, 2, 3], []), [1, 2, 3])
+        self.assertEqual(diff([], [1, 2]), [])
+        self.assertEqual(diff([1, 1, 2, 2], [1]), [2, 2])
+        self.assertEqual(diff([4, 5], [1, 1, 2, 5, 5]), [4])
+        self.assertEqual(diff(iter(range(10)), iter(range(0, 10, 3))),
+                         [1, 2, 4, 5, 7, 8])
+
+    def test_out_of_order(self) -> None:
+        with self.assertRaises(ValueError):
+            list(gen_sorted_difference([1, 3, 2], [1]))
+        with self.assertRaises(ValueError):
+            list(gen_sorted_difference([5], [1, 3, 2]))
+
+
+class KeysetTests(TestCase):
+    def test_pages(self) -> None:
+        engine = create_engine("sqlite://")
+        t = Table("t", MetaData(), Column("pk", Integer, primary_key=True))
+        t.create(engine)
+        pks = list(range(0, 50, 2))
+        engine.execute(t.insert(), [{"pk": pk} for pk in reversed(pks)])
+        session = sessionmaker(bind=engine)()
+        for pagesize in (1, 7, 25, 100):
+            self.assertEqual(
+                list(gen_unique_values_by_keyset(session, t, "pk", pagesize)),
+                pks)
+        # Deleting rows already seen doesn't disturb the pagination.
+        seen = []
+        for pk in gen_unique_values_by_keyset(session, t, "pk", 4):
+            seen.append(pk)
+            session.execute(t.delete().where(t.c.pk == pk))
+        self.assertEqual(seen, pks)
+        session.close()
+
+
+class GenResultRowsTests(TestCase):
+    def setUp(self) -> None:
+        engine = create_engine("sqlite://")
+        self.t = Table("t", MetaData(),
+                       Column("pk", Integer, primary_key=True))
+        self.t.create(engine)
+        engine.execute(self.t.insert(), [{"pk": pk} for pk in range(10)])
+        self.session = sessionmaker(bind=engine)()
+        self.addCleanup(self.session.close)
+        self.query = select([self.t.c.pk]).order_by(self.t.c.pk)
+        # Keep hold of what's executed, and the results.
+        self.executed = []  # type: List[Any]
+        self.results = []  # type: List[ResultProxy]
+        real_execute = self.session.execute
+
+        def execute(query: Any, *args: Any, **kwargs: Any) -> ResultProxy:
+            self.executed.append(query)
+            result = real_execute(query, *args, **kwargs)
+            self.results.append(result)
+            return result
+
+        self.session.execute = execute
+
+    def pks(self, **kwargs: Any) -> List[int]:
+        return [row[0] for row in gen_result_rows(self.session, self.query,
+                                                  **kwargs)]
+
+    def test_without_streaming(self) -> None:
+        with mock.patch.object(ResultProxy, "fetchmany") as fetchmany:
+            self.assertEqual(self.pks(), list(range(10)))
+        fetchmany.assert_not_called()
+        self.assertNotIn("stream_results",
+                         self.executed[0].get_execution_options())
+        self.assertTrue(self.results[0].closed)
+
+    def test_streaming_in_batches(self) -> None:
+        real_fetchmany = ResultProxy.fetchmany
+        with mock.patch.object(ResultProxy, "fetchmany", autospec=True,
+                               side_effect=real_fetchmany) as fetchmany:
+            self.assertEqual(self.pks(stream_results=True, fetch_size=4),
+                             list(range(10)))
+        self.assertTrue(
+            self.executed[0].get_execution_options()["stream_results"])
+        # Batches of 4, 4, 2, then nothing.
+        self.assertEqual([c[0][1] for c in fetchmany.call_args_list],
+                         [4, 4, 4, 4])
+        self.assertTrue(self.results[0].closed)
+
+    def test_closing_early_closes_result(self) -> None:
+        for stream_results in (False, True):
+            gen = gen_result_rows(self.session, self.query,
+                                  stream_results=stream_results, fetch_size=3)
+            self.assertEqual(next(gen)[0], 0)
+            self.assertFalse(self.results[-1].closed)
+            gen.close()
+            self.assertTrue(self.results[-1].closed)
+
+
+class TransactionSizeLimiterTests(TestCase):
+    def test_flushes_before_commit(self) -> None:
+        engine = create_engine("sqlite://")
+        t = Table("t", MetaData(), Column("pk", Integer, primary_key=True))
+        t.create(engine)
+        session = sessionmaker(bind=engine)()
+        inserter = None  # type: BatchedInserter
+        limiter = TransactionSizeLimiter(
+            session, max_rows_before_commit=5,
+            before_commit=lambda: inserter.flush())
+        inserter = BatchedInserter(session, max_rows_per_batch=4,
+                                   transaction_limiter=limiter)
+        for pk in range(6):
+            inserter.insert(t, {"pk": pk})
+        self.assertEqual(inserter.n_rows_pending, 2)
+        limiter.commit()
+        self.assertEqual(inserter.n_rows_pending, 0)
+        other_session = sessionmaker(bind=engine)()
+        self.assertEqual(other_session.query(t).count(), 6)
+        other_session.close()
+        session.close()
+
+
+class BatchedInserterTests(TestCase):
+    def setUp(self) -> None:
+        self.session = mock.Mock()
+        self.limiter = mock.Mock()
+        self.t1 = self.make_table("t1")
+        self.t2 = self.make_table("t2")
+
+    @staticmethod
+    def make_table(name: str) -> mock.Mock:
+        table = mock.Mock()
+        table.name = name
+        return table
+
+    def make_inserter(self, **kwargs: Any) -> BatchedInserter:
+        return BatchedInserter(self.session, transaction_limiter=self.limiter,
+                               **kwargs)
+
+    def written(self) -> List[List[Dict[str, Any]]]:
+        # Rows passed to each executemany call.
+        return [c[0][1] for c in self.session.execute.call_args_list]
+
+    def test_one_row_per_batch_by_default(self) -> None:
+        inserter = self.make_inserter()
+        inserter.insert(self.t1, {"a": 1}, n_bytes=10)
+        inserter.insert(self.t1, {"a": 2}, n_bytes=10)
+        self.assertEqual(self.written(), [[{"a": 1}], [{"a": 2}]])
+        self.assertEqual(inserter.n_rows_pending, 0)
+        self.limiter.notify.assert_called_with(n_rows=1, n_bytes=10)
+
+    def test_flushes_at_row_limit(self) -> None:
+        inserter = self.make_inserter(max_rows_per_batch=3)
+        for a in range(7):
+            inserter.insert(self.t1, {"a": a}, n_bytes=10)
+        self.assertEqual(self.written(), [
+            [{"a": 0}, {"a": 1}, {"a": 2}],
+            [{"a": 3}, {"a": 4}, {"a": 5}],
+        ])
+        self.assertEqual(inserter.n_rows_pending, 1)
+        self.assertEqual(self.limiter.notify.call_args_list, [
+            mock.call(n_rows=3, n_bytes=30),
+            mock.call(n_rows=3, n_bytes=30),
+        ])
+        inserter.flush()
+        self.assertEqual(self.written()[-1], [{"a": 6}])
+        self.limiter.notify.assert_called_with(n_rows=1, n_bytes=10)
+        self.assertEqual(inserter.n_rows_pending, 0)
+
+    def test_flushes_at_byte_limit(self) -> None:
+        inserter = self.make_inserter(max_rows_per_batch=100,
+                                      max_bytes_per_batch=25)
+        for a in range(5):
+            inserter.insert(self.t1, {"a": a}, n_bytes=10)
+        # The batch is written once it reaches the limit.
+        self.assertEqual(self.written(), [
+            [{"a": 0}, {"a": 1}, {"a": 2}],
+        ])
+        self.limiter.notify.assert_called_once_with(n_rows=3, n_bytes=30)
+        self.assertEqual(inserter.n_rows_pending, 2)
+
+    def test_tables_batched_separately(self) -> None:
+        inserter = self.make_inserter(max_rows_per_batch=2)
+        inserter.insert(self.t1, {"a": 1})
+        inserter.insert(self.t2, {"b": 1})
+        inserter.insert(self.t1, {"a": 2})
+        self.assertEqual(self.written(), [[{"a": 1}, {"a": 2}]])
+        self.assertEqual(inserter.n_rows_pending, 1)
+        inserter.flush()
+        self.assertEqual(self.written()[-1], [{"b": 1}])
+
+    def test_different_columns_flush_first(self) -> None:
+        inserter = self.make_inserter(max_rows_per_batch=10)
+        inserter.insert(self.t1, {"a": 1})
+        inserter.insert(self.t1, {"a": 2, "b": 2})
+        # All rows in a batch have the same columns; order is kept.
+        self.assertEqual(self.written(), [[{"a": 1}]])
+        inserter.flush()
+        self.assertEqual(self.written()[-1], [{"a": 2, "b": 2}])
+
+    def test_insert_on_duplicate(self) -> None:
+        inserter = self.make_inserter(insert_on_duplicate=True)
+        inserter.insert(self.t1, {"a": 1})
+        self.t1.insert_on_duplicate.assert_called_once_with()
+        self.t1.insert.assert_not_called()
+        self.session.execute.assert_called_once_with(
+            self.t1.insert_on_duplicate.return_value, [{"a": 1}])
+
+    def test_writes_rows_to_database(self) -> None:
+        engine = create_engine("sqlite://")
+        t = Table("t", MetaData(), Column("pk", Integer, primary_key=True))
+        t.create(engine)
+        session = sessionmaker(bind=engine)()
+        inserter = BatchedInserter(session, max_rows_per_batch=4)
+        for pk in range(10):
+            inserter.insert(t, {"pk": pk})
+        self.assertEqual(session.query(t).count(), 8)
+        inserter.flush()
+        self.assertEqual([row.pk for row in session.query(t)],
+                         list(range(10)))
+        session.close()
+
+    def test_failed_batch_retried_in_savepoints(self) -> None:
+        def execute(statement: Any, params: Any) -> None:
+            if isinstance(params, list) or params == {"a": 1}:
+                raise DatabaseError("INSERT", params, Exception("bad row"))
+
+        self.session.execute.side_effect = execute
+        inserter = self.make_inserter(max_rows_per_batch=3,
+                                      skip_failed_rows=True)
+        with self.assertLogs(level=logging.ERROR) as logging_cm:
+            for a in range(3):
+                inserter.insert(self.t1, {"a": a})
+        statement = self.t1.insert.return_value
+        self.assertEqual(self.session.mock_calls, [
+            # The batch fails and is rolled back...
+            mock.call.begin_nested(),
+            mock.call.execute(statement, [{"a": 0}, {"a": 1}, {"a": 2}]),
+            mock.call.begin_nested().rollback(),
+            # ... then each row is written in its own savepoint.
+            mock.call.begin_nested(),
+            mock.call.execute(statement, {"a": 0}),
+            mock.call.begin_nested().commit(),
+            mock.call.begin_nested(),
+            mock.call.execute(statement, {"a": 1}),
+            mock.call.begin_nested().rollback(),
+            mock.call.begin_nested(),
+            mock.call.execute(statement, {"a": 2}),
+            mock.call.begin_nested().commit(),
+        ])
+        self.assertIn("failed for 1 of 3 rows", logging_cm.output[-1])
+        self.limiter.notify.assert_called_once_with(n_rows=3, n_bytes=0)
+
+    def test_batch_failing_part_way_through(self) -> None:
+        # SQLite (via pysqlite) needs some help with SAVEPOINT; see
+        # https://docs.sqlalchemy.org/en/13/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl  # noqa
+        engine = create_engine("sqlite://")
+
+        @event.listens_for(engine, "connect")
+        def do_connect(dbapi_connection: Any, connection_record: Any) -> None:
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, "begin")
+        def do_begin(conn: Connection) -> None:
+            conn.execute("BEGIN")
+
+        t = Table("t", MetaData(), Column("pk", Integer, primary_key=True))
+        t.create(engine)
+        session = sessionmaker(bind=engine)()
+        session.execute(t.insert(), {"pk": 100})
+        inserter = BatchedInserter(session, max_rows_per_batch=4,
+                                   skip_failed_rows=True)
+        with self.assertLogs(level=logging.ERROR) as logging_cm:
+            # The duplicate fails after the first two rows have gone in.
+            for pk in [0, 1, 1, 2]:
+                inserter.insert(t, {"pk": pk})
+        self.assertIn("failed for 1 of 4 rows", logging_cm.output[-1])
+        session.commit()
+        self.assertEqual([row.pk for row in session.query(t)],
+                         [0, 1, 2, 100])
+        session.close()
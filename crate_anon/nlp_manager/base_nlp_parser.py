@@ -34,7 +34,7 @@ import json
 import logging
 import sys
 from typing import (
-    Any, Dict, Generator, Iterable, List, Optional, TextIO, Tuple,
+    Any, Dict, FrozenSet, Generator, Iterable, List, Optional, TextIO, Tuple,
     TYPE_CHECKING,
 )
 
@@ -50,7 +50,6 @@ from cardinal_pythonlib.sqlalchemy.schema import (
 from sqlalchemy.dialects import registry
 # from sqlalchemy.dialects.mssql.base import MSDialect
 from sqlalchemy.engine.base import Engine
-from sqlalchemy.exc import DatabaseError
 from sqlalchemy.orm.session import Session
 from sqlalchemy.schema import Column, Index, Table
 from sqlalchemy.sql import and_, exists, or_
@@ -479,6 +478,14 @@ class TableMaker(ABC):
             raise KeyError(f"No destination table for this NLP processor "
                            f"named {tablename!r}")
 
+    @lru_cache(maxsize=None)
+    def get_table_column_names(self, tablename: str) -> FrozenSet[str]:
+        """
+        Returns the names of all columns in a given destination table of this
+        NLP processor (see :meth:`get_table`).
+        """
+        return frozenset(c.name for c in self.get_table(tablename).columns)
+
     def make_tables(self, drop_first: bool = False) -> List[str]:
         """
         Creates all destination tables for this NLP processor in the
@@ -527,31 +534,68 @@ class TableMaker(ABC):
                 See e.g.
                 http://dev.mysql.com/doc/refman/5.5/en/innodb-deadlocks.html
         """  # noqa
+        self.delete_dest_records(ifconfig, [(srcpkval, srcpkstr)],
+                                 commit=commit)
+
+    def delete_dest_records(self,
+                            ifconfig: InputFieldConfig,
+                            srcpks: List[Tuple[int, Optional[str]]],
+                            commit: bool = False) -> None:
+        """
+        Deletes all destination records for several source records, with one
+        ``DELETE`` per destination table. As for :meth:`delete_dest_record`.
+
+        Args:
+            ifconfig:
+                :class:`crate_anon.nlp_manager.input_field_config.InputFieldConfig`
+                that defines the source database, table, and field (column)
+            srcpks:
+                list of ``srcpkval, srcpkstr`` tuples, giving the integer
+                primary key (PK) value of each source record and, for tables
+                with string PKs, the string PK value (otherwise ``None``)
+            commit:
+                execute a COMMIT after we have deleted the records?
+        """  # noqa
+        if not srcpks:
+            return
         session = self.dest_session
         srcdb = ifconfig.srcdb
         srctable = ifconfig.srctable
         srcfield = ifconfig.srcfield
         destdb_name = self._destdb.name
         nlpdef_name = self._nlpdef.name
+        # For string PKs, the integer PK value is a hash of the string, so any
+        # destination row whose string PK is in our list belongs to one of our
+        # source records; the integer PK values are there for the index.
+        int_pkvals = [pkval for pkval, pkstr in srcpks if pkstr is None]
+        str_pkvals = [pkval for pkval, pkstr in srcpks if pkstr is not None]
+        str_pkstrs = [pkstr for pkval, pkstr in srcpks if pkstr is not None]
         for tablename, desttable in self.tables().items():
             log.debug(f"delete_from_dest_dbs... {srcdb}.{srctable} -> "
                       f"{destdb_name}.{tablename}")
+            pk_conditions = []
+            if int_pkvals:
+                # noinspection PyProtectedMember,PyPropertyAccess
+                pk_conditions.append(desttable.c._srcpkval.in_(int_pkvals))
+            if str_pkstrs:
+                # noinspection PyProtectedMember,PyPropertyAccess
+                pk_conditions.append(and_(
+                    desttable.c._srcpkval.in_(str_pkvals),
+                    desttable.c._srcpkstr.in_(str_pkstrs)
+                ))
             # noinspection PyProtectedMember,PyPropertyAccess
             delquery = (
                 desttable.delete().
                 where(desttable.c._srcdb == srcdb).
                 where(desttable.c._srctable == srctable).
                 where(desttable.c._srcfield == srcfield).
-                where(desttable.c._srcpkval == srcpkval).
+                where(or_(*pk_conditions)).
                 where(desttable.c._nlpdef == nlpdef_name)
             )
-            if srcpkstr is not None:
-                # noinspection PyProtectedMember,PyPropertyAccess
-                delquery = delquery.where(desttable.c._srcpkstr == srcpkstr)
             with MultiTimerContext(timer, TIMING_DELETE_DEST_RECORD):
                 session.execute(delquery)
-            if commit:
-                self._nlpdef.commit(session)
+        if commit:
+            self._nlpdef.commit(session)
 
     def delete_where_srcpk_not(self,
                                ifconfig: InputFieldConfig,
@@ -673,6 +717,20 @@ class BaseNlpParser(TableMaker):
         """
         raise NotImplementedError
 
+    def get_prefilter_literals(self) \
+            -> Optional[FrozenSet[Tuple[str, bool]]]:
+        """
+        If every result from :meth:`parse` requires the text to contain one
+        of a set of literal strings, returns that set, so that text without
+        any of them can be skipped quickly; otherwise returns ``None`` (the
+        default).
+
+        See :func:`crate_anon.nlp_manager.regex_func.get_required_literals`
+        for the format, and
+        :class:`crate_anon.nlp_manager.regex_parser.RegexPrefilter`.
+        """
+        return None
+
     def process(self, text: str,
                 starting_fields_values: Dict[str, Any]) -> None:
         """
@@ -701,46 +759,96 @@ class BaseNlpParser(TableMaker):
             # log.warning(f"No word characters found in {text}")
             # ... the warning occurs frequently so slows down processing
             return
+        with MultiTimerContext(timer, TIMING_PARSE):
+            self._insert_results(self.parse(text), starting_fields_values)
+
+    @property
+    def max_records_in_flight(self) -> int:
+        """
+        How many pieces of text can this processor usefully work on at once,
+        via :meth:`process_records`? The default is 1; processors that can
+        pipeline their work override this.
+        """
+        return 1
+
+    def process_records(
+            self,
+            records: List[Tuple[str, Dict[str, Any]]]) -> List[bool]:
+        """
+        Processes several pieces of text, as for :meth:`process`. The default
+        implementation processes them one by one; processors that can work on
+        several at once override this.
+
+        Args:
+            records:
+                list of ``text, starting_fields_values`` tuples, as for
+                :meth:`process`
+
+        Returns:
+            a list of booleans, one per record: was it processed successfully
+            (i.e. without
+            :exc:`crate_anon.nlp_manager.base_nlp_parser.TextProcessingFailed`)?
+        """
+        successes = []  # type: List[bool]
+        for text, starting_fields_values in records:
+            try:
+                self.process(text, starting_fields_values)
+                successes.append(True)
+            except TextProcessingFailed:
+                successes.append(False)
+        return successes
+
+    def _insert_results(
+            self,
+            results: Iterable[Tuple[str, Dict[str, Any]]],
+            starting_fields_values: Dict[str, Any]) -> None:
+        """
+        Inserts NLP results for a single piece of text into the destination
+        database.
+
+        Args:
+            results:
+                the results, in the format yielded by :meth:`parse`
+            starting_fields_values:
+                as for :meth:`process`
+
+        Raises:
+            :exc:`crate_anon.nlp_manager.base_nlp_parser.TextProcessingFailed`
+            if this parser could not process the text (as we consume the
+            results)
+        """
         starting_fields_values[FN_NLPDEF] = self._nlpdef.name
         session = self.dest_session
+        inserter = self._nlpdef.get_batched_inserter(session)
         n_values = 0
-        with MultiTimerContext(timer, TIMING_PARSE):
-            for tablename, nlp_values in self.parse(text):
-                with MultiTimerContext(timer, TIMING_HANDLE_PARSED):
-                    # Merge dictionaries so EXISTING FIELDS/VALUES
-                    # (starting_fields_values) HAVE PRIORITY.
-                    nlp_values.update(starting_fields_values)
-                    sqla_table = self.get_table(tablename)
-                    # If we have superfluous keys in our dictionary, SQLAlchemy
-                    # will choke ("Unconsumed column names", reporting the
-                    # thing that's in our dictionary that it doesn't know
-                    # about). HOWEVER, note that SQLA column names may be mixed
-                    # case (e.g. 'Text') while our copy-column names are lower
-                    # case (e.g. 'text'), so we must have pre-converted
-                    # the SQLA column names to lower case. That happens in
-                    # InputFieldConfig.get_copy_columns and
-                    # InputFieldConfig.get_copy_indexes
-                    column_names = [c.name for c in sqla_table.columns]
-                    final_values = {k: v for k, v in nlp_values.items()
-                                    if k in column_names}
-                    # log.critical(repr(sqla_table))
-                    insertquery = sqla_table.insert().values(final_values)
-                    try:
-                        with MultiTimerContext(timer, TIMING_INSERT):
-                            session.execute(insertquery)
-                    except DatabaseError as e:
-                        # We can get an error on insert if for example the
-                        # output returned by the NLP is invalid for the column
-                        # type
-                        log.error(e)
-
-                    self._nlpdef.notify_transaction(
-                        session,
-                        n_rows=1,
-                        n_bytes=sys.getsizeof(final_values),
-                        force_commit=self._commit
-                    )
-                    n_values += 1
+        for tablename, nlp_values in results:
+            with MultiTimerContext(timer, TIMING_HANDLE_PARSED):
+                # Merge dictionaries so EXISTING FIELDS/VALUES
+                # (starting_fields_values) HAVE PRIORITY.
+                nlp_values.update(starting_fields_values)
+                sqla_table = self.get_table(tablename)
+                # If we have superfluous keys in our dictionary, SQLAlchemy
+                # will choke ("Unconsumed column names", reporting the
+                # thing that's in our dictionary that it doesn't know
+                # about). HOWEVER, note that SQLA column names may be mixed
+                # case (e.g. 'Text') while our copy-column names are lower
+                # case (e.g. 'text'), so we must have pre-converted
+                # the SQLA column names to lower case. That happens in
+                # InputFieldConfig.get_copy_columns and
+                # InputFieldConfig.get_copy_indexes
+                column_names = self.get_table_column_names(tablename)
+                final_values = {k: v for k, v in nlp_values.items()
+                                if k in column_names}
+                # The row may be buffered, and written as part of a
+                # multi-row batch; see the max_rows_per_insert_batch
+                # option. Batches count towards our transaction limits as
+                # they are written, and are written before any COMMIT.
+                with MultiTimerContext(timer, TIMING_INSERT):
+                    inserter.insert(sqla_table, final_values,
+                                    n_bytes=sys.getsizeof(final_values))
+                n_values += 1
+        if self._commit and n_values:
+            self._nlpdef.commit(session)
         log.debug(
             f"NLP processor {self.nlpdef_name}/{self.friendly_name}:"
             f" found {n_values} values")
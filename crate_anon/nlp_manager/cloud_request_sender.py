@@ -132,6 +132,10 @@ class CloudRequestSender(object):
         self._state = self.State.BUILDING_REQUEST
         self._request = None  # type: Optional[CloudRequestProcess]
 
+        self._prefetch_progress = incremental and ifconfig.prefetch_progress
+        if self._prefetch_progress:
+            ifconfig.prefetch_progress_records()
+
     def send_requests(
             self,
             global_recnum: int) -> Tuple[List[CloudRequestProcess], bool, int]:
@@ -253,9 +257,13 @@ class CloudRequestSender(object):
         """
         pkval = self._other_values[FN_SRCPKVAL]
         pkstr = self._other_values[FN_SRCPKSTR]
-        progrec = self._ifconfig.get_progress_record(pkval, pkstr)
-        if progrec is not None:
-            if progrec.srchash == srchash:
+        if self._prefetch_progress:
+            old_srchash = self._ifconfig.get_prefetched_srchash(pkval, pkstr)
+        else:
+            progrec = self._ifconfig.get_progress_record(pkval, pkstr)
+            old_srchash = progrec.srchash if progrec else None
+        if old_srchash is not None:
+            if old_srchash == srchash:
                 log.debug("Record previously processed; skipping")
                 return True
 
@@ -41,6 +41,7 @@ DEFAULT_CLOUD_MAX_RECORDS_PER_REQUEST = 1000
 DEFAULT_CLOUD_MAX_TRIES = 5
 DEFAULT_CLOUD_RATE_LIMIT_HZ = 2
 DEFAULT_CLOUD_WAIT_ON_CONN_ERR_S = 180  # in seconds
+DEFAULT_MAX_DOCS_IN_FLIGHT_PER_PROG = 2
 DEFAULT_REPORT_EVERY_NLP = 500  # low values slow down processing
 DEFAULT_TEMPORARY_TABLENAME = "_crate_nlp_temptable"
 
@@ -105,8 +106,11 @@ class NlpDefConfigKeys(object):
     TEMPORARY_TABLENAME = "temporary_tablename"
     MAX_ROWS_BEFORE_COMMIT = "max_rows_before_commit"
     MAX_BYTES_BEFORE_COMMIT = "max_bytes_before_commit"
+    MAX_ROWS_PER_INSERT_BATCH = "max_rows_per_insert_batch"
+    MAX_RECORDS_PER_DELETE_BATCH = "max_records_per_delete_batch"
     TRUNCATE_TEXT_AT = "truncate_text_at"
     RECORD_TRUNCATED_VALUES = "record_truncated_values"
+    REGEX_PREFILTER = "regex_prefilter"
     CLOUD_CONFIG = "cloud_config"
     CLOUD_REQUEST_DATA_DIR = "cloud_request_data_dir"
 
@@ -134,6 +138,9 @@ class InputFieldConfigKeys(object):
     COPYFIELDS = "copyfields"
     INDEXED_COPYFIELDS = "indexed_copyfields"
     DEBUG_ROW_LIMIT = "debug_row_limit"
+    STREAM_RESULTS = "stream_results"
+    FETCH_SIZE = "fetch_size"
+    PREFETCH_PROGRESS = "prefetch_progress"
 
 
 class ProcessorConfigKeys(object):
@@ -149,6 +156,8 @@ class ProcessorConfigKeys(object):
     INPUT_TERMINATOR = "input_terminator"
     OUTPUT_TERMINATOR = "output_terminator"
     MAX_EXTERNAL_PROG_USES = "max_external_prog_uses"
+    EXTERNAL_PROG_POOL_SIZE = "external_prog_pool_size"
+    MAX_DOCS_IN_FLIGHT_PER_PROG = "max_docs_in_flight_per_prog"
     PROCESSOR_NAME = "processor_name"
     PROCESSOR_VERSION = "processor_version"
     PROCESSOR_FORMAT = "processor_format"
@@ -48,10 +48,13 @@ from cardinal_pythonlib.timing import MultiTimerContext, timer
 from sqlalchemy import BigInteger, Column, DateTime, Index, String, Table
 from sqlalchemy.engine.base import Engine
 from sqlalchemy.orm.session import Session
-from sqlalchemy.sql import and_, column, exists, null, or_, select, table
+from sqlalchemy.sql import (
+    and_, bindparam, column, exists, null, or_, select, table,
+)
 from sqlalchemy.sql.schema import MetaData
 
 from crate_anon.common.parallel import is_my_job_by_hash_prehashed
+from crate_anon.common.sql import DEFAULT_FETCH_SIZE, gen_result_rows
 from crate_anon.nlp_manager.constants import (
     FN_CRATE_VERSION_FIELD,
     FN_WHEN_FETCHED,
@@ -86,8 +89,11 @@ log = logging.getLogger(__name__)
 TIMING_GEN_TEXT_SQL_SELECT = "gen_text_sql_select"
 TIMING_PROCESS_GEN_TEXT = "process_generated_text"
 TIMING_PROGRESS_DB_SELECT = "progress_db_select"
+TIMING_PROGRESS_DB_WRITE = "progress_db_write"
 TIMING_PROGRESS_DB_DELETE = "progress_db_delete"
 
+_APPROX_PROGRESS_BYTES = 200  # approximate size of a progress record
+
 
 # =============================================================================
 # Input field definition
@@ -136,6 +142,12 @@ class InputFieldConfig(object):
             InputFieldConfigKeys.INDEXED_COPYFIELDS)
         self._debug_row_limit = cfg.opt_int(
             InputFieldConfigKeys.DEBUG_ROW_LIMIT, default=0)
+        self._stream_results = cfg.opt_bool(
+            InputFieldConfigKeys.STREAM_RESULTS, default=False)
+        self._fetch_size = cfg.opt_int(
+            InputFieldConfigKeys.FETCH_SIZE, default=DEFAULT_FETCH_SIZE)
+        self._prefetch_progress = cfg.opt_bool(
+            InputFieldConfigKeys.PREFETCH_PROGRESS, default=False)
         # self._fetch_sorted = opt_bool('fetch_sorted', default=True)
 
         ensure_valid_table_name(self._srctable)
@@ -144,6 +156,10 @@ class InputFieldConfig(object):
         if self._srcdatetimefield:
             ensure_valid_field_name(self._srcdatetimefield)
 
+        if self._fetch_size < 1:
+            raise ValueError(f"{InputFieldConfigKeys.FETCH_SIZE} < 1, "
+                             f"nonsensical")
+
         if len(set(self._indexed_copyfields)) != len(self._indexed_copyfields):
             raise ValueError(
                 f"Redundant indexed_copyfields: {self._indexed_copyfields}")
@@ -166,6 +182,12 @@ class InputFieldConfig(object):
 
         self._db = nlpdef.get_database(self._srcdb)
 
+        # For prefetch_progress mode: maps (srcpkval, srcpkstr) to
+        # (NlpRecord PK, srchash), and buffers progress records to write.
+        self._progress_map = {}  # type: Dict[Tuple[int, Optional[str]], Tuple[int, str]]  # noqa
+        self._progress_inserts = []  # type: List[Dict[str, Any]]
+        self._progress_updates = []  # type: List[Dict[str, Any]]
+
     @property
     def srcdb(self) -> str:
         """
@@ -195,6 +217,15 @@ class InputFieldConfig(object):
         """
         return self._srcfield
 
+    @property
+    def prefetch_progress(self) -> bool:
+        """
+        Should we read all progress records for this input field at the
+        start, and write them in batches, rather than one at a time? See
+        :meth:`prefetch_progress_records`.
+        """
+        return self._prefetch_progress
+
     @property
     def srcdatetimefield(self) -> str:  # new in v0.18.52
         """
@@ -470,7 +501,9 @@ class InputFieldConfig(object):
         nrows_returned = 0
         with MultiTimerContext(timer, TIMING_GEN_TEXT_SQL_SELECT):
             when_fetched = get_now_utc_notz_datetime()
-            result = session.execute(query)
+            result = gen_result_rows(session, query,
+                                     stream_results=self._stream_results,
+                                     fetch_size=self._fetch_size)
             for row in result:  # ... a generator itself
                 with MultiTimerContext(timer, TIMING_PROCESS_GEN_TEXT):
                     # Get PK value
@@ -561,6 +594,121 @@ class InputFieldConfig(object):
             # This was surprisingly slow under SQL Server testing.
             return query.one_or_none()
 
+    # -------------------------------------------------------------------------
+    # Progress records, prefetched
+    # -------------------------------------------------------------------------
+
+    def prefetch_progress_records(self) -> None:
+        """
+        Reads the PK and source hash of all progress records for this input
+        field (and NLP definition) into memory, for
+        :meth:`get_prefetched_srchash` and :meth:`save_progress_record`. That
+        is much faster than calling :meth:`get_progress_record` for each
+        source record.
+        """
+        session = self._progress_session
+        query = (
+            select([NlpRecord.pk, NlpRecord.srcpkval, NlpRecord.srcpkstr,
+                    NlpRecord.srchash]).
+            where(NlpRecord.srcdb == self._srcdb).
+            where(NlpRecord.srctable == self._srctable).
+            where(NlpRecord.srcfield == self._srcfield).
+            where(NlpRecord.nlpdef == self._nlpdef.name)
+        )
+        with MultiTimerContext(timer, TIMING_PROGRESS_DB_SELECT):
+            self._progress_map = {
+                (srcpkval, srcpkstr): (pk, srchash)
+                for pk, srcpkval, srcpkstr, srchash in gen_result_rows(
+                    session, query,
+                    stream_results=self._stream_results,
+                    fetch_size=self._fetch_size)
+            }
+        log.info(f"Prefetched {len(self._progress_map)} progress records for "
+                 f"{self._srcdb}.{self._srctable}.{self._srcfield}")
+
+    def get_prefetched_srchash(self,
+                               srcpkval: int,
+                               srcpkstr: str = None) -> Optional[str]:
+        """
+        Returns the source hash from the (prefetched) progress record for the
+        given source record, or ``None`` if there isn't one. Call
+        :meth:`prefetch_progress_records` first.
+        """
+        progress = self._progress_map.get((srcpkval, srcpkstr))
+        return progress[1] if progress else None
+
+    def save_progress_record(self,
+                             srcpkval: int,
+                             srcpkstr: Optional[str],
+                             srchash: str,
+                             force_commit: bool = False) -> None:
+        """
+        Notes that we've processed a source record, creating a progress record
+        or updating the one that was prefetched (see
+        :meth:`prefetch_progress_records`). These are written in batches of
+        ``fetch_size``; call :meth:`flush_progress_records` at the end.
+
+        Args:
+            srcpkval: source PK value (or hash of a string PK)
+            srcpkstr: source string PK, or ``None``
+            srchash: hash of the source text
+            force_commit: COMMIT after writing each batch?
+        """
+        progress = self._progress_map.get((srcpkval, srcpkstr))
+        if progress:
+            self._progress_updates.append({
+                "_pk": progress[0],
+                "_srchash": srchash,
+                "_when": self._nlpdef.now,
+            })
+        else:
+            self._progress_inserts.append({
+                # Quasi-key fields:
+                "srcdb": self._srcdb,
+                "srctable": self._srctable,
+                "srcpkval": srcpkval,
+                "srcpkstr": srcpkstr,
+                "srcfield": self._srcfield,
+                "nlpdef": self._nlpdef.name,
+                # Other fields:
+                "srcpkfield": self._srcpkfield,
+                "whenprocessedutc": self._nlpdef.now,
+                "srchash": srchash,
+            })
+        if (len(self._progress_inserts) + len(self._progress_updates) >=
+                self._fetch_size):
+            self.flush_progress_records(force_commit=force_commit)
+
+    def flush_progress_records(self, force_commit: bool = False) -> None:
+        """
+        Writes progress records buffered by :meth:`save_progress_record`.
+
+        Args:
+            force_commit: COMMIT afterwards?
+        """
+        n_rows = len(self._progress_inserts) + len(self._progress_updates)
+        if not n_rows:
+            return
+        session = self._progress_session
+        nlprecord_table = NlpRecord.__table__
+        with MultiTimerContext(timer, TIMING_PROGRESS_DB_WRITE):
+            if self._progress_inserts:
+                session.execute(nlprecord_table.insert(),
+                                self._progress_inserts)
+            if self._progress_updates:
+                session.execute(
+                    nlprecord_table.update().
+                    where(nlprecord_table.c.pk == bindparam("_pk")).
+                    values(srchash=bindparam("_srchash"),
+                           whenprocessedutc=bindparam("_when")),
+                    self._progress_updates
+                )
+        self._progress_inserts = []
+        self._progress_updates = []
+        self._nlpdef.notify_transaction(
+            session, n_rows=n_rows, n_bytes=n_rows * _APPROX_PROGRESS_BYTES,
+            force_commit=force_commit)
+
     def gen_src_pks(self) -> Generator[Tuple[int, Optional[str]], None, None]:
         """
         Generate integer PKs from the source table.
@@ -577,7 +725,9 @@ class InputFieldConfig(object):
             select([column(self._srcpkfield)]).
             select_from(table(self._srctable))
         )
-        result = session.execute(query)
+        result = gen_result_rows(session, query,
+                                 stream_results=self._stream_results,
+                                 fetch_size=self._fetch_size)
         if self.is_pk_integer():
             for row in result:
                 yield row[0], None
@@ -33,6 +33,7 @@ crate_anon/nlp_manager/nlp_definition.py
 # =============================================================================
 
 import datetime
+import functools
 import json
 import logging
 import os
@@ -51,6 +52,7 @@ from sqlalchemy.schema import MetaData
 from crate_anon.anonymise.constants import (
     DEFAULT_MAX_BYTES_BEFORE_COMMIT,
     DEFAULT_MAX_ROWS_BEFORE_COMMIT,
+    DEFAULT_MAX_ROWS_PER_INSERT_BATCH,
 )
 from crate_anon.anonymise.dbholder import DatabaseHolder
 from crate_anon.common.constants import EnvVar
@@ -58,7 +60,7 @@ from crate_anon.common.extendedconfigparser import (
     ConfigSection,
     ExtendedConfigParser,
 )
-from crate_anon.common.sql import TransactionSizeLimiter
+from crate_anon.common.sql import BatchedInserter, TransactionSizeLimiter
 from crate_anon.nlp_manager.cloud_config import CloudConfig
 from crate_anon.nlp_manager.constants import (
     CloudNlpConfigKeys,
@@ -314,8 +316,11 @@ def demo_nlp_config() -> str:
 {NlpDefConfigKeys.HASHPHRASE} = {hashphrase}
 # {NlpDefConfigKeys.TRUNCATE_TEXT_AT} = {truncate_text_at}
 # {NlpDefConfigKeys.RECORD_TRUNCATED_VALUES} = False
+# {NlpDefConfigKeys.REGEX_PREFILTER} = True
 {NlpDefConfigKeys.MAX_ROWS_BEFORE_COMMIT} = {DEFAULT_MAX_ROWS_BEFORE_COMMIT}
 {NlpDefConfigKeys.MAX_BYTES_BEFORE_COMMIT} = {DEFAULT_MAX_BYTES_BEFORE_COMMIT}
+# {NlpDefConfigKeys.MAX_ROWS_PER_INSERT_BATCH} = {DEFAULT_MAX_ROWS_PER_INSERT_BATCH}
+# {NlpDefConfigKeys.MAX_RECORDS_PER_DELETE_BATCH} = 1
 
 # -----------------------------------------------------------------------------
 # Cloud NLP demo
@@ -395,6 +400,8 @@ def demo_nlp_config() -> str:
 {ProcessorConfigKeys.INPUT_TERMINATOR} = {nlp_input_terminator}
 {ProcessorConfigKeys.OUTPUT_TERMINATOR} = {nlp_output_terminator}
 # {ProcessorConfigKeys.MAX_EXTERNAL_PROG_USES} = 1000
+# {ProcessorConfigKeys.EXTERNAL_PROG_POOL_SIZE} = 4
+# {ProcessorConfigKeys.MAX_DOCS_IN_FLIGHT_PER_PROG} = 2
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # Define the output tables used by this GATE processor
@@ -460,6 +467,8 @@ def demo_nlp_config() -> str:
 {ProcessorConfigKeys.INPUT_TERMINATOR} = {nlp_input_terminator}
 {ProcessorConfigKeys.OUTPUT_TERMINATOR} = {nlp_output_terminator}
 # {ProcessorConfigKeys.MAX_EXTERNAL_PROG_USES} = 1000
+# {ProcessorConfigKeys.EXTERNAL_PROG_POOL_SIZE} = 4
+# {ProcessorConfigKeys.MAX_DOCS_IN_FLIGHT_PER_PROG} = 2
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # Define the output tables used by this GATE processor
@@ -528,6 +537,8 @@ def demo_nlp_config() -> str:
 {ProcessorConfigKeys.INPUT_TERMINATOR} = {nlp_input_terminator}
 {ProcessorConfigKeys.OUTPUT_TERMINATOR} = {nlp_output_terminator}
 # {ProcessorConfigKeys.MAX_EXTERNAL_PROG_USES} = 1000
+# {ProcessorConfigKeys.EXTERNAL_PROG_POOL_SIZE} = 4
+# {ProcessorConfigKeys.MAX_DOCS_IN_FLIGHT_PER_PROG} = 2
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # Define the output tables used by this GATE processor
@@ -629,6 +640,8 @@ def demo_nlp_config() -> str:
 {ProcessorConfigKeys.INPUT_TERMINATOR} = {nlp_input_terminator}
 {ProcessorConfigKeys.OUTPUT_TERMINATOR} = {nlp_output_terminator}
 # {ProcessorConfigKeys.MAX_EXTERNAL_PROG_USES} = 1000
+# {ProcessorConfigKeys.EXTERNAL_PROG_POOL_SIZE} = 4
+# {ProcessorConfigKeys.MAX_DOCS_IN_FLIGHT_PER_PROG} = 2
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # Define the output tables used by this GATE processor
@@ -717,6 +730,9 @@ OS_PATHSEP = {os.pathsep}
     {ridfield}
     {tridfield}
 # {InputFieldConfigKeys.DEBUG_ROW_LIMIT} = 0
+# {InputFieldConfigKeys.STREAM_RESULTS} = False
+# {InputFieldConfigKeys.FETCH_SIZE} = 1000
+# {InputFieldConfigKeys.PREFETCH_PROGRESS} = False
 
 [{NlpConfigPrefixes.INPUT}:{if_prog_notes}]
 
@@ -865,6 +881,12 @@ class NlpDefinition(object):
         self._max_bytes_before_commit = self._cfg.opt_int_positive(
             NlpDefConfigKeys.MAX_BYTES_BEFORE_COMMIT,
             DEFAULT_MAX_BYTES_BEFORE_COMMIT)
+        self._max_rows_per_insert_batch = self._cfg.opt_int_positive(
+            NlpDefConfigKeys.MAX_ROWS_PER_INSERT_BATCH,
+            DEFAULT_MAX_ROWS_PER_INSERT_BATCH)
+        self.max_records_per_delete_batch = max(1, self._cfg.opt_int_positive(
+            NlpDefConfigKeys.MAX_RECORDS_PER_DELETE_BATCH,
+            default=1))
         self._now = get_now_utc_notz_datetime()
         self.truncate_text_at = self._cfg.opt_int_positive(
             NlpDefConfigKeys.TRUNCATE_TEXT_AT,
@@ -872,6 +894,9 @@ class NlpDefinition(object):
         self.record_truncated_values = self._cfg.opt_bool(
             NlpDefConfigKeys.RECORD_TRUNCATED_VALUES,
             default=False)
+        self.regex_prefilter = self._cfg.opt_bool(
+            NlpDefConfigKeys.REGEX_PREFILTER,
+            default=True)
         self._cloud_config_name = self._cfg.opt_str(
             NlpDefConfigKeys.CLOUD_CONFIG)
         self._cloud_request_data_dir = self._cfg.opt_str(
@@ -914,6 +939,8 @@ class NlpDefinition(object):
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         self._transaction_limiters = {}  # type: Dict[Session, TransactionSizeLimiter]  # noqa
         # dictionary of session -> TransactionSizeLimiter
+        self._batched_inserters = {}  # type: Dict[Session, BatchedInserter]
+        # dictionary of session -> BatchedInserter, for NLP output rows
 
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         # Cloud config (loaded on request, then cached)
@@ -1120,9 +1147,46 @@ class NlpDefinition(object):
             self._transaction_limiters[session] = TransactionSizeLimiter(
                 session,
                 max_rows_before_commit=self._max_rows_before_commit,
-                max_bytes_before_commit=self._max_bytes_before_commit)
+                max_bytes_before_commit=self._max_bytes_before_commit,
+                before_commit=functools.partial(self.flush_inserts, session))
         return self._transaction_limiters[session]
 
+    def get_batched_inserter(self, session: Session) -> BatchedInserter:
+        """
+        Returns (or creates and returns) a batched inserter for NLP output
+        rows, for a given SQLAlchemy session. Its batches count towards the
+        session's transaction limiter (see :meth:`get_transation_limiter`),
+        and are always written before that session is committed.
+
+        Args:
+            session: SQLAlchemy ORM :class:`Session`
+
+        Returns:
+            a :class:`crate_anon.common.sql.BatchedInserter`
+        """
+        if session not in self._batched_inserters:
+            # We can get an error on insert if for example the output returned
+            # by the NLP is invalid for the column type; we log and skip such
+            # rows.
+            self._batched_inserters[session] = BatchedInserter(
+                session,
+                max_rows_per_batch=self._max_rows_per_insert_batch,
+                transaction_limiter=self.get_transation_limiter(session),
+                skip_failed_rows=True)
+        return self._batched_inserters[session]
+
+    def flush_inserts(self, session: Session) -> None:
+        """
+        Writes any NLP output rows buffered for a specific session (without
+        committing).
+
+        Args:
+            session: SQLAlchemy ORM :class:`Session`
+        """
+        inserter = self._batched_inserters.get(session)
+        if inserter:
+            inserter.flush()
+
     def notify_transaction(self, session: Session,
                            n_rows: int, n_bytes: int,
                            force_commit: bool = False) -> None:
@@ -78,6 +78,7 @@ from cardinal_pythonlib.argparse_func import (
 from cardinal_pythonlib.datetimefunc import get_now_utc_pendulum
 from cardinal_pythonlib.fileops import purge
 from cardinal_pythonlib.logs import configure_logger_for_colour
+from cardinal_pythonlib.sizeformatter import sizeof_fmt
 from cardinal_pythonlib.sqlalchemy.core_query import count_star
 from cardinal_pythonlib.timing import MultiTimerContext, timer
 from sqlalchemy.engine.base import Engine
@@ -94,15 +95,13 @@ from crate_anon.anonymise.constants import (
 from crate_anon.anonymise.dbholder import DatabaseHolder
 from crate_anon.common.exceptions import call_main_with_exception_reporting
 from crate_anon.common.formatting import print_record_counts
+from crate_anon.common.memsize import get_peak_memory_bytes
 from crate_anon.nlp_manager.all_processors import (
     make_nlp_parser_unconfigured,
     possible_processor_names,
     possible_processor_table,
 )
-from crate_anon.nlp_manager.base_nlp_parser import (
-    BaseNlpParser,
-    TextProcessingFailed,
-)
+from crate_anon.nlp_manager.base_nlp_parser import BaseNlpParser
 from crate_anon.nlp_manager.cloud_request_sender import CloudRequestSender
 from crate_anon.nlp_manager.constants import (
     DEFAULT_REPORT_EVERY_NLP,
@@ -124,6 +123,7 @@ from crate_anon.nlp_manager.nlp_definition import (
     NlpDefinition,
     demo_nlp_config,
 )
+from crate_anon.nlp_manager.regex_parser import RegexPrefilter
 from crate_anon.nlp_manager.cloud_parser import Cloud
 from crate_anon.nlp_manager.cloud_request import (
     CloudRequest,
@@ -486,65 +486,55 @@ def process_nlp(nlpdef: NlpDefinition,
         )
         log.critical(errmsg)
         raise ValueError(errmsg)
+    # Skip (regex) processors that can't find anything in a given text:
+    prefilter = (
+        RegexPrefilter(nlpdef.noncloud_processors)
+        if nlpdef.regex_prefilter else None
+    )
 
-    for ifconfig in nlpdef.inputfieldconfigs:
-        i = 0  # record count within this process
-        recnum = tasknum  # record count overall
-        totalcount = ifconfig.get_count()  # total number of records in table
-        for text, other_values in ifconfig.gen_text(tasknum=tasknum,
-                                                    ntasks=ntasks):
-            log.debug(len(text))
-            i += 1
+    def process_block(ifconfig: InputFieldConfig,
+                      block: List[Tuple[str, Dict[str, Any], str,
+                                        Optional[NlpRecord]]]) -> None:
+        """
+        Processes a block of source records, each as a tuple ``text,
+        other_values, srchash, progrec``. Blocks are of at least
+        ``max_records_per_delete_batch`` records, or more if a processor can
+        have more records in flight at once.
+        """
+        if incremental and block:
+            # Wipe older NLP output for these records (which may exist even
+            # for "new" records, if a processor failed last time), with one
+            # DELETE per destination table for the whole block, then COMMIT;
+            # see max_records_per_delete_batch.
+            srcpks = [(other_values[FN_SRCPKVAL], other_values[FN_SRCPKSTR])
+                      for _, other_values, _, _ in block]
+            dest_sessions = []  # type: List[Session]
+            for processor in nlpdef.noncloud_processors:
+                processor.delete_dest_records(ifconfig, srcpks)
+                if processor.dest_session not in dest_sessions:
+                    dest_sessions.append(processor.dest_session)
+            # If you don't COMMIT, you get deadlocks in incremental mode. See
+            # e.g. http://dev.mysql.com/doc/refman/5.5/en/innodb-deadlocks.html
+            for dest_session in dest_sessions:
+                nlpdef.commit(dest_session)
+
+        # Each processor works through the whole block (so that some can have
+        # several records in flight at once; see max_records_in_flight).
+        failed = set()  # type: Set[int]
+        for processor in nlpdef.noncloud_processors:
+            indexes = [
+                n for n, (text, _, _, _) in enumerate(block)
+                if not prefilter or prefilter.may_match(processor, text)
+            ]
+            successes = processor.process_records(
+                [(block[n][0], block[n][1]) for n in indexes])
+            failed.update(n for n, success in zip(indexes, successes)
+                          if not success)
+
+        for n, (text, other_values, srchash, progrec) in enumerate(block):
             pkval = other_values[FN_SRCPKVAL]
             pkstr = other_values[FN_SRCPKSTR]
-            if report_every and i % report_every == 0:
-                log.info(
-                    "Processing {db}.{t}.{c}, PK: {pkf}={pkv} "
-                    "({overall}record {approx}{recnum}/{totalcount})"
-                    "{thisproc}".format(
-                        db=other_values[FN_SRCDB],
-                        t=other_values[FN_SRCTABLE],
-                        c=other_values[FN_SRCFIELD],
-                        pkf=other_values[FN_SRCPKFIELD],
-                        pkv=pkstr if pkstr else pkval,
-                        overall="overall " if ntasks > 1 else "",
-                        approx="~" if pkstr and ntasks > 1 else "",
-                        # ... string hashing means approx. distribution
-                        recnum=recnum + 1,
-                        totalcount=totalcount,
-                        thisproc=(
-                            " ({i}/~{proccount} this process)".format(
-                                i=i,
-                                proccount=totalcount // ntasks)
-                            if ntasks > 1 else ""
-                        )
-                    )
-                )
-            recnum += ntasks
-            # log.critical("other_values={}".format(repr(other_values)))
-            srchash = nlpdef.hash(text)
-
-            progrec = None
-            if incremental:
-                progrec = ifconfig.get_progress_record(pkval, pkstr)
-                if progrec is not None:
-                    if progrec.srchash == srchash:
-                        log.debug("Record previously processed; skipping")
-                        continue
-                    else:
-                        log.debug("Record has changed")
-                else:
-                    log.debug("Record is new")
-
-            processor_failure = False
-            for processor in nlpdef.noncloud_processors:
-                if incremental:
-                    processor.delete_dest_record(ifconfig, pkval, pkstr,
-                                                 commit=incremental)
-                try:
-                    processor.process(text, other_values)
-                except TextProcessingFailed:
-                    processor_failure = True
+            processor_failure = n in failed
 
             # If at least one processor failed, don't tell the progress
             # database that this record has been handled. That means that if
@@ -565,6 +555,11 @@ def process_nlp(nlpdef: NlpDefinition,
             # source record.
             truncated = other_values[TRUNCATED_FLAG]
             if not truncated or nlpdef.record_truncated_values:
+                if ifconfig.prefetch_progress:
+                    # Written in batches. On committing, see below.
+                    ifconfig.save_progress_record(pkval, pkstr, srchash,
+                                                  force_commit=ntasks > 1)
+                    continue
                 if progrec:  # modifying an existing record
                     progrec.whenprocessedutc = nlpdef.now
                     progrec.srchash = srchash
@@ -614,6 +609,86 @@ def process_nlp(nlpdef: NlpDefinition,
                     n_bytes=sys.getsizeof(progrec),  # approx
                     force_commit=force_commit)
 
+    # Records are processed in blocks; see process_block().
+    block_size = max(
+        [nlpdef.max_records_per_delete_batch] +
+        [p.max_records_in_flight for p in nlpdef.noncloud_processors]
+    )
+
+    for ifconfig in nlpdef.inputfieldconfigs:
+        block = []  # type: List[Tuple[str, Dict[str, Any], str, Optional[NlpRecord]]]  # noqa
+        i = 0  # record count within this process
+        recnum = tasknum  # record count overall
+        totalcount = ifconfig.get_count()  # total number of records in table
+        prefetch = ifconfig.prefetch_progress
+        if prefetch and incremental:
+            # In full mode, we don't look at old progress records.
+            ifconfig.prefetch_progress_records()
+        for text, other_values in ifconfig.gen_text(tasknum=tasknum,
+                                                    ntasks=ntasks):
+            log.debug(len(text))
+            i += 1
+            pkval = other_values[FN_SRCPKVAL]
+            pkstr = other_values[FN_SRCPKSTR]
+            if report_every and i % report_every == 0:
+                log.info(
+                    "Processing {db}.{t}.{c}, PK: {pkf}={pkv} "
+                    "({overall}record {approx}{recnum}/{totalcount})"
+                    "{thisproc}".format(
+                        db=other_values[FN_SRCDB],
+                        t=other_values[FN_SRCTABLE],
+                        c=other_values[FN_SRCFIELD],
+                        pkf=other_values[FN_SRCPKFIELD],
+                        pkv=pkstr if pkstr else pkval,
+                        overall="overall " if ntasks > 1 else "",
+                        approx="~" if pkstr and ntasks > 1 else "",
+                        # ... string hashing means approx. distribution
+                        recnum=recnum + 1,
+                        totalcount=totalcount,
+                        thisproc=(
+                            " ({i}/~{proccount} this process)".format(
+                                i=i,
+                                proccount=totalcount // ntasks)
+                            if ntasks > 1 else ""
+                        )
+                    )
+                )
+            recnum += ntasks
+            # log.critical("other_values={}".format(repr(other_values)))
+            srchash = nlpdef.hash(text)
+
+            progrec = None
+            if incremental:
+                if prefetch:
+                    old_srchash = ifconfig.get_prefetched_srchash(pkval, pkstr)
+                else:
+                    progrec = ifconfig.get_progress_record(pkval, pkstr)
+                    old_srchash = progrec.srchash if progrec else None
+                if old_srchash is not None:
+                    if old_srchash == srchash:
+                        log.debug("Record previously processed; skipping")
+                        continue
+                    else:
+                        log.debug("Record has changed")
+                else:
+                    log.debug("Record is new")
+
+            block.append((text, other_values, srchash, progrec))
+            if len(block) >= block_size:
+                process_block(ifconfig, block)
+                block = []
+
+        process_block(ifconfig, block)
+        if prefetch:
+            ifconfig.flush_progress_records(force_commit=ntasks > 1)
+        peak_memory = get_peak_memory_bytes()
+        if peak_memory is not None:
+            log.info(f"Finished {ifconfig.srcdb}.{ifconfig.srctable}."
+                     f"{ifconfig.srcfield}: peak memory use "
+                     f"{sizeof_fmt(peak_memory)}")
+
+    if prefilter:
+        log.info(f"Regex prefilter: {prefilter}")
     nlpdef.commit_all()
 
 
@@ -819,6 +894,11 @@ def process_cloud_now(
                         crinfo.delete_dest_records(ifconfig, pkval, pkstr,
                                                    commit=True)
                         # Record progress in progress database
+                        if ifconfig.prefetch_progress:
+                            # Prefetched by the CloudRequestSender
+                            ifconfig.save_progress_record(pkval, pkstr,
+                                                          srchash)
+                            continue
                         progrec = ifconfig.get_progress_record(pkval, pkstr)
                     # Check that we haven't already done the progrec for this
                     # record to avoid clashes - it's possible as each processor
@@ -851,6 +931,7 @@ def process_cloud_now(
             with MultiTimerContext(timer, TIMING_PROGRESS_DB_ADD):
                 log.info("Adding to database...")
                 session.bulk_save_objects(progrecs)
+                ifconfig.flush_progress_records()
             session.commit()
 
     nlpdef.commit_all()
@@ -31,12 +31,17 @@ UTF-8, here and in the Java code.
 
 """
 
+from collections import deque
 import logging
 import os
+import queue
 import shlex
 import subprocess
 import sys
-from typing import Any, Dict, Generator, List, TextIO, Tuple
+import threading
+from typing import (
+    Any, Deque, Dict, Generator, Iterable, List, Optional, TextIO, Tuple,
+)
 
 from cardinal_pythonlib.cmdline import cmdline_quote
 from cardinal_pythonlib.dicts import (
@@ -47,11 +52,13 @@ from cardinal_pythonlib.lists import chunks
 from cardinal_pythonlib.tsv import tsv_pairs_to_dict
 from sqlalchemy import Column, Index
 
+from crate_anon.common.stringfunc import does_text_contain_word_chars
 from crate_anon.nlp_manager.base_nlp_parser import (
     BaseNlpParser,
     TextProcessingFailed,
 )
 from crate_anon.nlp_manager.constants import (
+    DEFAULT_MAX_DOCS_IN_FLIGHT_PER_PROG,
     MAX_SQL_FIELD_LEN,
     ProcessorConfigKeys,
     GateFieldNames as GateFN,
@@ -64,6 +71,322 @@ from crate_anon.nlp_manager.output_user_config import OutputUserConfig
 
 log = logging.getLogger(__name__)
 
+MAX_ATTEMPTS_PER_DOC = 3
+
+
+# =============================================================================
+# Pool of external processes
+# =============================================================================
+
+class ExternalProgWorker(object):
+    """
+    One external process within an :class:`ExternalProgPool`, plus a thread
+    that reads its stdout and reports each complete output (all lines up to an
+    output terminator) to the pool.
+    """
+    def __init__(self,
+                 name: str,
+                 args: List[str],
+                 output_terminator: str,
+                 encoding: str,
+                 events: queue.Queue) -> None:
+        """
+        Args:
+            name:
+                name for log messages
+            args:
+                command-line arguments to launch the external program
+            output_terminator:
+                line that the program sends after its output for each document
+            encoding:
+                encoding for the pipes to/from the program
+            events:
+                queue to which we report ``worker, generation, lines``
+                tuples: ``lines`` is a list of output lines for a document,
+                or ``None`` if the program's stdout has closed (i.e. it has
+                finished or died); ``generation`` identifies the launch of the
+                program that this relates to
+        """
+        self.name = name
+        self._args = args
+        self._output_terminator = output_terminator
+        self._encoding = encoding
+        self._events = events
+        self._p = None  # type: Optional[subprocess.Popen]
+        self.generation = 0
+        self.n_uses = 0
+        self.in_flight = deque()  # type: Deque[int]
+        # ... document numbers sent but not yet finished, in the order sent
+
+    @property
+    def started(self) -> bool:
+        """
+        Has the external program been launched?
+        """
+        return self._p is not None
+
+    def start(self) -> None:
+        """
+        Launch the external program, and a thread to read its output.
+        """
+        self.generation += 1
+        self.n_uses = 0
+        log.info(f"Launching command ({self.name}): "
+                 f"{cmdline_quote(self._args)}")
+        self._p = subprocess.Popen(self._args,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   shell=False)
+        # ... as for Gate._start(), we don't ask for stderr.
+        thread = threading.Thread(target=self._read_stdout,
+                                  args=(self._p.stdout, self.generation),
+                                  daemon=True)
+        thread.start()
+
+    def _read_stdout(self, stdout: Any, generation: int) -> None:
+        """
+        Thread function to read the program's stdout until it closes.
+        """
+        terminator = self._output_terminator + os.linesep
+        lines = []  # type: List[str]
+        for bytes_ in iter(stdout.readline, b""):
+            line = bytes_.decode(self._encoding)
+            if line == terminator:
+                self._events.put((self, generation, lines))
+                lines = []
+            else:
+                lines.append(line)
+        self._events.put((self, generation, None))
+
+    def send(self, text: str, input_terminator: str) -> None:
+        """
+        Sends a document to the program (via its stdin).
+
+        Raises:
+            :exc:`OSError` (e.g. :exc:`BrokenPipeError`) if the program has
+            died
+        """
+        log.debug(f"SENDING ({self.name}): {text}")
+        self._p.stdin.write((text + os.linesep +
+                             input_terminator + os.linesep)
+                            .encode(self._encoding))
+        self._p.stdin.flush()
+
+    def finish(self) -> None:
+        """
+        Close down the external program (by closing its stdin, or killing it
+        if that fails), and wait for it to exit.
+        """
+        if not self._p:
+            return
+        try:
+            self._p.stdin.close()
+        except OSError:
+            self._p.kill()
+        self._p.wait()
+        self._p = None
+        self.in_flight.clear()
+
+    def restart(self) -> None:
+        """
+        Close down the external program and restart it.
+        """
+        self.finish()
+        self.start()
+
+
+class ExternalProgPool(object):
+    """
+    Runs several copies of an external program, such as our Java interface to
+    GATE, which each take documents via stdin (each followed by an input
+    terminator line) and return results via stdout (each followed by an output
+    terminator line).
+
+    - Several documents are kept in flight per program, so the programs can
+      work while Python handles their results.
+    - If a program dies, it is relaunched, and the documents that it hadn't
+      finished are sent again (up to a limit per document).
+    """
+    def __init__(self,
+                 args: List[str],
+                 n_progs: int,
+                 max_docs_in_flight_per_prog: int,
+                 input_terminator: str,
+                 output_terminator: str,
+                 encoding: str = "utf8",
+                 max_uses: int = 0,
+                 max_attempts_per_doc: int = MAX_ATTEMPTS_PER_DOC) -> None:
+        """
+        Args:
+            args:
+                command-line arguments to launch the external program
+            n_progs:
+                number of copies of the program to run
+            max_docs_in_flight_per_prog:
+                maximum number of documents sent to each program whose output
+                we've not yet had
+            input_terminator:
+                line to send after each document
+            output_terminator:
+                line that the program sends after its output for each document
+            encoding:
+                encoding for the pipes to/from the program
+            max_uses:
+                relaunch each program after this many documents (e.g. if it
+                leaks memory); 0 for no limit
+            max_attempts_per_doc:
+                give up on a document if the program dies this many times
+                while working on it
+        """
+        self._input_terminator = input_terminator
+        self._max_docs_in_flight = max(1, max_docs_in_flight_per_prog)
+        self._max_uses = max_uses
+        self._max_attempts = max(1, max_attempts_per_doc)
+        self._events = queue.Queue()  # type: queue.Queue
+        self._workers = [
+            ExternalProgWorker(
+                name=f"process {i + 1}/{n_progs}",
+                args=args,
+                output_terminator=output_terminator,
+                encoding=encoding,
+                events=self._events
+            )
+            for i in range(max(1, n_progs))
+        ]
+
+    @property
+    def capacity(self) -> int:
+        """
+        The maximum number of documents in flight, across all programs.
+        """
+        return len(self._workers) * self._max_docs_in_flight
+
+    def gen_output(self, texts: List[str]) \
+            -> Generator[Optional[List[str]], None, None]:
+        """
+        Sends documents to the programs, and yields their output, in the same
+        order.
+
+        Args:
+            texts: the documents
+
+        Yields:
+            for each document, a list of output lines (with line endings), or
+            ``None`` if we gave up on the document
+        """
+        n = len(texts)
+        pending = deque(range(n))  # type: Deque[int]
+        attempts = [0] * n
+        done = {}  # type: Dict[int, Optional[List[str]]]
+        next_to_yield = 0
+        try:
+            while next_to_yield < n:
+                self._send_pending(texts, pending, attempts, done)
+                while next_to_yield in done:
+                    yield done.pop(next_to_yield)
+                    next_to_yield += 1
+                if next_to_yield < n:
+                    self._handle_event(pending, attempts, done)
+        finally:
+            # If our caller stopped early, don't confuse our next caller with
+            # output for documents that they didn't send.
+            for worker in self._workers:
+                if worker.in_flight:
+                    log.warning(f"Abandoning {len(worker.in_flight)} "
+                                f"documents; relaunching {worker.name}")
+                    worker.restart()
+
+    def _choose_worker(self) -> Optional[ExternalProgWorker]:
+        """
+        Returns the least busy program that can take another document, if
+        there is one, launching or relaunching it if required.
+        """
+        candidates = []  # type: List[ExternalProgWorker]
+        for worker in self._workers:
+            in_flight = len(worker.in_flight)
+            if not worker.started:
+                worker.start()
+            elif (0 < self._max_uses <= worker.n_uses + in_flight and
+                    not in_flight):
+                log.info(f"Relaunching {worker.name} after {worker.n_uses} "
+                         f"uses")
+                worker.restart()
+            if (in_flight < self._max_docs_in_flight and
+                    not 0 < self._max_uses <= worker.n_uses + in_flight):
+                candidates.append(worker)
+        if not candidates:
+            return None
+        return min(candidates, key=lambda w: len(w.in_flight))
+
+    def _send_pending(self,
+                      texts: List[str],
+                      pending: Deque[int],
+                      attempts: List[int],
+                      done: Dict[int, Optional[List[str]]]) -> None:
+        """
+        Sends pending documents to programs that have room for them.
+        """
+        while pending:
+            worker = self._choose_worker()
+            if worker is None:
+                return
+            docnum = pending.popleft()
+            attempts[docnum] += 1
+            worker.in_flight.append(docnum)
+            try:
+                worker.send(texts[docnum], self._input_terminator)
+            except OSError:
+                # e.g. BrokenPipeError
+                self._recover(worker, pending, attempts, done)
+
+    def _handle_event(self,
+                      pending: Deque[int],
+                      attempts: List[int],
+                      done: Dict[int, Optional[List[str]]]) -> None:
+        """
+        Waits for a program to finish a document (or die), and deals with it.
+        """
+        worker, generation, lines = self._events.get()
+        if generation != worker.generation:
+            return  # from a previous launch of this program; ignore
+        if lines is None:
+            self._recover(worker, pending, attempts, done)
+            return
+        docnum = worker.in_flight.popleft()
+        done[docnum] = lines
+        worker.n_uses += 1
+
+    def _recover(self,
+                 worker: ExternalProgWorker,
+                 pending: Deque[int],
+                 attempts: List[int],
+                 done: Dict[int, Optional[List[str]]]) -> None:
+        """
+        Relaunches a program that has died, and puts the documents it was
+        working on back in the queue (or gives up on them).
+        """
+        log.error(f"External program ({worker.name}) died; relaunching it")
+        lost = list(worker.in_flight)
+        worker.restart()
+        # The program works through documents in order, so it was working on
+        # the first; the others don't count as having been attempted.
+        for docnum in lost[1:]:
+            attempts[docnum] -= 1
+        for docnum in reversed(lost):
+            if attempts[docnum] >= self._max_attempts:
+                log.error(f"Giving up on document after {attempts[docnum]} "
+                          f"attempts")
+                done[docnum] = None
+            else:
+                pending.appendleft(docnum)
+
+    def finish(self) -> None:
+        """
+        Close down all the external programs.
+        """
+        for worker in self._workers:
+            worker.finish()
+
 
 # =============================================================================
 # Process handling
@@ -137,6 +460,8 @@ class Gate(BaseNlpParser):
             # Debugging only
             self._debug_mode = True
             self._max_external_prog_uses = 0
+            self._pool_size = 0
+            self._max_docs_in_flight = DEFAULT_MAX_DOCS_IN_FLIGHT_PER_PROG
             self._input_terminator = 'input_terminator'
             self._output_terminator = 'output_terminator'
             typepairs = []  # type: List[str]
@@ -148,6 +473,12 @@ class Gate(BaseNlpParser):
             self._max_external_prog_uses = self._cfgsection.opt_int_positive(
                 ProcessorConfigKeys.MAX_EXTERNAL_PROG_USES,
                 default=0)
+            self._pool_size = self._cfgsection.opt_int_positive(
+                ProcessorConfigKeys.EXTERNAL_PROG_POOL_SIZE,
+                default=0)
+            self._max_docs_in_flight = self._cfgsection.opt_int_positive(
+                ProcessorConfigKeys.MAX_DOCS_IN_FLIGHT_PER_PROG,
+                default=DEFAULT_MAX_DOCS_IN_FLIGHT_PER_PROG)
             self._input_terminator = self._cfgsection.opt_str(
                 ProcessorConfigKeys.INPUT_TERMINATOR,
                 required=True)
@@ -190,6 +521,17 @@ class Gate(BaseNlpParser):
         self._pipe_encoding = 'utf8'
         self._p = None  # the subprocess
         self._started = False
+        # Optionally, a pool of subprocesses instead:
+        self._pool = None  # type: Optional[ExternalProgPool]
+        if self._pool_size > 0:
+            self._pool = ExternalProgPool(
+                args=self._progargs,
+                n_progs=self._pool_size,
+                max_docs_in_flight_per_prog=self._max_docs_in_flight,
+                input_terminator=self._input_terminator,
+                output_terminator=self._output_terminator,
+                encoding=self._pipe_encoding,
+                max_uses=self._max_external_prog_uses)
 
         # Sanity checks
         for ty, tn in self._type_to_tablename.items():
@@ -285,6 +627,13 @@ class Gate(BaseNlpParser):
           eventually by the output_terminator, at which point this set is
           complete.
         """
+        if self._pool:
+            lines = list(self._pool.gen_output([text]))[0]
+            if lines is None:
+                raise TextProcessingFailed()
+            yield from self._gen_results_from_lines(lines)
+            return
+
         self._start()  # ensure started
 
         try:
@@ -296,28 +645,10 @@ class Gate(BaseNlpParser):
             self._flush_subproc_stdin()  # required in the Python 3 system
 
             # Receive
-            for line in iter(self._decode_from_subproc_stdout,
-                             self._output_terminator + os.linesep):
-                # ... iterate until the sentinel output_terminator is received
-                line = line.rstrip("\n")
-                # ... remove trailing newline, but NOT TABS
-                # ... if you strip tabs, you get superfluous
-                #     "Bad chunk, not of length 2" messages.
-                log.debug("stdout received: " + line)
-                d = tsv_pairs_to_dict(line)
-                log.debug(f"dictionary received: {d}")
-                try:
-                    annottype = d[GateFN.TYPE].lower()
-                except KeyError:
-                    raise ValueError("_type information not in data received")
-                if annottype not in self._type_to_tablename:
-                    log.warning(
-                        f"Unknown annotation type, skipping: {annottype}")
-                    continue
-                c = self._outputtypemap[annottype]
-                rename_keys_in_dict(d, c.renames)
-                set_null_values_in_dict(d, c.null_literals)
-                yield self._type_to_tablename[annottype], d
+            lines = iter(self._decode_from_subproc_stdout,
+                         self._output_terminator + os.linesep)
+            # ... iterate until the sentinel output_terminator is received
+            yield from self._gen_results_from_lines(lines)
 
             self._n_uses += 1
             # Restart subprocess?
@@ -330,6 +661,67 @@ class Gate(BaseNlpParser):
             self._restart()
             raise TextProcessingFailed()
 
+    def _gen_results_from_lines(
+            self,
+            lines: Iterable[str]) -> Generator[Tuple[str, Dict[str, Any]],
+                                               None, None]:
+        """
+        Converts the output from the external process, for one piece of text,
+        to results in the format returned by :meth:`parse`.
+
+        Args:
+            lines: lines of output, with their line endings
+        """
+        for line in lines:
+            line = line.rstrip("\n")
+            # ... remove trailing newline, but NOT TABS
+            # ... if you strip tabs, you get superfluous
+            #     "Bad chunk, not of length 2" messages.
+            log.debug("stdout received: " + line)
+            d = tsv_pairs_to_dict(line)
+            log.debug(f"dictionary received: {d}")
+            try:
+                annottype = d[GateFN.TYPE].lower()
+            except KeyError:
+                raise ValueError("_type information not in data received")
+            if annottype not in self._type_to_tablename:
+                log.warning(
+                    f"Unknown annotation type, skipping: {annottype}")
+                continue
+            c = self._outputtypemap[annottype]
+            rename_keys_in_dict(d, c.renames)
+            set_null_values_in_dict(d, c.null_literals)
+            yield self._type_to_tablename[annottype], d
+
+    @property
+    def max_records_in_flight(self) -> int:
+        # docstring in superclass
+        if self._pool:
+            return self._pool.capacity
+        return 1
+
+    def process_records(
+            self,
+            records: List[Tuple[str, Dict[str, Any]]]) -> List[bool]:
+        """
+        Processes several pieces of text, as for :meth:`process`. With a pool
+        of external processes, several are in flight at once, and we insert
+        the results for each (in order) while the processes work on the rest.
+        """
+        if not self._pool:
+            return super().process_records(records)
+        successes = [True] * len(records)
+        indexes = [n for n, (text, _) in enumerate(records)
+                   if does_text_contain_word_chars(text)]
+        outputs = self._pool.gen_output([records[n][0] for n in indexes])
+        for n, lines in zip(indexes, outputs):
+            if lines is None:
+                successes[n] = False
+                continue
+            self._insert_results(self._gen_results_from_lines(lines),
+                                 records[n][1])
+        return successes
+
     # -------------------------------------------------------------------------
     # Test
     # -------------------------------------------------------------------------
@@ -32,12 +32,20 @@ but bear in mind.
 
 """
 
-from typing import Any, Dict, Optional, Pattern, Tuple
+import re
+from typing import Any, Dict, FrozenSet, Iterable, Optional, Pattern, Set, Tuple
 
 import regex
 # noinspection PyProtectedMember
 from regex import _regex_core
 
+try:  # Python 3.11+
+    # noinspection PyProtectedMember
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
+
 # =============================================================================
 # Core regex functions
 # =============================================================================
@@ -101,3 +109,276 @@ def get_regex_dict_match(text: Optional[str],
             if r.match(text):
                 return True, value
     return False, default
+
+
+# =============================================================================
+# Literals that a regex requires, for prefiltering text
+# =============================================================================
+# - Many regexes can only match text containing one of a few literal strings:
+#   e.g. a CRP regex needs "crp" or "c-reactive protein" or similar. Checking
+#   for those literals first is much faster than running the regex.
+# - We work the literals out from the regex's parse tree. The regex module
+#   doesn't expose its parser, so we use that of Python's re module, which
+#   understands the syntax we use. For anything we don't understand, we give
+#   up, so the regex is always run.
+# - Case-insensitive matching: we compare "folded" text (see
+#   fold_for_prefilter) with folded literals. We only use ASCII literals. Under
+#   regex.IGNORECASE, a few non-ASCII characters match ASCII letters, so we
+#   fold those to the ASCII letter (lower() would not).
+# - Word boundaries (\b) are recorded in literals as a marker character, so
+#   that short literals can be checked as whole words (e.g. "k" for potassium
+#   only counts if the text contains the word "k", not just the letter).
+
+_PREFILTER_FOLD_TABLE = {
+    0x130: "i",  # LATIN CAPITAL LETTER I WITH DOT ABOVE
+    0x131: "i",  # LATIN SMALL LETTER DOTLESS I
+    0x17f: "s",  # LATIN SMALL LETTER LONG S
+    0x212a: "k",  # KELVIN SIGN
+}
+_WORD_BOUNDARY = "\ue000"  # marker; not ASCII, so not in any literal
+_MAX_EXACT_LITERALS = 64  # max alternatives we track for an exact match
+_MAX_CLASS_SIZE = 10  # max characters in a [...] class that we expand
+_ZERO_WIDTH_OPS = (sre_constants.AT, sre_constants.ASSERT,
+                   sre_constants.ASSERT_NOT)
+_ASCII_WORD_REGEX = re.compile(r"[a-z0-9_]+")
+_REPEAT_OPS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT,
+               getattr(sre_constants, "POSSESSIVE_REPEAT", None))
+_ATOMIC_GROUP = getattr(sre_constants, "ATOMIC_GROUP", None)  # Python 3.11+
+_NAMED_GROUP_REGEX = re.compile(r"(?<!\\)\(\?P<\w+>")
+
+
+class _LiteralInfo(object):
+    """
+    What we know about the text that a regex (or part of one) matches, in
+    terms of (folded) literal strings. Each attribute is a set of strings, or
+    ``None`` if we can't tell:
+
+    - ``exact``: the text consumed is exactly one of these;
+    - ``prefix``: the text consumed starts with one of these;
+    - ``suffix``: the text consumed ends with one of these;
+    - ``required``: the text consumed contains one of these.
+    """
+    def __init__(self,
+                 exact: Set[str] = None,
+                 prefix: Set[str] = None,
+                 suffix: Set[str] = None,
+                 required: Set[str] = None) -> None:
+        self.exact = exact
+        self.prefix = exact if exact is not None else prefix
+        self.suffix = exact if exact is not None else suffix
+        self.required = _best_requirement(
+            required,
+            _as_requirement(exact),
+            _as_requirement(self.prefix),
+            _as_requirement(self.suffix),
+        )
+
+
+def fold_for_prefilter(text: str) -> str:
+    """
+    Folds the case of text, so that any text matching a regex
+    case-insensitively contains (after folding) the regex's folded literals
+    (see :func:`get_required_literals`).
+    """
+    return text.translate(_PREFILTER_FOLD_TABLE).lower()
+
+
+def _product(a: Optional[Set[str]],
+             b: Optional[Set[str]]) -> Optional[Set[str]]:
+    """
+    All concatenations of a string from ``a`` and one from ``b``, or ``None``
+    if either is ``None`` or there would be too many.
+    """
+    if a is None or b is None or len(a) * len(b) > _MAX_EXACT_LITERALS:
+        return None
+    double_boundary = _WORD_BOUNDARY * 2  # \b\b is the same as \b
+    return {(x + y).replace(double_boundary, _WORD_BOUNDARY)
+            for x in a for y in b}
+
+
+def _union(sets: Iterable[Optional[Set[str]]]) -> Optional[Set[str]]:
+    """
+    The union of some sets, or ``None`` if any is ``None``.
+    """
+    result = set()  # type: Set[str]
+    for x in sets:
+        if x is None:
+            return None
+        result |= x
+    return result
+
+
+def _best_requirement(*requirements: Optional[Set[str]]) \
+        -> Optional[Set[str]]:
+    """
+    Of several sets of literals, one of which (that is, one literal from the
+    set) must be present, returns the most selective: the one whose shortest
+    literal is longest, then the smallest. ``None`` means "no requirement".
+    """
+    best = None  # type: Optional[Set[str]]
+    best_key = None  # type: Optional[Tuple[int, int]]
+    for r in requirements:
+        if r is None:
+            continue
+        key = (min(len(x) for x in r), -len(r))  # \b counts as a character
+        if best_key is None or key > best_key:
+            best, best_key = r, key
+    return best
+
+
+def _as_requirement(literals: Optional[Set[str]]) -> Optional[Set[str]]:
+    """
+    Converts an "exact", "prefix" or "suffix" set to a requirement (``None``
+    if it contains an empty string, since then nothing is required).
+    """
+    if not literals or any(not _strip_boundaries(x) for x in literals):
+        return None
+    return literals
+
+
+def _strip_boundaries(literal: str) -> str:
+    """
+    Removes word boundary markers from a literal.
+    """
+    return literal.replace(_WORD_BOUNDARY, "")
+
+
+_UNKNOWN = _LiteralInfo()  # we know nothing
+
+
+def _get_literal_info(subpattern: Iterable[Tuple[Any, Any]]) -> _LiteralInfo:
+    """
+    Analyses a sequence of items in a parsed (sub)pattern from ``sre_parse``.
+    See :class:`_LiteralInfo`.
+    """
+    run = {""}  # type: Optional[Set[str]]  # exact text since the last unknown
+    prefix = None  # type: Optional[Set[str]]
+    broken = False  # have we met something whose exact text is unknown?
+    required = None  # type: Optional[Set[str]]
+    for op, av in subpattern:
+        item = _get_item_literal_info(op, av)
+        if item.exact is not None:
+            joined = _product(run, item.exact)
+            if joined is None:  # too many; keep what we have
+                required = _best_requirement(required, _as_requirement(run))
+                if not broken:
+                    prefix = run
+                    broken = True
+                joined = item.exact
+            run = joined
+            continue
+        # An item whose exact text is unknown. The run so far, then its
+        # prefix, must appear.
+        run_then_prefix = _product(run, item.prefix)
+        required = _best_requirement(
+            required,
+            _as_requirement(run),
+            _as_requirement(run_then_prefix),
+            item.required,
+        )
+        if not broken:
+            prefix = run_then_prefix if run_then_prefix is not None else run
+            broken = True
+        run = item.suffix if item.suffix is not None else {""}
+    if not broken:
+        return _LiteralInfo(exact=run)
+    return _LiteralInfo(prefix=prefix, suffix=run, required=required)
+
+
+def _get_item_literal_info(op: Any, av: Any) -> _LiteralInfo:
+    """
+    As for :func:`_get_literal_info`, for a single item of a parsed pattern.
+    """
+    if op == sre_constants.LITERAL:
+        c = chr(av)
+        if ord(c) < 128:
+            return _LiteralInfo(exact={fold_for_prefilter(c)})
+        return _UNKNOWN  # we don't know how non-ASCII characters fold
+    if op == sre_constants.IN:
+        chars = set()  # type: Set[str]
+        for class_op, class_av in av:
+            if class_op == sre_constants.LITERAL:
+                chars.add(chr(class_av))
+            elif (class_op == sre_constants.RANGE and
+                    class_av[1] - class_av[0] < _MAX_CLASS_SIZE):
+                chars.update(chr(x) for x in range(class_av[0],
+                                                   class_av[1] + 1))
+            else:  # e.g. NEGATE, CATEGORY, big RANGE
+                return _UNKNOWN
+        if len(chars) > _MAX_CLASS_SIZE or any(ord(c) >= 128 for c in chars):
+            return _UNKNOWN
+        return _LiteralInfo(exact={fold_for_prefilter(c) for c in chars})
+    if op == sre_constants.AT and av == sre_constants.AT_BOUNDARY:
+        return _LiteralInfo(exact={_WORD_BOUNDARY})
+    if op in _ZERO_WIDTH_OPS:
+        return _LiteralInfo(exact={""})  # consumes nothing
+    if op == sre_constants.SUBPATTERN:
+        return _get_literal_info(av[-1])
+    if op == _ATOMIC_GROUP:
+        return _get_literal_info(av)
+    if op == sre_constants.BRANCH:
+        alts = [_get_literal_info(alt) for alt in av[1]]
+        exact = _union(alt.exact for alt in alts)
+        if exact is not None and len(exact) > _MAX_EXACT_LITERALS:
+            exact = None
+        return _LiteralInfo(
+            exact=exact,
+            prefix=_union(alt.prefix for alt in alts),
+            suffix=_union(alt.suffix for alt in alts),
+            required=_union(alt.required for alt in alts),
+        )
+    if op in _REPEAT_OPS:
+        min_repeats, max_repeats, subpattern = av
+        item = _get_literal_info(subpattern)
+        if min_repeats == 0:
+            if max_repeats == 1 and item.exact is not None:
+                return _LiteralInfo(exact=item.exact | {""})
+            return _UNKNOWN
+        if min_repeats == max_repeats and item.exact is not None:
+            exact = {""}  # type: Optional[Set[str]]
+            for _ in range(min_repeats):
+                exact = _product(exact, item.exact)
+            if exact is not None:
+                return _LiteralInfo(exact=exact)
+        return _LiteralInfo(prefix=item.prefix, suffix=item.suffix,
+                            required=item.required)
+    return _UNKNOWN  # e.g. ANY, NOT_LITERAL, CATEGORY, GROUPREF
+
+
+def get_required_literals(regex_str: str) \
+        -> Optional[FrozenSet[Tuple[str, bool]]]:
+    """
+    Works out some literal strings, such that any text that the regex
+    (compiled with :func:`compile_regex`) matches must contain at least one of
+    them.
+
+    Args:
+        regex_str: the regex
+
+    Returns:
+        a set of tuples ``literal, whole_word``, where ``literal`` is folded
+        with :func:`fold_for_prefilter`, and ``whole_word`` is true if the
+        literal must appear as a whole word (a run of word characters with
+        word boundaries either side); or ``None`` if we can't work out any
+        such literals (in which case the regex might match anything)
+    """
+    # The re module doesn't allow two groups with the same name, which we
+    # use; group names don't matter here.
+    regex_str = _NAMED_GROUP_REGEX.sub("(?:", regex_str)
+    try:
+        parsed = sre_parse.parse(
+            regex_str, re.IGNORECASE | re.MULTILINE | re.VERBOSE)
+    except (re.error, RecursionError):
+        return None
+    required = _get_literal_info(parsed).required
+    if not required:
+        return None
+    result = set()  # type: Set[Tuple[str, bool]]
+    for literal in required:
+        core = _strip_boundaries(literal)
+        whole_word = (
+            literal == _WORD_BOUNDARY + core + _WORD_BOUNDARY and
+            _ASCII_WORD_REGEX.fullmatch(core) is not None
+        )
+        result.add((core, whole_word))
+    return frozenset(result)
@@ -31,7 +31,10 @@ crate_anon/nlp_manager/regex_parser.py
 from abc import abstractmethod, ABC
 import logging
 import sys
-from typing import Any, Dict, Generator, List, Optional, TextIO, Tuple
+from typing import (
+    Any, Dict, FrozenSet, Generator, Iterable, List, Optional, Set, TextIO,
+    Tuple,
+)
 
 from cardinal_pythonlib.logs import main_only_quicksetup_rootlogger
 from sqlalchemy import Column, Integer, Float, String, Text
@@ -51,7 +54,9 @@ from crate_anon.nlp_manager.number import to_float, to_pos_float
 from crate_anon.nlp_manager.regex_func import (
     compile_regex,
     compile_regex_dict,
+    fold_for_prefilter,
     get_regex_dict_match,
+    get_required_literals,
 )
 from crate_anon.nlp_manager.regex_numbers import (
     BILLION,
@@ -735,6 +740,13 @@ class SimpleNumericalResultParser(NumericalResultParser, ABC):
         self.units_to_factor = compile_regex_dict(units_to_factor)
         self.take_absolute = take_absolute
 
+    def get_prefilter_literals(self) \
+            -> Optional[FrozenSet[Tuple[str, bool]]]:
+        # docstring in superclass
+        if type(self).parse is not SimpleNumericalResultParser.parse:
+            return None  # a subclass does its own thing
+        return get_required_literals(self.regex_str_for_debugging)
+
     def parse(self, text: str,
               debug: bool = False) -> Generator[Tuple[str, Dict[str, Any]],
                                                 None, None]:
@@ -920,6 +932,13 @@ class NumeratorOutOfDenominatorParser(BaseNlpParser, ABC):
             f"NLP class to find X-out-of-Y results. Regular expression: "
             f"\n\n{self.regex_str}", file=file)
 
+    def get_prefilter_literals(self) \
+            -> Optional[FrozenSet[Tuple[str, bool]]]:
+        # docstring in superclass
+        if type(self).parse is not NumeratorOutOfDenominatorParser.parse:
+            return None  # a subclass does its own thing
+        return get_required_literals(self.regex_str)
+
     def dest_tables_columns(self) -> Dict[str, List[Column]]:
         # docstring in superclass
         return {self.tablename: [
@@ -1256,6 +1275,19 @@ class ValidatorBase(BaseNlpParser):
             Column(FN_END, Integer, comment=HELP_END),
         ]}
 
+    def get_prefilter_literals(self) \
+            -> Optional[FrozenSet[Tuple[str, bool]]]:
+        # docstring in superclass
+        if type(self).parse is not ValidatorBase.parse:
+            return None  # a subclass does its own thing
+        literals = set()  # type: Set[Tuple[str, bool]]
+        for regex_str in self.regex_str_list:
+            regex_literals = get_required_literals(regex_str)
+            if regex_literals is None:
+                return None
+            literals |= regex_literals
+        return frozenset(literals)
+
     def parse(self, text: str) -> Generator[Tuple[str, Dict[str, Any]],
                                             None, None]:
         # docstring in superclass
@@ -1309,6 +1341,94 @@ class ValidatorBase(BaseNlpParser):
             f"... no tests implemented for validator {self.classname()}")
 
 
+# =============================================================================
+# Prefilter, to skip parsers that can't match
+# =============================================================================
+
+WORD_REGEX = compile_regex(r"\w+")
+
+
+class RegexPrefilter(object):
+    """
+    Checks text cheaply, before a set of parsers (typically many regex-based
+    ones) are run on it, for the literal strings that each parser's regex
+    needs (see :meth:`BaseNlpParser.get_prefilter_literals`). A parser whose
+    literals are all absent can't produce any results, so needn't be run.
+
+    - The results are identical to running every parser.
+    - Each text is folded (see
+      :func:`crate_anon.nlp_manager.regex_func.fold_for_prefilter`) and split
+      into words once, however many parsers are checked against it, and the
+      check for a set of literals is done once per text (validators use the
+      same literals as their parsers, and several parsers share literals).
+    - We don't use an Aho-Corasick automaton: Python's substring search is
+      fast, and there aren't many literals. We don't run parsers on just a
+      "window" of text around a literal, either: for lookarounds and
+      overlapping matches, results might differ.
+    - Parsers that can't tell us any literals are always run.
+    """
+    def __init__(self, parsers: Iterable[BaseNlpParser]) -> None:
+        """
+        Args:
+            parsers: the parsers that will be checked
+        """
+        # For each parser: (substrings, whole words)
+        self._parser_literals = {}  # type: Dict[BaseNlpParser, Tuple[FrozenSet[str], FrozenSet[str]]]  # noqa
+        for parser in parsers:
+            literals = parser.get_prefilter_literals()
+            if literals is None:
+                continue
+            self._parser_literals[parser] = (
+                frozenset(x for x, whole_word in literals if not whole_word),
+                frozenset(x for x, whole_word in literals if whole_word),
+            )
+        self._text = None  # type: Optional[str]
+        self._folded_text = ""
+        self._words = None  # type: Optional[FrozenSet[str]]
+        self._results = {}  # type: Dict[Tuple[FrozenSet[str], FrozenSet[str]], bool]  # noqa
+        self.n_checked = 0
+        self.n_skipped = 0
+
+    def __str__(self) -> str:
+        pct = 100 * self.n_skipped / self.n_checked if self.n_checked else 0
+        return (
+            f"skipped {self.n_skipped} of {self.n_checked} parser runs "
+            f"({pct:.1f}%) for {len(self._parser_literals)} parsers"
+        )
+
+    def may_match(self, parser: BaseNlpParser, text: str) -> bool:
+        """
+        Might the parser produce results from this text? (If not, there's no
+        need to run it.)
+        """
+        literals = self._parser_literals.get(parser)
+        if literals is None:
+            return True
+        self.n_checked += 1
+        if text is not self._text:
+            # New text. Work out things lazily; we may not need them.
+            self._text = text
+            self._folded_text = fold_for_prefilter(text)
+            self._words = None
+            self._results.clear()
+        result = self._results.get(literals)
+        if result is None:
+            substrings, words = literals
+            if words and self._words is None:
+                # Split the original text, so word boundaries are exactly as
+                # the parser's regex sees them, then fold it.
+                self._words = frozenset(fold_for_prefilter(
+                    " ".join(WORD_REGEX.findall(text))).split())
+            result = (
+                any(x in self._folded_text for x in substrings) or
+                (bool(words) and not words.isdisjoint(self._words))
+            )
+            self._results[literals] = result
+        if not result:
+            self.n_skipped += 1
+        return result
+
+
 # =============================================================================
 # More general testing
 # =============================================================================
@@ -593,6 +593,49 @@ class CloudRequestSenderTests(TestCase):
         self.assertIn(f"DEBUG:{logger_name}:Record is new",
                       logging_cm.output)
 
+    def test_skips_previous_record_if_incremental_prefetched(self) -> None:
+        self.test_text = [
+            (PANAMOWA, {
+                FN_SRCPKVAL: 1,
+                FN_SRCPKSTR: None,
+            }),
+            (PAGODA, {
+                FN_SRCPKVAL: 2,
+                FN_SRCPKSTR: None,
+            }),
+        ]
+        prefetched = {
+            (1, None): self.hasher.hash(PANAMOWA),  # same as before
+            (2, None): self.hasher.hash(PATACA),  # changed
+        }
+        self.ifconfig.prefetch_progress = True
+        self.ifconfig.get_prefetched_srchash = (
+            lambda pkval, pkstr: prefetched.get((pkval, pkstr))
+        )
+        sender = TestCloudRequestSender(
+            self.get_text(),
+            self.crinfo,
+            self.ifconfig,
+            incremental=True,
+        )
+        self.ifconfig.prefetch_progress_records.assert_called_once_with()
+        sender.test_requests = [
+            CloudRequestProcess(
+                crinfo=self.crinfo,
+                nlpdef=self.nlpdef,
+            ),
+        ]
+
+        with mock.patch.object(sender.test_requests[0],
+                               "send_process_request"):
+            (requests_out,
+             records_processed,
+             global_recnum_out) = sender.send_requests(0)
+
+        content_0 = requests_out[0]._request_process[NKeys.ARGS][NKeys.CONTENT]
+        self.assertEqual([c[NKeys.TEXT] for c in content_0], [PAGODA])
+        self.ifconfig.get_progress_record.assert_not_called()
+
     def test_log_message_frequency(self) -> None:
         self.test_text = [
             (PANAMOWA, {
@@ -28,12 +28,16 @@ crate_anon/nlp_manager/tests/nlp_parser_tests.py
 import logging
 import sys
 
+from sqlalchemy import create_engine
 from sqlalchemy.exc import OperationalError
-from sqlalchemy.schema import Column
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import Column, MetaData, Table
 from typing import Any, Dict, Generator, List, Tuple
 from unittest import mock, TestCase
 
+from crate_anon.common.sql import BatchedInserter
 from crate_anon.nlp_manager.base_nlp_parser import BaseNlpParser
+from crate_anon.nlp_manager.input_field_config import InputFieldConfig
 
 
 class FruitParser(BaseNlpParser):
@@ -64,59 +68,62 @@ class NlpParserProcessTests(TestCase):
         mock_column = mock.Mock()
         mock_column.name = "fruit"  # so set it here
 
-        self.mock_values_method = mock.Mock()
-        mock_insert_object = mock.Mock(values=self.mock_values_method)
-        mock_insert_method = mock.Mock(return_value=mock_insert_object)
+        self.mock_insert_object = mock.Mock()
+        mock_insert_method = mock.Mock(return_value=self.mock_insert_object)
         mock_sqla_table = mock.Mock(columns=[mock_column],
                                     insert=mock_insert_method)
+        mock_sqla_table.name = "output"
         self.mock_get_table = mock.Mock(return_value=mock_sqla_table)
 
-        self.mock_notify_transaction_method = mock.Mock()
-        self.mock_nlpdef = mock.Mock(
-            notify_transaction=self.mock_notify_transaction_method
-        )
+        self.mock_notify_method = mock.Mock()
+        self.mock_limiter = mock.Mock(notify=self.mock_notify_method)
+        self.mock_commit_method = mock.Mock()
+        self.mock_nlpdef = mock.Mock(commit=self.mock_commit_method)
         self.mock_nlpdef.name = "fruitdef"
+        self.set_batch_size(1)
+
+    def set_batch_size(self, max_rows_per_batch: int) -> None:
+        self.inserter = BatchedInserter(
+            self.mock_session,
+            max_rows_per_batch=max_rows_per_batch,
+            transaction_limiter=self.mock_limiter,
+            skip_failed_rows=True
+        )
+        self.mock_nlpdef.get_batched_inserter = mock.Mock(
+            return_value=self.inserter)
+
+    def process(self, text: str) -> None:
+        with mock.patch.multiple(self.parser,
+                                 _nlpdef=self.mock_nlpdef,
+                                 _destdb=self.mock_db,
+                                 get_table=self.mock_get_table,
+                                 _friendly_name="Fruit"):
+            starting_fields_values = {}
+            self.parser.process(text, starting_fields_values)
 
     def test_inserts_values(self) -> None:
         with self.assertLogs(level=logging.DEBUG) as logging_cm:
-            with mock.patch.multiple(self.parser,
-                                     _nlpdef=self.mock_nlpdef,
-                                     _destdb=self.mock_db,
-                                     get_table=self.mock_get_table,
-                                     _friendly_name="Fruit"):
-
-                starting_fields_values = {}
-
-                self.parser.process(
-                    "Apple Banana Cabbage Dandelion Edelweiss Fig",
-                    starting_fields_values
-                )
-
-        self.mock_values_method.assert_any_call({"fruit": "apple"})
-        self.mock_values_method.assert_any_call({"fruit": "banana"})
-        self.mock_values_method.assert_any_call({"fruit": "fig"})
-        self.assertEqual(self.mock_values_method.call_count, 3)
-        self.assertEqual(self.mock_execute_method.call_count, 3)
-
-        self.mock_notify_transaction_method.assert_any_call(
-            self.mock_session, n_rows=1, n_bytes=sys.getsizeof(
-                {"fruit": "apple"}
-            ),
-            force_commit=mock.ANY
+            self.process("Apple Banana Cabbage Dandelion Edelweiss Fig")
+
+        self.mock_nlpdef.get_batched_inserter.assert_called_with(
+            self.mock_session)
+        self.assertEqual(self.mock_execute_method.call_args_list, [
+            mock.call(self.mock_insert_object, [{"fruit": "apple"}]),
+            mock.call(self.mock_insert_object, [{"fruit": "banana"}]),
+            mock.call(self.mock_insert_object, [{"fruit": "fig"}]),
+        ])
+
+        self.mock_notify_method.assert_any_call(
+            n_rows=1, n_bytes=sys.getsizeof({"fruit": "apple"})
         )
-        self.mock_notify_transaction_method.assert_any_call(
-            self.mock_session, n_rows=1, n_bytes=sys.getsizeof(
-                {"fruit": "banana"}
-            ),
-            force_commit=mock.ANY
+        self.mock_notify_method.assert_any_call(
+            n_rows=1, n_bytes=sys.getsizeof({"fruit": "banana"})
         )
-        self.mock_notify_transaction_method.assert_any_call(
-            self.mock_session, n_rows=1, n_bytes=sys.getsizeof(
-                {"fruit": "fig"}
-            ),
-            force_commit=mock.ANY
+        self.mock_notify_method.assert_any_call(
+            n_rows=1, n_bytes=sys.getsizeof({"fruit": "fig"})
         )
-        self.assertEqual(self.mock_notify_transaction_method.call_count, 3)
+        self.assertEqual(self.mock_notify_method.call_count, 3)
+        self.mock_commit_method.assert_not_called()
 
         logger_name = "crate_anon.nlp_manager.base_nlp_parser"
         self.assertIn(
@@ -124,31 +131,51 @@ class NlpParserProcessTests(TestCase):
             logging_cm.output
         )
 
+    def test_inserts_values_in_batches(self) -> None:
+        self.set_batch_size(2)
+        self.process("Apple Banana Cabbage Dandelion Edelweiss Fig")
+        self.process("Cherry")
+
+        # The third and fourth values make up the second batch, which spans
+        # two pieces of text.
+        self.assertEqual(self.mock_execute_method.call_args_list, [
+            mock.call(self.mock_insert_object,
+                      [{"fruit": "apple"}, {"fruit": "banana"}]),
+            mock.call(self.mock_insert_object,
+                      [{"fruit": "fig"}, {"fruit": "cherry"}]),
+        ])
+        self.mock_notify_method.assert_called_with(
+            n_rows=2, n_bytes=2 * sys.getsizeof({"fruit": "fig"})
+        )
+        self.assertEqual(self.mock_notify_method.call_count, 2)
+
+        self.process("Banana")
+        self.assertEqual(self.mock_execute_method.call_count, 2)
+        self.assertEqual(self.inserter.n_rows_pending, 1)
+        self.inserter.flush()
+        self.mock_execute_method.assert_called_with(
+            self.mock_insert_object, [{"fruit": "banana"}])
+        self.assertEqual(self.inserter.n_rows_pending, 0)
+
+    def test_commits_if_requested(self) -> None:
+        self.set_batch_size(100)
+        with mock.patch.object(self.parser, "_commit", True):
+            self.process("Cabbage")
+            self.mock_commit_method.assert_not_called()
+            self.process("Apple Banana")
+        self.mock_commit_method.assert_called_once_with(self.mock_session)
+
     def test_handles_failed_insert(self) -> None:
         self.mock_execute_method.side_effect = OperationalError(
             "Insert failed", None, None, None
         )
         with self.assertLogs(level=logging.ERROR) as logging_cm:
-            with mock.patch.multiple(self.parser,
-                                     _nlpdef=self.mock_nlpdef,
-                                     _destdb=self.mock_db,
-                                     get_table=self.mock_get_table,
-                                     _friendly_name="Fruit"):
-
-                starting_fields_values = {}
-
-                self.parser.process(
-                    "Apple",
-                    starting_fields_values
-                )
-
-        self.mock_notify_transaction_method.assert_any_call(
-            self.mock_session, n_rows=1, n_bytes=sys.getsizeof(
-                {"fruit": "apple"}
-            ),
-            force_commit=mock.ANY
+            self.process("Apple")
+
+        self.mock_notify_method.assert_any_call(
+            n_rows=1, n_bytes=sys.getsizeof({"fruit": "apple"})
         )
-        logger_name = "crate_anon.nlp_manager.base_nlp_parser"
+        logger_name = "crate_anon.common.sql"
 
         self.assertIn(
             f"ERROR:{logger_name}",
@@ -158,3 +185,88 @@ class NlpParserProcessTests(TestCase):
             "Insert failed",
             logging_cm.output[0]
         )
+
+    def test_handles_failed_insert_in_batch(self) -> None:
+        def execute(statement: Any, rows: Any) -> None:
+            if isinstance(rows, list) or rows["fruit"] == "banana":
+                raise OperationalError("Insert failed", None, None, None)
+
+        self.mock_execute_method.side_effect = execute
+        self.set_batch_size(3)
+        with self.assertLogs(level=logging.ERROR) as logging_cm:
+            self.process("Apple Banana Fig")
+
+        # The batch fails, so its rows are written singly, and only the bad
+        # one is lost.
+        self.assertEqual(self.mock_execute_method.call_args_list, [
+            mock.call(self.mock_insert_object, [{"fruit": "apple"},
+                                                {"fruit": "banana"},
+                                                {"fruit": "fig"}]),
+            mock.call(self.mock_insert_object, {"fruit": "apple"}),
+            mock.call(self.mock_insert_object, {"fruit": "banana"}),
+            mock.call(self.mock_insert_object, {"fruit": "fig"}),
+        ])
+        self.assertEqual(len(logging_cm.output), 2)
+        self.assertIn("Insert failed", logging_cm.output[0])
+        self.assertIn("failed for 1 of 3 rows", logging_cm.output[1])
+
+
+class NlpParserDeleteTests(TestCase):
+    def setUp(self) -> None:
+        self.parser = FruitParser(None, None)
+        engine = create_engine("sqlite://")
+        self.table = Table("output", MetaData(),
+                           *InputFieldConfig.get_core_columns_for_dest())
+        self.table.create(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.mock_db = mock.Mock(session=self.session)
+        self.mock_db.name = "dest"
+        self.mock_nlpdef = mock.Mock()
+        self.mock_nlpdef.name = "fruitdef"
+        self.mock_ifconfig = mock.Mock(srcdb="src", srctable="notes",
+                                       srcfield="text")
+
+    def insert(self, rows: List[Tuple[int, str, str]]) -> None:
+        self.session.execute(self.table.insert(), [
+            dict(_pk=i + 1, _srcdb="src", _srctable="notes", _srcfield="text",
+                 _srcpkfield="id", _srcpkval=pkval, _srcpkstr=pkstr,
+                 _nlpdef=nlpdef)
+            for i, (pkval, pkstr, nlpdef) in enumerate(rows)
+        ])
+
+    def remaining(self) -> List[Tuple[int, str, str]]:
+        return [
+            (row._srcpkval, row._srcpkstr, row._nlpdef)
+            for row in self.session.execute(
+                self.table.select().order_by(self.table.c._pk))
+        ]
+
+    def delete(self, srcpks: List[Tuple[int, str]]) -> None:
+        with mock.patch.multiple(self.parser,
+                                 _nlpdef=self.mock_nlpdef,
+                                 _destdb=self.mock_db,
+                                 tables=mock.Mock(
+                                     return_value={"output": self.table})):
+            self.parser.delete_dest_records(self.mock_ifconfig, srcpks,
+                                            commit=True)
+
+    def test_deletes_integer_pks(self) -> None:
+        self.insert([(1, None, "fruitdef"), (2, None, "fruitdef"),
+                     (3, None, "fruitdef"), (2, None, "otherdef"),
+                     (2, None, "fruitdef")])
+        self.delete([(2, None), (3, None), (4, None)])
+        self.assertEqual(self.remaining(), [(1, None, "fruitdef"),
+                                            (2, None, "otherdef")])
+        self.mock_nlpdef.commit.assert_called_once_with(self.session)
+
+    def test_deletes_string_pks(self) -> None:
+        self.insert([(11, "a", "fruitdef"), (12, "b", "fruitdef"),
+                     (13, "c", "fruitdef"), (12, "b", "fruitdef")])
+        self.delete([(12, "b"), (13, "c")])
+        self.assertEqual(self.remaining(), [(11, "a", "fruitdef")])
+
+    def test_deletes_nothing(self) -> None:
+        self.insert([(1, None, "fruitdef")])
+        self.delete([])
+        self.assertEqual(self.remaining(), [(1, None, "fruitdef")])
+        self.mock_nlpdef.commit.assert_not_called()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""
+crate_anon/nlp_manager/tests/parse_gate_tests.py
+
+===============================================================================
+
+    Copyright (C) 2015-2021 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+"""
+
+import logging
+import os
+import sys
+from tempfile import TemporaryDirectory
+from typing import Any, Dict, List, Optional, Tuple
+from unittest import mock, TestCase
+
+from crate_anon.nlp_manager.parse_gate import ExternalProgPool, Gate
+
+# A stand-in for our Java GATE interface: for each document, it reports each
+# word as an annotation. A document containing "crash" makes it die (just the
+# first time, for "crash_once").
+FAKE_PROG = """
+import os
+import sys
+
+marker = sys.argv[1]
+lines = []
+for line in sys.stdin:
+    line = line.rstrip("\\n")
+    if line != "INPUT_END":
+        lines.append(line)
+        continue
+    words = " ".join(lines).split()
+    lines = []
+    if "crash" in words or ("crash_once" in words and
+                            not os.path.exists(marker)):
+        open(marker, "w").close()
+        os._exit(1)
+    for word in words:
+        print(f"_type\\tword\\t_content\\t{word}")
+    print("OUTPUT_END")
+    sys.stdout.flush()
+"""
+
+
+class ExternalProgPoolTests(TestCase):
+    def setUp(self) -> None:
+        self.tempdir = TemporaryDirectory()
+        prog = os.path.join(self.tempdir.name, "fake_gate.py")
+        with open(prog, "w") as f:
+            f.write(FAKE_PROG)
+        self.args = [sys.executable, prog,
+                     os.path.join(self.tempdir.name, "crashed")]
+        self.pools = []  # type: List[ExternalProgPool]
+
+    def tearDown(self) -> None:
+        for pool in self.pools:
+            pool.finish()
+        self.tempdir.cleanup()
+
+    def make_pool(self, n_progs: int, max_uses: int = 0) -> ExternalProgPool:
+        pool = ExternalProgPool(
+            args=self.args,
+            n_progs=n_progs,
+            max_docs_in_flight_per_prog=3,
+            input_terminator="INPUT_END",
+            output_terminator="OUTPUT_END",
+            max_uses=max_uses
+        )
+        self.pools.append(pool)
+        return pool
+
+    @staticmethod
+    def expected(text: str) -> Optional[List[str]]:
+        return [f"_type\tword\t_content\t{word}{os.linesep}"
+                for word in text.split()]
+
+    def test_outputs_in_order(self) -> None:
+        pool = self.make_pool(n_progs=3)
+        self.assertEqual(pool.capacity, 9)
+        texts = [" ".join(f"w{i}_{j}" for j in range(i % 5))
+                 for i in range(50)]
+        self.assertEqual(list(pool.gen_output(texts)),
+                         [self.expected(text) for text in texts])
+        # The same programs carry on for the next call.
+        self.assertEqual(list(pool.gen_output(texts[:3])),
+                         [self.expected(text) for text in texts[:3]])
+
+    def test_relaunches_crashed_program(self) -> None:
+        pool = self.make_pool(n_progs=2)
+        texts = [f"doc {i}" for i in range(10)]
+        texts[4] = "doc crash_once"
+        with self.assertLogs(level=logging.ERROR) as logging_cm:
+            outputs = list(pool.gen_output(texts))
+        self.assertEqual(outputs, [self.expected(text) for text in texts])
+        self.assertIn("died; relaunching", logging_cm.output[0])
+
+    def test_gives_up_on_bad_document(self) -> None:
+        pool = self.make_pool(n_progs=2)
+        texts = [f"doc {i}" for i in range(10)]
+        texts[4] = "doc crash"
+        with self.assertLogs(level=logging.ERROR):
+            outputs = list(pool.gen_output(texts))
+        self.assertEqual(outputs, [None if i == 4 else self.expected(text)
+                                   for i, text in enumerate(texts)])
+
+    def test_relaunches_after_max_uses(self) -> None:
+        pool = self.make_pool(n_progs=1, max_uses=4)
+        texts = [f"doc {i}" for i in range(10)]
+        with self.assertLogs(level=logging.INFO) as logging_cm:
+            outputs = list(pool.gen_output(texts))
+        self.assertEqual(outputs, [self.expected(text) for text in texts])
+        self.assertEqual(
+            len([x for x in logging_cm.output if "after 4 uses" in x]), 2)
+
+    def test_abandoned_output(self) -> None:
+        pool = self.make_pool(n_progs=2)
+        texts = [f"doc {i}" for i in range(10)]
+        with self.assertLogs(level=logging.WARNING):
+            for _ in pool.gen_output(texts):
+                break
+        self.assertEqual(list(pool.gen_output(texts[5:])),
+                         [self.expected(text) for text in texts[5:]])
+
+
+class GateProcessRecordsTests(TestCase):
+    def test_process_records(self) -> None:
+        gate = Gate(None, None)
+        gate._type_to_tablename = {"word": "words"}
+        gate._outputtypemap = {"word": mock.Mock(renames={},
+                                                 null_literals=[])}
+        gate._pool = mock.Mock(capacity=6)
+        gate._pool.gen_output.return_value = iter([
+            ["_type\tword\t_content\tx\n", "_type\tword\t_content\ty\n"],
+            None,
+        ])
+        inserted = []  # type: List[Tuple[List[Tuple[str, Dict[str, Any]]], Dict[str, Any]]]  # noqa
+
+        def insert_results(results: Any, values: Dict[str, Any]) -> None:
+            inserted.append((list(results), values))
+
+        records = [("x y", {"n": 1}), (" ", {"n": 2}), ("crash", {"n": 3})]
+        with mock.patch.object(gate, "_insert_results", insert_results):
+            successes = gate.process_records(records)
+
+        self.assertEqual(gate.max_records_in_flight, 6)
+        gate._pool.gen_output.assert_called_once_with(["x y", "crash"])
+        self.assertEqual(successes, [True, True, False])
+        self.assertEqual(inserted, [
+            ([("words", {"_type": "word", "_content": "x"}),
+              ("words", {"_type": "word", "_content": "y"})], {"n": 1}),
+        ])
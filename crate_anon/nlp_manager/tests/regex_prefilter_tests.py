@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""
+crate_anon/nlp_manager/tests/regex_prefilter_tests.py
+
+===============================================================================
+
+    Copyright (C) 2015-2021 Rudolf Cardinal (rudolf@pobox.com).
+
+    This file is part of CRATE.
+
+    CRATE is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    CRATE is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with CRATE. If not, see <http://www.gnu.org/licenses/>.
+
+===============================================================================
+
+"""
+
+import logging
+import os
+import random
+import string
+import sys
+import timeit
+from typing import Any, List, Set
+from unittest import skipUnless, TestCase
+
+import regex
+
+from crate_anon.common.constants import EnvVar
+from crate_anon.nlp_manager.all_processors import all_parser_classes
+from crate_anon.nlp_manager.base_nlp_parser import BaseNlpParser
+from crate_anon.nlp_manager.regex_func import (
+    fold_for_prefilter,
+    get_required_literals,
+)
+from crate_anon.nlp_manager.regex_parser import (
+    NumeratorOutOfDenominatorParser,
+    NumericalResultParser,
+    RegexPrefilter,
+    ValidatorBase,
+)
+
+log = logging.getLogger(__name__)
+
+EXTRA_TEXTS = [
+    # Non-ASCII characters that match ASCII letters case-insensitively:
+    "K 4.5",  # Kelvin sign
+    "LİTHIUM 0.6",  # I with dot above
+    "Potasſium 4.1",  # long s
+    # Word boundaries next to non-ASCII letters:
+    "éK 4", "Ké 4", "Ḱ 4",
+    "",
+    " ",
+]
+
+
+def get_regex_parsers() -> List[BaseNlpParser]:
+    """
+    Unconfigured instances of all our regex-based parsers.
+    """
+    return [
+        cls(None, None)
+        for cls in all_parser_classes()
+        if issubclass(cls, (NumericalResultParser,
+                            NumeratorOutOfDenominatorParser,
+                            ValidatorBase))
+    ]
+
+
+def get_test_texts(parsers: List[BaseNlpParser]) -> List[str]:
+    """
+    Gathers the texts that the parsers use in their self-tests.
+    """
+    texts = set()  # type: Set[str]
+
+    def record(test_texts: Any, *args, **kwargs) -> None:
+        if isinstance(test_texts, str):
+            texts.add(test_texts)
+        else:  # a list of strings, or of (string, expected) tuples
+            for x in test_texts:
+                texts.add(x if isinstance(x, str) else x[0])
+
+    for parser in parsers:
+        for method in ("detailed_test", "test_bp_parser",
+                       "test_numerator_denominator_parser",
+                       "test_numerical_parser", "test_parser",
+                       "test_validator"):
+            setattr(parser, method, record)
+        parser.test()
+    return sorted(texts) + EXTRA_TEXTS
+
+
+def make_corpus(texts: List[str], n_docs: int) -> List[str]:
+    """
+    Makes documents of prose, with some of our test texts in them.
+    """
+    rng = random.Random(1234)
+    words = ["".join(rng.choice(string.ascii_lowercase)
+                     for _ in range(rng.randint(1, 10)))
+             for _ in range(500)]
+    docs = []  # type: List[str]
+    for _ in range(n_docs):
+        parts = []  # type: List[str]
+        for _ in range(20):
+            parts.append(" ".join(rng.choice(words) for _ in range(20)) + ".")
+            if rng.random() < 0.1:
+                parts.append(rng.choice(texts))
+        docs.append("\n".join(parts))
+    return docs
+
+
+class RequiredLiteralsTests(TestCase):
+    def test_literals(self) -> None:
+        f = get_required_literals
+        self.assertEqual(f("abc"), {("abc", False)})
+        self.assertEqual(f(r"\b CRP \b"), {("crp", True)})
+        self.assertEqual(f(r"\b (?: K | Potassium ) \b \s* \d+"),
+                         {("k", True), ("potassium", True)})
+        self.assertEqual(f(r"\b K \s"), {("k", False)})  # not a whole word
+        self.assertEqual(f(r"(?P<x> Na | Sodium ) \s* \d+"),
+                         {("na", False), ("sodium", False)})
+        self.assertEqual(f(r"\d+ \s* mmol"), {("mmol", False)})
+        self.assertEqual(f(r"x?"), None)  # might match an empty string
+        self.assertEqual(f(r"\w+"), None)
+        self.assertEqual(f(r"café"), {("caf", False)})
+        self.assertEqual(f("("), None)  # bad regex
+
+    def test_fold_table(self) -> None:
+        # Every character that matches an ASCII character case-insensitively
+        # must fold to it.
+        all_chars = "".join(chr(x) for x in range(sys.maxunicode + 1)
+                            if not 0xd800 <= x <= 0xdfff)
+        for c in string.printable:
+            for m in regex.finditer(regex.escape(c), all_chars,
+                                    flags=regex.IGNORECASE):
+                self.assertEqual(fold_for_prefilter(m.group()),
+                                 fold_for_prefilter(c),
+                                 f"{m.group()!r} should fold like {c!r}")
+
+
+class RegexPrefilterTests(TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.parsers = get_regex_parsers()
+        cls.texts = get_test_texts(cls.parsers)
+
+    def test_identical_results(self) -> None:
+        # Any text that the prefilter skips would produce no results.
+        prefilter = RegexPrefilter(self.parsers)
+        for text in self.texts:
+            for parser in self.parsers:
+                if not prefilter.may_match(parser, text):
+                    self.assertEqual(
+                        list(parser.parse(text)), [],
+                        f"{parser.classname()} wrongly skipped {text!r}")
+        self.assertGreater(prefilter.n_skipped, 0)
+        log.info(f"Test texts: {prefilter}")
+
+    @skipUnless(EnvVar.RUN_BENCHMARKS in os.environ,
+                f"set {EnvVar.RUN_BENCHMARKS} to run benchmarks")
+    def test_benchmark(self) -> None:
+        # Documents per second, running all our regex parsers over a synthetic
+        # corpus. Set CRATE_RUN_BENCHMARKS and run pytest with
+        # "-o log_cli=true --log-cli-level=INFO" to see the results.
+        corpus = make_corpus(self.texts, n_docs=50)
+        prefilter = RegexPrefilter(self.parsers)
+
+        def run_all() -> List[Any]:
+            return [list(p.parse(doc))
+                    for doc in corpus for p in self.parsers]
+
+        def run_prefiltered() -> List[Any]:
+            return [list(p.parse(doc)) if prefilter.may_match(p, doc) else []
+                    for doc in corpus for p in self.parsers]
+
+        self.assertEqual(run_prefiltered(), run_all())
+        before = len(corpus) / min(timeit.repeat(run_all, number=1, repeat=3))
+        after = len(corpus) / min(timeit.repeat(run_prefiltered, number=1,
+                                                repeat=3))
+        log.info(f"Running {len(self.parsers)} parsers: before {before:.0f} "
+                 f"docs/s; after {after:.0f} docs/s; {prefilter}")
+        self.assertGreater(after, before)